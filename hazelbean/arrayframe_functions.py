@@ -76,6 +76,18 @@ def raster_calculator_flex(input_, op, output_path, **kwargs): #KWARGS: datatype
             input_tuples_list[c] = (i[0], 'raw')
 
 
+    # A string op is an expression (see hb.raster_calculator_expression) over the inputs named a, b, c... in order,
+    # or over kwargs['names'] if given.
+    if isinstance(op, str):
+        names = kwargs.get('names') or [chr(ord('a') + c) for c in range(input_size)]
+        if len(names) != input_size or any(i[1] == 'raw' for i in input_tuples_list):
+            raise NameError('Expression op given to raster_calculator_flex() needs one name per raster and no raw inputs.')
+        L.info('Launching raster_calculator_expression on ', str(input_tuples_list), '    \nto output path', output_path)
+        hb.raster_calculator_expression(op, dict(zip(names, input_tuples_list)), output_path, datatype, ndv, gtiff_creation_options=gtiff_creation_options)
+        if kwargs.get('add_overviews'):
+            hb.add_overviews_to_path(output_path)
+        return
+
     # Check that the op matches the number of rasters.
     if len(inspect.signature(op).parameters) != input_size:
         raise NameError('op given to raster_calculator_flex() did not have the same number of parameters as the number of rasters given.')
@@ -164,15 +176,20 @@ def af_where_lt_value_set_to(a, value, set_to, output_path):
 
 
 def tiled_sum(input_path):
+    # Blocks are read into one reused buffer, so no per-block array is allocated.
+    if isinstance(input_path, str):
+        input_path = (input_path, 1)
     return_sum = 0
-    for offsets, data in hb.iterblocks_hb(input_path):
+    for offsets, data in hb.iterblocks_hb(input_path, reuse_buffer=True):
         return_sum += np.sum(data)
 
     return return_sum
 
 def tiled_num_nonzero(input_path):
+    if isinstance(input_path, str):
+        input_path = (input_path, 1)
     return_sum = 0
-    for offsets, data in hb.iterblocks_hb(input_path):
+    for offsets, data in hb.iterblocks_hb(input_path, reuse_buffer=True):
         return_sum += np.count_nonzero(data)
 
     return return_sum
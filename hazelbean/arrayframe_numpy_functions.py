@@ -70,15 +70,20 @@ def proportion_change(after, before, output_path):
 
 
 def tiled_sum(input_path):
+    # Blocks are read into one reused buffer, so no per-block array is allocated.
+    if isinstance(input_path, str):
+        input_path = (input_path, 1)
     return_sum = 0
-    for offsets, data in hb.iterblocks(input_path):
+    for offsets, data in hb.iterblocks_hb(input_path, reuse_buffer=True):
         return_sum += np.sum(data)
 
     return return_sum
 
 def tiled_num_nonzero(input_path):
+    if isinstance(input_path, str):
+        input_path = (input_path, 1)
     return_sum = 0
-    for offsets, data in hb.iterblocks(input_path):
+    for offsets, data in hb.iterblocks_hb(input_path, reuse_buffer=True):
         return_sum += np.count_nonzero(data)
 
     return return_sum
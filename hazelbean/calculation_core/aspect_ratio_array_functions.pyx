@@ -170,3 +170,147 @@ def upscale_using_mean(np.ndarray[np.float64_t, ndim=2] high_res_array, long lon
 
 
 
+
+ctypedef fused block_numeric_t:
+    np.uint8_t
+    np.int8_t
+    np.uint16_t
+    np.int16_t
+    np.uint32_t
+    np.int32_t
+    np.uint64_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def upscale_block_by_factor(const block_numeric_t[:, ::1] fine_array not None, long long upscale_factor, str method, nodata=None):
+    """Reduce each upscale_factor by upscale_factor window of fine_array to one coarse cell, skipping nodata (and NaN).
+
+    Unlike upscale_retaining_sum and upscale_using_mean, this keeps the input type where it can: 'min' and 'max' return
+    the input type, 'sum' returns int64 for integer input and float64 for float input, 'mean' returns float64, and
+    'count' returns the int64 number of valid fine cells. The valid counts are returned as well so the caller can mark
+    coarse cells with no valid fine cells. The loop releases the GIL, so blocks can be reduced from several threads.
+
+    Returns:
+        (coarse_array, valid_count_array)
+    """
+    cdef Py_ssize_t n_coarse_rows = fine_array.shape[0] // upscale_factor
+    cdef Py_ssize_t n_coarse_cols = fine_array.shape[1] // upscale_factor
+    cdef Py_ssize_t cr, cc, fr, fc
+    cdef bint has_nodata = nodata is not None
+    cdef block_numeric_t nodata_value = 0
+    cdef block_numeric_t value, extreme
+    cdef double float_sum
+    cdef long long int_sum, count
+    cdef int method_id
+    cdef bint is_float = block_numeric_t is np.float32_t or block_numeric_t is np.float64_t
+
+    if method == 'sum':
+        method_id = 0
+    elif method == 'mean':
+        method_id = 1
+    elif method == 'min':
+        method_id = 2
+    elif method == 'max':
+        method_id = 3
+    elif method == 'count':
+        method_id = 4
+    else:
+        raise ValueError('method must be one of sum, mean, min, max or count, got ' + str(method))
+    if has_nodata:
+        # A nodata the block type cannot hold exactly (eg -9999 for uint8, -3.4e38 for int32 or 2.5 for any integer
+        # type) cannot occur in the block, so the block is treated as having no nodata rather than casting it, which
+        # would raise OverflowError or truncate it onto a valid value.
+        block_dtype = np.asarray(fine_array[:1, :1]).dtype
+        if is_float:
+            with np.errstate(over='ignore'):
+                has_nodata = float(block_dtype.type(nodata)) == float(nodata)
+        else:
+            has_nodata = float(nodata).is_integer() and np.iinfo(block_dtype).min <= nodata <= np.iinfo(block_dtype).max
+    if has_nodata:
+        nodata_value = <block_numeric_t>block_dtype.type(nodata)
+
+    counts = np.zeros((n_coarse_rows, n_coarse_cols), dtype=np.int64)
+    cdef np.int64_t[:, ::1] counts_view = counts
+    if method_id == 0 and not is_float:
+        output = np.zeros((n_coarse_rows, n_coarse_cols), dtype=np.int64)
+    elif method_id == 0 or method_id == 1:
+        output = np.zeros((n_coarse_rows, n_coarse_cols), dtype=np.float64)
+    elif method_id == 4:
+        output = counts
+    else:
+        output = np.zeros((n_coarse_rows, n_coarse_cols), dtype=np.asarray(fine_array[:1, :1]).dtype)
+    cdef np.int64_t[:, ::1] int64_output
+    cdef np.float64_t[:, ::1] float64_output
+    cdef block_numeric_t[:, ::1] same_type_output
+    if method_id == 0 and not is_float:
+        int64_output = output
+    elif method_id == 0 or method_id == 1:
+        float64_output = output
+    elif method_id == 2 or method_id == 3:
+        same_type_output = output
+
+    with nogil:
+        for cr in range(n_coarse_rows):
+            for cc in range(n_coarse_cols):
+                float_sum = 0.0
+                int_sum = 0
+                count = 0
+                extreme = 0
+                for fr in range(cr * upscale_factor, (cr + 1) * upscale_factor):
+                    for fc in range(cc * upscale_factor, (cc + 1) * upscale_factor):
+                        value = fine_array[fr, fc]
+                        if has_nodata and value == nodata_value:
+                            continue
+                        if is_float and value != value:
+                            continue
+                        if count == 0:
+                            extreme = value
+                        elif method_id == 2 and value < extreme:
+                            extreme = value
+                        elif method_id == 3 and value > extreme:
+                            extreme = value
+                        if is_float:
+                            float_sum = float_sum + value
+                        else:
+                            int_sum = int_sum + <long long>value
+                        count = count + 1
+                counts_view[cr, cc] = count
+                if method_id == 0:
+                    if is_float:
+                        float64_output[cr, cc] = float_sum
+                    else:
+                        int64_output[cr, cc] = int_sum
+                elif method_id == 1:
+                    if count > 0:
+                        if is_float:
+                            float64_output[cr, cc] = float_sum / count
+                        else:
+                            float64_output[cr, cc] = (<double>int_sum) / count
+                elif method_id == 2 or method_id == 3:
+                    same_type_output[cr, cc] = extreme
+
+    return output, counts
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def naive_downscale_block(const block_numeric_t[:, ::1] coarse_array not None, long long downscale_factor):
+    """Typed, GIL-releasing version of naive_downscale: repeat each coarse cell into a downscale_factor by
+    downscale_factor window, keeping the input type."""
+    cdef Py_ssize_t n_coarse_rows = coarse_array.shape[0]
+    cdef Py_ssize_t n_coarse_cols = coarse_array.shape[1]
+    cdef Py_ssize_t fr, fc
+    output = np.empty((n_coarse_rows * downscale_factor, n_coarse_cols * downscale_factor), dtype=np.asarray(coarse_array[:1, :1]).dtype)
+    cdef block_numeric_t[:, ::1] output_view = output
+
+    with nogil:
+        for fr in range(n_coarse_rows * downscale_factor):
+            for fc in range(n_coarse_cols * downscale_factor):
+                output_view[fr, fc] = coarse_array[fr // downscale_factor, fc // downscale_factor]
+    return output
+
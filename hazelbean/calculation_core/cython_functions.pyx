@@ -1121,33 +1121,6 @@ def allocate_among_rank_arrays(ndarray[DTYPEINT32_t, ndim=2] initial_classes not
 #     return output_array
 
 
-def calc_change_matrix_of_two_int_arrays(ndarray[DTYPEINT32_t, ndim=2] a1 not None, ndarray[DTYPEINT32_t, ndim=2] a2 not None):
-    unique1, count1 = np.unique(a1, return_counts=True)
-    unique2, count2 = np.unique(a2, return_counts=True)
-
-    cdef int i, j
-    cdef int n_rows = a1.shape[0]
-    cdef int n_cols = a1.shape[1]
-    cdef int m_n_rows = len(count1)
-
-    # Create lookup from lulc class to lulc counter
-    #cdef np.ndarray[np.int32_t, ndim=1] lulc_counters = np.zeros((m_n_rows), dtype=np.int64)
-
-    lulc_counters = {}
-
-    for i in range(m_n_rows):
-        lulc_counters[unique1[i]] = i
-
-    cdef np.ndarray[np.int32_t, ndim=2] a3 = np.zeros((m_n_rows, m_n_rows), dtype=np.int64)
-
-    for i in range(n_rows):
-        for j in range(n_cols):
-            a3[lulc_counters[a1[i, j]], lulc_counters[a2[i, j]]] += 1
-
-    return a3
-
-
-
 def get_rank_array_and_keys_from_sorted_keys_no_nan_mask(ndarray[DTYPEINT64_t, ndim=2] keys not None,
                                                          DTYPEINT64_t n_rows,
                                                          DTYPEINT64_t n_cols):
@@ -1247,12 +1220,13 @@ def get_rank_array_from_sorted_keys_cython(ndarray[DTYPEINT64_t, ndim=1] ranked_
 
 
 
-def allocate_from_sorted_keys(ndarray[DTYPEINT64_t, ndim=2] keys not None,
+def allocate_from_sorted_keys(const DTYPEINT64_t[:, :] keys not None,
                               ndarray[DTYPEFLOAT64_t, ndim=2] value not None,
                               DTYPEFLOAT64_t goal
                               ):
+    # keys is a typed memoryview so that read-only memory-mapped keys (eg from rank_raster_out_of_core) are accepted.
 
-    cdef long long n_keys = len(keys[0])
+    cdef long long n_keys = keys.shape[1]
     cdef long long n_rows = value.shape[0]
     cdef long long n_cols = value.shape[1]
     cdef long long i, j
@@ -1272,16 +1246,16 @@ def allocate_from_sorted_keys(ndarray[DTYPEINT64_t, ndim=2] keys not None,
 
 
 
-def allocate_from_sorted_keys_with_eligibility_mask(ndarray[DTYPEINT64_t, ndim=2] keys not None,
+def allocate_from_sorted_keys_with_eligibility_mask(const DTYPEINT64_t[:, :] keys not None,
                               ndarray[DTYPEFLOAT64_t, ndim=2] value_per_proportion not None,
                               DTYPEFLOAT64_t goal,
                               ndarray[DTYPEFLOAT64_t, ndim=2] eligibile_proportion not None
                               ):
 
-    cdef int n_keys = len(keys[0])
+    cdef long long n_keys = keys.shape[1]
     cdef int n_rows = value_per_proportion.shape[0]
     cdef int n_cols = value_per_proportion.shape[1]
-    cdef int i, j
+    cdef long long i, j
 
     cdef float obtained_value = 0.0
 
@@ -1827,6 +1801,323 @@ def allocate_all_sectors(ndarray[np.float64_t, ndim=2] projections_array not Non
 
 
 
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _allocate_country_all_sectors(const np.int64_t[::1] key_rows,
+                                       const np.int64_t[::1] key_cols,
+                                       const double[::1] key_yields,
+                                       const np.int64_t[::1] key_starts,
+                                       const np.int64_t[::1] key_stops,
+                                       double[::1] demand,
+                                       double[::1] production,
+                                       double[:, ::1] available_land,
+                                       const np.int32_t[:, ::1] country_ids,
+                                       np.int32_t country_id,
+                                       const double[::1] min_viable_proportions,
+                                       const double[::1] max_viable_proportions,
+                                       const double[::1] footprint_requirements,
+                                       const double[::1] yield_notes,
+                                       const np.int64_t[::1] step_sizes,
+                                       np.int64_t[::1] out_rows,
+                                       np.int64_t[::1] out_cols,
+                                       double[::1] out_proportions,
+                                       double[::1] out_yields,
+                                       const np.int64_t[::1] out_starts,
+                                       np.int64_t[::1] out_counts) noexcept nogil:
+    # Same per-cell logic as allocate_all_sectors, restricted to one country's keys. Only writes to available_land
+    # cells inside country_id, so countries can run concurrently. Returns 1 if a cell had positive demand but zero
+    # yield (the case allocate_all_sectors raises on), else 0.
+    cdef Py_ssize_t num_sectors = key_starts.shape[0]
+    cdef Py_ssize_t n_rows = available_land.shape[0]
+    cdef Py_ssize_t n_cols = available_land.shape[1]
+    cdef Py_ssize_t s, i, step, n_active, d
+    cdef np.int64_t r, c, nr, nc, o
+    cdef double current_yield, proportion, yield_obtained, available
+    cdef long long n_pads
+    cdef np.int64_t[8] neighbor_row_offsets = [-1, -1, -1, 0, 1, 1, 1, 0]
+    cdef np.int64_t[8] neighbor_col_offsets = [-1, 0, 1, 1, 1, 0, -1, -1]
+    cdef np.int64_t[64] positions_stack
+    cdef np.int64_t[64] continue_stack
+    cdef np.int64_t *positions = positions_stack
+    cdef np.int64_t *sector_continue = continue_stack
+
+    if num_sectors > 64:
+        positions = <np.int64_t *> malloc(num_sectors * sizeof(np.int64_t))
+        sector_continue = <np.int64_t *> malloc(num_sectors * sizeof(np.int64_t))
+
+    for s in range(num_sectors):
+        positions[s] = key_starts[s]
+        sector_continue[s] = 1 if key_starts[s] < key_stops[s] else 0
+        out_counts[s] = 0
+
+    n_active = 1
+    while n_active > 0:
+        n_active = 0
+        for s in range(num_sectors):
+            if sector_continue[s] == 0:
+                continue
+            for step in range(step_sizes[s]):
+                i = positions[s]
+                if i >= key_stops[s] or sector_continue[s] == 0:
+                    sector_continue[s] = 0
+                    break
+                positions[s] += 1
+                r = key_rows[i]
+                c = key_cols[i]
+                available = available_land[r, c]
+                if available < min_viable_proportions[s]:
+                    continue
+
+                if yield_notes[s] == 0:
+                    current_yield = key_yields[i]
+                elif yield_notes[s] == 1:
+                    current_yield = 1.0
+                elif yield_notes[s] == 2:
+                    current_yield = key_yields[i] * 2
+                elif yield_notes[s] == 9:
+                    current_yield = key_yields[i] * 9
+                else:
+                    current_yield = yield_notes[s]
+
+                if available > max_viable_proportions[s]:
+                    proportion = max_viable_proportions[s]
+                else:
+                    proportion = available
+
+                if footprint_requirements[s] == 2:
+                    n_pads = <long long>(proportion / min_viable_proportions[s])
+                    proportion = n_pads * min_viable_proportions[s]
+                    yield_obtained = n_pads * current_yield
+                elif footprint_requirements[s] == 5:
+                    yield_obtained = current_yield
+                else:
+                    yield_obtained = proportion * current_yield
+
+                if demand[s] >= current_yield:
+                    if current_yield > 0:
+                        o = out_starts[s] + out_counts[s]
+                        out_rows[o] = r
+                        out_cols[o] = c
+                        out_proportions[o] = proportion
+                        out_yields[o] = yield_obtained
+                        out_counts[s] += 1
+                        available_land[r, c] -= proportion
+
+                        if yield_notes[s] == 9:
+                            # Adjacent cells are only taken within the same country, which keeps countries independent.
+                            for d in range(8):
+                                nr = r + neighbor_row_offsets[d]
+                                nc = c + neighbor_col_offsets[d]
+                                if nr < 0 or nr >= n_rows or nc < 0 or nc >= n_cols:
+                                    continue
+                                if country_ids[nr, nc] != country_id or available_land[nr, nc] <= 0.0:
+                                    continue
+                                o = out_starts[s] + out_counts[s]
+                                out_rows[o] = nr
+                                out_cols[o] = nc
+                                out_proportions[o] = available_land[nr, nc]
+                                out_yields[o] = 0.0
+                                out_counts[s] += 1
+                                available_land[nr, nc] = 0.0
+
+                        production[s] += yield_obtained
+                        demand[s] -= yield_obtained
+                elif demand[s] > 0:
+                    if current_yield <= 0:
+                        if num_sectors > 64:
+                            free(positions)
+                            free(sector_continue)
+                        return 1
+                    o = out_starts[s] + out_counts[s]
+                    out_rows[o] = r
+                    out_cols[o] = c
+                    out_proportions[o] = proportion
+                    out_yields[o] = proportion * yield_obtained
+                    out_counts[s] += 1
+                    production[s] += demand[s]
+                    available_land[r, c] -= proportion * (demand[s] / current_yield)
+                    demand[s] = 0.0
+                    sector_continue[s] = 0
+                else:
+                    sector_continue[s] = 0
+            n_active += sector_continue[s]
+
+    if num_sectors > 64:
+        free(positions)
+        free(sector_continue)
+    return 0
+
+
+def _allocate_country_all_sectors_py(country_index, dict arrays):
+    """Python-callable wrapper that releases the GIL while one country is allocated."""
+    cdef const np.int64_t[::1] key_rows = arrays['key_rows']
+    cdef const np.int64_t[::1] key_cols = arrays['key_cols']
+    cdef const double[::1] key_yields = arrays['key_yields']
+    cdef const np.int64_t[::1] key_starts = arrays['key_starts'][country_index]
+    cdef const np.int64_t[::1] key_stops = arrays['key_stops'][country_index]
+    cdef double[::1] demand = arrays['projections_array'][country_index]
+    cdef double[::1] production = arrays['country_sector_production'][country_index]
+    cdef double[:, ::1] available_land = arrays['available_land']
+    cdef const np.int32_t[:, ::1] country_ids = arrays['country_ids']
+    cdef np.int32_t country_id = country_index + 1
+    cdef const double[::1] min_viable_proportions = arrays['min_viable_proportions']
+    cdef const double[::1] max_viable_proportions = arrays['max_viable_proportions']
+    cdef const double[::1] footprint_requirements = arrays['footprint_requirements']
+    cdef const double[::1] yield_notes = arrays['yield_notes']
+    cdef const np.int64_t[::1] step_sizes = arrays['step_sizes']
+    cdef np.int64_t[::1] out_rows = arrays['out_rows']
+    cdef np.int64_t[::1] out_cols = arrays['out_cols']
+    cdef double[::1] out_proportions = arrays['out_proportions']
+    cdef double[::1] out_yields = arrays['out_yields']
+    cdef const np.int64_t[::1] out_starts = arrays['out_starts'][country_index]
+    cdef np.int64_t[::1] out_counts = arrays['out_counts'][country_index]
+    cdef int error
+
+    with nogil:
+        error = _allocate_country_all_sectors(
+            key_rows, key_cols, key_yields, key_starts, key_stops, demand, production, available_land, country_ids,
+            country_id, min_viable_proportions, max_viable_proportions, footprint_requirements, yield_notes, step_sizes,
+            out_rows, out_cols, out_proportions, out_yields, out_starts, out_counts)
+    return error
+
+
+def allocate_all_sectors_partitioned(ndarray[np.float64_t, ndim=2] projections_array not None, # n_countries by n_sectors float array of demand to allocate, counted down in place as in allocate_all_sectors.
+                                     list country_iso3 not None,
+                                     list sector_names not None,
+                                     ndarray[np.float64_t, ndim=1] sector_min_viable_proportions not None,
+                                     ndarray[np.float64_t, ndim=1] sector_max_viable_proportions not None,
+                                     ndarray[np.float64_t, ndim=1] sector_footprint_requirements not None,
+                                     ndarray[np.float64_t, ndim=1] sector_yield_notes not None,
+                                     ndarray[np.int64_t, ndim=3] ranked_keys not None,
+                                     ndarray[np.float64_t, ndim=2] sector_yields not None,
+                                     ndarray[np.int64_t, ndim=1] sector_num_changes not None,
+                                     ndarray[np.float64_t, ndim=2] available_land not None, # Modified in place, as in allocate_all_sectors.
+                                     ndarray[np.int32_t, ndim=2] country_ids not None,
+                                     n_threads=None,
+                                     ):
+    """Country-partitioned, multithreaded version of allocate_all_sectors with the same inputs and outputs.
+
+    Each sector's ranked keys are grouped by country (a stable sort on the country id, so each group keeps its rank
+    order, as calculate_zone_to_chunk_list_lookup_dict groups cells by zone). Countries are then independent: a
+    country only reads and writes available_land in its own cells, so countries are allocated concurrently in threads
+    that release the GIL, and the result does not depend on thread scheduling. Within a country the sectors take
+    turns along their ranked keys in steps as in allocate_all_sectors.
+
+    Differences from allocate_all_sectors: sectors interleave by position within the country rather than within the
+    global key list; adjacent cells for hydro (yield note 9) are only taken within the same country; cells whose
+    country id is outside 1..n_countries are skipped; and the change lists are compact (one entry per allocated cell,
+    grouped by country in country order) rather than having an entry for every considered cell.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    start = time.time()
+    cdef long long num_sectors = len(sector_names)
+    cdef long long num_countries = len(country_iso3)
+    cdef long long num_iteration_steps = int(2.6e+07)
+    cdef long long s, c
+
+    for s in range(num_sectors):
+        if not (sector_yield_notes[s] in (0, 1, 2, 9) or sector_yield_notes[s] > 9):
+            raise NameError('Unknown sector_yield_notes value ' + str(sector_yield_notes[s]) + ' for sector ' + str(sector_names[s]))
+        if sector_footprint_requirements[s] not in (0, 1, 2, 3, 4, 5):
+            raise NameError('Unknown sector_footprint_requirements value ' + str(sector_footprint_requirements[s]) + ' for sector ' + str(sector_names[s]))
+
+    country_ids = np.ascontiguousarray(country_ids)
+    available_land_contiguous = np.ascontiguousarray(available_land)
+
+    # Group each sector's keys by country, keeping rank order within each country.
+    key_rows_list, key_cols_list, key_yields_list = [], [], []
+    key_starts = np.zeros((num_countries, num_sectors), dtype=np.int64)
+    key_stops = np.zeros((num_countries, num_sectors), dtype=np.int64)
+    out_starts = np.zeros((num_countries, num_sectors), dtype=np.int64)
+    step_sizes = np.zeros(num_sectors, dtype=np.int64)
+    key_base = 0
+    out_base = 0
+    for s in range(num_sectors):
+        step_sizes[s] = len(sector_yields[s]) // num_iteration_steps + 1
+        n_keys = int(sector_num_changes[s])
+        rows = ranked_keys[s, 0, :n_keys]
+        cols = ranked_keys[s, 1, :n_keys]
+        key_country_ids = country_ids[rows, cols]
+        in_country = np.flatnonzero((key_country_ids >= 1) & (key_country_ids <= num_countries))
+        order = in_country[np.argsort(key_country_ids[in_country], kind='stable')]
+        counts = np.bincount(key_country_ids[order] - 1, minlength=num_countries).astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        key_starts[:, s] = key_base + offsets
+        key_stops[:, s] = key_base + offsets + counts
+        key_base += len(order)
+        key_rows_list.append(rows[order])
+        key_cols_list.append(cols[order])
+        key_yields_list.append(sector_yields[s, :n_keys][order])
+
+        capacity = counts * (9 if sector_yield_notes[s] == 9 else 1)
+        out_starts[:, s] = out_base + np.concatenate([[0], np.cumsum(capacity)[:-1]])
+        out_base += int(np.sum(capacity))
+
+    arrays = {
+        'key_rows': np.ascontiguousarray(np.concatenate(key_rows_list), dtype=np.int64),
+        'key_cols': np.ascontiguousarray(np.concatenate(key_cols_list), dtype=np.int64),
+        'key_yields': np.ascontiguousarray(np.concatenate(key_yields_list), dtype=np.float64),
+        'key_starts': key_starts,
+        'key_stops': key_stops,
+        'projections_array': projections_array if projections_array.flags['C_CONTIGUOUS'] else np.ascontiguousarray(projections_array),
+        'country_sector_production': np.zeros((num_countries, num_sectors), dtype=np.float64),
+        'available_land': available_land_contiguous,
+        'country_ids': country_ids,
+        'min_viable_proportions': np.ascontiguousarray(sector_min_viable_proportions),
+        'max_viable_proportions': np.ascontiguousarray(sector_max_viable_proportions),
+        'footprint_requirements': np.ascontiguousarray(sector_footprint_requirements),
+        'yield_notes': np.ascontiguousarray(sector_yield_notes),
+        'step_sizes': step_sizes,
+        'out_rows': np.zeros(out_base, dtype=np.int64),
+        'out_cols': np.zeros(out_base, dtype=np.int64),
+        'out_proportions': np.zeros(out_base, dtype=np.float64),
+        'out_yields': np.zeros(out_base, dtype=np.float64),
+        'out_starts': out_starts,
+        'out_counts': np.zeros((num_countries, num_sectors), dtype=np.int64),
+    }
+
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    print ('Cython function allocating ' + str(num_sectors) + ' sectors over ' + str(num_countries) + ' countries in ' + str(n_threads) + ' threads.')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        errors = list(executor.map(lambda country_index: _allocate_country_all_sectors_py(country_index, arrays), range(num_countries)))
+    for c in range(num_countries):
+        if errors[c]:
+            raise NameError('WARNING!! sector demand was less than yield  AND yield was zero? Country ' + str(country_iso3[c]))
+
+    if arrays['projections_array'] is not projections_array:
+        projections_array[:] = arrays['projections_array']
+    if available_land_contiguous is not available_land:
+        available_land[:] = available_land_contiguous
+
+    # Assemble compact per-sector change lists in country order.
+    out_counts = arrays['out_counts']
+    max_to_allocate = max(int(np.max(np.sum(out_counts, axis=0))) if num_countries > 0 else 0, 1)
+    sector_change_keys_lists = np.zeros((num_sectors, 2, max_to_allocate), dtype=np.int64)
+    sector_proportion_allocated_lists = np.zeros((num_sectors, max_to_allocate), dtype=np.float64)
+    sector_yield_obtained_lists = np.zeros((num_sectors, max_to_allocate), dtype=np.float64)
+    report = ''
+    for s in range(num_sectors):
+        segments = [slice(out_starts[c, s], out_starts[c, s] + out_counts[c, s]) for c in range(num_countries)]
+        n_sector = int(np.sum(out_counts[:, s]))
+        if n_sector > 0:
+            sector_change_keys_lists[s, 0, :n_sector] = np.concatenate([arrays['out_rows'][i] for i in segments])
+            sector_change_keys_lists[s, 1, :n_sector] = np.concatenate([arrays['out_cols'][i] for i in segments])
+            sector_proportion_allocated_lists[s, :n_sector] = np.concatenate([arrays['out_proportions'][i] for i in segments])
+            sector_yield_obtained_lists[s, :n_sector] = np.concatenate([arrays['out_yields'][i] for i in segments])
+        for c in range(num_countries):
+            if projections_array[c, s] > 0 and key_stops[c, s] > key_starts[c, s]:
+                report += 'sector: ' + str(sector_names[s]) + ', country: ' + str(country_iso3[c]) + ', unmet demand after exhausting ranked keys: ' + str(projections_array[c, s]) + '\n'
+
+    print ('cython time: ' + str(time.time() - start))
+
+    return sector_change_keys_lists, sector_proportion_allocated_lists, sector_yield_obtained_lists, arrays['country_sector_production'], report
+
+
+
 @cython.cdivision(False)
 @cython.boundscheck(True)
 @cython.wraparound(True)
@@ -2546,7 +2837,7 @@ def update_float_array_with_change_list_and_value_list(
 @cython.boundscheck(False)
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
 def create_order_array_from_ranked_keys(
-                         ndarray[np.int64_t, ndim=2] ranked_keys not None,
+                         const np.int64_t[:, :] ranked_keys not None,
                          np.int64_t output_n_rows,
                          np.int64_t output_n_cols,
 ):
@@ -2567,7 +2858,7 @@ def create_order_array_from_ranked_keys(
 @cython.boundscheck(False)
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
 def create_values_1dim_array_from_ranked_keys(
-                         ndarray[np.int64_t, ndim=2] ranked_keys not None,
+                         const np.int64_t[:, :] ranked_keys not None,
                          ndarray[np.float64_t, ndim=2] values_array not None,
 ):
     start = time.time()
@@ -2657,6 +2948,36 @@ def calc_change_matrix_of_two_int_arrays(ndarray[DTYPEINT32_t, ndim=2] a1 not No
 
     return a3, lulc_counters
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def accumulate_change_matrix(const np.int32_t[:, ::1] baseline_class_index not None,
+                             const np.int32_t[:, ::1] scenario_class_index not None,
+                             const np.int32_t[:, ::1] zone_index,
+                             np.int64_t[:, :, ::1] counts not None):
+    """Add the transitions in one block to counts[zone, baseline_class, scenario_class]. Inputs are class (and zone)
+    positions as int32, with -1 for cells to skip (nodata or not in the class list). zone_index may be None, in
+    which case everything goes to zone 0. Releases the GIL so blocks can be accumulated from several threads, each
+    into its own counts array."""
+    cdef Py_ssize_t n_rows = baseline_class_index.shape[0]
+    cdef Py_ssize_t n_cols = baseline_class_index.shape[1]
+    cdef Py_ssize_t i, j
+    cdef np.int32_t a, b, z = 0
+    cdef bint has_zones = zone_index is not None
+
+    with nogil:
+        for i in range(n_rows):
+            for j in range(n_cols):
+                a = baseline_class_index[i, j]
+                b = scenario_class_index[i, j]
+                if a < 0 or b < 0:
+                    continue
+                if has_zones:
+                    z = zone_index[i, j]
+                    if z < 0:
+                        continue
+                counts[z, a, b] += 1
+    return counts
+
 @cython.cdivision(True)
 @cython.embedsignature(True)
 @cython.boundscheck(True)
@@ -2717,6 +3038,36 @@ def calculate_coarse_state_stack_from_fine_classified(ndarray[DTYPEINT32_t, ndim
 
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def accumulate_class_coverage_by_factor(const np.int32_t[:, ::1] class_position not None,
+                                        long long upscale_factor,
+                                        const double[::1] fine_row_weights not None,
+                                        double[:, :, ::1] output_3d not None):
+    """Streaming, GIL-releasing counterpart of calculate_coarse_state_stack_from_fine_classified for one strip.
+
+    class_position holds, for each fine cell, the position of its class in the class list (-1 to skip). For every
+    fine cell, fine_row_weights[fine_row] (1.0 for counts, or the cell area) is added to
+    output_3d[position, coarse_row, coarse_col], where the coarse cell is upscale_factor by upscale_factor fine cells.
+    """
+    cdef Py_ssize_t n_fine_rows = class_position.shape[0]
+    cdef Py_ssize_t n_fine_cols = class_position.shape[1]
+    cdef Py_ssize_t n_positions = output_3d.shape[0]
+    cdef Py_ssize_t fr, fc
+    cdef np.int32_t position
+    cdef double weight
+
+    with nogil:
+        for fr in range(n_fine_rows):
+            weight = fine_row_weights[fr]
+            for fc in range(n_fine_cols):
+                position = class_position[fr, fc]
+                if position < 0 or position >= n_positions:
+                    continue
+                output_3d[position, fr // upscale_factor, fc // upscale_factor] += weight
+    return output_3d
+
+
 def calculate_zone_to_chunk_list_lookup_dict(ndarray[DTYPEINT32_t, ndim=2] input_array):
     """For every unique id in input_array, return two row, column arrays that store for each id-th column set of RC indices that are in that id. """
 
@@ -2758,3 +3109,74 @@ def calculate_zone_to_chunk_list_lookup_dict(ndarray[DTYPEINT32_t, ndim=2] input
 
 
 
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def distance_transform_edt_row_pass(double[:, ::1] f_squared not None, double sampling_x=1.0, bint wrap_x=False):
+    """Second (row-wise) pass of the exact separable Euclidean distance transform (Felzenszwalb & Huttenlocher's
+    lower envelope of parabolas).
+
+    f_squared holds, for each cell, the squared distance to the nearest feature within its own column (inf if none),
+    as produced by the column pass. Returns the squared Euclidean distance to the nearest feature. If wrap_x, the
+    rows are treated as circular (e.g. longitude on a global grid) by extending them by half a row on each side.
+    Releases the GIL so that several row strips can be processed in parallel from Python threads.
+    """
+    cdef Py_ssize_t n_rows = f_squared.shape[0]
+    cdef Py_ssize_t n_cols = f_squared.shape[1]
+    cdef Py_ssize_t pad = n_cols // 2 if wrap_x else 0
+    cdef Py_ssize_t n_ext = n_cols + 2 * pad
+    cdef np.ndarray[np.float64_t, ndim=2] result = np.empty((n_rows, n_cols), dtype=np.float64)
+    cdef double[:, ::1] result_view = result
+    cdef double[::1] f_ext = np.empty(n_ext, dtype=np.float64)
+    cdef double[::1] z = np.empty(n_ext + 1, dtype=np.float64)
+    cdef Py_ssize_t[::1] v = np.empty(n_ext, dtype=np.intp)
+    cdef double s2 = sampling_x * sampling_x
+    cdef double inf = np.inf
+    cdef double s
+    cdef Py_ssize_t row, q, k, j, src, position
+
+    with nogil:
+        for row in range(n_rows):
+            for q in range(n_ext):
+                src = q - pad
+                if src < 0:
+                    src = src + n_cols
+                elif src >= n_cols:
+                    src = src - n_cols
+                f_ext[q] = f_squared[row, src]
+
+            # Build the lower envelope from the parabolas rooted at cells that have a feature in their column.
+            k = -1
+            for q in range(n_ext):
+                if f_ext[q] == inf:
+                    continue
+                if k < 0:
+                    k = 0
+                    v[0] = q
+                    z[0] = -inf
+                    z[1] = inf
+                    continue
+                s = ((f_ext[q] + s2 * q * q) - (f_ext[v[k]] + s2 * v[k] * v[k])) / (2.0 * s2 * (q - v[k]))
+                while s <= z[k]:
+                    k = k - 1
+                    s = ((f_ext[q] + s2 * q * q) - (f_ext[v[k]] + s2 * v[k] * v[k])) / (2.0 * s2 * (q - v[k]))
+                k = k + 1
+                v[k] = q
+                z[k] = s
+                z[k + 1] = inf
+
+            if k < 0:
+                for j in range(n_cols):
+                    result_view[row, j] = inf
+                continue
+
+            k = 0
+            for j in range(n_cols):
+                position = j + pad
+                while z[k + 1] < position:
+                    k = k + 1
+                result_view[row, j] = s2 * (position - v[k]) * (position - v[k]) + f_ext[v[k]]
+
+    return result
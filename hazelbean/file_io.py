@@ -110,11 +110,41 @@ def get_strings_between_values(input_string, value_1, value_2, return_only_first
         print ('NYI')
 
 
-def file_to_python_object(file_uri, declare_type=None, verbose=False, return_all_parts=False, xls_worksheet=None, output_key_data_type=None, output_value_data_type=None, add_first_col_as_named_var=True):
+def file_to_python_object(file_uri, declare_type=None, verbose=False, return_all_parts=False, xls_worksheet=None, output_key_data_type=None, output_value_data_type=None, add_first_col_as_named_var=True,
+                          use_cache=True, cache_dir=None):
     """
     Version that follows the simple rule of if the UL cell is blank its a DD. Else LL
 
+    If use_cache, the parsed object is kept in memory keyed by the file's path, size and mtime, and also in cache_dir
+    if it is given (see hb.read_with_file_cache), so tables reread by every task are only parsed once.
     """
+    if not os.path.exists(file_uri):
+        raise NameError('File given to file_to_python_object does not exist: ' + file_uri)
+
+    variant_key = ('file_to_python_object', declare_type, xls_worksheet, output_key_data_type, output_value_data_type, add_first_col_as_named_var)
+    data, metadata = hb.read_with_file_cache(file_uri, variant_key, lambda path: _file_to_python_object(path, declare_type, xls_worksheet, output_key_data_type, output_value_data_type, add_first_col_as_named_var),
+                                             use_cache=use_cache, cache_dir=cache_dir)
+
+    # JSON is returned as is.
+    if metadata is None:
+        return data
+
+    if verbose:
+        print ('\nReading file at ' + file_uri)
+        print ('data_type: ' + metadata['data_type'] + ',  shape: num_rows ' + str(metadata['num_rows']) + ', num_cols ' + str(metadata['num_cols']))
+        print ('col_headers: ' + ', '.join(metadata['col_headers']))
+        print ('row_headers: ' + ', '.join(metadata['row_headers']))
+        print ('python object loaded (next line):')
+        print (data)
+
+    if return_all_parts:
+        return data, metadata
+    else:
+        return data
+
+
+def _file_to_python_object(file_uri, declare_type=None, xls_worksheet=None, output_key_data_type=None, output_value_data_type=None, add_first_col_as_named_var=True):
+    # Parse file_uri for file_to_python_object, returning the data and its metadata (None for JSON).
     if not output_value_data_type:
         output_value_data_type = str
 
@@ -143,7 +173,7 @@ def file_to_python_object(file_uri, declare_type=None, verbose=False, return_all
     if file_extension == '.json':
         json_data=open(file_uri).read()
         data = json.loads(json_data)
-        return data
+        return data, None
 
     elif file_extension == '.xls' or file_extension == '.xlsx':
         # If XLS, convert to a temporary csv.
@@ -230,18 +260,7 @@ def file_to_python_object(file_uri, declare_type=None, verbose=False, return_all
     metadata = OrderedDict()
     metadata.update({'data_type':data_type,'num_rows':num_rows, 'num_cols':num_cols, 'row_headers':row_headers, 'col_headers':col_headers})
 
-    if verbose:
-        print ('\nReading file at ' + file_uri)
-        print ('data_type: ' + data_type + ',  shape: num_rows ' + str(num_rows) + ', num_cols ' + str(num_cols))
-        print ('col_headers: ' + ', '.join(col_headers))
-        print ('row_headers: ' + ', '.join(row_headers))
-        print ('python object loaded (next line):')
-        print (data)
-
-    if return_all_parts:
-        return data, metadata
-    else:
-        return data
+    return data, metadata
 
 
 def save_string_as_file(input_string, file_path):
@@ -716,6 +735,8 @@ def propose_fuzzy_merge(left_df, right_df, on=None, left_on=None, right_on=None,
 
 
 def merge_dataframes_with_remap(left_df, right_df, remap_df_or_path, remap_left_col='remap_input', remap_right_col='remap_output', on=None, left_on=None, right_on=None, how='outer'):
+    # Merge right_df onto left_df after remapping the values of right_df's right_on column with the remap table. The
+    # remap is a hash lookup of the whole column, and right_df itself is not modified.
     if isinstance(remap_df_or_path, str):
         if remap_df_or_path.endswith('.csv'):
             remap_df_or_path = pd.read_csv(remap_df_or_path, encoding='latin')
@@ -731,17 +752,14 @@ def merge_dataframes_with_remap(left_df, right_df, remap_df_or_path, remap_left_
         right_on = on
 
 
-    left_values = remap_df_or_path[remap_left_col]
-
-    right_values = remap_df_or_path[remap_right_col]
-    remap_dict = dict(zip(left_values, right_values))
-
-
-    right_df[right_on] = right_df[right_on].replace(remap_dict)
-
-    # remap_dict = {k: v for k, v in dict(zip(left_values, right_values).items()}
+    # As with a dict of the pairs, the last output of a repeated input wins.
+    remap_df = remap_df_or_path.drop_duplicates(remap_left_col, keep='last')
+    if len(remap_df) > 0:
+        remap_positions = pd.Index(remap_df[remap_left_col]).get_indexer(right_df[right_on])
+        remapped = np.where(remap_positions >= 0, remap_df[remap_right_col].to_numpy()[remap_positions], right_df[right_on].to_numpy())
+        right_df = right_df.assign(**{right_on: remapped})
 
-    merged_df = pd.merge(left_df, right_df, left_on=left_on, right_on=right_on, how=how)
+    merged_df = hb.df_merge_frames(left_df, right_df, how, left_on, right_on)
     return merged_df
 
 
@@ -23,6 +23,7 @@ import scipy.interpolate
 import scipy.sparse
 import scipy.signal
 import scipy.ndimage
+import scipy.fft
 import scipy.signal.signaltools
 import shapely.wkt
 import shapely.ops
@@ -35,6 +36,7 @@ import numpy as numpy
 import hazelbean as hb
 import multiprocessing
 import threading
+import concurrent.futures
 import pygeoprocessing as pgp
 
 L = hb.get_logger('geoprocessing')
@@ -1244,11 +1246,13 @@ def calculate_disjoint_polygon_set(vector_path, layer_index=0):
 
 def distance_transform_edt(
         base_mask_raster_path_band, target_distance_raster_path,
-        working_dir=None):
+        working_dir=None, sampling_distance=(1.0, 1.0), wrap_x=False,
+        n_workers=None, strip_size=128):
     """Calculate the euclidean distance transform on base raster.
 
     Calculates the euclidean distance transform on the base raster in units of
-    pixels.
+    pixels (or of sampling_distance if given). This is the hazelbean-native,
+    out-of-core version; see distance_transform_edt_tiled for how it works.
 
     Parameters:
         base_raster_path_band (tuple): a tuple including file path to a raster
@@ -1260,31 +1264,178 @@ def distance_transform_edt(
             closest non-zero pixel.
          working_dir (string): If not None, indicates where temporary files
             should be created during this run.
+        sampling_distance (tuple): (x, y) size of a pixel in the desired output units.
+        wrap_x (bool): If True, distances wrap around the east-west edge, eg
+            for a global raster (see hb.raster_wraps_east_west).
+        n_workers (int): Number of threads for the column and row passes.
+        strip_size (int): Number of columns (first pass) or rows (second pass) per strip.
 
     Returns:
         None
     """
-    with tempfile.NamedTemporaryFile(
-            prefix='dt_mask', delete=False, dir=working_dir) as dt_mask_file:
-        dt_mask_path = dt_mask_file.name
+    distance_transform_edt_tiled(
+        base_mask_raster_path_band, target_distance_raster_path, working_dir=working_dir,
+        sampling_distance=sampling_distance, wrap_x=wrap_x, n_workers=n_workers, strip_size=strip_size)
+
+
+def _edt_last_feature_rows(mask, row_offset, last_above):
+    """Row of the last True cell of each column of mask (rows row_offset onward of the full raster), or last_above (the
+    last feature row above the chunk) where there is none."""
+    row_index = numpy.arange(row_offset, row_offset + mask.shape[0], dtype=numpy.float32)[:, None]
+    return numpy.maximum(last_above, numpy.where(mask, row_index, -numpy.inf).max(axis=0, initial=-numpy.inf)).astype(numpy.float32)
+
+
+def _edt_column_pass(mask, row_offset=0, last_above=None, next_below=None):
+    """Distance in pixels from each cell to the nearest True cell in its own column (inf if none), for a chunk of rows
+    starting at row_offset. last_above and next_below are, per column, the rows of the nearest features above and below
+    the chunk (default none). Returns the distances and the first feature row of the chunk (or next_below), which is
+    next_below for the chunk above. Float32 is exact for any realistic number of rows."""
+    n_rows, n_cols = mask.shape
+    if last_above is None:
+        last_above = numpy.full(n_cols, -numpy.inf, dtype=numpy.float32)
+    if next_below is None:
+        next_below = numpy.full(n_cols, numpy.inf, dtype=numpy.float32)
+    row_index = numpy.arange(row_offset, row_offset + n_rows, dtype=numpy.float32)[:, None]
+    above = numpy.where(mask, row_index, -numpy.inf).astype(numpy.float32)
+    above[0] = numpy.maximum(above[0], last_above)
+    numpy.maximum.accumulate(above, axis=0, out=above)
+    below = numpy.where(mask, row_index, numpy.inf).astype(numpy.float32)[::-1]
+    below[0] = numpy.minimum(below[0], next_below)
+    below = numpy.minimum.accumulate(below, axis=0)[::-1]
+    return numpy.minimum(row_index - above, below - row_index), below[0].copy()
+
+
+def distance_transform_edt_tiled(
+        base_mask_raster_path_band, target_distance_raster_path,
+        working_dir=None, sampling_distance=(1.0, 1.0), wrap_x=False,
+        n_workers=None, strip_size=128, largest_block=hb.globals.LARGEST_ITERBLOCK,
+        gtiff_creation_options=hb.globals.DEFAULT_GTIFF_CREATION_OPTIONS):
+    """Exact Euclidean distance transform of a raster that does not need to fit in memory.
+
+    Non-zero, non-nodata pixels of base_mask_raster_path_band are features. The transform is separable:
+
+        1. Column pass: strips of strip_size columns are read in chunks of about largest_block cells. A downward sweep
+           records the last feature row above each chunk, then an upward sweep carries the next feature row below and
+           writes the distance to the nearest feature within each column to a temporary float32 raster. So no
+           full-height column strip is ever read.
+        2. Row pass: strips of strip_size full-width rows of that raster are read and the lower envelope of parabolas
+           (cython_functions.distance_transform_edt_row_pass, which releases the GIL) gives the exact 2D distance.
+
+    Both passes run their strips in a thread pool, so only n_workers strips (or chunks) are in memory at once. If
+    wrap_x (eg for rasters spanning 360 degrees, see hb.raster_wraps_east_west), the row pass treats rows as circular
+    so that a road at 179.9E is near a cell at 179.9W. Pixels with no feature anywhere are written as nodata (-9999).
+
+    Parameters:
+        base_mask_raster_path_band (tuple): (path, band_index) of the feature mask.
+        target_distance_raster_path (str): float32 output, same grid as the mask.
+        working_dir (str): Where to write the temporary column pass raster.
+        sampling_distance (tuple): (x, y) size of a pixel in the output units. Defaults to pixels.
+        wrap_x (bool): Wrap east-west.
+        n_workers (int): Threads per pass. Defaults to the cpu count.
+        strip_size (int): Columns or rows per strip.
+        largest_block (int): Approximate number of cells per column pass chunk.
+
+    Returns:
+        None
+    """
+    from hazelbean.calculation_core.cython_functions import distance_transform_edt_row_pass
+
     raster_info = get_raster_info(base_mask_raster_path_band[0])
-    nodata = raster_info['nodata'][base_mask_raster_path_band[1]-1]
-    nodata_out = 255
-
-    def _mask_op(base_array):
-        """Convert base_array to 1 if >0, 0 if == 0 or nodata."""
-        return numpy.where(
-            base_array == nodata, nodata_out, base_array != 0)
-
-    pgp.raster_calculator(
-        [base_mask_raster_path_band], _mask_op, dt_mask_path,
-        gdal.GDT_Byte, nodata_out, calc_raster_stats=False)
-    pgp.geoprocessing_core.distance_transform_edt(
-        (dt_mask_path, 1), target_distance_raster_path)
+    n_cols, n_rows = raster_info['raster_size']
+    nodata = raster_info['nodata'][base_mask_raster_path_band[1] - 1]
+    geotransform = raster_info['geotransform']
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    sampling_x, sampling_y = float(sampling_distance[0]), float(sampling_distance[1])
+    target_nodata = -9999.0
+
+    with tempfile.NamedTemporaryFile(
+            prefix='edt_column_pass', suffix='.tif', delete=False, dir=working_dir) as column_pass_file:
+        column_pass_path = column_pass_file.name
+
+    gtiff_driver = gdal.GetDriverByName('GTiff')
+    column_pass_raster = gtiff_driver.Create(
+        column_pass_path, n_cols, n_rows, 1, gdal.GDT_Float32,
+        options=hb.globals.DEFAULT_GTIFF_NO_COMPRESS_CREATION_OPTIONS)
+    column_pass_band = column_pass_raster.GetRasterBand(1)
+    write_lock = threading.Lock()
+    thread_local = threading.local()
+
+    def _get_band(path, band_index):
+        # Each thread keeps its own handle because GDAL datasets are not thread safe.
+        key = (path, band_index)
+        if not hasattr(thread_local, 'bands'):
+            thread_local.bands = {}
+        if key not in thread_local.bands:
+            raster = gdal.OpenEx(path, gdal.OF_RASTER)
+            thread_local.bands[key] = (raster, raster.GetRasterBand(band_index))
+        return thread_local.bands[key][1]
+
+    def _read_mask(col_offset, row_offset, win_xsize, win_ysize):
+        base_array = _get_band(*base_mask_raster_path_band).ReadAsArray(col_offset, row_offset, win_xsize, win_ysize)
+        mask = base_array != 0
+        if nodata is not None:
+            mask &= base_array != nodata
+        return mask
+
+    def _column_strip(col_offset):
+        win_xsize = min(strip_size, n_cols - col_offset)
+        chunk_rows = max(1, int(largest_block // win_xsize))
+        row_offsets = list(range(0, n_rows, chunk_rows))
+
+        # Downward sweep: only the last feature row above each chunk is kept.
+        last_above_list = []
+        last_above = numpy.full(win_xsize, -numpy.inf, dtype=numpy.float32)
+        for row_offset in row_offsets:
+            last_above_list.append(last_above)
+            last_above = _edt_last_feature_rows(_read_mask(col_offset, row_offset, win_xsize, min(chunk_rows, n_rows - row_offset)), row_offset, last_above)
+
+        # Upward sweep, carrying the first feature row below.
+        next_below = None
+        for row_offset, last_above in zip(row_offsets[::-1], last_above_list[::-1]):
+            mask = _read_mask(col_offset, row_offset, win_xsize, min(chunk_rows, n_rows - row_offset))
+            column_distance, next_below = _edt_column_pass(mask, row_offset, last_above, next_below)
+            with write_lock:
+                column_pass_band.WriteArray(column_distance, xoff=col_offset, yoff=row_offset)
+
     try:
-        os.remove(dt_mask_path)
-    except OSError:
-        L.warn("couldn't remove file %s", dt_mask_path)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(_column_strip, range(0, n_cols, strip_size)))
+        column_pass_band.FlushCache()
+        column_pass_band = None
+        column_pass_raster = None
+
+        target_raster = gtiff_driver.Create(
+            target_distance_raster_path, n_cols, n_rows, 1, gdal.GDT_Float32,
+            options=gtiff_creation_options)
+        target_raster.SetProjection(raster_info['projection'])
+        target_raster.SetGeoTransform(geotransform)
+        target_band = target_raster.GetRasterBand(1)
+        target_band.SetNoDataValue(target_nodata)
+
+        def _row_strip(row_offset):
+            win_ysize = min(strip_size, n_rows - row_offset)
+            column_distance = _get_band(column_pass_path, 1).ReadAsArray(0, row_offset, n_cols, win_ysize).astype(numpy.float64)
+            column_distance *= sampling_y
+            column_distance *= column_distance
+            distance = numpy.sqrt(distance_transform_edt_row_pass(column_distance, sampling_x, wrap_x))
+            distance[numpy.isinf(distance)] = target_nodata
+            with write_lock:
+                target_band.WriteArray(distance, xoff=0, yoff=row_offset)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(_row_strip, range(0, n_rows, strip_size)))
+
+        target_band.FlushCache()
+        target_band = None
+        target_raster = None
+    finally:
+        column_pass_band = None
+        column_pass_raster = None
+        try:
+            os.remove(column_pass_path)
+        except OSError:
+            L.warn("couldn't remove file %s", column_pass_path)
 
 
 def _next_regular(base):
@@ -1810,6 +1961,192 @@ def convolve_2d(
     target_raster = None
 
 
+def convolve_2d_multi(
+        signal_path_band_list, kernel_path_band, target_path_list,
+        class_list=None, ignore_nodata=False, mask_nodata=True,
+        normalize_kernel=False, target_datatype=gdal.GDT_Float32,
+        target_nodata=None, wrap_x=False,
+        gtiff_creation_options=hb.DEFAULT_GTIFF_CREATION_OPTIONS,
+        n_threads=None, largest_block=hb.globals.LARGEST_ITERBLOCK):
+    """Convolve one kernel over many signals in a single blockwise pass.
+
+    Same semantics as convolve_2d (nodata treated as 0.0, ignore_nodata renormalizes by the convolved valid mask,
+    mask_nodata writes nodata where the signal is nodata), but for a batch of aligned signals, e.g. the class-binary
+    masks used for SEALS adjacency. Rather than N calls that each recompute the kernel FFT and re-read the signal,
+    each output block is read once with a halo of the kernel size, the kernel spectrum is computed once per FFT shape
+    and reused for every signal, and all outputs are written from that block.
+
+    Parameters:
+        signal_path_band_list (list): (path, band) tuples of aligned signal rasters, one per output. If class_list
+            is given, this must be a single (path, band) of a categorical raster (or a list containing one).
+        kernel_path_band (tuple or np.ndarray): (path, band) of the kernel raster, or the kernel array itself (e.g.
+            from hb.generate_gaussian_kernel). The kernel is held in memory.
+        target_path_list (list): Output paths, one per signal (or per class).
+        class_list (list): If given, output i is the convolution of (categorical == class_list[i]).
+        ignore_nodata (bool): See convolve_2d.
+        mask_nodata (bool): See convolve_2d.
+        normalize_kernel (bool): Divide the kernel by its sum.
+        target_datatype (GDAL type): GDT_Float32 (default, computes in float32) or GDT_Float64.
+        target_nodata (float): Output nodata. Defaults to the minimum float32.
+        wrap_x (bool): Let the kernel wrap around the east-west edge, for global grids. See hb.raster_wraps_east_west.
+        n_threads (int): Threads processing blocks concurrently. Defaults to the cpu count.
+        largest_block (int): Cells per output block, passed to hb.iterblocks_hb.
+
+    Returns:
+        None
+    """
+    if class_list is not None:
+        if hb.is_raster_path_band_formatted(signal_path_band_list):
+            signal_path_band_list = [signal_path_band_list]
+        if len(signal_path_band_list) != 1:
+            raise ValueError('When class_list is given, signal_path_band_list must be a single categorical raster, got ' + str(signal_path_band_list))
+        n_outputs = len(class_list)
+    else:
+        n_outputs = len(signal_path_band_list)
+    if len(target_path_list) != n_outputs:
+        raise ValueError('Expected ' + str(n_outputs) + ' target paths but got ' + str(len(target_path_list)))
+
+    if target_datatype == gdal.GDT_Float32:
+        compute_type = numpy.float32
+    elif target_datatype == gdal.GDT_Float64:
+        compute_type = numpy.float64
+    else:
+        raise ValueError('convolve_2d_multi only supports gdal.GDT_Float32 or gdal.GDT_Float64 targets.')
+    if target_nodata is None:
+        target_nodata = numpy.finfo(numpy.float32).min
+
+    raster_info_list = [get_raster_info(path_band[0]) for path_band in signal_path_band_list]
+    if len(set(raster_info['raster_size'] for raster_info in raster_info_list)) > 1:
+        raise ValueError('Signal rasters are not all the same size: ' + str(signal_path_band_list))
+    n_cols, n_rows = raster_info_list[0]['raster_size']
+    signal_nodata_list = [raster_info['nodata'][path_band[1] - 1] for raster_info, path_band in zip(raster_info_list, signal_path_band_list)]
+
+    if isinstance(kernel_path_band, numpy.ndarray):
+        kernel = kernel_path_band.astype(numpy.float64)
+    else:
+        kernel_raster = gdal.OpenEx(kernel_path_band[0], gdal.OF_RASTER)
+        kernel_band = kernel_raster.GetRasterBand(kernel_path_band[1])
+        kernel = kernel_band.ReadAsArray().astype(numpy.float64)
+        kernel_nodata = kernel_band.GetNoDataValue()
+        if kernel_nodata is not None and ignore_nodata:
+            kernel[numpy.isclose(kernel, kernel_nodata)] = 0.0
+        kernel_band = None
+        kernel_raster = None
+    kernel_sum = numpy.sum(kernel)
+    if normalize_kernel:
+        kernel = kernel / kernel_sum
+    kernel = kernel.astype(compute_type)
+
+    # Output[r, c] = sum_ij signal[r + n_k // 2 - i, c + n_k // 2 - j] * kernel[i, j], which is the same alignment as convolve_2d.
+    n_rows_kernel, n_cols_kernel = kernel.shape
+    halo_top, halo_bottom = n_rows_kernel - 1 - n_rows_kernel // 2, n_rows_kernel // 2
+    halo_left, halo_right = n_cols_kernel - 1 - n_cols_kernel // 2, n_cols_kernel // 2
+
+    for target_path in target_path_list:
+        new_raster_from_base(
+            signal_path_band_list[0][0], target_path, target_datatype, [target_nodata],
+            gtiff_creation_options=gtiff_creation_options)
+    target_raster_list = [gdal.OpenEx(target_path, gdal.OF_RASTER | gdal.GA_Update) for target_path in target_path_list]
+    target_band_list = [target_raster.GetRasterBand(1) for target_raster in target_raster_list]
+
+    kernel_fft_cache = {}
+    cache_lock = threading.Lock()
+    write_lock = threading.Lock()
+    thread_local = threading.local()
+
+    def _kernel_fft(fshape):
+        # Blocks share a handful of shapes (interior, right edge, bottom edge), so the kernel spectrum is computed a few times at most.
+        with cache_lock:
+            if fshape not in kernel_fft_cache:
+                kernel_fft_cache[fshape] = scipy.fft.rfftn(kernel, fshape)
+            return kernel_fft_cache[fshape]
+
+    def _signal_bands():
+        if not hasattr(thread_local, 'bands'):
+            thread_local.rasters = [gdal.OpenEx(path_band[0], gdal.OF_RASTER) for path_band in signal_path_band_list]
+            thread_local.bands = [raster.GetRasterBand(path_band[1]) for raster, path_band in zip(thread_local.rasters, signal_path_band_list)]
+        return thread_local.bands
+
+    def _convolve(padded_array, fshape, fslice):
+        return scipy.fft.irfftn(scipy.fft.rfftn(padded_array, fshape) * _kernel_fft(fshape), fshape)[fslice]
+
+    def _process_block(offset):
+        win_xsize, win_ysize = offset['win_xsize'], offset['win_ysize']
+        padded_shape = (win_ysize + n_rows_kernel - 1, win_xsize + n_cols_kernel - 1)
+        fshape = tuple(_next_regular(int(padded_shape[i] + kernel.shape[i] - 1)) for i in range(2))
+        fslice = (slice(n_rows_kernel - 1, n_rows_kernel - 1 + win_ysize), slice(n_cols_kernel - 1, n_cols_kernel - 1 + win_xsize))
+        halo = (halo_left, halo_top, halo_right, halo_bottom)
+        # Cells of the halo beyond the raster edge are neither signal nor valid, as in convolve_2d.
+        inside = hb.get_halo_inside_raster_mask(
+            dict(offset, halo_left=halo_left, halo_top=halo_top, halo_right=halo_right, halo_bottom=halo_bottom),
+            (n_cols, n_rows), wrap_x=wrap_x)
+
+        signal_bands = _signal_bands()
+        results = []
+        if class_list is not None:
+            categorical = hb.read_block_with_halo(signal_bands[0], offset, halo, wrap_x=wrap_x, fill_value=0)
+            nodata = signal_nodata_list[0]
+            valid = inside if nodata is None else inside & (categorical != nodata)
+            # One read and one valid mask convolution for all of the classes.
+            mask_result = _convolve(valid.astype(compute_type), fshape, fslice) if (nodata is not None and ignore_nodata) else None
+            core_valid = valid[halo_top:halo_top + win_ysize, halo_left:halo_left + win_xsize]
+            for class_id in class_list:
+                class_array = ((categorical == class_id) & valid).astype(compute_type)
+                results.append((_convolve(class_array, fshape, fslice), mask_result, core_valid, nodata))
+        else:
+            for signal_band, nodata in zip(signal_bands, signal_nodata_list):
+                signal = hb.read_block_with_halo(signal_band, offset, halo, wrap_x=wrap_x, fill_value=0).astype(compute_type)
+                valid = inside
+                if nodata is not None:
+                    valid = inside & ~numpy.isclose(signal, nodata)
+                    signal[~valid] = 0.0
+                mask_result = _convolve(valid.astype(compute_type), fshape, fslice) if (nodata is not None and ignore_nodata) else None
+                core_valid = valid[halo_top:halo_top + win_ysize, halo_left:halo_left + win_xsize]
+                results.append((_convolve(signal, fshape, fslice), mask_result, core_valid, nodata))
+
+        output_list = []
+        for result, mask_result, core_valid, nodata in results:
+            output = result.astype(compute_type, copy=False)
+            if mask_result is not None:
+                # Renormalize so that nodata neighbors are not counted, as convolve_2d does in its second pass.
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    output = output / mask_result
+                if not normalize_kernel:
+                    output *= kernel_sum
+            if nodata is not None and mask_nodata:
+                output[~core_valid] = target_nodata
+            output_list.append(output)
+
+        with write_lock:
+            for target_band, output in zip(target_band_list, output_list):
+                target_band.WriteArray(output, xoff=offset['xoff'], yoff=offset['yoff'])
+
+    offsets = list(hb.iterblocks_hb((target_path_list[0], 1), largest_block=largest_block, offset_only=True))
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+
+    L.info('starting convolve_2d_multi of ' + str(n_outputs) + ' signals over ' + str(len(offsets)) + ' blocks')
+    last_time = time.time()
+    n_blocks_processed = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for _ in executor.map(_process_block, offsets):
+                n_blocks_processed += 1
+                last_time = _invoke_timed_callback(
+                    last_time, lambda: L.info(
+                        "convolve_2d_multi approximately %.1f%% complete",
+                        100.0 * float(n_blocks_processed) / len(offsets)),
+                    hb.LOGGING_PERIOD)
+    finally:
+        for target_band in target_band_list:
+            target_band.FlushCache()
+        target_band_list[:] = []
+        for target_raster in target_raster_list:
+            target_raster.FlushCache()
+        target_raster_list[:] = []
+    L.info('convolve_2d_multi 100.0% complete')
+
+
 def convolve_2d_old(
         signal_path_band, kernel_path_band, target_path,
         ignore_nodata=False, mask_nodata=True, normalize_kernel=False,
@@ -1,12 +1,13 @@
 """Hazelbean relies on pygeoprocessing, but there are some cases where an optimal change requires duplicating some code. To minimize upgrading challenges
 Hazelbean offers a few functions that reimplement pgp and by convention keep a similar funciton name with the change listed after the matched function name."""
 
-import os, sys, time, math, logging
+import os, sys, time, math, logging, ast
 import hazelbean as hb
 
 from osgeo import gdal
 from osgeo import osr
 from osgeo import ogr
+from osgeo import gdal_array
 import numpy as np
 import numpy as numpy
 from collections import OrderedDict
@@ -15,7 +16,10 @@ from decimal import Decimal
 import functools
 import queue
 import threading
+import multiprocessing
+import concurrent.futures
 import json
+import scipy.ndimage
 import pygeoprocessing
 
 
@@ -666,66 +670,31 @@ def read_raster_stats(raster_path):
 def calculate_raster_stats(raster_path, return_unique_values_list=False):
     """Calculate and set min, max, stdev, and mean for all bands in raster.
     optionally return also a list of unique values
+
+    Uses a single multithreaded read per band via hb.compute_raster_stats_block_scan rather than separate passes
+    for the mean and the stdev.
+
     Parameters:
         raster_path (string): a path to a GDAL raster raster that will be
             modified by having its band statistics set
+        return_unique_values_list (bool): if True, also track unique values
+            (integer rasters only)
 
     Returns:
-        None
+        None, or if return_unique_values_list, a list (one entry per band) of
+        unique values arrays (None for float bands).
     """
-    raster = gdal.OpenEx(raster_path, gdal.GA_Update)
-    raster_properties = hb.get_raster_info_hb(raster_path)
-    for band_index in range(raster.RasterCount):
-        target_min = None
-        target_max = None
-        target_n = 0
-        target_sum = 0.0
-        for _, target_block in hb.iterblocks(
-                (raster_path, 1)):
-            nodata_target = raster_properties['nodata'][band_index]
-            # guard against an undefined nodata target
-            valid_mask = numpy.ones(target_block.shape, dtype=bool)
-            if nodata_target is not None:
-                valid_mask[:] = target_block != nodata_target
-            valid_block = target_block[valid_mask]
-            if valid_block.size == 0:
-                continue
-            if target_min is None:
-                # initialize first min/max
-                target_min = target_max = valid_block[0]
-            target_sum += numpy.sum(valid_block)
-            target_min = min(numpy.min(valid_block), target_min)
-            target_max = max(numpy.max(valid_block), target_max)
-            target_n += valid_block.size
-
-        if target_min is not None:
-            target_mean = target_sum / float(target_n)
-            stdev_sum = 0.0
-            for _, target_block in hb.iterblocks(
-                    (raster_path, 1)):
-                # guard against an undefined nodata target
-                valid_mask = numpy.ones(target_block.shape, dtype=bool)
-                if nodata_target is not None:
-                    valid_mask = target_block != nodata_target
-                valid_block = target_block[valid_mask]
-                stdev_sum += numpy.sum((valid_block - target_mean) ** 2)
-            target_stddev = (stdev_sum / float(target_n)) ** 0.5
-
-            target_band = raster.GetRasterBand(band_index + 1)
-            target_band.SetStatistics(
-                float(target_min), float(target_max), float(target_mean),
-                float(target_stddev))
-            target_band = None
-        else:
-            L.warn(
-                "Stats not calculated for %s band %d since no non-nodata "
-                "pixels were found.", raster_path, band_index + 1)
-    raster = None
+    stats_by_band = hb.add_stats_to_geotiff_with_block_scan(
+        raster_path, calculate_histogram=False, write_unique_values_list=bool(return_unique_values_list),
+        max_unique_values=None, write_to_aux_xml=False)
+
+    if return_unique_values_list:
+        return [stats_by_band[band_index]['unique_values'] for band_index in sorted(stats_by_band)]
 
 
 def iterblocks_hb(
         raster_path_band, largest_block=hb.globals.LARGEST_ITERBLOCK,
-        offset_only=False):
+        offset_only=False, dtype=None, reuse_buffer=False):
     """Iterate across all the memory blocks in the input raster.
 
     Result is a generator of block location information and numpy arrays.
@@ -752,6 +721,11 @@ def iterblocks_hb(
             returns offset dictionary and doesn't read any binary data from
             the raster.  This can be useful when iterating over writing to
             an output.
+        dtype (numpy dtype): If given, blocks are read directly as this type
+            (GDAL converts while reading) rather than the band's own type.
+        reuse_buffer (boolean): If True, every block is read into the same
+            preallocated buffer and the yielded array is a view of it, so it
+            is overwritten on the next iteration. Copy it if it must be kept.
 
     Yields:
         If ``offset_only`` is false, on each iteration, a tuple containing a
@@ -804,6 +778,7 @@ def iterblocks_hb(
 
     n_col_blocks = int(math.ceil(n_cols / float(cols_per_block)))
     n_row_blocks = int(math.ceil(n_rows / float(rows_per_block)))
+    buffer_dict = {}
 
     for row_block_index in range(n_row_blocks):
         row_offset = row_block_index * rows_per_block
@@ -824,18 +799,486 @@ def iterblocks_hb(
             }
             if offset_only:
                 yield offset_dict
+            elif reuse_buffer:
+                yield (offset_dict, read_block_into_buffer(band, offset_dict, buffer_dict, dtype=dtype))
+            elif dtype is not None:
+                yield (offset_dict, band.ReadAsArray(**offset_dict, buf_type=gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype))))
             else:
                 yield (offset_dict, band.ReadAsArray(**offset_dict))
 
     band = None
     raster = None
 
+
+def get_block_buffer(buffer_dict, key, win_ysize, win_xsize, dtype):
+    """Return a C-contiguous (win_ysize, win_xsize) array of dtype that is a view of a flat buffer kept in buffer_dict
+    under key, growing the buffer only when a larger window is requested. Block loops use this to avoid allocating new
+    arrays for every block (and every edge block shape). The view is invalidated by the next call with the same key."""
+    n_cells = win_ysize * win_xsize
+    dtype = np.dtype(dtype)
+    flat_buffer = buffer_dict.get(key)
+    if flat_buffer is None or flat_buffer.dtype != dtype or flat_buffer.size < n_cells:
+        flat_buffer = np.empty(n_cells, dtype=dtype)
+        buffer_dict[key] = flat_buffer
+    return flat_buffer[:n_cells].reshape((win_ysize, win_xsize))
+
+
+def read_block_into_buffer(band, offset_dict, buffer_dict, key=None, dtype=None):
+    """Read the offset_dict window of band into a reusable buffer from get_block_buffer (keyed by key, default the
+    band's dataset description and band number) and return the view. If dtype is given, GDAL converts to it while
+    reading, avoiding a separate astype copy."""
+    if dtype is None:
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+    if key is None:
+        key = (band.GetDataset().GetDescription(), band.GetBand())
+    buffer = get_block_buffer(buffer_dict, key, offset_dict['win_ysize'], offset_dict['win_xsize'], dtype)
+    result = band.ReadAsArray(offset_dict['xoff'], offset_dict['yoff'], offset_dict['win_xsize'], offset_dict['win_ysize'], buf_obj=buffer)
+    if not isinstance(result, np.ndarray):
+        raise ValueError('Unable to read ' + str(offset_dict) + ' from ' + str(band.GetDataset().GetDescription()))
+    return buffer
+
+def raster_wraps_east_west(raster_path):
+    """Return True if the raster is in geographic coordinates and spans the full 360 degrees of longitude, in which
+    case the first and last columns are neighbors."""
+    raster_info = hb.get_raster_info_hb(raster_path)
+    if not raster_info['projection']:
+        return False
+    srs = osr.SpatialReference(raster_info['projection'])
+    return srs.IsGeographic() == 1 and abs(abs(raster_info['geotransform'][1]) * raster_info['raster_size'][0] - 360.0) < 1e-6
+
+
+def _get_halo_tuple(halo):
+    """Return halo as (left, top, right, bottom) from an int or a 4-tuple."""
+    if isinstance(halo, (int, np.integer)):
+        return (int(halo),) * 4
+    if len(halo) != 4:
+        raise ValueError('halo must be an int or a (left, top, right, bottom) tuple, got ' + str(halo))
+    return tuple(int(i) for i in halo)
+
+
+def read_block_with_halo(band, offset_dict, halo, wrap_x=False, fill_value=0):
+    """Read the block described by offset_dict grown by halo cells on each side.
+
+    Rows (and, unless wrap_x, columns) of the halo that fall outside of the raster are filled with fill_value. With
+    wrap_x the halo at the east and west edges is read from the opposite side of the raster, as for global grids.
+
+    Parameters:
+        band (gdal.Band): Band to read from.
+        offset_dict (dict): xoff, yoff, win_xsize, win_ysize as yielded by iterblocks_hb.
+        halo (int or tuple): Cells to add on each side, or (left, top, right, bottom).
+        wrap_x (bool): Wrap the halo around the east-west edge.
+        fill_value: Value for halo cells outside of the raster.
+
+    Returns:
+        2d array of shape (win_ysize + top + bottom, win_xsize + left + right).
+    """
+    halo_left, halo_top, halo_right, halo_bottom = _get_halo_tuple(halo)
+    n_cols, n_rows = band.XSize, band.YSize
+    xoff, yoff = offset_dict['xoff'], offset_dict['yoff']
+    win_xsize, win_ysize = offset_dict['win_xsize'], offset_dict['win_ysize']
+
+    read_top = max(yoff - halo_top, 0)
+    read_bottom = min(yoff + win_ysize + halo_bottom, n_rows)
+    padded_shape = (win_ysize + halo_top + halo_bottom, win_xsize + halo_left + halo_right)
+    top = read_top - (yoff - halo_top)
+
+    if wrap_x and (halo_left > 0 or halo_right > 0):
+        if halo_left > n_cols or halo_right > n_cols:
+            raise ValueError('A wrapped halo cannot be wider than the raster.')
+        # Read up to three column ranges: the wrapped west halo, the block plus any in-raster halo, and the wrapped
+        # east halo.
+        pieces = []
+        if xoff - halo_left < 0:
+            pieces.append((n_cols + xoff - halo_left, halo_left - xoff))
+        core_left = max(xoff - halo_left, 0)
+        core_right = min(xoff + win_xsize + halo_right, n_cols)
+        pieces.append((core_left, core_right - core_left))
+        if xoff + win_xsize + halo_right > n_cols:
+            pieces.append((0, xoff + win_xsize + halo_right - n_cols))
+        array = np.concatenate(
+            [band.ReadAsArray(piece_xoff, read_top, piece_xsize, read_bottom - read_top) for piece_xoff, piece_xsize in pieces], axis=1)
+        left = 0
+    else:
+        read_left = max(xoff - halo_left, 0)
+        read_right = min(xoff + win_xsize + halo_right, n_cols)
+        array = band.ReadAsArray(read_left, read_top, read_right - read_left, read_bottom - read_top)
+        left = read_left - (xoff - halo_left)
+
+    if array.shape == padded_shape:
+        return array
+    padded = np.full(padded_shape, fill_value, dtype=array.dtype)
+    padded[top:top + array.shape[0], left:left + array.shape[1]] = array
+    return padded
+
+
+def get_halo_inside_raster_mask(offset_dict, raster_size, wrap_x=False):
+    """Return a bool array the shape of a haloed block that is False where the halo falls outside of the raster.
+
+    Parameters:
+        offset_dict (dict): Offset dict with halo_left, halo_top, halo_right, halo_bottom as yielded by
+            iterblocks_with_halo.
+        raster_size (tuple): (n_cols, n_rows) of the raster.
+        wrap_x (bool): If True, columns are never outside of the raster.
+    """
+    n_cols, n_rows = raster_size
+    halo_left, halo_top = offset_dict['halo_left'], offset_dict['halo_top']
+    halo_right, halo_bottom = offset_dict['halo_right'], offset_dict['halo_bottom']
+    shape = (offset_dict['win_ysize'] + halo_top + halo_bottom, offset_dict['win_xsize'] + halo_left + halo_right)
+    inside = np.ones(shape, dtype=bool)
+    inside[:max(halo_top - offset_dict['yoff'], 0)] = False
+    n_bottom_outside = max(offset_dict['yoff'] + offset_dict['win_ysize'] + halo_bottom - n_rows, 0)
+    if n_bottom_outside:
+        inside[-n_bottom_outside:] = False
+    if not wrap_x:
+        inside[:, :max(halo_left - offset_dict['xoff'], 0)] = False
+        n_right_outside = max(offset_dict['xoff'] + offset_dict['win_xsize'] + halo_right - n_cols, 0)
+        if n_right_outside:
+            inside[:, -n_right_outside:] = False
+    return inside
+
+
+def iterblocks_with_halo(
+        raster_path_band, halo=1, wrap_x=False, fill_value=None,
+        largest_block=hb.globals.LARGEST_ITERBLOCK, offset_only=False):
+    """Iterate over the blocks of a raster as iterblocks_hb does, but with each array grown by a halo for focal operations.
+
+    The blocks themselves (xoff, yoff, win_xsize, win_ysize) are the same non-overlapping tiling as iterblocks_hb, so
+    writing the cropped result of each block covers the raster exactly once. The offset dict additionally has
+    halo_left, halo_top, halo_right and halo_bottom, which crop_halo and write_block_cropping_halo use to recover the
+    core of the block.
+
+    Args:
+        raster_path_band (tuple): (path, band_index) to iterate over.
+        halo (int or tuple): Cells of overlap on each side, or (left, top, right, bottom).
+        wrap_x (bool): Read the east-west halo from the opposite edge of the raster, for global grids. See
+            raster_wraps_east_west.
+        fill_value: Value for halo cells outside of the raster. Defaults to the band nodata value, or 0 if there is none.
+        largest_block (int): See iterblocks_hb.
+        offset_only (bool): Only yield the offset dicts.
+
+    Yields:
+        (offset_dict, array) tuples, or offset_dict if offset_only.
+    """
+    halo_left, halo_top, halo_right, halo_bottom = _get_halo_tuple(halo)
+    raster = None
+    band = None
+    if not offset_only:
+        raster = gdal.OpenEx(raster_path_band[0], gdal.OF_RASTER)
+        band = raster.GetRasterBand(raster_path_band[1])
+        if fill_value is None:
+            fill_value = band.GetNoDataValue()
+            if fill_value is None:
+                fill_value = 0
+
+    for offset_dict in iterblocks_hb(raster_path_band, largest_block=largest_block, offset_only=True):
+        offset_dict.update({'halo_left': halo_left, 'halo_top': halo_top, 'halo_right': halo_right, 'halo_bottom': halo_bottom})
+        if offset_only:
+            yield offset_dict
+        else:
+            yield offset_dict, read_block_with_halo(band, offset_dict, (halo_left, halo_top, halo_right, halo_bottom), wrap_x=wrap_x, fill_value=fill_value)
+
+    band = None
+    raster = None
+
+
+def crop_halo(array, offset_dict):
+    """Return the core of a haloed block array (a view), dropping the halo described in offset_dict."""
+    return array[offset_dict['halo_top']:offset_dict['halo_top'] + offset_dict['win_ysize'],
+                 offset_dict['halo_left']:offset_dict['halo_left'] + offset_dict['win_xsize']]
+
+
+def write_block_cropping_halo(band, array, offset_dict):
+    """Write a block to band at offset_dict's location. If array still has its halo (ie is larger than the block), the
+    halo is cropped first."""
+    if array.shape != (offset_dict['win_ysize'], offset_dict['win_xsize']):
+        array = crop_halo(array, offset_dict)
+    band.WriteArray(array, xoff=offset_dict['xoff'], yoff=offset_dict['yoff'])
+
+
+def _box_sum(array, radius):
+    """Sum of each (2 * radius + 1) square window of a 2d array, for the cells at least radius from the edge.
+    Uses a summed-area table so cost does not depend on radius."""
+    window = 2 * radius + 1
+    integral = np.zeros((array.shape[0] + 1, array.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(array, axis=0, dtype=np.float64), axis=1, out=integral[1:, 1:])
+    return integral[window:, window:] - integral[:-window, window:] - integral[window:, :-window] + integral[:-window, :-window]
+
+
+def _focal_statistic_of_block(array, valid, radius, statistic):
+    """Compute the focal statistic for the core of a block haloed by radius. Returns (result, n_valid_neighbors)."""
+    count = _box_sum(valid, radius)
+    if statistic in ('sum', 'mean'):
+        total = _box_sum(np.where(valid, array, 0), radius)
+        if statistic == 'sum':
+            return total, count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return total / count, count
+    elif statistic == 'max':
+        if np.issubdtype(array.dtype, np.floating):
+            lowest = -np.inf
+        else:
+            lowest = np.iinfo(array.dtype).min
+        result = scipy.ndimage.maximum_filter(np.where(valid, array, lowest), size=2 * radius + 1, mode='nearest')
+        return result[radius:result.shape[0] - radius, radius:result.shape[1] - radius], count
+    elif statistic == 'majority':
+        core_shape = count.shape
+        best_count = np.zeros(core_shape, dtype=np.float64)
+        result = np.zeros(core_shape, dtype=array.dtype)
+        # Classes in ascending order with a strict comparison, so ties go to the smallest class.
+        for class_id in np.unique(array[valid]):
+            class_count = _box_sum(valid & (array == class_id), radius)
+            is_better = class_count > best_count
+            result[is_better] = class_id
+            best_count[is_better] = class_count[is_better]
+        return result, count
+    raise ValueError('Unknown focal statistic: ' + str(statistic))
+
+
+def focal_statistics(
+        input_path_band, output_path, radius=1, statistic='mean',
+        wrap_x=None, mask_nodata=True, output_datatype=None,
+        output_nodata=None, n_threads=None,
+        largest_block=hb.globals.LARGEST_ITERBLOCK,
+        gtiff_creation_options=hb.globals.DEFAULT_GTIFF_CREATION_OPTIONS):
+    """Compute a moving-window statistic over a square (2 * radius + 1) neighborhood, streaming blocks with
+    iterblocks_with_halo so that memory use does not depend on raster size. Nodata cells are excluded from every
+    neighborhood; cells whose neighborhood has no valid cells are nodata.
+
+    Args:
+        input_path_band (tuple or str): (path, band) or a path (band 1).
+        output_path (str): Output raster path.
+        radius (int): Neighborhood radius in cells.
+        statistic (str): One of 'mean', 'sum', 'max' or 'majority'. Majority ties go to the smallest class.
+        wrap_x (bool): Let neighborhoods wrap around the east-west edge. None to detect with raster_wraps_east_west.
+        mask_nodata (bool): If True, cells that are nodata in the input are nodata in the output.
+        output_datatype (int): GDAL type. Defaults to Float32 for mean and sum, and the input type for max and majority.
+        output_nodata: Defaults to -9999.0 for mean and sum, and the input nodata (or the type minimum) otherwise.
+        n_threads (int): Threads processing blocks concurrently. Defaults to the cpu count.
+        largest_block (int): See iterblocks_hb.
+        gtiff_creation_options (list): Creation options for the output.
+    """
+    if statistic not in ('mean', 'sum', 'max', 'majority'):
+        raise ValueError('statistic must be one of mean, sum, max or majority, got ' + str(statistic))
+    if isinstance(input_path_band, str):
+        input_path_band = (input_path_band, 1)
+    radius = int(radius)
+
+    raster_info = hb.get_raster_info_hb(input_path_band[0])
+    raster_size = raster_info['raster_size']
+    input_nodata = raster_info['nodata'][input_path_band[1] - 1]
+    input_datatype = raster_info['datatype']
+    if wrap_x is None:
+        wrap_x = raster_wraps_east_west(input_path_band[0])
+
+    if output_datatype is None:
+        output_datatype = gdal.GDT_Float32 if statistic in ('mean', 'sum') else input_datatype
+    output_numpy_type = hb.gdal_number_to_numpy_type[output_datatype]
+    if output_nodata is None:
+        if statistic in ('mean', 'sum'):
+            output_nodata = -9999.0
+        elif input_nodata is not None:
+            output_nodata = input_nodata
+        elif np.issubdtype(output_numpy_type, np.floating):
+            output_nodata = float(np.finfo(output_numpy_type).min)
+        else:
+            output_nodata = int(np.iinfo(output_numpy_type).min)
+
+    hb.new_raster_from_base(
+        input_path_band[0], output_path, output_datatype, [output_nodata],
+        gtiff_creation_options=gtiff_creation_options)
+    output_raster = gdal.OpenEx(output_path, gdal.OF_RASTER | gdal.GA_Update)
+    output_band = output_raster.GetRasterBand(1)
+
+    thread_local = threading.local()
+    write_lock = threading.Lock()
+
+    def _process_block(offset_dict):
+        if not hasattr(thread_local, 'band'):
+            thread_local.raster = gdal.OpenEx(input_path_band[0], gdal.OF_RASTER)
+            thread_local.band = thread_local.raster.GetRasterBand(input_path_band[1])
+        array = read_block_with_halo(thread_local.band, offset_dict, radius, wrap_x=wrap_x, fill_value=0)
+        valid = get_halo_inside_raster_mask(offset_dict, raster_size, wrap_x=wrap_x)
+        if input_nodata is not None:
+            valid &= array != input_nodata
+        if np.issubdtype(array.dtype, np.floating):
+            valid &= ~np.isnan(array)
+
+        result, count = _focal_statistic_of_block(array, valid, radius, statistic)
+        result = result.astype(output_numpy_type)
+        result[count == 0] = output_nodata
+        if mask_nodata:
+            result[~crop_halo(valid, offset_dict)] = output_nodata
+        with write_lock:
+            write_block_cropping_halo(output_band, result, offset_dict)
+
+    offsets = list(iterblocks_with_halo(input_path_band, halo=radius, largest_block=largest_block, offset_only=True))
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+
+    last_time = time.time()
+    n_blocks_processed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for _ in executor.map(_process_block, offsets):
+            n_blocks_processed += 1
+            last_time = _invoke_timed_callback(
+                last_time, lambda: L.info(
+                    'focal_statistics %s approximately %.1f%% complete', statistic,
+                    100.0 * float(n_blocks_processed) / len(offsets)),
+                hb.globals.LOGGING_PERIOD)
+
+    output_band.FlushCache()
+    output_band = None
+    output_raster = None
+
+
+def focal_mean(input_path_band, output_path, radius=1, **kwargs):
+    """Moving-window mean of valid cells. See focal_statistics."""
+    return focal_statistics(input_path_band, output_path, radius=radius, statistic='mean', **kwargs)
+
+
+def focal_sum(input_path_band, output_path, radius=1, **kwargs):
+    """Moving-window sum of valid cells. See focal_statistics."""
+    return focal_statistics(input_path_band, output_path, radius=radius, statistic='sum', **kwargs)
+
+
+def focal_max(input_path_band, output_path, radius=1, **kwargs):
+    """Moving-window maximum of valid cells. See focal_statistics."""
+    return focal_statistics(input_path_band, output_path, radius=radius, statistic='max', **kwargs)
+
+
+def focal_majority(input_path_band, output_path, radius=1, **kwargs):
+    """Moving-window most common class of valid cells. See focal_statistics."""
+    return focal_statistics(input_path_band, output_path, radius=radius, statistic='majority', **kwargs)
+
+
+def get_sparse_gtiff_creation_options(gtiff_creation_options):
+    """Return a copy of gtiff_creation_options with SPARSE_OK=TRUE, so that blocks never written are not materialized
+    in the file and read back as the band's nodata value."""
+    options = [i for i in gtiff_creation_options if not str(i).upper().startswith('SPARSE_OK')]
+    options.append('SPARSE_OK=TRUE')
+    return options
+
+
+def is_block_empty_by_coverage(band, offset_dict):
+    """Cheaply test, without reading pixels, whether the window of band is entirely absent or sparse tiles (ie would
+    be read back as nodata). Uses GDAL's GetDataCoverageStatus; returns False if the driver cannot tell or the band
+    has no nodata value."""
+    if band.GetNoDataValue() is None or not hasattr(band, 'GetDataCoverageStatus'):
+        return False
+    flags, percent_covered = band.GetDataCoverageStatus(
+        offset_dict['xoff'], offset_dict['yoff'], offset_dict['win_xsize'], offset_dict['win_ysize'])
+    return bool(flags & gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY) and not flags & gdal.GDAL_DATA_COVERAGE_STATUS_DATA and percent_covered == 0
+
+
+def is_array_all_nodata(array, nodata):
+    """True if every cell of array is nodata (NaN nodata is matched with isnan)."""
+    if nodata is None:
+        return False
+    if np.isnan(nodata):
+        return bool(np.isnan(array).all())
+    return bool((array == nodata).all())
+
+
+def get_block_valid_count_index_path(raster_path_band):
+    """Path of the per-block valid cell count sidecar of a (path, band) tuple."""
+    return str(raster_path_band[0]) + '.band' + str(raster_path_band[1]) + '.block_valid_counts.npz'
+
+
+def build_block_valid_count_index(raster_path_band, index_path=None, largest_block=hb.globals.LARGEST_ITERBLOCK):
+    """Count the valid (not nodata) cells of every iterblocks_hb window of raster_path_band and save them in a sidecar
+    at index_path (by default next to the raster, see get_block_valid_count_index_path), so that later passes can skip
+    empty blocks without reading them. Blocks that are sparse in the file are counted without reading. If the sidecar
+    cannot be written (eg a read-only directory) the index is still returned, just not saved. Returns the index dict."""
+    raster = gdal.OpenEx(raster_path_band[0], gdal.OF_RASTER)
+    band = raster.GetRasterBand(raster_path_band[1])
+    nodata = band.GetNoDataValue()
+    block_offsets = []
+    valid_counts = []
+    for offset_dict in iterblocks_hb(raster_path_band, largest_block=largest_block, offset_only=True):
+        block_offsets.append([offset_dict['xoff'], offset_dict['yoff'], offset_dict['win_xsize'], offset_dict['win_ysize']])
+        if is_block_empty_by_coverage(band, offset_dict):
+            valid_counts.append(0)
+            continue
+        array = band.ReadAsArray(**offset_dict)
+        if nodata is None:
+            valid_counts.append(array.size)
+        elif np.isnan(nodata):
+            valid_counts.append(int(np.count_nonzero(~np.isnan(array))))
+        else:
+            valid_counts.append(int(np.count_nonzero(array != nodata)))
+    band = None
+    raster = None
+
+    stat_result = os.stat(raster_path_band[0])
+    index = {
+        'block_offsets': np.asarray(block_offsets, dtype=np.int64).reshape(-1, 4),
+        'valid_counts': np.asarray(valid_counts, dtype=np.int64),
+        'largest_block': np.int64(largest_block),
+        'source_size': np.int64(stat_result.st_size),
+        'source_mtime_ns': np.int64(stat_result.st_mtime_ns),
+    }
+    if index_path is None:
+        index_path = get_block_valid_count_index_path(raster_path_band)
+    temp_path = index_path + '.' + str(os.getpid()) + '.tmp.npz'
+    try:
+        np.savez(temp_path, **index)
+        os.replace(temp_path, index_path)
+    except Exception as e:
+        L.debug('Unable to write block valid count index ' + str(index_path) + ', using it from memory: ' + str(e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return index
+
+
+def load_block_valid_count_index(raster_path_band, build_if_missing=False, index_path=None, largest_block=hb.globals.LARGEST_ITERBLOCK):
+    """Load the per-block valid count sidecar of raster_path_band (at index_path, by default next to the raster) as a
+    dict of (xoff, yoff, win_xsize, win_ysize) to valid count. Returns None if it does not exist (or is out of date with
+    the raster) and build_if_missing is False."""
+    if index_path is None:
+        index_path = get_block_valid_count_index_path(raster_path_band)
+    index = None
+    if os.path.exists(index_path):
+        try:
+            with np.load(index_path) as npz:
+                index = {key: npz[key] for key in npz.files}
+            stat_result = os.stat(raster_path_band[0])
+            if index['source_size'] != stat_result.st_size or index['source_mtime_ns'] != stat_result.st_mtime_ns:
+                index = None
+        except Exception as e:
+            L.debug('Ignoring unreadable block valid count index ' + str(index_path) + ': ' + str(e))
+            index = None
+    if index is None:
+        if not build_if_missing:
+            return None
+        index = build_block_valid_count_index(raster_path_band, index_path=index_path, largest_block=largest_block)
+    return {tuple(int(j) for j in offsets): int(count) for offsets, count in zip(index['block_offsets'], index['valid_counts'])}
+
+
+def write_array_skipping_nodata_blocks(band, array, nodata):
+    """Write array (the full size of band) one native block at a time, skipping blocks that are entirely nodata. Used
+    with SPARSE_OK=TRUE outputs so that empty blocks are never materialized. Returns the number of blocks skipped."""
+    block_xsize, block_ysize = band.GetBlockSize()
+    n_rows, n_cols = array.shape
+    n_skipped = 0
+    for row_start in range(0, n_rows, block_ysize):
+        row_end = min(row_start + block_ysize, n_rows)
+        for col_start in range(0, n_cols, block_xsize):
+            col_end = min(col_start + block_xsize, n_cols)
+            block = array[row_start: row_end, col_start: col_end]
+            if is_array_all_nodata(block, nodata):
+                n_skipped += 1
+                continue
+            band.WriteArray(block, xoff=col_start, yoff=row_start)
+    return n_skipped
+
+
 def raster_calculator_hb(
         base_raster_path_band_const_list, local_op, target_raster_path,
         datatype_target, nodata_target, read_datatype=None,
         gtiff_creation_options=hb.globals.DEFAULT_GTIFF_CREATION_OPTIONS,
         calc_raster_stats=False, invoke_full_callback=True,
-        largest_block=hb.globals.LARGEST_ITERBLOCK):
+        largest_block=hb.globals.LARGEST_ITERBLOCK, skip_nodata_blocks=False,
+        reuse_buffers=True):
     """Apply local a raster operation on a stack of rasters.
 
     This function applies a user defined function across a stack of
@@ -847,6 +1290,8 @@ def raster_calculator_hb(
             (str, int) tuples, `numpy.ndarray`s of up to two
             dimensions, or an (object, 'raw') tuple.  A `(str, int)`
             tuple refers to a raster path band index pair to use as an input.
+            A hb.netcdf.NetcdfRasterSource is read like a raster band, so
+            netcdf slices need not be extracted to geotiffs first.
             The `numpy.ndarray`s must be broadcastable to each other AND the
             size of the raster inputs. Values passed by  `(object, 'raw')`
             tuples pass `object` directly into the `local_op`. All rasters
@@ -891,6 +1336,20 @@ def raster_calculator_hb(
             overhead dominates the iteration.  Defaults to 2**20.  A value of
             anything less than the original blocksize of the raster will
             result in blocksizes equal to the original size.
+        skip_nodata_blocks (bool or str): If True (or 'all'), windows where
+            every raster input is entirely nodata are not read (when a
+            block valid count sidecar or sparse tiles show they are empty)
+            or passed to `local_op`, and the target is created with
+            SPARSE_OK=TRUE so those blocks are never written and read back
+            as `nodata_target`. If 'any', a window is skipped when any raster
+            input is entirely nodata. Only use this if `local_op` returns
+            nodata for such windows. Requires `nodata_target`.
+        reuse_buffers (bool): If True, raster inputs are read (already
+            converted to `read_datatype` or `datatype_target`), and windows
+            of full size array inputs copied, into buffers that are reused
+            across blocks, so `local_op` must not keep references to its
+            input arrays between calls. `local_op` may modify its inputs
+            either way; the caller's arrays are never passed as views.
 
     Returns:
         None
@@ -912,6 +1371,7 @@ def raster_calculator_hb(
     else:
         for value in base_raster_path_band_const_list:
             if (not _is_raster_path_band_formatted(value) and
+                    not _is_raster_source(value) and
                     not isinstance(value, numpy.ndarray) and
                     not (isinstance(value, tuple) and len(value) == 2 and
                          value[1] == 'raw')):
@@ -959,9 +1419,9 @@ def raster_calculator_hb(
 
     # check that raster inputs are all the same dimensions
     raster_info_list = [
-        hb.get_raster_info_hb(path_band[0])
-        for path_band in base_raster_path_band_const_list
-        if _is_raster_path_band_formatted(path_band)]
+        hb.get_raster_info_hb(value[0]) if _is_raster_path_band_formatted(value) else value.get_raster_info()
+        for value in base_raster_path_band_const_list
+        if _is_raster_path_band_formatted(value) or _is_raster_source(value)]
     geospatial_info_set = set()
     for raster_info in raster_info_list:
         geospatial_info_set.add(raster_info['raster_size'])
@@ -1029,6 +1489,7 @@ def raster_calculator_hb(
     base_canonical_arg_list = []
     base_raster_list = []
     base_band_list = []
+    base_band_path_band_list = [] # None for raster sources, which have no sidecar indices
     for value in base_raster_path_band_const_list:
         # the input has been tested and value is either a raster/path band
         # tuple, 1d ndarray, 2d ndarray, or (value, 'raw') tuple.
@@ -1038,7 +1499,13 @@ def raster_calculator_hb(
             base_raster_list.append(gdal.OpenEx(value[0], gdal.OF_RASTER))
             base_band_list.append(
                 base_raster_list[-1].GetRasterBand(value[1]))
+            base_band_path_band_list.append(value)
             base_canonical_arg_list.append(base_band_list[-1])
+        elif _is_raster_source(value):
+            # read lazily by window exactly like a band
+            base_band_list.append(value)
+            base_band_path_band_list.append(None)
+            base_canonical_arg_list.append(value)
         elif isinstance(value, numpy.ndarray):
             if value.ndim == 1:
                 # easier to process as a 2d array for writing to band
@@ -1071,6 +1538,20 @@ def raster_calculator_hb(
             "parameter. This is the input list: " + str(
                 base_raster_path_band_const_list))
 
+    # set up skipping of empty input windows
+    if skip_nodata_blocks not in (False, True, 'all', 'any'):
+        raise ValueError("skip_nodata_blocks must be True, False, 'all' or 'any', got " + str(skip_nodata_blocks))
+    if skip_nodata_blocks and nodata_target is None:
+        L.warning('skip_nodata_blocks requires nodata_target, so no blocks will be skipped.')
+        skip_nodata_blocks = False
+    if skip_nodata_blocks and not base_band_list:
+        skip_nodata_blocks = False
+    if skip_nodata_blocks:
+        gtiff_creation_options = get_sparse_gtiff_creation_options(gtiff_creation_options)
+        base_nodata_list = [band.GetNoDataValue() for band in base_band_list]
+        base_valid_count_index_list = [load_block_valid_count_index(path_band) if path_band is not None else None for path_band in base_band_path_band_list]
+        blocks_skipped = 0
+
     # create target raster
     gtiff_driver = gdal.GetDriverByName('GTiff')
     try:
@@ -1087,6 +1568,9 @@ def raster_calculator_hb(
         # use the first raster in the list for the projection and geotransform
         target_raster.SetProjection(base_raster_list[0].GetProjection())
         target_raster.SetGeoTransform(base_raster_list[0].GetGeoTransform())
+    elif base_band_list:
+        target_raster.SetProjection(base_band_list[0].projection)
+        target_raster.SetGeoTransform(base_band_list[0].geotransform)
     target_band.FlushCache()
     target_raster.FlushCache()
 
@@ -1123,6 +1607,9 @@ def raster_calculator_hb(
 
         pixels_processed = 0
         n_pixels = n_cols * n_rows
+        read_gdal_type = read_datatype if read_datatype else datatype_target
+        read_numpy_type = gdal_array.GDALTypeCodeToNumericTypeCode(read_gdal_type) if read_gdal_type else None
+        buffer_dict = {}
 
         # iterate over each block and calculate local_op
         for block_offset in iterblocks_hb(
@@ -1137,11 +1624,26 @@ def raster_calculator_hb(
             blocksize = (block_offset['win_ysize'], block_offset['win_xsize'])
             data_blocks = []
 
-
-            for value in base_canonical_arg_list:
-                if isinstance(value, gdal.Band):
+            if skip_nodata_blocks:
+                # First try to tell from the sidecar indices and sparse tiles without reading anything.
+                block_key = (block_offset['xoff'], block_offset['yoff'], block_offset['win_xsize'], block_offset['win_ysize'])
+                known_empty_list = []
+                for band, valid_count_index in zip(base_band_list, base_valid_count_index_list):
+                    if valid_count_index is not None and block_key in valid_count_index:
+                        known_empty_list.append(valid_count_index[block_key] == 0)
+                    else:
+                        known_empty_list.append(is_block_empty_by_coverage(band, block_offset))
+                if (any if skip_nodata_blocks == 'any' else all)(known_empty_list):
+                    blocks_skipped += 1
+                    pixels_processed += blocksize[0] * blocksize[1]
+                    continue
+
+            for arg_index, value in enumerate(base_canonical_arg_list):
+                if isinstance(value, gdal.Band) or _is_raster_source(value):
                     # HB Modificaiton: allow type reinterpretation at read
-                    if read_datatype:
+                    if reuse_buffers and (read_numpy_type is not None or not read_gdal_type):
+                        data_blocks.append(read_block_into_buffer(value, block_offset, buffer_dict, key=arg_index, dtype=read_numpy_type))
+                    elif read_datatype:
                         data_blocks.append(value.ReadAsArray(**block_offset, buf_type=read_datatype))
                     elif datatype_target:
                         data_blocks.append(value.ReadAsArray(**block_offset, buf_type=datatype_target))
@@ -1168,8 +1670,15 @@ def raster_calculator_hb(
                                 offset_list[dim_index] +
                                 blocksize[dim_index], )
                             tile_dims[dim_index] = 1
-                    data_blocks.append(
-                        numpy.tile(value[slice_list], tile_dims))
+                    if tile_dims == [1, 1] and reuse_buffers:
+                        # Full size array, so copy the window into a reused buffer rather than tiling a new copy. A
+                        # copy (not a view) so that local_op cannot modify the caller's array.
+                        array_block = get_block_buffer(buffer_dict, ('array', arg_index), blocksize[0], blocksize[1], value.dtype)
+                        np.copyto(array_block, value[tuple(slice_list)])
+                        data_blocks.append(array_block)
+                    else:
+                        data_blocks.append(
+                            numpy.tile(value[tuple(slice_list)], tile_dims))
                 # HB EXTENSION, support input as a dict of replacement values for reclassification
                 elif type(value) in [dict, OrderedDict]:
                     data_blocks.append(value)
@@ -1177,6 +1686,14 @@ def raster_calculator_hb(
                     # must be a raw tuple
                     data_blocks.append(value[0])
 
+            if skip_nodata_blocks:
+                band_blocks = [block for block, value in zip(data_blocks, base_canonical_arg_list) if isinstance(value, gdal.Band) or _is_raster_source(value)]
+                empty_list = [is_array_all_nodata(block, nodata) for block, nodata in zip(band_blocks, base_nodata_list)]
+                if (any if skip_nodata_blocks == 'any' else all)(empty_list):
+                    blocks_skipped += 1
+                    pixels_processed += blocksize[0] * blocksize[1]
+                    continue
+
             # HB EXTENSION, now supports memoryviews, which are faster in cython.
 
             target_block = np.asarray(local_op(*data_blocks))
@@ -1214,6 +1731,8 @@ def raster_calculator_hb(
                     last_time, lambda: L.info(
                         'Raster calculator progress: ' + str(float(pixels_processed) / n_pixels * 100.0)), hb.LOGGING_PERIOD)
         L.debug('raster_calculator_hb finished on ' + str(target_raster_path))
+        if skip_nodata_blocks:
+            L.debug('raster_calculator_hb skipped ' + str(blocks_skipped) + ' empty blocks.')
 
         if calc_raster_stats:
             L.info("signaling stats worker to terminate")
@@ -1262,6 +1781,251 @@ def raster_calculator_hb(
 # INTERNAL FUNCTIONS
 # UNLESS OTHERWISE NOTED, all internal functions are copied without modification from pygeoprocessing here so they can be called as internal funcs.
 
+_EXPRESSION_BINARY_UFUNCS = {
+    ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide,
+    ast.FloorDiv: np.floor_divide, ast.Mod: np.mod, ast.Pow: np.power,
+    ast.BitAnd: np.bitwise_and, ast.BitOr: np.bitwise_or, ast.BitXor: np.bitwise_xor,
+}
+_EXPRESSION_COMPARE_UFUNCS = {
+    ast.Gt: np.greater, ast.GtE: np.greater_equal, ast.Lt: np.less, ast.LtE: np.less_equal,
+    ast.Eq: np.equal, ast.NotEq: np.not_equal,
+}
+_EXPRESSION_FUNCTIONS = {
+    'minimum': np.minimum, 'maximum': np.maximum, 'abs': np.absolute, 'sqrt': np.sqrt, 'exp': np.exp,
+    'log': np.log, 'log10': np.log10, 'floor': np.floor, 'ceil': np.ceil, 'isnan': np.isnan,
+}
+_EXPRESSION_BOOL_UFUNCS = {np.logical_and, np.logical_or, np.logical_xor, np.logical_not, np.isnan}
+_EXPRESSION_BITWISE_UFUNCS = {np.bitwise_and, np.bitwise_or, np.bitwise_xor, np.invert}
+
+
+def compile_raster_expression(expression, names, constants=None):
+    """Compile a numpy-style expression string over named rasters (eg "where((a > 0) & (b == 0), a * c, -1)") to a
+    list of steps for evaluate_raster_expression.
+
+    Every step is a ufunc call with out= set to a numbered work buffer, and a buffer is freed for reuse as soon as its
+    value is consumed, so evaluating a block allocates at most as many buffers as the expression is deep (not one per
+    operation as a lambda does) and those buffers are reused across blocks. Supported are + - * / // % **, comparisons
+    (chained comparisons are and-ed), and/or/not, numeric constants, names in constants, and the functions where,
+    minimum, maximum, abs, sqrt, exp, log, log10, floor, ceil and isnan (optionally prefixed with np.).
+
+    & | ^ ~ are bitwise as in numpy: on booleans (eg comparisons) they are and, or, xor and not, and otherwise their
+    operands are cast to int64, so "(a & 4) > 0" tests bit 2 of an integer bitmask raster a. Non-integer constants
+    are rejected as their operands.
+
+    Returns a dict with the steps, the names used and the result (an operand spec).
+    """
+    constants = constants or {}
+    names = list(names)
+    tree = ast.parse(expression, mode='eval').body
+    steps = []
+    free_registers = {'num': [], 'bool': [], 'int': []}
+    n_registers = {'num': 0, 'bool': 0, 'int': 0}
+    used_names = []
+
+    def allocate(kind):
+        if free_registers[kind]:
+            return ('reg', kind, free_registers[kind].pop())
+        n_registers[kind] += 1
+        return ('reg', kind, n_registers[kind] - 1)
+
+    def release(*operands):
+        for operand in operands:
+            if operand[0] == 'reg':
+                free_registers[operand[1]].append(operand[2])
+
+    def kind_of(operand):
+        if operand[0] == 'reg':
+            return operand[1]
+        if operand[0] == 'const':
+            return 'bool' if isinstance(operand[1], (bool, np.bool_)) else 'num'
+        return 'num'
+
+    def emit_ufunc(ufunc, operands, keep=None):
+        if ufunc in _EXPRESSION_BITWISE_UFUNCS:
+            for operand in operands:
+                if operand[0] == 'const' and not isinstance(operand[1], (int, np.integer, np.bool_)):
+                    raise ValueError('Bitwise operators in raster expression ' + str(expression) + ' need integer or boolean operands, got ' + str(operand[1]))
+        if all(operand[0] == 'const' for operand in operands):
+            with np.errstate(all='ignore'):
+                return ('const', ufunc(*[operand[1] for operand in operands]).item())
+        if ufunc in _EXPRESSION_BITWISE_UFUNCS:
+            kind = 'bool' if all(kind_of(operand) == 'bool' for operand in operands) else 'int'
+        else:
+            kind = 'bool' if ufunc in _EXPRESSION_BOOL_UFUNCS or ufunc in _EXPRESSION_COMPARE_UFUNCS.values() else 'num'
+        # Operands are released before the output is allocated, so the output may reuse (and overwrite) one of them.
+        release(*[operand for operand in operands if operand is not keep])
+        out = allocate(kind)
+        steps.append(('ufunc', ufunc, operands, out))
+        return out
+
+    def visit(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, bool)):
+            return ('const', node.value)
+        if isinstance(node, ast.Name):
+            if node.id in names:
+                if node.id not in used_names:
+                    used_names.append(node.id)
+                return ('input', node.id)
+            if node.id in constants:
+                return ('const', constants[node.id])
+            if node.id in ('True', 'False'):
+                return ('const', node.id == 'True')
+            raise NameError('Name ' + str(node.id) + ' in raster expression is neither an input raster nor a constant.')
+        if isinstance(node, ast.BinOp) and type(node.op) in _EXPRESSION_BINARY_UFUNCS:
+            return emit_ufunc(_EXPRESSION_BINARY_UFUNCS[type(node.op)], [visit(node.left), visit(node.right)])
+        if isinstance(node, ast.UnaryOp):
+            operand = visit(node.operand)
+            if isinstance(node.op, ast.USub):
+                return emit_ufunc(np.negative, [operand])
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            if isinstance(node.op, ast.Invert):
+                return emit_ufunc(np.invert, [operand])
+            if isinstance(node.op, ast.Not):
+                return emit_ufunc(np.logical_not, [operand])
+        if isinstance(node, ast.BoolOp):
+            ufunc = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            result = visit(node.values[0])
+            for value in node.values[1:]:
+                result = emit_ufunc(ufunc, [result, visit(value)])
+            return result
+        if isinstance(node, ast.Compare):
+            left = visit(node.left)
+            result = None
+            for op, comparator in zip(node.ops, node.comparators):
+                if type(op) not in _EXPRESSION_COMPARE_UFUNCS:
+                    break
+                right = visit(comparator)
+                # In a chained comparison (a < b < c), b is needed again by the next link.
+                keep = right if comparator is not node.comparators[-1] else None
+                comparison = emit_ufunc(_EXPRESSION_COMPARE_UFUNCS[type(op)], [left, right], keep=keep)
+                result = comparison if result is None else emit_ufunc(np.logical_and, [result, comparison])
+                left = right
+            else:
+                return result
+        if isinstance(node, ast.Call):
+            function_name = node.func.attr if isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name) and node.func.value.id in ('np', 'numpy') else getattr(node.func, 'id', None)
+            if function_name == 'where' and len(node.args) == 3:
+                condition, if_true, if_false = [visit(arg) for arg in node.args]
+                if condition[0] == 'const':
+                    release(if_false if condition[1] else if_true)
+                    return if_true if condition[1] else if_false
+                if kind_of(condition) != 'bool':
+                    condition = emit_ufunc(np.not_equal, [condition, ('const', 0)])
+                kind = 'bool' if kind_of(if_true) == kind_of(if_false) == 'bool' else 'num'
+                if if_false[0] == 'reg' and if_false[1] == kind:
+                    out = if_false
+                else:
+                    release(if_false)
+                    out = allocate(kind)
+                    steps.append(('copy', None, [if_false], out))
+                steps.append(('where', None, [condition, if_true], out))
+                release(condition, if_true)
+                return out
+            if function_name in _EXPRESSION_FUNCTIONS:
+                return emit_ufunc(_EXPRESSION_FUNCTIONS[function_name], [visit(arg) for arg in node.args])
+        raise ValueError('Unsupported syntax in raster expression ' + str(expression) + ': ' + ast.dump(node))
+
+    result = visit(tree)
+    return {'expression': expression, 'steps': steps, 'result': result, 'used_names': used_names, 'n_registers': dict(n_registers)}
+
+
+def evaluate_raster_expression(compiled_expression, array_dict, nodata_dict=None, target_nodata=None, buffer_dict=None, dtype=np.float64):
+    """Evaluate a compile_raster_expression result on same-shaped 2D arrays in array_dict (name to array).
+
+    Cells where any used input equals its nodata_dict value (or is NaN, if that is its nodata) are set to target_nodata.
+    Work buffers are taken from buffer_dict (see get_block_buffer), so calling this block after block with the same
+    buffer_dict allocates nothing after the first block. The returned array is one of those buffers.
+    """
+    if isinstance(compiled_expression, str):
+        compiled_expression = compile_raster_expression(compiled_expression, array_dict.keys())
+    if buffer_dict is None:
+        buffer_dict = {}
+    nodata_dict = nodata_dict or {}
+    shape = next(iter(array_dict.values())).shape
+    dtypes = {'num': np.dtype(dtype), 'bool': np.dtype(bool), 'int': np.dtype(np.int64)}
+
+    def resolve(operand):
+        if operand[0] == 'reg':
+            return get_block_buffer(buffer_dict, ('expression', operand[1], operand[2]), shape[0], shape[1], dtypes[operand[1]])
+        if operand[0] == 'input':
+            return array_dict[operand[1]]
+        return operand[1]
+
+    with np.errstate(all='ignore'):
+        for step_type, ufunc, operands, out in compiled_expression['steps']:
+            out_array = resolve(out)
+            if step_type == 'ufunc' and out[1] == 'int':
+                # Bitwise operators on numbers, whose operands are read as floats.
+                ufunc(*[resolve(operand) for operand in operands], out=out_array, dtype=np.int64, casting='unsafe')
+            elif step_type == 'ufunc':
+                ufunc(*[resolve(operand) for operand in operands], out=out_array)
+            elif step_type == 'copy':
+                np.copyto(out_array, resolve(operands[0]), casting='unsafe')
+            else:
+                np.copyto(out_array, resolve(operands[1]), where=resolve(operands[0]), casting='unsafe')
+
+        result = compiled_expression['result']
+        if result[0] != 'reg' or result[1] != 'num':
+            # Result is an input, a constant or a boolean, so copy it into a numeric buffer to be safe to modify.
+            result_array = get_block_buffer(buffer_dict, ('expression', 'result'), shape[0], shape[1], dtypes['num'])
+            np.copyto(result_array, resolve(result), casting='unsafe')
+        else:
+            result_array = resolve(result)
+
+        if target_nodata is not None:
+            invalid = None
+            for name in compiled_expression['used_names']:
+                nodata = nodata_dict.get(name)
+                if nodata is None:
+                    continue
+                if invalid is None:
+                    invalid = get_block_buffer(buffer_dict, ('expression', 'invalid'), shape[0], shape[1], bool)
+                    target = invalid
+                else:
+                    target = get_block_buffer(buffer_dict, ('expression', 'invalid_input'), shape[0], shape[1], bool)
+                if np.isnan(nodata):
+                    np.isnan(array_dict[name], out=target)
+                else:
+                    np.equal(array_dict[name], nodata, out=target)
+                if target is not invalid:
+                    np.logical_or(invalid, target, out=invalid)
+            if invalid is not None:
+                np.copyto(result_array, target_nodata, where=invalid, casting='unsafe')
+    return result_array
+
+
+def raster_calculator_expression(
+        expression, raster_path_band_dict, target_raster_path, datatype_target=gdal.GDT_Float32, nodata_target=-9999.,
+        constants=None, calc_dtype=np.float64, gtiff_creation_options=hb.globals.DEFAULT_GTIFF_CREATION_OPTIONS,
+        largest_block=hb.globals.LARGEST_ITERBLOCK, skip_nodata_blocks=False):
+    """Raster calculator taking an expression string rather than a local_op, eg
+
+        hb.raster_calculator_expression('where((a > 0) & (b == 0), a * c, 0)', {'a': a_path, 'b': b_path, 'c': c_path}, output_path)
+
+    raster_path_band_dict maps the names used in expression to paths (band 1) or (path, band) tuples. Inputs are read
+    directly as calc_dtype into reused buffers and the expression is evaluated with in-place ufunc chains (see
+    compile_raster_expression), so memory use per block does not grow with the number of operations. Cells where any
+    raster used is nodata are written as nodata_target. Other keyword args are passed to raster_calculator_hb.
+    """
+    raster_path_band_dict = {name: (value if hb.is_raster_path_band_formatted(value) else (value, 1)) for name, value in raster_path_band_dict.items()}
+    compiled_expression = compile_raster_expression(expression, raster_path_band_dict.keys(), constants=constants)
+    used_names = compiled_expression['used_names']
+    if not used_names:
+        raise ValueError('Raster expression ' + str(expression) + ' does not use any of the rasters ' + str(list(raster_path_band_dict.keys())))
+    nodata_dict = {name: hb.get_raster_info_hb(raster_path_band_dict[name][0])['nodata'][raster_path_band_dict[name][1] - 1] for name in used_names}
+    buffer_dict = {}
+
+    def expression_op(*arrays):
+        return evaluate_raster_expression(compiled_expression, dict(zip(used_names, arrays)), nodata_dict=nodata_dict,
+                                          target_nodata=nodata_target, buffer_dict=buffer_dict, dtype=calc_dtype)
+
+    raster_calculator_hb(
+        [raster_path_band_dict[name] for name in used_names], expression_op, target_raster_path, datatype_target, nodata_target,
+        read_datatype=gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(calc_dtype)), gtiff_creation_options=gtiff_creation_options,
+        largest_block=largest_block, skip_nodata_blocks=skip_nodata_blocks, reuse_buffers=True)
+
+
 def _invoke_timed_callback(
         reference_time, callback_lambda, callback_period):
     """Invoke callback if a certain amount of time has passed.
@@ -1303,6 +2067,12 @@ def _is_raster_path_band_formatted(raster_path_band):
         return True
 
 
+def _is_raster_source(value):
+    """Return true if value is a lazily read raster source (eg a hb.netcdf.NetcdfRasterSource) usable in place of a
+    raster band."""
+    return isinstance(value, hb.netcdf.NetcdfRasterSource)
+
+
 # def make_gdal_callback(message):
 #     """Build a timed logger callback that prints `message` replaced.
 
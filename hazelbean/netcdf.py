@@ -1,10 +1,16 @@
 import os
+import copy
+import json
+import threading
+import multiprocessing
+import concurrent.futures
 import netCDF4
 import netCDF4 as nc
 import hazelbean as hb
 import time
 import numpy as np
 import pandas as pd
+from osgeo import gdal, gdal_array, osr
 from hazelbean import config as hb_config
 
 L = hb_config.get_logger('netcdf')
@@ -19,12 +25,7 @@ def describe_netcdf(input_nc_path, just_metadata=False, return_as_string=False,
     else:
         print('\ndescribe_netcdf: ' + input_nc_path)
 
-    try:
-        ds = netCDF4.Dataset(input_nc_path, 'r')
-    except:
-        raise NameError('Unable to load netcdf at ' + input_nc_path)
-
-    metadata_dict = ds.__dict__
+    metadata_dict = get_netcdf_description_dict(input_nc_path, max_to_describe)['metadata']
     if just_metadata:
         if return_as_string:
             return_string += str(hb.print_dict(metadata_dict, return_as_string=return_as_string))
@@ -43,11 +44,69 @@ def describe_netcdf(input_nc_path, just_metadata=False, return_as_string=False,
             return
             
 
-def get_netcdf_description_dict(input_nc_path, max_dimension_load_size=2000):
+# In-process cache of netcdf descriptions keyed by (abspath, size, mtime_ns, max_dimension_load_size).
+_netcdf_description_cache = {}
+
+
+def get_netcdf_description_cache_path(input_nc_path):
+    """Path of the sidecar file holding the cached descriptions of the netcdf at input_nc_path."""
+    return str(input_nc_path) + '.description.json'
+
+
+def get_netcdf_description_dict(input_nc_path, max_dimension_load_size=2000, use_cache=True):
     # Get a nested dictionary of the contents of the netcdf file at input_nc_path.
     # Useful for iterating through the content. Different than just
     # describing it because it gives you a lookup list of the dim values
     # and dim keys.
+    # If max_dimension_load_size is None, all the values of every dimension are loaded.
+    # If use_cache, the description is kept in memory and in a json sidecar next to the file (see
+    # get_netcdf_description_cache_path and hb.encode_cache_object), both keyed by the file's size and mtime, so
+    # repeated calls, and other processes such as parallel workers, do not reopen and reparse the header and
+    # dimension values.
+    if not use_cache:
+        return _build_netcdf_description_dict(input_nc_path, max_dimension_load_size)
+
+    try:
+        stat = os.stat(input_nc_path)
+    except OSError:
+        raise NameError('Unable to load netcdf at ' + str(input_nc_path))
+    memory_key = (os.path.abspath(input_nc_path), stat.st_size, stat.st_mtime_ns, max_dimension_load_size)
+    if memory_key in _netcdf_description_cache:
+        return copy.deepcopy(_netcdf_description_cache[memory_key])
+
+    cache_path = get_netcdf_description_cache_path(input_nc_path)
+    descriptions = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cached = hb.decode_cache_object(json.load(f))
+            if cached['source_size'] == stat.st_size and cached['source_mtime_ns'] == stat.st_mtime_ns:
+                descriptions = cached['descriptions']
+        except Exception as e:
+            L.debug('Ignoring unreadable netcdf description cache ' + cache_path + ': ' + str(e))
+
+    if max_dimension_load_size in descriptions:
+        contents_dict = descriptions[max_dimension_load_size]
+    else:
+        contents_dict = _build_netcdf_description_dict(input_nc_path, max_dimension_load_size)
+        descriptions[max_dimension_load_size] = contents_dict
+        # Write to a temporary file then rename so concurrent readers never see a partial sidecar.
+        temp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(hb.encode_cache_object({'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns, 'descriptions': descriptions}), f)
+            os.replace(temp_path, cache_path)
+        except Exception as e:
+            L.debug('Unable to write netcdf description cache ' + cache_path + ': ' + str(e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    _netcdf_description_cache[memory_key] = contents_dict
+    return copy.deepcopy(contents_dict)
+
+
+def _build_netcdf_description_dict(input_nc_path, max_dimension_load_size=2000):
+    # Read the description returned by get_netcdf_description_dict from the file itself.
 
     try:
         ds = netCDF4.Dataset(input_nc_path, 'r')
@@ -72,7 +131,7 @@ def get_netcdf_description_dict(input_nc_path, max_dimension_load_size=2000):
                 if not attr.startswith('_') and attr not in attributes_to_skip:
                     contents_dict['dims'][k][attr] = getattr(dim_as_variable, attr)
 
-            if v.size < max_dimension_load_size:
+            if max_dimension_load_size is None or v.size < max_dimension_load_size:
                 contents_dict['dims'][k]['values'] = dim_as_variable[:]
                 contents_dict['dims'][k]['index_value_lookup'] = dict(zip(range(len(v)), contents_dict['dims'][k]['values']))
             else:
@@ -89,6 +148,7 @@ def get_netcdf_description_dict(input_nc_path, max_dimension_load_size=2000):
                 if not attr.startswith('_') and attr not in attributes_to_skip:
                     contents_dict['vars'][k][attr] = getattr(v, attr)
 
+    ds.close()
     return contents_dict
 
 
@@ -114,6 +174,282 @@ def get_netcdf_writable_vars_from_description_dict(description_dict):
 
     
     return possible_extract_dims, possible_vars
+def get_netcdf_chunk_shape(var):
+    """Return the on-disk chunk shape of a netCDF4 variable, treating contiguous storage as one chunk per leading
+    index with whole 2D slices (which is how contiguous data is laid out)."""
+    chunking = var.chunking()
+    if chunking is None or chunking == 'contiguous':
+        return [1] * (len(var.shape) - 2) + list(var.shape[-2:])
+    return [int(i) for i in chunking]
+
+
+def plan_netcdf_slice_reads(var_shape, chunk_shape, leading_index_list, itemsize, max_read_bytes=2 ** 28):
+    """Plan chunk-aligned reads of the 2D slices of a variable at each tuple in leading_index_list (indices of all but
+    the last two dims).
+
+    Slices whose leading indices fall in the same on-disk chunk are grouped so the chunk is decompressed once for all of
+    them, and each group is read as strips of whole chunk rows small enough to keep a read under max_read_bytes.
+    Returns a list of dicts with 'leading_slices' (slices over the leading dims bounding the group), 'members' (positions
+    in leading_index_list) and 'row_strips' ((start, stop) row ranges).
+    """
+    leading_chunk_shape = chunk_shape[:-2]
+    n_rows, n_cols = var_shape[-2:]
+    row_chunk = max(1, int(chunk_shape[-2]))
+    groups = {}
+    for position, leading_index in enumerate(leading_index_list):
+        key = tuple(int(i) // int(c) for i, c in zip(leading_index, leading_chunk_shape))
+        groups.setdefault(key, []).append(position)
+
+    plan = []
+    for key in sorted(groups):
+        members = groups[key]
+        member_indices = np.asarray([leading_index_list[i] for i in members], dtype=np.int64).reshape(len(members), -1)
+        leading_slices = [slice(int(member_indices[:, dim].min()), int(member_indices[:, dim].max()) + 1) for dim in range(member_indices.shape[1])]
+        depth = int(np.prod([s.stop - s.start for s in leading_slices])) if leading_slices else 1
+        rows_per_strip = int(max_read_bytes // max(1, depth * n_cols * itemsize))
+        rows_per_strip = max(row_chunk, rows_per_strip // row_chunk * row_chunk)
+        row_strips = [(row_start, min(row_start + rows_per_strip, n_rows)) for row_start in range(0, n_rows, rows_per_strip)]
+        plan.append({'leading_slices': leading_slices, 'members': members, 'row_strips': row_strips})
+    return plan
+
+
+def _get_netcdf_var_fill_value(var):
+    fill_value = None
+    if '_FillValue' in var.__dict__:
+        fill_value = var.__dict__['_FillValue']
+    if 'missing_value' in var.__dict__:
+        fill_value = var.__dict__['missing_value']
+    return fill_value
+
+
+def _netcdf_slice_to_output_array(array, fill_value, ndv, invalid_above=None):
+    # Masked values come back filled with the fill value, so mapping fill_value to ndv handles both.
+    array = np.array(array)
+    if fill_value is not None:
+        array = np.where(array == fill_value, ndv, array)
+    if invalid_above is not None:
+        array = np.where(array > invalid_above, ndv, array)
+    return array
+
+
+def get_gdal_data_type_for_netcdf_var(var_dtype, ndv=None):
+    """GDAL data type for geotiffs of a netcdf variable of numpy type var_dtype, widened if needed so that ndv fits (eg
+    Int16 for a uint8 variable with an ndv of -9999). Float64 if GDAL has no equivalent type."""
+    dtype = np.dtype(var_dtype)
+    if ndv is not None:
+        if dtype.kind in 'iu':
+            if float(ndv).is_integer():
+                dtype = np.result_type(dtype, np.min_scalar_type(int(ndv)))
+            else:
+                dtype = np.dtype(np.float64)
+        elif dtype.kind == 'f':
+            with np.errstate(over='ignore'):
+                if float(dtype.type(ndv)) != float(ndv) and not np.isnan(ndv):
+                    dtype = np.dtype(np.float64)
+    data_type = gdal_array.NumericTypeCodeToGDALTypeCode(dtype)
+    return data_type if data_type is not None else gdal.GDT_Float64
+
+
+def extract_netcdf_slices_to_geotiffs(input_nc_path, slice_job_list, geotransform=None, projection=4326, ndv=-9999, data_type=7,
+                                      skip_if_exists=False, invalid_above=None, n_writer_threads=None, max_read_bytes=2 ** 28,
+                                      gtiff_creation_options=None):
+    """Write many 2D slices of netcdf variables to geotiffs, reading according to each variable's chunk layout.
+
+    slice_job_list is a list of (var_name, leading_index_tuple, output_path), where leading_index_tuple holds the indices
+    of all dims except the last two (eg (time_index,) for a (time, lat, lon) variable). Jobs with an existing output are
+    dropped before anything is read if skip_if_exists. The rest are grouped by on-disk chunk (see
+    plan_netcdf_slice_reads) so every chunk is decompressed once, and the strips read are written to the open output
+    geotiffs by a pool of writer threads (GDAL compresses outside the GIL) while the next strip is read. Reads happen on
+    the calling thread because the netCDF library is not thread safe.
+
+    If geotransform is None it is derived, as elsewhere in this module, assuming a global grid with the resolution
+    given by the lon dimension. If data_type is None each variable keeps its own type (see
+    get_gdal_data_type_for_netcdf_var).
+    """
+    if skip_if_exists:
+        skipped = [job for job in slice_job_list if hb.path_exists(job[2])]
+        if skipped:
+            L.info('Skipping ' + str(len(skipped)) + ' netcdf slices whose outputs already exist.')
+        slice_job_list = [job for job in slice_job_list if not hb.path_exists(job[2])]
+    if len(slice_job_list) == 0:
+        return []
+
+    if gtiff_creation_options is None:
+        gtiff_creation_options = hb.DEFAULT_GTIFF_CREATION_OPTIONS
+    if n_writer_threads is None:
+        n_writer_threads = multiprocessing.cpu_count()
+    srs = osr.SpatialReference()
+    if isinstance(projection, int):
+        srs.ImportFromEPSG(projection)
+        projection_wkt = srs.ExportToWkt()
+    else:
+        projection_wkt = projection
+
+    jobs_by_var = {}
+    for job in slice_job_list:
+        jobs_by_var.setdefault(job[0], []).append(job)
+
+    written_paths = []
+    with netCDF4.Dataset(input_nc_path, 'r') as ds, concurrent.futures.ThreadPoolExecutor(max_workers=n_writer_threads) as executor:
+        if geotransform is None:
+            res = (360.0) / len(ds.variables['lon'])
+            geotransform = [-180.0, res, 0.0, 90.0, 0.0, -1 * res]
+
+        for var_name, jobs in jobs_by_var.items():
+            var = ds.variables[var_name]
+            n_rows, n_cols = var.shape[-2:]
+            var_data_type = data_type if data_type is not None else get_gdal_data_type_for_netcdf_var(var.dtype, ndv)
+            fill_value = _get_netcdf_var_fill_value(var)
+            leading_index_list = [tuple(int(i) for i in job[1]) for job in jobs]
+            plan = plan_netcdf_slice_reads(var.shape, get_netcdf_chunk_shape(var), leading_index_list, var.dtype.itemsize, max_read_bytes=max_read_bytes)
+
+            for group in plan:
+                output_bands = {}
+                output_datasets = {}
+                for position in group['members']:
+                    output_path = jobs[position][2]
+                    hb.create_directories(output_path)
+                    output_ds = gdal.GetDriverByName('GTiff').Create(output_path, n_cols, n_rows, 1, var_data_type, gtiff_creation_options)
+                    output_ds.SetGeoTransform(geotransform)
+                    output_ds.SetProjection(projection_wkt)
+                    output_ds.GetRasterBand(1).SetNoDataValue(ndv)
+                    output_datasets[position] = output_ds
+                    output_bands[position] = output_ds.GetRasterBand(1)
+
+                pending = []
+                for row_start, row_stop in group['row_strips']:
+                    strip = var[tuple(group['leading_slices']) + (slice(row_start, row_stop), slice(None))]
+                    # Wait for the previous strip's writes so at most two strips are in memory.
+                    for future in pending:
+                        future.result()
+                    pending = []
+                    for position in group['members']:
+                        member_index = tuple(i - s.start for i, s in zip(leading_index_list[position], group['leading_slices']))
+
+                        def write_strip(band=output_bands[position], array=strip[member_index], row_start=row_start):
+                            band.WriteArray(_netcdf_slice_to_output_array(array, fill_value, ndv, invalid_above), 0, row_start)
+
+                        pending.append(executor.submit(write_strip))
+                for future in pending:
+                    future.result()
+
+                for position in group['members']:
+                    output_bands[position].FlushCache()
+                    output_bands[position] = None
+                    output_datasets[position] = None
+                    written_paths.append(jobs[position][2])
+    return written_paths
+
+
+class NetcdfRasterSource(object):
+    """A 2D slice (var_name at leading_index, the indices of all but the last two dims) of a netcdf file presented like a
+    single GDAL band, so block operations can read it directly instead of extracting it to a geotiff first.
+
+    It has the band methods the block engine uses (ReadAsArray with windows, buf_obj and buf_type, GetNoDataValue,
+    GetBlockSize, DataType, XSize and YSize), and get_raster_info returns the same dict as hb.get_raster_info_hb.
+    raster_calculator_hb, zonal_statistics_rasterized and load_geotiff_chunk_by_bb (and thus RegressionFrame loading)
+    accept it in place of a path. Rows are in file order. Unless given, the geotransform and projection are taken from
+    the GeoTransform and spatial_ref of the variable's grid_mapping variable (as written by GDAL and
+    stack_geotiffs_to_netcdf) if it has one, otherwise, as in extract_global_netcdf, a global EPSG:4326 grid is assumed.
+    Values equal to the variable's fill value (or above invalid_above) are read as ndv. Reads are serialized with a lock
+    because the netCDF library is not thread safe.
+    """
+    _read_lock = threading.Lock()
+
+    def __init__(self, nc_path, var_name, leading_index=(), geotransform=None, projection=None, ndv=-9999., invalid_above=None):
+        self.nc_path = nc_path
+        self.var_name = var_name
+        self.leading_index = tuple(int(i) for i in np.atleast_1d(leading_index))
+        self.ndv = ndv
+        self.invalid_above = invalid_above
+        self._ds = netCDF4.Dataset(nc_path, 'r')
+        self._var = self._ds.variables[var_name]
+        if len(self.leading_index) != len(self._var.shape) - 2:
+            raise ValueError('leading_index ' + str(self.leading_index) + ' does not select a 2D slice of ' + var_name + ' with dimensions ' + str(self._var.dimensions))
+        self.YSize, self.XSize = [int(i) for i in self._var.shape[-2:]]
+        self.fill_value = _get_netcdf_var_fill_value(self._var)
+        self.DataType = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(self._var.dtype))
+
+        grid_mapping = None
+        if 'grid_mapping' in self._var.ncattrs() and self._var.grid_mapping in self._ds.variables:
+            grid_mapping = self._ds.variables[self._var.grid_mapping]
+        if geotransform is None:
+            if grid_mapping is not None and 'GeoTransform' in grid_mapping.ncattrs():
+                geotransform = [float(i) for i in str(grid_mapping.GeoTransform).split()]
+            else:
+                res = (360.0) / len(self._ds.variables['lon'])
+                geotransform = [-180.0, res, 0.0, 90.0, 0.0, -1 * res]
+        self.geotransform = list(geotransform)
+        if projection is None:
+            if grid_mapping is not None and 'spatial_ref' in grid_mapping.ncattrs():
+                projection = str(grid_mapping.spatial_ref)
+            else:
+                projection = 4326
+        if isinstance(projection, int):
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(projection)
+            projection = srs.ExportToWkt()
+        self.projection = projection
+
+    def __repr__(self):
+        return 'NetcdfRasterSource(' + str(self.nc_path) + ', ' + str(self.var_name) + ', ' + str(self.leading_index) + ')'
+
+    def GetNoDataValue(self):
+        return self.ndv
+
+    def GetBlockSize(self):
+        chunk_shape = get_netcdf_chunk_shape(self._var)
+        return [int(chunk_shape[-1]), int(chunk_shape[-2])]
+
+    def ReadAsArray(self, xoff=0, yoff=0, win_xsize=None, win_ysize=None, buf_obj=None, buf_type=None, **kwargs):
+        if win_xsize is None:
+            win_xsize = self.XSize - xoff
+        if win_ysize is None:
+            win_ysize = self.YSize - yoff
+        with self._read_lock:
+            array = self._var[self.leading_index + (slice(yoff, yoff + win_ysize), slice(xoff, xoff + win_xsize))]
+        array = _netcdf_slice_to_output_array(array, self.fill_value, self.ndv, self.invalid_above)
+        if buf_obj is not None:
+            np.copyto(buf_obj, array, casting='unsafe')
+            return buf_obj
+        if buf_type is not None:
+            array = array.astype(gdal_array.GDALTypeCodeToNumericTypeCode(buf_type))
+        return array
+
+    def get_raster_info(self):
+        """Raster info dict in the form of hb.get_raster_info_hb."""
+        return {
+            'raster_size': (self.XSize, self.YSize),
+            'n_bands': 1,
+            'nodata': [self.ndv],
+            'datatype': self.DataType,
+            'geotransform': self.geotransform,
+            'pixel_size': (self.geotransform[1], self.geotransform[5]),
+            'projection': self.projection,
+            'ndv': self.ndv,
+            'data_type': self.DataType,
+            'size': self.XSize * self.YSize,
+            'shape': (self.YSize, self.XSize),
+            'block_size': self.GetBlockSize(),
+            'bounding_box': [self.geotransform[0], self.geotransform[3] + self.geotransform[5] * self.YSize,
+                             self.geotransform[0] + self.geotransform[1] * self.XSize, self.geotransform[3]],
+        }
+
+    def bb_to_cr_size(self, bb):
+        """Column, row, n_cols, n_rows of the cells whose centroids are within bb (xmin, ymin, xmax, ymax)."""
+        c = int(round((bb[0] - self.geotransform[0]) / self.geotransform[1]))
+        r = int(round((bb[3] - self.geotransform[3]) / self.geotransform[5]))
+        c_right = int(round((bb[2] - self.geotransform[0]) / self.geotransform[1]))
+        r_bottom = int(round((bb[1] - self.geotransform[3]) / self.geotransform[5]))
+        return c, r, c_right - c, r_bottom - r
+
+    def close(self):
+        if self._ds is not None:
+            self._ds.close()
+            self._ds = None
+            self._var = None
+
+
 def extract_global_netcdf_to_geotiffs(input_nc_path,
                                      output_dir,
                                      vars_to_extract=None,
@@ -235,6 +571,7 @@ def extract_global_netcdf(
     only_report_names=False,
     skip_if_exists=False,
     verbose=False,    
+    n_writer_threads=None,
     ):
     # Full-featured extraction of a global netcdf file. By default extracts everything.
     # Adjustment_dict can adjust a numeric variable by a constant or a multiplier. 
@@ -251,22 +588,20 @@ def extract_global_netcdf(
     #     'lc_class': [1, 2],
     #     'time': [2030, 2040],
     # }
+    # Walking the dims only collects the slices to write. They are then read chunk by chunk and written by
+    # n_writer_threads in extract_netcdf_slices_to_geotiffs.
 
 
-    try:
-        ds = netCDF4.Dataset(input_nc_path, 'r')
-    except:
-        raise NameError('Unable to load netcdf at ' + input_nc_path)
-    L.debug('Loaded nc file ', input_nc_path)
-
+    # The (cached) description holds everything needed to plan the extraction, so the file itself is only opened
+    # to read the slices. All dimension values are loaded (not just the first 2000) so no slices are skipped.
+    nc_dict = get_netcdf_description_dict(input_nc_path, None)
+    L.debug('Loaded nc file description ', input_nc_path)
 
     # Derive geotransform based on calculated resolution from size of longitude index.
-    res = (360.0) / len(ds.variables['lon'])
+    res = (360.0) / nc_dict['dims']['lon']['size']
     geotransform = [-180.0, res, 0.0, 90.0, 0.0, -1 * res]
     projection = 'wgs84'
 
-    nc_dict = get_netcdf_description_dict(input_nc_path, 2000)
-
     extraction_dims, vars = get_netcdf_writable_vars_from_description_dict(nc_dict)
 
     if verbose:        
@@ -311,8 +646,7 @@ def extract_global_netcdf(
                                 adjusted_dim_value /= int(op[1:])                  
 
                         # Make a copy of the dim values to modify
-                        dim_as_var = ds.variables[current_dim_name]
-                        dim_values_present = list(np.array(dim_as_var[:]))
+                        dim_values_present = list(np.array(nc_dict['dims'][current_dim_name]['values']))
                         current_adjusted_dim_values_to_extract = dim_values_present.copy()
 
                         # adjusted_dim_value = dim_value
@@ -366,8 +700,7 @@ def extract_global_netcdf(
                                 adjusted_dim_value /= int(op[6:])              
 
                         # Make a copy of the dim values to modify
-                        dim_as_var = ds.variables[current_dim_name]
-                        dim_values_present = list(np.array(dim_as_var[:]))
+                        dim_values_present = list(np.array(nc_dict['dims'][current_dim_name]['values']))
                         current_adjusted_dim_values_to_extract = dim_values_present.copy()
 
                         # adjusted_dim_value = dim_value
@@ -422,48 +755,14 @@ def extract_global_netcdf(
                             do_it = True
 
                         if do_it:
-                            var = ds.variables[var_name]             
-
-                            # Important optimization note: 
-                            # array = np.array(var[packed_dims[0], :]) is about 100x as fast as array = np.array(var)[packed_dims[0], :]     
-                            # because it more efficiently slices and odesn't have to convert the whole masked array in the nc to
-                            # a numpy array.
-                            if len(packed_dims) == 1:   
-                                array = np.array(var[packed_dims[0], :])
-                            elif len(packed_dims) == 2:
-                                array = np.array(var[packed_dims[0], packed_dims[1], :]  ) 
-                            elif len(packed_dims) == 3:
-                                array = np.array(var[packed_dims[0], packed_dims[1], packed_dims[2] :]  ) 
-                            elif len(packed_dims) == 4:
-                                array = np.array(var[packed_dims[0], packed_dims[1], packed_dims[2], packed_dims[3], :])   
-                            elif len(packed_dims) == 5:
-                                array = np.array(var[packed_dims[0], packed_dims[1], packed_dims[2], packed_dims[3], packed_dims[4], :]   )
-                            elif len(packed_dims) == 6:
-                                array = np.array(var[packed_dims[0], packed_dims[1], packed_dims[2], packed_dims[3], packed_dims[4], packed_dims[5], :]  ) 
-                            elif len(packed_dims) == 7:
-                                array = np.array(var[packed_dims[0], packed_dims[1], packed_dims[2], packed_dims[3], packed_dims[4], packed_dims[5], packed_dims[6], :]  ) 
-
-
-                            fill_value = None
-                            if '_FillValue' in var.__dict__:
-                                fill_value = var.__dict__['_FillValue']
-                            if 'missing_value' in var.__dict__:
-                                fill_value = var.__dict__['missing_value']
-
-                            if ndv is None:
-                                ndv = -9999
-                            if fill_value is not None:
-                                array = np.where(array == fill_value, ndv, array)
-
-
                             if verbose:
-                                L.info('Writing to ', output_geotiff_path)
-                            hb.save_array_as_geotiff(array, output_geotiff_path, ndv=ndv, data_type=7, compress=True, n_cols=array.shape[1], n_rows=array.shape[0],
-                                                    geotransform_override=geotransform, projection_override=projection)
+                                L.info('Planning write to ', output_geotiff_path)
+                            slice_job_list.append((var_name, tuple(int(i) for i in packed_dims), output_geotiff_path))
         else:
             L.debug('Current var is less than 3 dimensions. Skipping. Current dim name: ' + str(current_dim_name))            
 
 
+    slice_job_list = []
     for var_name in vars:
         dim_names_for_this_var = nc_dict['vars'][var_name]['dimensions']
         preceding_dirs = [''] * (len(dim_names_for_this_var) - 2)
@@ -473,6 +772,10 @@ def extract_global_netcdf(
         packed_dims = [''] * (len(dim_names_for_this_var) - 2)
         walk_var_dims(var_name, filter_dict, preceding_dirs=preceding_dirs, packed_dims=packed_dims, output_dir=output_dir, ndv=ndv, skip_if_exists=skip_if_exists)
 
+    if ndv is None:
+        ndv = -9999
+    extract_netcdf_slices_to_geotiffs(input_nc_path, slice_job_list, geotransform=geotransform, ndv=ndv, data_type=7, n_writer_threads=n_writer_threads)
+
 
 def extract_netcdf_to_geotiffs(input_nc_path, output_dir, vars_to_extract=None, var_rename_dict=None, time_indices_to_extract=None, time_rename_op=None, ndv=None, data_type=None, return_only_proposed_filenames=False, verbose=True):
     # NYI, need to incorporate changes in extract_global_netcdf_to_geotiff
@@ -525,6 +828,7 @@ def extract_netcdf_to_geotiffs(input_nc_path, output_dir, vars_to_extract=None,
     geotransform = [-180.0, res, 0.0, 90.0, 0.0, -1 * res]
     projection = 'wgs84'
     proposed_filenames = []
+    slice_job_list = []
 
     for var_name, var in ds.variables.items():
         if vars_to_extract is not None:
@@ -564,20 +868,13 @@ def extract_netcdf_to_geotiffs(input_nc_path, output_dir, vars_to_extract=None,
                     if hb.path_exists(output_geotiff_path):
                         L.info(output_geotiff_path + ' already exists so netcdf_to_geotiffs() skipped it.')
                     else:
-                        array = np.array(var[time_index])
-                        fill_value = None
-                        if '_FillValue' in var.__dict__:
-                            fill_value = var.__dict__['_FillValue']
-                        if 'missing_value' in var.__dict__:
-                            fill_value = var.__dict__['missing_value']
+                        slice_job_list.append((var_name, (time_index,), output_geotiff_path))
 
-                        if ndv is None:
-                            ndv = -9999
-                        if fill_value is not None:
-                            array = np.where(array == fill_value, ndv, array)
-
-                        hb.save_array_as_geotiff(array, output_geotiff_path, ndv=ndv, data_type=data_type, compress=True, n_cols=array.shape[1], n_rows=array.shape[0],
-                                                 geotransform_override=geotransform, projection_override=projection)
+    ds.close()
+    if len(slice_job_list) > 0:
+        if ndv is None:
+            ndv = -9999
+        extract_netcdf_slices_to_geotiffs(input_nc_path, slice_job_list, geotransform=geotransform, ndv=ndv, data_type=data_type)
 
     return proposed_filenames
 
@@ -611,6 +908,7 @@ def extract_luh_netcdf_to_geotiffs(input_nc_uri, output_dir, dim_selection_indic
     geotransform = [-180.0, res, 0.0, 90.0, 0.0, -1 * res]
     projection = 'wgs84'
 
+    slice_job_list = []
     for var_name, var in ncfile.variables.items():
         if 'standard_name' in var.__dict__:
             var_string = str(var_name)
@@ -620,14 +918,13 @@ def extract_luh_netcdf_to_geotiffs(input_nc_uri, output_dir, dim_selection_indic
 
             if var_name not in dim_names:
                 # BROKEN, this wouldn't work with other dim_selection_indices schemes.
-                array = var[:][dim_selection_indices[0]]
-
-                no_data_value = -9999
-                array = np.where(array > 1E19, no_data_value, array)
-
                 output_geotiff_path = os.path.join(output_dir, var_string + '.tif')
-                hb.save_array_as_geotiff(array, output_geotiff_path, ndv=no_data_value, data_type=7, compress=True, n_cols=array.shape[1], n_rows=array.shape[0],
-                                         geotransform_override=geotransform, projection_override=projection)
+                slice_job_list.append((var_name, (dim_selection_indices[0],), output_geotiff_path))
+    ncfile.close()
+
+    # Reads only the selected slice (rather than var[:]) and writes all vars in parallel.
+    no_data_value = -9999
+    extract_netcdf_slices_to_geotiffs(input_nc_uri, slice_job_list, geotransform=geotransform, ndv=no_data_value, data_type=7, invalid_above=1E19)
 
                 # output_geotiff_rp_uri = hb.suri(output_geotiff_path, 'eck')
                 # wkt = hb.get_wkt_from_epsg_code(54012)
@@ -640,11 +937,9 @@ def get_cell_size_from_nc_path(input_path):
     hb.assert_path_is_gdal_readable(input_path)
 
     if input_path.endswith('.nc'):
-        ds = netCDF4.Dataset(input_path, 'r')
         dims_dict = {}
-        dim_names = ds.dimensions.keys()
-        for dim_name in dim_names:
-            dims_dict[ds.dimensions[dim_name].name] = ds.dimensions[dim_name].size
+        for dim_name, dim_dict in get_netcdf_description_dict(input_path)['dims'].items():
+            dims_dict[dim_dict['name']] = dim_dict['size']
 
         if 'lat' in dims_dict:
             return 180. / float(dims_dict['lat'])
@@ -654,9 +949,154 @@ def get_cell_size_from_nc_path(input_path):
     else:
         raise NameError('Didnt read the path correctly, it should end in .nc')
 
-def write_geotiff_as_netcdf(input_path, output_path):
+def get_netcdf_stack_chunk_shape(n_layers, n_rows, n_cols, itemsize, target_chunk_bytes=2 ** 20):
+    """Chunk shape (layers, rows, cols) of about target_chunk_bytes for a stack of n_layers maps, balanced so that
+    reading one cell's full series and reading one whole map touch about the same number of chunks.
 
-    return 1
+    With C cells per chunk and depth d, a series read touches n_layers / d chunks and a map read touches
+    n_rows * n_cols * d / C, which are equal for d = sqrt(n_layers * C / (n_rows * n_cols)). The remaining C / d cells
+    are split between rows and cols in proportion to the map's shape.
+    """
+    n_chunk_cells = max(1, int(target_chunk_bytes // itemsize))
+    depth = int(round(np.sqrt(float(n_layers) * n_chunk_cells / (float(n_rows) * n_cols))))
+    depth = min(max(depth, 1), n_layers)
+    n_tile_cells = max(1, n_chunk_cells // depth)
+    tile_rows = int(round(np.sqrt(n_tile_cells * float(n_rows) / n_cols)))
+    tile_rows = min(max(tile_rows, 1), n_rows)
+    tile_cols = min(max(n_tile_cells // tile_rows, 1), n_cols)
+    return [depth, tile_rows, tile_cols]
+
+
+def stack_geotiffs_to_netcdf(input_paths, output_path, var_name='stack', stack_dim_name='layer', stack_dim_values=None,
+                             chunk_shape=None, complevel=4, n_reader_threads=None, max_block_bytes=2 ** 27,
+                             target_chunk_bytes=2 ** 20, global_attributes=None, variable_attributes=None):
+    """Stack aligned single band geotiffs into the chunked, compressed 3D netcdf4 variable var_name with dimensions
+    (stack_dim_name, lat, lon), or (stack_dim_name, y, x) if the rasters are not geographic. If stack_dim_name is None,
+    input_paths must hold one raster and the variable is 2D.
+
+    stack_dim_values (eg years or crop names) become the coordinate variable of the new dimension, defaulting to
+    0..n-1. Coordinates of the map dimensions are cell centers from the geotransform, rows stay in the rasters'
+    north-first order, and the geotransform and projection are also written to a 'crs' grid mapping variable (as GDAL
+    does) so hb.netcdf.NetcdfRasterSource or GDAL can read it back with the same extent. The nodata value of the first raster becomes the
+    _FillValue.
+
+    chunk_shape defaults to get_netcdf_stack_chunk_shape. The stack is written one chunk-deep group of layers at a time,
+    in row strips of whole chunks holding at most max_block_bytes, so each chunk is compressed exactly once and memory
+    does not grow with the number of layers. Strips are read by a pool of n_reader_threads (each with its own GDAL
+    handles) while the previous strip is written, because the netCDF library itself is not thread safe.
+    """
+    input_paths = list(input_paths)
+    if len(input_paths) == 0:
+        raise NameError('No rasters given to stack_geotiffs_to_netcdf.')
+    if stack_dim_name is None and len(input_paths) != 1:
+        raise NameError('stack_dim_name can only be None when writing a single raster, got ' + str(len(input_paths)))
+    if stack_dim_values is not None and len(stack_dim_values) != len(input_paths):
+        raise NameError('stack_dim_values has ' + str(len(stack_dim_values)) + ' values for ' + str(len(input_paths)) + ' rasters.')
+
+    first_info = hb.get_raster_info_hb(input_paths[0])
+    for path in input_paths[1:]:
+        if hb.get_raster_info_hb(path)['raster_size'] != first_info['raster_size']:
+            raise NameError('Rasters given to stack_geotiffs_to_netcdf are not aligned: ' + str(path) + ' does not have the shape of ' + str(input_paths[0]))
+    n_cols, n_rows = first_info['raster_size']
+    n_layers = len(input_paths)
+    gt = first_info['geotransform']
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(first_info['datatype']))
+    ndv = first_info['nodata'][0]
+
+    if chunk_shape is None:
+        chunk_shape = get_netcdf_stack_chunk_shape(n_layers, n_rows, n_cols, dtype.itemsize, target_chunk_bytes=target_chunk_bytes)
+    if stack_dim_name is None:
+        chunk_shape = [1] + list(chunk_shape[-2:])
+    depth, tile_rows, tile_cols = [int(i) for i in chunk_shape]
+
+    # Row strips of whole chunks, as tall as max_block_bytes allows for one chunk-deep group of layers.
+    strip_rows = max(1, int(max_block_bytes // (depth * tile_rows * n_cols * dtype.itemsize))) * tile_rows
+    row_strips = [(row_start, min(row_start + strip_rows, n_rows)) for row_start in range(0, n_rows, strip_rows)]
+
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(first_info['projection'])
+    if srs.IsGeographic():
+        y_dim_name, x_dim_name = 'lat', 'lon'
+    else:
+        y_dim_name, x_dim_name = 'y', 'x'
+
+    if n_reader_threads is None:
+        n_reader_threads = multiprocessing.cpu_count()
+    thread_local = threading.local()
+
+    def read_strip(layer_index, row_start, row_stop):
+        # Each reader thread keeps its own handles because GDAL datasets cannot be shared across threads.
+        if not hasattr(thread_local, 'bands'):
+            thread_local.datasets = {}
+            thread_local.bands = {}
+        if layer_index not in thread_local.bands:
+            thread_local.datasets[layer_index] = gdal.OpenEx(input_paths[layer_index], gdal.OF_RASTER)
+            thread_local.bands[layer_index] = thread_local.datasets[layer_index].GetRasterBand(1)
+        return thread_local.bands[layer_index].ReadAsArray(0, row_start, n_cols, row_stop - row_start)
+
+    hb.create_directories(output_path)
+    with netCDF4.Dataset(output_path, 'w', format='NETCDF4') as ds, concurrent.futures.ThreadPoolExecutor(max_workers=n_reader_threads) as executor:
+        if global_attributes is not None:
+            ds.setncatts(dict(global_attributes))
+        ds.createDimension(y_dim_name, n_rows)
+        ds.createDimension(x_dim_name, n_cols)
+        ds.createVariable(y_dim_name, 'f8', (y_dim_name,))[:] = gt[3] + (np.arange(n_rows) + 0.5) * gt[5]
+        ds.createVariable(x_dim_name, 'f8', (x_dim_name,))[:] = gt[0] + (np.arange(n_cols) + 0.5) * gt[1]
+        crs_var = ds.createVariable('crs', 'i4')
+        crs_var.spatial_ref = first_info['projection']
+        crs_var.GeoTransform = ' '.join(str(i) for i in gt)
+
+        if stack_dim_name is None:
+            dimensions = (y_dim_name, x_dim_name)
+            chunksizes = (tile_rows, tile_cols)
+        else:
+            dimensions = (stack_dim_name, y_dim_name, x_dim_name)
+            chunksizes = (depth, tile_rows, tile_cols)
+            ds.createDimension(stack_dim_name, n_layers)
+            if stack_dim_values is None:
+                stack_dim_values = np.arange(n_layers)
+            if all(isinstance(i, str) for i in stack_dim_values):
+                stack_var = ds.createVariable(stack_dim_name, str, (stack_dim_name,))
+                for i, value in enumerate(stack_dim_values):
+                    stack_var[i] = value
+            else:
+                stack_dim_values = np.asarray(stack_dim_values)
+                ds.createVariable(stack_dim_name, stack_dim_values.dtype, (stack_dim_name,))[:] = stack_dim_values
+
+        var = ds.createVariable(var_name, dtype, dimensions, zlib=complevel > 0, complevel=max(complevel, 1), shuffle=True,
+                                chunksizes=chunksizes, fill_value=ndv)
+        var.grid_mapping = 'crs'
+        # Values are written as read; _FillValue marks nodata, so no masking or scaling is applied on write.
+        var.set_auto_maskandscale(False)
+        if variable_attributes is not None:
+            var.setncatts(dict(variable_attributes))
+
+        strip_jobs = [(layer_start, min(layer_start + depth, n_layers), row_start, row_stop)
+                      for layer_start in range(0, n_layers, depth) for row_start, row_stop in row_strips]
+
+        def submit_reads(job):
+            return [executor.submit(read_strip, layer_index, job[2], job[3]) for layer_index in range(job[0], job[1])]
+
+        pending = submit_reads(strip_jobs[0])
+        for job_index, job in enumerate(strip_jobs):
+            arrays = [future.result() for future in pending]
+            # Read the next strip while this one is compressed and written.
+            pending = submit_reads(strip_jobs[job_index + 1]) if job_index + 1 < len(strip_jobs) else []
+            if stack_dim_name is None:
+                var[job[2]: job[3], :] = arrays[0]
+            else:
+                var[job[0]: job[1], job[2]: job[3], :] = np.stack(arrays)
+            arrays = None
+            L.debug('stack_geotiffs_to_netcdf wrote layers ' + str(job[0]) + '-' + str(job[1]) + ', rows ' + str(job[2]) + '-' + str(job[3]) + ' of ' + str(output_path))
+    return output_path
+
+
+def write_geotiff_as_netcdf(input_path, output_path, var_name=None, **kwargs):
+    """Write the geotiff at input_path as a 2D chunked, compressed netcdf variable (named after the file by default),
+    streaming it through stack_geotiffs_to_netcdf rather than loading it whole."""
+    if var_name is None:
+        var_name = os.path.splitext(os.path.split(input_path)[1])[0]
+    return stack_geotiffs_to_netcdf([input_path], output_path, var_name=var_name, stack_dim_name=None, **kwargs)
 
 def load_netcdf_as_array(input_path):
     nc_fid = netCDF4.Dataset(input_path, 'r')  # Dataset is the class behavior to open the file
@@ -772,9 +1212,35 @@ def show_netcdf(input_path):
     plt.show()
 
 
-def compress_netcdf(input_path, output_path):
+def _copy_netcdf_variable_in_slabs(src_var, trg_var, max_read_bytes=2 ** 27):
+    """Copy src_var to trg_var in slabs along its first dimension (and its second if a single index of the first is
+    already too large) of at most about max_read_bytes, aligned to src_var's chunks, rather than loading it whole."""
+    if len(src_var.shape) == 0:
+        trg_var.assignValue(src_var.getValue())
+        return
+    if len(src_var.shape) == 1 or not isinstance(src_var.dtype, np.dtype):
+        trg_var[:] = src_var[:]
+        return
+    chunking = src_var.chunking()
+    chunk_shape = [1] * len(src_var.shape) if chunking is None or chunking == 'contiguous' else [int(i) for i in chunking]
+    index_bytes = src_var.dtype.itemsize * int(np.prod(src_var.shape[1:]))
+    if index_bytes * chunk_shape[0] <= max_read_bytes:
+        step = max(1, int(max_read_bytes // (index_bytes * chunk_shape[0]))) * chunk_shape[0]
+        for start in range(0, src_var.shape[0], step):
+            trg_var[start: start + step] = src_var[start: start + step]
+    else:
+        row_bytes = src_var.dtype.itemsize * int(np.prod(src_var.shape[2:])) * chunk_shape[0]
+        row_step = max(1, int(max_read_bytes // (row_bytes * chunk_shape[1]))) * chunk_shape[1]
+        for start in range(0, src_var.shape[0], chunk_shape[0]):
+            for row_start in range(0, src_var.shape[1], row_step):
+                index = (slice(start, start + chunk_shape[0]), slice(row_start, row_start + row_step))
+                trg_var[index] = src_var[index]
 
 
+def compress_netcdf(input_path, output_path, complevel=4, max_read_bytes=2 ** 27):
+    """Copy the netcdf at input_path to output_path with every variable zlib compressed, keeping its chunk layout and
+    copying in chunk-aligned slabs (see _copy_netcdf_variable_in_slabs) so memory does not scale with the file."""
+
     src = nc.Dataset(input_path)
     trg = nc.Dataset(output_path, mode='w')
 
@@ -787,128 +1253,38 @@ def compress_netcdf(input_path, output_path):
 
     # Create the variables in the file
     for name, var in src.variables.items():
-        trg.createVariable(name, var.dtype, var.dimensions, zlib=True)
+        var.set_auto_maskandscale(False)
+        chunking = var.chunking()
+        chunksizes = None if chunking is None or chunking == 'contiguous' else chunking
+        # _FillValue can only be set when the variable is created.
+        fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+        trg.createVariable(name, var.datatype, var.dimensions, zlib=True, complevel=complevel, chunksizes=chunksizes, fill_value=fill_value)
 
         # Copy the variable attributes
-        trg.variables[name].setncatts({a: var.getncattr(a) for a in var.ncattrs()})
+        trg.variables[name].setncatts({a: var.getncattr(a) for a in var.ncattrs() if a != '_FillValue'})
+        trg.variables[name].set_auto_maskandscale(False)
 
-        # Copy the variables values (as 'f4' eventually)
-        trg.variables[name][:] = src.variables[name][:]
+        # Copy the variables values
+        _copy_netcdf_variable_in_slabs(var, trg.variables[name], max_read_bytes=max_read_bytes)
 
     # Save the file
     trg.close()
     src.close()
 
-def combine_earthstat_tifs_to_nc(tif_paths, nc_path):
-    # get Dims
-    z = len(tif_paths)
-    size_check = list(set([hb.get_shape_from_dataset_path(path) for path in tif_paths]))
-
-    if len(size_check) < 1:
-        raise NameError('Shapes given as a list to combine_tifs_to_nc led to no shape.')
-    elif len(size_check) > 1:
-        raise NameError('Shapes given as a list to combine_tifs_to_nc didnt all have the same shape.')
-    else:
-        pass
-
-    y = size_check[0][0]
-    x = size_check[0][1]
-
-    match = nc.Dataset(r"C:\OneDrive\Projects\base_data\luh2\raw_data\RCP26_SSP1\multiple-states_input4MIPs_landState_ScenarioMIP_UofMD-IMAGE-ssp126-2-1-f_gn_2015-2100.nc")
-
-
-    # y = match.variables['primf'].current_shape
-
-
-    target_nc = nc.Dataset(nc_path, mode='w', format='NETCDF4')
-    target_nc.description = 'Description is here.'
+def combine_earthstat_tifs_to_nc(tif_paths, nc_path, var_name='value', **kwargs):
+    """Stack aligned earthstat geotiffs (named like barley_HarvestedAreaFraction.tif) into var_name along a 'crop'
+    dimension whose coordinate holds the crop names, streaming with stack_geotiffs_to_netcdf. Extra kwargs are passed
+    to it."""
+    crop_names = [os.path.split(path)[1].split('_')[0] for path in tif_paths]
+    global_attributes = {'Conventions': 'CF-1.6', 'extent': list(hb.global_bounding_box)}
+    global_attributes.update(kwargs.pop('global_attributes', {}) or {})
+    return stack_geotiffs_to_netcdf(tif_paths, nc_path, var_name=var_name, stack_dim_name='crop', stack_dim_values=crop_names,
+                                    global_attributes=global_attributes, **kwargs)
 
-    # copy Global attributes from original file
-    for att in match.ncattrs():
-        setattr(target_nc, att, getattr(match, att))
 
-    # Get metadata from known source
-
-    hb.pp(match)
-    hb.pp(match['primf'])
-
-    target_nc.createDimension('y', y)
-    target_nc.createDimension('x', x)
-
-    lon_var = target_nc.createVariable('lon', 'f4', ('x'))
-    lat_var = target_nc.createVariable('lat', 'f4', ('y'))
-    # x_var = target_nc.createVariable('x', 'f4', ('x'))
-    # y_var = target_nc.createVariable('y', 'f4', ('y'))
-    primf_var = target_nc.createVariable('primf', 'f4', ('y', 'x'))
-
-    # for var in match.variables:
-    # for var in ['bounds']:
-    for var in ['lat', 'lon', 'primf']:
-        hb.pp(match.variables[var].ncattrs())
-        for att in match.variables[var].ncattrs():
-            setattr(target_nc.variables[var], att, getattr(match.variables[var], att))
-    lon_var[:] = match.variables['lon'][:]
-    lat_var[:] = match.variables['lat'][:]
-    primf_var[:] = match.variables['primf'][:]
-    # x_var[:] = match.variables['x'][:]
-    # y_var[:] = match.variables['y'][:]
-
-    target_nc.Conventions = 'CF-1.6'
-
-
-
-    target_nc.extent = hb.global_bounding_box
-    target_nc.close()
-
-
-def combine_earthstat_tifs_to_nc_new(tif_paths, nc_path):
-
-    aborted = 1    
-    if aborted:
-        return
-
-    # get Dims
-    z = len(tif_paths)
-    size_check = list(set([hb.get_shape_from_dataset_path(path) for path in tif_paths]))
-
-    if len(size_check) < 1:
-        raise NameError('Shapes given as a list to combine_tifs_to_nc led to no shape.')
-    elif len(size_check) > 1:
-        raise NameError('Shapes given as a list to combine_tifs_to_nc didnt all have the same shape.')
-    else:
-        pass
-    y = size_check[0][0]
-    x = size_check[0][1]
-
-    target_nc = nc.Dataset(nc_path, mode='w')
-    # target_nc.createDimension('time', z)
-    # target_nc.createDimension('esa_lulc_class', z)
-    target_nc.createDimension('lon', y)
-    target_nc.createDimension('lat', x)
-
-    # time = target_nc.createVariable('time', float, ('time',), zlib=True, fill_value=-9999)
-    lats = target_nc.createVariable('lat', float, ('lat',), zlib=False, fill_value=-9999.)
-    lons = target_nc.createVariable('lon', float, ('lon',), zlib=False, fill_value=-9999.)
-
-    y_res = 180.0 / y
-    x_res = 360.0 / x
-
-    lats[:] = np.arange(-180., 180., x_res)
-    lons[:] = np.arange(-90., 90., y_res)
-
-    lats[:] = np.arange(-180. + x_res / 2., 180. + x_res / 2., x_res)
-    lons[:] = np.arange(-90. + y_res / 2., 90. + y_res / 2., y_res)
-
-    for c, path in enumerate(tif_paths):
-        crop_name = os.path.split(path)[1].split('_')[0]
-        var = target_nc.createVariable(crop_name, float, ('lon', 'lat'), zlib=True, fill_value=-9999.0, chunksizes=(43, 21))
-        # ds = gdal.OpenEx(path)
-        # current_array = ds.ReadAsArray()
-        # var[:] = np.flipud(current_array)
-        # var[c, :] = current_array
-    #
-    # close file to write on disk
-    target_nc.close()
+def combine_earthstat_tifs_to_nc_new(tif_paths, nc_path, **kwargs):
+    """Deprecated alias of combine_earthstat_tifs_to_nc."""
+    return combine_earthstat_tifs_to_nc(tif_paths, nc_path, **kwargs)
 
 def read_earthstat_nc_slice(input_nc_path, crop_name):
     # TODOOO, conclusion is that ::4 slicing is 10x faster in gdal but chunk slicing in a square is 2x faster in nc.
@@ -1313,7 +1313,6 @@ def make_path_global_pyramid(
     write_unique_values_list = True makes it write to the xml stats file a comma separated list of unique values
     """
 
-    # TODOO write_unique_values_list unimplemented but good idea for fasterstats.
     if verbose:
         L.info('Running make_path_global_pyramid on ' + str(input_path))
 
@@ -1538,8 +1537,11 @@ def make_path_global_pyramid(
         if not os.path.exists(processed_path + '.aux.xml') or overwrite_overviews:
             if verbose:
                 L.info('Starting to calculate stats for ' + str(processed_path))
-            ds.GetRasterBand(1).ComputeStatistics(False)  # False here means approx NOT okay
-            ds.GetRasterBand(1).GetHistogram(approx_ok=0)
+            ds = None
+
+            # One read of the data for exact stats, histogram and (optionally) the unique values list.
+            hb.add_stats_to_geotiff_with_block_scan(processed_path, band_index=1, write_unique_values_list=write_unique_values_list,
+                                                    write_to_aux_xml=make_overviews_external, verbose=verbose)
     ds = None
     return True
 
@@ -2000,8 +2002,31 @@ def load_geotiff_chunk_by_bb(input_path, bb, inclusion_behavior='centroid', stri
 
     if given output_path will make it write there (potentially EXTREMELY computaitonally slow)
     if output_path is True and not a string, will save to a atemp file.
+
+    input_path may also be a hb.netcdf.NetcdfRasterSource, in which case only the window is read from the netcdf (with
+    centroid inclusion and stride by cell skipping), so eg RegressionFrame inputs need not be extracted to geotiffs.
      """
-     
+
+    if isinstance(input_path, hb.netcdf.NetcdfRasterSource):
+        if bb is None:
+            c, r, c_size, r_size = 0, 0, input_path.XSize, input_path.YSize
+        else:
+            c, r, c_size, r_size = input_path.bb_to_cr_size(bb)
+        stride_rate = int(stride_rate) if stride_rate else 1
+        a = input_path.ReadAsArray(c, r, c_size, r_size, buf_type=datatype)
+        a = a[:int(r_size / stride_rate) * stride_rate:stride_rate, :int(c_size / stride_rate) * stride_rate:stride_rate]
+        if output_path is not None:
+            if output_path is True:
+                output_path = hb.temp('.tif')
+            gt = list(input_path.geotransform)
+            gt[0] = gt[0] + c * gt[1]
+            gt[3] = gt[3] + r * gt[5]
+            gt[1] = gt[1] * stride_rate
+            gt[5] = gt[5] * stride_rate
+            hb.save_array_as_geotiff(a, output_path, data_type=datatype if datatype is not None else input_path.DataType, ndv=input_path.ndv,
+                                     geotransform_override=gt, projection_override=input_path.projection, n_cols_override=a.shape[1], n_rows_override=a.shape[0])
+        return a
+
     if not hb.path_exists(input_path):
         raise NameError('load_geotiff_chunk_by_bb unable to open ' + str(input_path))
     c, r, c_size, r_size = hb.bb_path_to_cr_size(input_path, bb, inclusion_behavior=inclusion_behavior)
@@ -455,16 +455,36 @@ def zonal_statistics_flex(input_raster,
 
 def zonal_statistics_rasterized(zone_ids_raster_path, values_raster_path, zones_ndv=None, values_ndv=None, zone_ids_data_type=None,
                                 values_data_type=None, unique_zone_ids=None, stats_to_retrieve='sums', enumeration_classes=None,
-                                multiply_raster_path=None, verbose=True, max_enumerate_value=1000):
+                                multiply_raster_path=None, verbose=True, max_enumerate_value=1000, use_zone_block_index=False):
     """
     Calculate zonal statistics using a pre-generated raster ID array.
 
     NOTE that by construction, this type of zonal statistics cannot handle overlapping polygons (each polygon is just represented by its id int value in the raster).
+
+    If use_zone_block_index, the zone block index sidecar of zone_ids_raster_path (see hb.build_zone_block_index, built
+    on first use) gives the unique zone ids without loading the whole raster, and only the blocks containing one of
+    unique_zone_ids are read. Stats for a single country out of a global ids raster thus only read that country's blocks.
+    It is off by default because building the index writes a .zone_block_index.npz next to zone_ids_raster_path. If the
+    index cannot be built or saved (eg a read-only data directory), it is used from memory or all blocks are read.
+
+    values_raster_path may also be a hb.netcdf.NetcdfRasterSource aligned with the zones, which is read block by block
+    directly from the netcdf.
     """
 
     if verbose:
         L.info('Starting to run zonal_statistics_rasterized using iterblocks.')
 
+    zone_block_index = None
+    if use_zone_block_index:
+        try:
+            zone_block_index = hb.load_zone_block_index(zone_ids_raster_path)
+        except Exception as e:
+            # The index is only an optimization, so fall back to scanning every block.
+            L.warning('Unable to build the zone block index of ' + str(zone_ids_raster_path) + ', reading all blocks instead: ' + str(e))
+    if zone_block_index is not None:
+        if unique_zone_ids is None:
+            unique_zone_ids = zone_block_index['zone_ids']
+
     # TODOOO: Figure out how to make it work if there's no vector path
     if unique_zone_ids is None:
         if verbose:
@@ -497,7 +517,25 @@ def zonal_statistics_rasterized(zone_ids_raster_path, values_raster_path, zones_
     # Iterate through block_offsets
     zone_ids_raster_path_band = (zone_ids_raster_path, 1)
     aggregated_enumeration = None
-    for c, block_offset in enumerate(list(hb.iterblocks_hb(zone_ids_raster_path_band, offset_only=True))):
+    if zone_block_index is not None:
+        # Blocks that only hold other zones (or zones_ndv) contribute nothing, so skip them.
+        requested_zone_ids = unique_zone_ids[unique_zone_ids != zones_ndv] if zones_ndv is not None else unique_zone_ids
+        block_offsets = hb.get_block_offsets_for_zone_ids(zone_ids_raster_path, requested_zone_ids, zone_block_index=zone_block_index)
+        if verbose:
+            L.info('Zone block index selected ' + str(len(block_offsets)) + ' of ' + str(len(zone_block_index['block_offsets'])) + ' blocks.')
+    else:
+        block_offsets = list(hb.iterblocks_hb(zone_ids_raster_path_band, offset_only=True))
+
+    # Open once and read each block straight into reused, correctly typed buffers rather than ReadAsArray().astype().
+    zones_ds = gdal.OpenEx(zone_ids_raster_path)
+    if isinstance(values_raster_path, hb.netcdf.NetcdfRasterSource):
+        values_band = values_raster_path
+    else:
+        values_ds = gdal.OpenEx(values_raster_path)
+        values_band = values_ds.GetRasterBand(1)
+    multiply_ds = gdal.OpenEx(multiply_raster_path) if multiply_raster_path is not None and stats_to_retrieve == 'enumeration' else None
+    buffer_dict = {}
+    for c, block_offset in enumerate(block_offsets):
         sample_fraction = None # TODOO add this in to function call.
         # sample_fraction = .05
         if sample_fraction is not None:
@@ -516,17 +554,15 @@ def zonal_statistics_rasterized(zone_ids_raster_path, values_raster_path, zones_
                 'buf_xsize': block_offset['win_xsize'],
             }
 
-            zones_ds = gdal.OpenEx(zone_ids_raster_path)
-            values_ds = gdal.OpenEx(values_raster_path)
             # No idea why, but using **block_offset_new_gdal_api failed, so I unpack it manually here.
             try:
-                values_array = values_ds.ReadAsArray(block_offset_new_gdal_api['xoff'], block_offset_new_gdal_api['yoff'], block_offset_new_gdal_api['buf_xsize'], block_offset_new_gdal_api['buf_ysize']).astype(np.float64)
+                values_array = hb.read_block_into_buffer(values_band, block_offset, buffer_dict, key='values', dtype=np.float64)
             except:
-                L.critical('unable to load ' + values_raster_path)
+                L.critical('unable to load ' + str(values_raster_path))
                 pass
             
             try:
-                zones_array = zones_ds.ReadAsArray(block_offset_new_gdal_api['xoff'], block_offset_new_gdal_api['yoff'], block_offset_new_gdal_api['buf_xsize'], block_offset_new_gdal_api['buf_ysize']).astype(np.int64)
+                zones_array = hb.read_block_into_buffer(zones_ds.GetRasterBand(1), block_offset, buffer_dict, key='zones', dtype=np.int64)
 
             except:
                 L.critical('unable to load ' + zone_ids_raster_path)
@@ -547,7 +583,7 @@ def zonal_statistics_rasterized(zone_ids_raster_path, values_raster_path, zones_
                 sums = hb.calculation_core.cython_functions.zonal_stats_cythonized(zones_array, values_array, unique_zone_ids_np, zones_ndv=zones_ndv, values_ndv=values_ndv, stats_to_retrieve=stats_to_retrieve)
                 sums = np.asarray(sums, dtype=float)
                 sums[np.isnan(sums)] = 0.0 
-                aggregated_sums = aggregated_sums + sums
+                aggregated_sums += sums
             elif stats_to_retrieve == 'sums_counts':
                 sums, counts = hb.calculation_core.cython_functions.zonal_stats_cythonized(zones_array, values_array, unique_zone_ids_np, zones_ndv=zones_ndv, values_ndv=values_ndv, stats_to_retrieve=stats_to_retrieve)
                 sums = np.asarray(sums, dtype=float)
@@ -555,21 +591,20 @@ def zonal_statistics_rasterized(zone_ids_raster_path, values_raster_path, zones_
 
                 sums[np.isnan(sums)] = 0.0 
                 counts[np.isnan(counts)] = 0
-                aggregated_sums = aggregated_sums + sums
-                aggregated_counts = aggregated_counts + counts
+                aggregated_sums += sums
+                aggregated_counts += counts
 
             
             elif stats_to_retrieve == 'enumeration':
                 if multiply_raster_path is not None:
-                    multiply_ds = gdal.OpenEx(multiply_raster_path)
-                    shape = hb.get_shape_from_dataset_path(multiply_raster_path)
-                    if shape[1] == 1: # FEATURE NOTE: if you give a 1 dim array, it will be multiplied repeatedly over the vertical cols of the input_array. This is useful for when you want to multiple just the hectarage by latitude vertical strip array.
+                    if multiply_ds.RasterXSize == 1: # FEATURE NOTE: if you give a 1 dim array, it will be multiplied repeatedly over the vertical cols of the input_array. This is useful for when you want to multiple just the hectarage by latitude vertical strip array.
 
                         # If is vertical stripe, just read based on y buffer.
-                        multiply_raster = multiply_ds.ReadAsArray(0, block_offset_new_gdal_api['yoff'], 1, block_offset_new_gdal_api['buf_ysize']).astype(np.float64)
+                        multiply_offset = {'xoff': 0, 'yoff': block_offset['yoff'], 'win_xsize': 1, 'win_ysize': block_offset['win_ysize']}
                     else:
                         # "C:\Users\jajohns\Files\seals\projects\test_iucn_30by30\intermediate\project_aoi\pyramids\aoi_ha_per_cell_coarse.tif"
-                        multiply_raster = multiply_ds.ReadAsArray(block_offset_new_gdal_api['xoff'], block_offset_new_gdal_api['yoff'], block_offset_new_gdal_api['buf_xsize'], block_offset_new_gdal_api['buf_ysize']).astype(np.float64)
+                        multiply_offset = block_offset
+                    multiply_raster = hb.read_block_into_buffer(multiply_ds.GetRasterBand(1), multiply_offset, buffer_dict, key='multiply', dtype=np.float64)
                 else:
                     multiply_raster = np.asarray([[1]], dtype=np.float64)
                 enumeration = hb.calculation_core.cython_functions.zonal_stats_cythonized(zones_array, values_array, unique_zone_ids_np, zones_ndv=zones_ndv, values_ndv=values_ndv,
@@ -583,7 +618,9 @@ def zonal_statistics_rasterized(zone_ids_raster_path, values_raster_path, zones_
 
             last_time = hb.invoke_timed_callback(
                 last_time, lambda: print('Zonal statistics rasterized on ' + str(values_raster_path) + ': ' + str(float(pixels_processed) / n_pixels * 100.0)), 2)
-    
+    zones_ds = None
+    values_ds = None
+    multiply_ds = None
 
     if stats_to_retrieve == 'sums':
         return unique_zone_ids, aggregated_sums
@@ -1,6 +1,6 @@
 import hazelbean as hb
 
-import os, sys, shutil, random, math, atexit, time
+import os, sys, shutil, random, math, atexit, time, tempfile
 from osgeo import gdal, gdalconst
 from collections import OrderedDict
 import functools, collections
@@ -12,8 +12,11 @@ import numpy as np
 import random
 import multiprocessing
 import multiprocessing.pool
+import concurrent.futures
+import threading
 import scipy
 import geopandas as gpd
+import pandas as pd
 import warnings
 import logging
 from hazelbean import geoprocessing
@@ -1161,11 +1164,14 @@ def save_array_as_geotiff(array, out_uri, geotiff_uri_to_match=None, ds_to_match
                           geotransform_override=None, projection_override=None, n_cols_override=None,
                           n_rows_override=None, n_rows=None, n_cols=None, compress=True, compression_method=None, tile_method='block',
                           verbose=None, set_inf_to_no_data_value=False,
-                          save_png=False):
+                          save_png=False, sparse=False):
     '''
     Saves an array as a geotiff at uri_out. Attempts to correctly deal with many possible data flaws, such as
     assigning a datatype to the geotiff that matches the required pixel depth. Also determines the best (according to me)
     no_data_value to use based on the dtype and range of the data
+
+    If sparse, the geotiff is created with SPARSE_OK=TRUE and blocks that are entirely ndv are not written, which for
+    mostly-ocean global arrays makes writing faster and the file smaller. Those blocks read back as ndv.
     '''
 
     if data_type_override is not None:
@@ -1338,11 +1344,16 @@ def save_array_as_geotiff(array, out_uri, geotiff_uri_to_match=None, ds_to_match
     if execute_in_python:
         hb.create_directories(processed_out_uri)
         driver = gdal.GetDriverByName('GTiff')
+        if sparse:
+            dst_options = hb.get_sparse_gtiff_creation_options(dst_options)
         dst_ds = driver.Create(processed_out_uri, n_cols, n_rows, 1, data_type, dst_options)
         dst_ds.SetGeoTransform(geotransform)
         dst_ds.SetProjection(projection)
         dst_ds.GetRasterBand(1).SetNoDataValue(ndv)
-        dst_ds.GetRasterBand(1).WriteArray(array)
+        if sparse:
+            hb.write_array_skipping_nodata_blocks(dst_ds.GetRasterBand(1), array, ndv)
+        else:
+            dst_ds.GetRasterBand(1).WriteArray(array)
     # else:
     #     command_line_gdal_translate(array, processed_out_uri, tiled=True, compression_method=compression_method)
 
@@ -2395,77 +2406,340 @@ def merge_bounding_boxes(bb1, bb2, mode):
     bb_out = [op(x, y) for op, x, y in zip(comparison_ops, bb1, bb2)]
     return bb_out
 
-def get_rank_array_and_keys(input_array, nan_mask=None, highest_first=True, ndv=None, verbose=True):
-    # NOTE, i could get a decent performance increase here by masking nans before the sort.
+def get_flat_index_dtype(n_cells):
+    """Return np.int32 if every flat index into an array of n_cells fits in it, otherwise np.int64."""
+    if n_cells < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
 
-    prior_logging_level = L.getEffectiveLevel()
-    L.setLevel(logging.DEBUG)
 
+def _merge_sorted_runs(values_a, keys_a, values_b, keys_b):
+    """Stably merge two ascending runs, where every element of run a came before every element of run b."""
+    n = len(values_a) + len(values_b)
+    positions_a = np.arange(len(values_a)) + np.searchsorted(values_b, values_a, side='left')
+    positions_b = np.arange(len(values_b)) + np.searchsorted(values_a, values_b, side='right')
+    values = np.empty(n, dtype=values_a.dtype)
+    keys = np.empty(n, dtype=keys_a.dtype)
+    values[positions_a] = values_a
+    values[positions_b] = values_b
+    keys[positions_a] = keys_a
+    keys[positions_b] = keys_b
+    return values, keys
 
-    if ndv is not None and nan_mask is None:
-        nan_mask = np.where(input_array==ndv, 1, 0)
 
-    if ndv is None:
-        ndv = -9999
+def parallel_stable_argsort(values, n_threads=None, min_chunk_size=2 ** 22):
+    """Return the indices that stably sort values ascending (same result as np.argsort(values, kind='stable')).
+
+    Large arrays are split into n_threads runs that are argsorted concurrently (numpy releases the GIL while sorting)
+    and then merged pairwise, also in threads. Indices are int32 when values is small enough.
+    """
+    n = len(values)
+    index_dtype = get_flat_index_dtype(n)
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    n_runs = int(min(n_threads, max(n // min_chunk_size, 1)))
+    if n_runs <= 1:
+        return np.argsort(values, kind='stable').astype(index_dtype, copy=False)
+
+    bounds = np.linspace(0, n, n_runs + 1).astype(np.int64)
+
+    def _sort_run(run_index):
+        start, stop = bounds[run_index], bounds[run_index + 1]
+        run_keys = np.argsort(values[start:stop], kind='stable').astype(index_dtype, copy=False)
+        run_keys += index_dtype(start)
+        return values[run_keys], run_keys
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        runs = list(executor.map(_sort_run, range(n_runs)))
+        while len(runs) > 1:
+            # Merging adjacent pairs keeps the earlier run first, which keeps the merge stable.
+            merged = list(executor.map(lambda i: _merge_sorted_runs(*runs[i], *runs[i + 1]), range(0, len(runs) - 1, 2)))
+            if len(runs) % 2:
+                merged.append(runs[-1])
+            runs = merged
+    return runs[0][1]
+
+
+def _argsort_for_ranking(values, stable, n_threads):
+    if stable:
+        return parallel_stable_argsort(values, n_threads=n_threads)
+    return np.argsort(values).astype(get_flat_index_dtype(len(values)), copy=False)
+
+
+def get_ranked_flat_keys(input_array, nan_mask=None, highest_first=True, top_k=None, n_threads=None, stable=True):
+    """Rank the cells of an array, masking before sorting.
+
+    Only cells that are not masked are gathered and sorted, and keys are flat indices into input_array, int32 when the
+    array has fewer than 2**31 cells, so memory is proportional to the number of valid cells rather than 2 x int64
+    row/col pairs over the whole raster. Ties are broken by flat index (top-left first) in both directions, so results
+    are deterministic.
 
-    sorted_keys = input_array.argsort(axis=None)
+    Args:
+        input_array (np.ndarray): Values to rank. NaN cells are always masked.
+        nan_mask (np.ndarray): Same shape as input_array; cells equal to 1 (or True) are excluded.
+        highest_first (bool): Rank the largest value first.
+        top_k (int): If given, return only the first top_k keys. Uses argpartition so only those cells are sorted,
+            which is all that allocations that stop after N cells need.
+        n_threads (int): Threads for the sort, see parallel_stable_argsort.
+        stable (bool): If False, use numpy's default (faster, single-threaded) sort, in which case the order of tied
+            values is not defined.
 
-    # sorted_keys = np.asarray(zip())
-    unraveled_keys = np.unravel_index(sorted_keys, shape=input_array.shape)  # returns TWO arrays in a tuple of all the rows, then all the cols keys
-    # unraveled_keys = np.unravel_index(sorted_keys, shape=input_array.shape)  # returns TWO arrays in a tuple of all the rows, then all the cols keys
+    Returns:
+        1d array of flat indices in rank order. Use np.unravel_index(keys, input_array.shape) for rows and cols.
+    """
+    flat_values = input_array.ravel()
+    index_dtype = get_flat_index_dtype(flat_values.size)
+    exclude = None
+    if nan_mask is not None:
+        exclude = np.asarray(nan_mask).ravel() == 1
+    if np.issubdtype(flat_values.dtype, np.floating):
+        is_nan = np.isnan(flat_values)
+        exclude = is_nan if exclude is None else exclude | is_nan
+
+    if exclude is None:
+        valid_keys = None
+        values = flat_values
+    else:
+        valid_keys = np.flatnonzero(~exclude).astype(index_dtype, copy=False)
+        exclude = None
+        values = flat_values[valid_keys]
+    n_valid = len(values)
 
     if highest_first:
-        sorted_keys = (unraveled_keys[0][::-1].astype(np.int64), unraveled_keys[1][::-1].astype(np.int64))#.astype(np.int64)# thus here we need to reverse each seperately
-        unraveled_keys = None  # Key memory chokepoint
+        # Sorting the reversed values ascending and then reversing the order gives a descending sort whose ties stay
+        # in ascending index order, without negating (which is wrong for unsigned types).
+        values = values[::-1]
+
+    if top_k is not None and top_k < n_valid:
+        top_k = int(max(top_k, 0))
+        if top_k == 0:
+            return np.zeros(0, dtype=index_dtype)
+        if highest_first:
+            threshold = np.partition(values, n_valid - top_k)[n_valid - top_k]
+            candidates = np.flatnonzero(values > threshold)
+            ties = np.flatnonzero(values == threshold)[::-1]  # Reversed positions, so these are the lowest indices first.
+        else:
+            threshold = np.partition(values, top_k - 1)[top_k - 1]
+            candidates = np.flatnonzero(values < threshold)
+            ties = np.flatnonzero(values == threshold)
+        candidates = np.sort(np.concatenate([candidates, ties[:top_k - len(candidates)]]))
+        order = candidates[_argsort_for_ranking(values[candidates], stable, n_threads)]
     else:
-        sorted_keys = unraveled_keys.astype(np.int64)
-        unraveled_keys = None  # Key memory chokepoint
+        order = _argsort_for_ranking(values, stable, n_threads)
 
-    sorted_keys = np.array(sorted_keys).astype(np.int64)
+    if highest_first:
+        order = order[::-1]
+        if top_k is not None and top_k < n_valid:
+            order = order[:top_k]
+        order = (n_valid - 1) - order.astype(index_dtype, copy=False)
+    elif top_k is not None:
+        order = order[:top_k]
 
-    if nan_mask is not None:
-        nan_mask = nan_mask.astype(np.int64)
-        array, keys = hb.get_rank_array_and_keys_from_sorted_keys_with_nan_mask(sorted_keys, nan_mask, ndv)
-    else:
-        array, keys = hb.get_rank_array_and_keys_from_sorted_keys_no_nan_mask(sorted_keys, input_array.shape[0], input_array.shape[1])
+    order = order.astype(index_dtype, copy=False)
+    if valid_keys is None:
+        return np.ascontiguousarray(order)
+    return valid_keys[order]
 
-    L.setLevel(prior_logging_level)
-    return array, keys
 
+def get_rank_array_and_keys(input_array, nan_mask=None, highest_first=True, ndv=None, verbose=True, top_k=None, n_threads=None):
+    """Return a 2d int64 array of the rank of each cell (1 is first, ndv where masked or beyond top_k) and the
+    (2, n) int64 row/col keys in rank order, as expected by the allocation functions in cython_functions.
+
+    Masks nodata before sorting, see get_ranked_flat_keys.
+    """
+    if ndv is not None and nan_mask is None:
+        nan_mask = np.where(input_array == ndv, 1, 0)
 
+    if ndv is None:
+        ndv = -9999
 
+    flat_keys = get_ranked_flat_keys(input_array, nan_mask=nan_mask, highest_first=highest_first, top_k=top_k, n_threads=n_threads)
 
-def rank_array(input_array, nan_mask=None, highest_first=True, ndv=None, clip_below=None, clip_above=None):
+    if nan_mask is None and top_k is None and not np.issubdtype(input_array.dtype, np.floating):
+        rank_array = np.empty(input_array.size, dtype=np.int64)
+    else:
+        rank_array = np.full(input_array.size, ndv, dtype=np.int64)
+    rank_array[flat_keys] = np.arange(1, len(flat_keys) + 1, dtype=np.int64)
+    rank_array = rank_array.reshape(input_array.shape)
+
+    keys = np.empty((2, len(flat_keys)), dtype=np.int64)
+    np.divmod(flat_keys, input_array.shape[1], out=(keys[0], keys[1]))
+
+    if verbose:
+        L.debug('Ranked ' + str(len(flat_keys)) + ' of ' + str(input_array.size) + ' cells.')
+    return rank_array, keys
+
+
+def rank_array(input_array, nan_mask=None, highest_first=True, ndv=None, clip_below=None, clip_above=None, top_k=None, n_threads=None):
     if nan_mask is not None:
         if ndv is not None:
             nan_mask = np.where(input_array==ndv, 1, nan_mask).astype(np.byte)
         else:
             nan_mask = nan_mask.astype(np.byte)
     if clip_below is not None:
-        nan_mask = np.where(input_array < clip_below, 1, nan_mask).astype(np.byte)
+        nan_mask = np.where(input_array < clip_below, 1, 0 if nan_mask is None else nan_mask).astype(np.byte)
     if clip_above is not None:
-        nan_mask = np.where(input_array > clip_above, 1, nan_mask).astype(np.byte)
+        nan_mask = np.where(input_array > clip_above, 1, 0 if nan_mask is None else nan_mask).astype(np.byte)
 
     L.info('  Arg sorting to get keys.')
     start1 = time.time()
-    if nan_mask is not None:
-        keys_where = np.where(nan_mask != 1)
-        if highest_first:
-            sorted_keys_1dim = input_array[keys_where].argsort(axis=None)[::-1]
-        else:
-            sorted_keys_1dim = input_array[keys_where].argsort(axis=None)
-
-        sorted_keys = (keys_where[0][sorted_keys_1dim], keys_where[1][sorted_keys_1dim])
-    else:
-        sorted_keys = np.unravel_index(input_array.argsort(axis=None), dims=input_array.shape)
-        L.info('  Extracting keys and/or value and order arrays.')
-        if highest_first:
-            sorted_keys = np.asarray([sorted_keys[0][::-1], sorted_keys[1][::-1]])
+    flat_keys = get_ranked_flat_keys(input_array, nan_mask=nan_mask, highest_first=highest_first, top_k=top_k, n_threads=n_threads)
+    sorted_keys = np.unravel_index(flat_keys, input_array.shape)
+    if nan_mask is None and highest_first:
+        sorted_keys = np.asarray(sorted_keys)
 
-    print ('elapsed time', time.time() - start1)
+    L.info('  elapsed time ' + str(time.time() - start1))
 
     return sorted_keys
 
+def _sort_run_for_out_of_core_ranking(sort_values, keys, run_dir, run_index):
+    """Sort one run by (sort_values, keys) and spill it to run_dir as two .npy files. Returns their paths."""
+    order = np.lexsort((keys, sort_values))
+    values_path = os.path.join(run_dir, 'run_' + str(run_index) + '_values.npy')
+    keys_path = os.path.join(run_dir, 'run_' + str(run_index) + '_keys.npy')
+    np.save(values_path, sort_values[order])
+    np.save(keys_path, keys[order])
+    return values_path, keys_path
+
+
+def rank_raster_out_of_core(
+        raster_path_band, output_keys_path, highest_first=True,
+        working_dir=None, max_run_size=2 ** 26, merge_buffer_size=2 ** 20,
+        n_threads=None, largest_block=hb.globals.LARGEST_ITERBLOCK):
+    """Rank the valid cells of a raster that may be larger than memory, writing the ranked keys to a .npy file.
+
+    The output has the same layout as the keys from get_rank_array_and_keys, a (2, n_valid) int64 array of rows then
+    cols in rank order, so it can be passed directly to allocate_from_sorted_keys, create_order_array_from_ranked_keys
+    and the other allocators that take ranked keys.
+
+    Blocks from iterblocks_hb are gathered (nodata and NaN dropped) into runs of at most max_run_size cells, each run
+    is sorted in a thread pool and spilled to working_dir, and the runs are then k-way merged into a memory-mapped
+    output, merge_buffer_size cells per run at a time. Ties are ordered by flat index, so the keys are identical to
+    those from get_rank_array_and_keys on the whole array.
+
+    Args:
+        raster_path_band (tuple or str): (path, band) or a path (band 1).
+        output_keys_path (str): .npy path to write.
+        highest_first (bool): Rank the largest value first.
+        working_dir (str): Where to spill the sorted runs. Defaults to the directory of output_keys_path.
+        max_run_size (int): Cells per sorted run. At most n_threads runs are held at once, and memory use is a few
+            times max_run_size per thread.
+        merge_buffer_size (int): Cells read from each run per merge step.
+        n_threads (int): Threads sorting runs. Defaults to the cpu count.
+        largest_block (int): See iterblocks_hb.
+
+    Returns:
+        The ranked keys, memory-mapped read-only from output_keys_path.
+    """
+    if isinstance(raster_path_band, str):
+        raster_path_band = (raster_path_band, 1)
+    raster_info = hb.get_raster_info_hb(raster_path_band[0])
+    n_cols, n_rows = raster_info['raster_size']
+    nodata = raster_info['nodata'][raster_path_band[1] - 1]
+    numpy_type = hb.gdal_number_to_numpy_type[raster_info['datatype']]
+    is_float = np.issubdtype(numpy_type, np.floating)
+    # Everything is merged ascending on (sort_value, key), so highest_first negates, which needs a signed type.
+    sort_type = np.float64 if is_float else np.int64
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    if working_dir is None:
+        working_dir = os.path.dirname(os.path.abspath(output_keys_path))
+    run_dir = tempfile.mkdtemp(dir=working_dir, prefix='rank_runs_')
+
+    try:
+        run_paths = []
+        in_flight = set()
+        pending_values, pending_keys, n_pending = [], [], 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+            def _submit_run():
+                # Each submitted run holds max_run_size cells in memory until it is sorted and spilled, so at most
+                # n_threads runs are in flight and reading waits for one to finish.
+                while len(in_flight) >= n_threads:
+                    done, not_done = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    in_flight.difference_update(done)
+                    run_paths.extend(future.result() for future in done)
+                in_flight.add(executor.submit(
+                    _sort_run_for_out_of_core_ranking, np.concatenate(pending_values), np.concatenate(pending_keys),
+                    run_dir, len(run_paths) + len(in_flight)))
+
+            for offset, block in hb.iterblocks_hb(raster_path_band, largest_block=largest_block):
+                valid = np.ones(block.shape, dtype=bool)
+                if nodata is not None:
+                    valid &= block != nodata
+                if is_float:
+                    valid &= ~np.isnan(block)
+                block_rows, block_cols = np.nonzero(valid)
+                keys = (block_rows.astype(np.int64) + offset['yoff']) * n_cols + (block_cols.astype(np.int64) + offset['xoff'])
+                values = block[valid].astype(sort_type)
+                if highest_first:
+                    np.negative(values, out=values)
+                pending_values.append(values)
+                pending_keys.append(keys)
+                n_pending += len(keys)
+                if n_pending >= max_run_size:
+                    _submit_run()
+                    pending_values, pending_keys, n_pending = [], [], 0
+            if n_pending > 0:
+                _submit_run()
+            pending_values, pending_keys = None, None
+            run_paths.extend(future.result() for future in concurrent.futures.as_completed(in_flight))
+
+        runs = [(np.load(values_path, mmap_mode='r'), np.load(keys_path, mmap_mode='r')) for values_path, keys_path in run_paths]
+        n_valid = int(sum(len(run_keys) for _, run_keys in runs))
+        L.info('rank_raster_out_of_core merging ' + str(len(runs)) + ' sorted runs of ' + str(n_valid) + ' cells.')
+
+        output_keys = np.lib.format.open_memmap(output_keys_path, mode='w+', dtype=np.int64, shape=(2, n_valid))
+        positions = [0] * len(runs)
+        buffers = [None] * len(runs)
+        n_written = 0
+        while True:
+            # Refill each run's buffer so that it holds at most merge_buffer_size unmerged cells.
+            for i, (run_values, run_keys) in enumerate(runs):
+                if buffers[i] is None or len(buffers[i][0]) == 0:
+                    stop = min(positions[i] + merge_buffer_size, len(run_keys))
+                    buffers[i] = (np.asarray(run_values[positions[i]:stop]), np.asarray(run_keys[positions[i]:stop]))
+                    positions[i] = stop
+            active = [i for i in range(len(runs)) if len(buffers[i][0]) > 0]
+            if not active:
+                break
+
+            # Every buffered cell at or before the smallest last-buffered cell across runs still waiting on data is
+            # final. The run that holds that smallest cell drains fully, so each step makes progress.
+            boundary_value, boundary_key = None, None
+            for i in active:
+                if positions[i] < len(runs[i][1]):
+                    last = (buffers[i][0][-1], buffers[i][1][-1])
+                    if boundary_value is None or last < (boundary_value, boundary_key):
+                        boundary_value, boundary_key = last
+
+            merge_values, merge_keys = [], []
+            for i in active:
+                buffer_values, buffer_keys = buffers[i]
+                if boundary_value is None:
+                    n_take = len(buffer_keys)
+                else:
+                    n_take = int(np.searchsorted(buffer_values, boundary_value, side='left'))
+                    n_equal = int(np.searchsorted(buffer_values, boundary_value, side='right')) - n_take
+                    n_take += int(np.searchsorted(buffer_keys[n_take:n_take + n_equal], boundary_key, side='right'))
+                merge_values.append(buffer_values[:n_take])
+                merge_keys.append(buffer_keys[:n_take])
+                buffers[i] = (buffer_values[n_take:], buffer_keys[n_take:])
+
+            merge_values = np.concatenate(merge_values)
+            merge_keys = np.concatenate(merge_keys)
+            merge_keys = merge_keys[np.lexsort((merge_keys, merge_values))]
+            n_merged = len(merge_keys)
+            np.divmod(merge_keys, n_cols, out=(output_keys[0, n_written:n_written + n_merged], output_keys[1, n_written:n_written + n_merged]))
+            n_written += n_merged
+
+        output_keys.flush()
+        del output_keys
+        runs = None
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    return np.load(output_keys_path, mmap_mode='r')
+
 def get_rank_array(input_array, ignore_value=None, highest_first=True):
     print ('DEPRECATED     in favor of rank_array()')
 
@@ -5675,23 +5949,36 @@ def unique_raster_values_count(dataset_uri, ignore_nodata=True):
 
     Returns:
         itemfreq (dict): values to count.
-    """
-
-    dataset = gdal.Open(dataset_uri)
-    band = dataset.GetRasterBand(1)
-    nodata = band.GetNoDataValue()
 
+    Integer rasters are counted in one multithreaded read with compute_raster_stats_block_scan. Other rasters are
+    counted block by block with iterblocks_hb.
+    """
+    numpy_type = gdal_number_to_numpy_type[hb.get_raster_info_hb(dataset_uri)['datatype']]
     itemfreq = collections.defaultdict(int)
-    for row_index in range(band.YSize):
-        cur_array = band.ReadAsArray(0, row_index, band.XSize, 1)[0]
-        for val in numpy.unique(cur_array):
-            if ignore_nodata and val == nodata:
-                continue
-            itemfreq[val] += numpy.count_nonzero(cur_array == val)
-
-    band = None
-    gdal.Dataset.__swig_destroy__(dataset)
-    dataset = None
+    if not np.issubdtype(numpy_type, np.integer):
+        # compute_raster_stats_block_scan only tracks unique values of integer rasters.
+        nodata = hb.get_ndv_from_path(dataset_uri)
+        for offset, block in hb.iterblocks_hb((dataset_uri, 1)):
+            if ignore_nodata and nodata is not None:
+                block = block[block != nodata]
+            for val, count in zip(*np.unique(block, return_counts=True)):
+                itemfreq[val] += int(count)
+        return itemfreq
+
+    stats = compute_raster_stats_block_scan(dataset_uri, calculate_histogram=False, calculate_unique_values=True, max_unique_values=None)
+
+    for val, count in zip(stats['unique_values'], stats['unique_counts']):
+        itemfreq[val] += int(count)
+
+    if not ignore_nodata:
+        dataset = gdal.Open(dataset_uri)
+        band = dataset.GetRasterBand(1)
+        nodata = band.GetNoDataValue()
+        n_nodata = band.XSize * band.YSize - stats['valid_count']
+        if nodata is not None and n_nodata > 0:
+            itemfreq[nodata] += n_nodata
+        band = None
+        dataset = None
     return itemfreq
 
 
@@ -6219,18 +6506,15 @@ def compress_geotiffs_in_dir_recursive(dir,
                                        displace_original=False,
                                        min_size_to_compress=2500000,
                                        force_to_datatype=None,
+                                       max_workers=None,
+                                       manifest_path=None,
                                        ):
     warnings.warn('Deprecated in favor of hb.pyramids.compress_path')
-    uris = hb.list_filtered_paths_recursively(dir, include_extensions=include_extensions, exclude_extensions=exclude_extensions, include_strings=include_strings, exclude_strings=exclude_strings)
-
-    for uri in uris:
-        print ('Compressing ' + uri)
-        if os.path.getsize(uri) > min_size_to_compress:
-            compress_with_gdal_translate(uri, displace_original=displace_original, datatype=force_to_datatype)
-            print ('Compressing ' + uri)
-        else:
-            print ('Not compressing ' + uri + '. It wasnt that big...')
-
+    return compress_and_add_overviews_for_geotiffs_in_dir_parallel(dir, include_extensions=include_extensions, exclude_extensions=exclude_extensions,
+                                                                   include_strings=include_strings, exclude_strings=exclude_strings,
+                                                                   compress=True, add_overviews=False, displace_original=displace_original,
+                                                                   min_size_to_compress=min_size_to_compress, force_to_datatype=force_to_datatype,
+                                                                   compression='LZW', blocksize=256, manifest_path=manifest_path, max_workers=max_workers)
 
 
 def add_overviews_for_geotiffs_in_dir_recursive(dir,
@@ -6239,12 +6523,13 @@ def add_overviews_for_geotiffs_in_dir_recursive(dir,
                                                 include_strings=None,
                                                 exclude_strings=None,
                                                 overwrite_existing=False,
+                                                max_workers=None,
+                                                manifest_path=None,
                                                 ):
-    uris = hb.list_filtered_paths_recursively(dir, include_extensions=include_extensions, exclude_extensions=exclude_extensions, include_strings=include_strings, exclude_strings=exclude_strings)
-
-    for uri in uris:
-        if not os.path.exists(uri + '.ovr') or overwrite_existing:
-            add_geotiff_overview_file(uri)
+    return compress_and_add_overviews_for_geotiffs_in_dir_parallel(dir, include_extensions=include_extensions, exclude_extensions=exclude_extensions,
+                                                                   include_strings=include_strings, exclude_strings=exclude_strings,
+                                                                   compress=False, add_overviews=True, overwrite_existing_overviews=overwrite_existing,
+                                                                   manifest_path=manifest_path, max_workers=max_workers)
 
 
 def compress_and_add_overviews_for_geotiffs_in_dir_recursive(dir,
@@ -6255,22 +6540,240 @@ def compress_and_add_overviews_for_geotiffs_in_dir_recursive(dir,
                                                              displace_original=False,
                                                              min_size_to_compress=2500000,
                                                              force_to_datatype=None,
+                                                             max_workers=None,
+                                                             manifest_path=None,
                                                              ):
     warnings.warn('Deprecated in favor of hb.pyramids.compress_path')
+    return compress_and_add_overviews_for_geotiffs_in_dir_parallel(dir, include_extensions=include_extensions, exclude_extensions=exclude_extensions,
+                                                                   include_strings=include_strings, exclude_strings=exclude_strings,
+                                                                   compress=True, add_overviews=True, displace_original=displace_original,
+                                                                   min_size_to_compress=min_size_to_compress, force_to_datatype=force_to_datatype,
+                                                                   compression='LZW', blocksize=256, manifest_path=manifest_path, max_workers=max_workers)
+
+def _worker_compress_and_add_overviews(input_path, options):
+    """Process-pool worker for compress_and_add_overviews_for_geotiffs_in_dir_parallel. Must be top level so it can
+    be pickled. Returns (input_path, success, message, record) where record is the manifest entry for the file."""
+    process_name = multiprocessing.current_process().name
+    try:
+        gdal.SetCacheMax(int(options['gdal_cache_bytes']))
+        gdal.SetConfigOption('COMPRESS_OVERVIEW', options['overview_compression'])
+        gdal.SetConfigOption('INTERLEAVE_OVERVIEW', 'PIXEL')
+
+        output_path = input_path
+        compressed = False
+        if options['compress'] and os.path.getsize(input_path) > options['min_size_to_compress']:
+            if options['displace_original']:
+                output_path = input_path
+            else:
+                output_path = hb.suri(input_path, 'compressed')
+
+            # Write to a temporary file and then move it into place so that a crash never leaves a half written output.
+            temp_path = hb.suri(input_path, 'compressing_' + str(os.getpid()))
+            creation_options = ['TILED=YES', 'BIGTIFF=IF_SAFER', 'COMPRESS=' + options['compression'],
+                                'BLOCKXSIZE=' + str(options['blocksize']), 'BLOCKYSIZE=' + str(options['blocksize'])]
+            translate_kwargs = {'format': 'GTiff', 'creationOptions': creation_options}
+            if options['force_to_datatype'] is not None:
+                force_to_datatype = options['force_to_datatype']
+                if isinstance(force_to_datatype, str):
+                    force_to_datatype = hb.gdal_name_to_gdal_number[force_to_datatype]
+                translate_kwargs['outputType'] = hb.gdal_number_to_gdal_type[force_to_datatype]
+            try:
+                result = gdal.Translate(temp_path, input_path, **translate_kwargs)
+                if result is None:
+                    raise NameError('gdal.Translate failed on ' + str(input_path))
+                result = None
+                os.replace(temp_path, output_path)
+            finally:
+                # Only left behind if the translate or the move failed.
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            compressed = True
+
+        n_overviews = 0
+        if options['add_overviews']:
+            if not os.path.exists(output_path + '.ovr') or options['overwrite_existing_overviews'] or compressed:
+                if os.path.exists(output_path + '.ovr'):
+                    os.remove(output_path + '.ovr')
+                ds = gdal.OpenEx(output_path, gdal.OF_RASTER)  # Read-only so that overviews go to an external .ovr.
+                ds.BuildOverviews(options['overview_resampling_method'].upper(), options['overview_levels'])
+                ds = None
+            n_overviews = len(options['overview_levels'])
+
+        ds = gdal.OpenEx(output_path, gdal.OF_RASTER)
+        band = ds.GetRasterBand(1)
+        settings = {
+            'compression': ds.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION', None),
+            'data_type': band.DataType,
+            'block_size': list(band.GetBlockSize()),
+            'n_overviews': n_overviews,
+        }
+        band = None
+        ds = None
 
-    uris = hb.list_filtered_paths_recursively(dir, include_extensions=include_extensions, exclude_extensions=exclude_extensions, include_strings=include_strings, exclude_strings=exclude_strings)
+        record = {
+            'output_path': output_path,
+            'size': os.path.getsize(input_path),
+            'mtime': os.path.getmtime(input_path),
+            'options_signature': options['signature'],
+            'settings': settings,
+            'completed_at': time.time(),
+        }
+        return (input_path, True, 'Processed by ' + process_name + (' (compressed)' if compressed else ''), record)
+    except Exception as e:
+        return (input_path, False, 'Error in ' + process_name + ': ' + type(e).__name__ + ' - ' + str(e), None)
 
-    for uri in uris:
 
-        if os.path.getsize(uri) > min_size_to_compress:
-            compress_with_gdal_translate(uri, displace_original=displace_original, datatype=force_to_datatype)
-            print ('Compressing ' + uri)
-        else:
-            print ('Not compressing ' + uri + '. It wasnt that big...')
-        print ('Creating overviews for ' + uri)
+def read_batch_manifest(manifest_path):
+    """Read a batch-processing manifest written by compress_and_add_overviews_for_geotiffs_in_dir_parallel. Returns an
+    empty dict if it does not exist or is unreadable (e.g. was being written when the machine went down)."""
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (ValueError, OSError):
+        L.warning('Unable to read batch manifest at ' + str(manifest_path) + ', starting a new one.')
+        return {}
+
+
+def write_batch_manifest(manifest, manifest_path):
+    """Write the manifest atomically so that an interrupted write never corrupts the completed-files record."""
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_path, manifest_path)
+
+
+def is_batch_manifest_entry_current(manifest, path, options_signature):
+    """True if path is recorded as done in the manifest with the same size, mtime and requested options."""
+    record = manifest.get(path)
+    if record is None or not os.path.exists(path):
+        return False
+    return (record.get('size') == os.path.getsize(path) and record.get('mtime') == os.path.getmtime(path)
+            and record.get('options_signature') == options_signature)
+
+
+def get_available_memory_bytes():
+    """Available physical memory in bytes, using psutil if installed and sysconf otherwise. None if unknown."""
+    try:
+        import psutil
+        return int(psutil.virtual_memory().available)
+    except ImportError:
+        pass
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES'))
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_n_workers_for_memory_budget(n_tasks, memory_per_worker_gb=1.0, memory_budget_gb=None, max_workers=None):
+    """Number of worker processes to use so that n_workers * memory_per_worker_gb fits within memory_budget_gb
+    (default: 80% of currently available memory), capped by the cpu count and the number of tasks."""
+    if memory_budget_gb is None:
+        available_bytes = get_available_memory_bytes()
+        if available_bytes is not None:
+            memory_budget_gb = 0.8 * available_bytes / 1024 ** 3
+    if max_workers is None:
+        max_workers = max(multiprocessing.cpu_count() - 1, 1)
+    n_workers = max_workers
+    if memory_budget_gb is not None:
+        n_workers = min(n_workers, int(memory_budget_gb // memory_per_worker_gb))
+    return max(1, min(n_workers, n_tasks))
+
+
+def compress_and_add_overviews_for_geotiffs_in_dir_parallel(dir,
+                                                            include_extensions='.tif',
+                                                            exclude_extensions=None,
+                                                            include_strings=None,
+                                                            exclude_strings=None,
+                                                            compress=True,
+                                                            add_overviews=True,
+                                                            displace_original=True,
+                                                            min_size_to_compress=2500000,
+                                                            force_to_datatype=None,
+                                                            compression='DEFLATE',
+                                                            overview_compression='DEFLATE',
+                                                            blocksize=512,
+                                                            overview_levels=None,
+                                                            overview_resampling_method='average',
+                                                            overwrite_existing_overviews=False,
+                                                            manifest_path=None,
+                                                            max_workers=None,
+                                                            memory_budget_gb=None,
+                                                            memory_per_worker_gb=1.0,
+                                                            verbose=True,
+                                                            ):
+    """Compress and/or add external overviews to every geotiff under dir using a process pool, resumably.
+
+    Each completed file is recorded in a json manifest (default: hb_batch_manifest.json in dir) with its size, mtime,
+    the requested options and the resulting settings. The manifest is rewritten atomically after each file, so if the
+    run is interrupted, calling this again skips everything that was finished (and unchanged since) and continues
+    with the rest. Outputs written next to the inputs (when displace_original is False) are not picked up as new inputs.
+
+    The number of processes is sized so that n_workers * memory_per_worker_gb fits in memory_budget_gb (default 80% of
+    available memory). Each worker gets a GDAL block cache of half of memory_per_worker_gb.
+
+    compression applies to the rewritten geotiffs and overview_compression to the .ovr files, so the deprecated
+    wrappers keep the LZW geotiffs and DEFLATE overviews that gdal_translate and gdaladdo used to write.
+
+    Returns a list of (input_path, success, message) tuples for the files processed in this call.
+    """
+    if manifest_path is None:
+        manifest_path = os.path.join(dir, 'hb_batch_manifest.json')
+    if overview_levels is None:
+        overview_levels = [2, 4, 8, 16, 32]
+
+    options = {
+        'compress': compress,
+        'add_overviews': add_overviews,
+        'displace_original': displace_original,
+        'min_size_to_compress': min_size_to_compress,
+        'force_to_datatype': force_to_datatype,
+        'compression': compression,
+        'overview_compression': overview_compression,
+        'blocksize': blocksize,
+        'overview_levels': list(overview_levels),
+        'overview_resampling_method': overview_resampling_method,
+        'overwrite_existing_overviews': overwrite_existing_overviews,
+        'gdal_cache_bytes': memory_per_worker_gb * 1024 ** 3 / 2,
+    }
+    options['signature'] = json.dumps({k: v for k, v in options.items() if k not in ['overwrite_existing_overviews', 'gdal_cache_bytes']}, sort_keys=True)
+
+    manifest = read_batch_manifest(manifest_path)
+    manifest_outputs = set(record.get('output_path') for record in manifest.values() if record.get('output_path'))
+
+    paths = hb.list_filtered_paths_recursively(dir, include_extensions=include_extensions, exclude_extensions=exclude_extensions, include_strings=include_strings, exclude_strings=exclude_strings)
+    paths_to_process = []
+    for path in paths:
+        if path in manifest_outputs and path not in manifest:
+            continue
+        if '_compressing_' in os.path.basename(path):  # Leftover temporary file from an interrupted run.
+            continue
+        if is_batch_manifest_entry_current(manifest, path, options['signature']):
+            continue
+        paths_to_process.append(path)
+
+    if verbose:
+        hb.log('Found ' + str(len(paths)) + ' geotiffs in ' + str(dir) + ', ' + str(len(paths) - len(paths_to_process)) + ' already done according to ' + str(manifest_path))
+    if not paths_to_process:
+        return []
 
-        if not os.path.exists(uri + '.ovr'):
-            add_geotiff_overview_file(uri)
+    n_workers = get_n_workers_for_memory_budget(len(paths_to_process), memory_per_worker_gb=memory_per_worker_gb, memory_budget_gb=memory_budget_gb, max_workers=max_workers)
+    if verbose:
+        hb.log('Processing ' + str(len(paths_to_process)) + ' geotiffs with ' + str(n_workers) + ' worker processes.')
+
+    results = []
+    worker = functools.partial(_worker_compress_and_add_overviews, options=options)
+    with multiprocessing.Pool(processes=n_workers) as pool:
+        # imap_unordered so that the manifest is updated as each file finishes rather than when the whole batch does.
+        for input_path, success, message, record in pool.imap_unordered(worker, paths_to_process):
+            if success:
+                manifest[input_path] = record
+                write_batch_manifest(manifest, manifest_path)
+            if verbose:
+                hb.log(('SUCCESS: ' if success else 'FAILURE: ') + input_path + ' - ' + message)
+            results.append((input_path, success, message))
+    return results
 
 
 def create_global_polygons_from_graticules_for_degree(degree, output_path, match_path):
@@ -6413,41 +6916,22 @@ def raster_path_has_stats(input_path, approx_ok=False):
 
 def add_stats_to_geotiff_with_gdal(geotiff_path, approx_ok=False, force=True, verbose=True):
     """
-    Computes raster statistics and embeds them into GeoTIFF internal metadata
-    without creating .aux.xml files when opened in QGIS.
+    Computes raster statistics and writes them where get_stats_from_geotiff reads them.
+
+    Now a thin wrapper around add_stats_to_geotiff_with_block_scan, so the stats are exact and come from one
+    multithreaded read (with the histogram and, for integer rasters, the unique values from the same read).
 
     Parameters:
         geotiff_path (str): Path to GeoTIFF.
-        approx_ok (bool): Allow approximate stats computation.
-        force (bool): Force recomputation of statistics.
+        approx_ok (bool): Accept existing approximate stats when force is False. Computed stats are always exact.
+        force (bool): Force recomputation of statistics. If False, existing stats (exact, unless approx_ok) are kept.
         verbose (bool): Print detailed statistics per band.
     """
-    ds = gdal.Open(geotiff_path)
-    # ds = gdal.Open(geotiff_path, gdal.GA_Update)
-
-    if not ds:
-        raise ValueError(f"Could not open {geotiff_path}")
-
-    for band_index in range(1, ds.RasterCount + 1):
-        band = ds.GetRasterBand(band_index)  
-        band.SetMetadataItem("STATISTICS_MINIMUM", None)
-        band.SetMetadataItem("STATISTICS_MAXIMUM", None)
-        band.SetMetadataItem("STATISTICS_MEAN", None)
-        band.SetMetadataItem("STATISTICS_STDDEV", None)                    
-        stats = band.ComputeStatistics(approx_ok=approx_ok, callback=hb.make_gdal_callback('Calculating stats.') if verbose else None)
-        if not approx_ok:
-            band.SetMetadataItem("STATISTICS_APPROXIMATE", "NO")
-        else:
-            band.SetMetadataItem("STATISTICS_APPROXIMATE", "YES")
-            
-        if verbose:
-            hb.log( f"Band {band_index} from path {geotiff_path} has stats: min={stats[0]:.4f}, max={stats[1]:.4f}, mean={stats[2]:.4f}, stddev={stats[3]:.4f}"
-            )
+    if not force and raster_path_has_stats(geotiff_path, approx_ok=approx_ok):
+        return
+    add_stats_to_geotiff_with_block_scan(geotiff_path, write_to_aux_xml=True, verbose=verbose)
 
-        band.FlushCache()
 
-    ds = None 
-    
 def find_gdalinfo():
     """Find gdalinfo executable across different OS and conda setups"""
     
@@ -6497,176 +6981,27 @@ def find_gdalinfo():
 
 def add_stats_to_geotiff_with_gdalinfo(geotiff_path, approx_ok=False, verbose=True, force_recompute=True):
     """
-    Uses gdalinfo to compute base stats and histogram, then parses its JSON output
-    to calculate and store STATISTICS_VALID_COUNT using GDAL Python API.
-    This version includes more robust JSON parsing.
+    Computes stats, histogram, STATISTICS_VALID_COUNT and STATISTICS_SUM and stores them in the GeoTIFF itself.
+
+    Previously this shelled out to gdalinfo; it is now a thin wrapper around add_stats_to_geotiff_with_block_scan
+    (one exact, multithreaded read) writing internally as before. If force_recompute is False and the file already
+    has stats (exact, unless approx_ok), nothing is computed. Returns True on success and False on failure.
     """
     if not os.path.exists(geotiff_path):
         hb.log(f"ERROR: File not found: {geotiff_path}")
         return False
-
-    # 1. Unset stats (optional, as in previous gdalinfo example)
-    if force_recompute:
-        gdalinfo_path = find_gdalinfo()
-        cmd_unset = [gdalinfo_path, '-unsetstats', geotiff_path]
-        # cmd_unset = ["C:/Users/jajohns/miniforge3/envs/env2025k/Library/bin/gdalinfo.exe", '-unsetstats', geotiff_path]
-        if verbose:
-            hb.log(f"Attempting to unset existing stats for {geotiff_path} with: {' '.join(cmd_unset)}")
-        try:
-            # Run quietly unless verbose for unsetting
-            process_unset = subprocess.run(cmd_unset, capture_output=not verbose, text=True, check=False, env=os.environ.copy()) # Allow non-zero exit code
-            if process_unset.returncode != 0 and verbose:
-                hb.log(f"  Note: 'gdalinfo -unsetstats' may have failed (return code {process_unset.returncode}). This can happen with older GDAL versions or if no stats were present. Stderr: {process_unset.stderr.strip() if process_unset.stderr else 'N/A'}")
-            elif verbose and process_unset.returncode == 0:
-                 hb.log(f"  Successfully ran 'gdalinfo -unsetstats' or no stats were present to unset.")
-        except FileNotFoundError:
-            hb.log(f"ERROR: gdalinfo command not found. Cannot run '{' '.join(cmd_unset)}'. Please ensure GDAL command-line tools are installed and in PATH.")
-            # return False
-        except Exception as e:
-            hb.log(f"ERROR during 'gdalinfo -unsetstats' for {geotiff_path}: {e}")
-            # Potentially continue, as the main stats computation might still work/overwrite
-    # 'Driver: GTiff/GeoTIFF\nFiles: C:/Users/jajohns/Files/seals/projects/luh2_300m_global/intermediate/stitched_lulc_simplified_scenarios\\copy_20250530_142029_721now.tif\nSize is 129600, 64800\nCoordinate System is:\nGEOGCRS["WGS 84",\n    ENSEMBLE["World Geodetic System 1984 ensemble",\n        MEMBER["World Geodetic System 1984 (Transit)"],\n        MEMBER["World Geodetic System 1984 (G730)"],\n        MEMBER["World Geodetic System 1984 (G873)"],\n        MEMBER["World Geodetic System 1984 (G1150)"],\n        MEMBER["World Geodetic System 1984 (G1674)"],\n        MEMBER["World Geodetic System 1984 (G1762)"],\n        MEMBER["World Geodetic System 1984 (G2139)"],\n        MEMBER["World Geodetic System 1984 (G2296)"],\n        ELLIPSOID["WGS 84",6378137,298.257223563,\n            LENGTHUNIT["metre",1]],\n        ENSEMBLEACCURACY[2.0]],\n    PRIMEM["Greenwich",0,\n        ANGLEUNIT["degree",0.0174532925199433]],\n    CS[ellipsoidal,2],\n        AXIS["geodetic latitude (Lat)",north,\n            ORDER[1],\n            ANGLEUNIT["degree",0.0174532925199433]],\n        AXIS["geodetic longitude (Lon)",east,\n            ORDER[2],\n            ANGLEUNIT["degree",0.0174532925199433]],\n    USAGE[\n        SCOPE["Horizontal component of 3D system."],\n        AREA["World."],\n        BBOX[-90,-180,90,180]],\n    ID["EPSG",4326]]\nData axis to CRS axis mapping: 2,1\nOrigin = (-180.000000000000000,90.000000000000000)\nPixel Size = (0.002777777777778,-0.002777777777778)\nMetadata:\n  AREA_OR_POINT=Area\nImage Structure Metadata:\n  LAYOUT=COG\n  COMPRESSION=ZSTD\n  INTERLEAVE=BAND\nCorner Coordinates:\nUpper Left  (-180.0000000,  90.0000000) (180d 0\' 0.00"W, 90d 0\' 0.00"N)\nLower Left  (-180.0000000, -90.0000000) (180d 0\' 0.00"W, 90d 0\' 0.00"S)\nUpper Right ( 180.0000000,  90.0000000) (180d 0\' 0.00"E, 90d 0\' 0.00"N)\nLower Right ( 180.0000000, -90.0000000) (180d 0\' 0.00"E, 90d 0\' 0.00"S)\nCenter      (   0.0000000,   0.0000000) (  0d 0\' 0.01"E,  0d 0\' 0.01"N)\nBand 1 Block=512x512 Type=Byte, ColorInterp=Gray\n0...10...20...30...40...50...60...70...80...90...100 - done.\n  256 buckets from -0.5 to 255.5:\n  0 12479975 327004056 176115841 653118942 431070063 5674971368 1123319755 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 \n  NoData Value=255\n  Overviews: 43200x21600, 8640x4320, 4320x2160, 1440x720, 720x360, 360x180\n'
-    # 2. Compute stats and histogram using gdalinfo (this will write them to the TIFF)
-    # cmd_stats_hist = ['gdalinfo', '-hist', geotiff_path]
-    compute_hist = 0
-    if compute_hist:
-        cmd_stats_hist = [gdalinfo_path, '-hist', geotiff_path]
-        if verbose:
-            hb.log(f"Computing base stats & histogram for {geotiff_path} with: {' '.join(cmd_stats_hist)}")
-        try:
-            process_stats_hist = subprocess.run(cmd_stats_hist, capture_output=True, text=True, check=True, env=os.environ.copy())
-            if verbose:
-                # Print a snippet to avoid overwhelming logs if output is huge
-                output_snippet = process_stats_hist.stdout
-                if len(output_snippet) > 1000:
-                    output_snippet = output_snippet[:1000] + "\n... (output truncated)"
-                hb.log(f"  'gdalinfo -hist' stdout snippet:\n{output_snippet}")
-            if "STATISTICS_MINIMUM" not in process_stats_hist.stdout: # Basic check
-                hb.log(f"  WARNING: 'STATISTICS_MINIMUM' not found in 'gdalinfo -hist' output for {geotiff_path}. Base stats might not have been written/embedded correctly.")
-                # Depending on strictness, you might `return False` here
-        except FileNotFoundError:
-            hb.log(f"ERROR: gdalinfo command not found. Cannot run '{' '.join(cmd_stats_hist)}'.")
-            # return False
-        except subprocess.CalledProcessError as e:
-            hb.log(f"ERROR: 'gdalinfo -hist' failed for {geotiff_path} with exit code {e.returncode}.")
-            hb.log(f"  Stdout: {e.stdout.strip() if e.stdout else 'N/A'}")
-            hb.log(f"  Stderr: {e.stderr.strip() if e.stderr else 'N/A'}")
-            # return False
-        except Exception as e:
-            hb.log(f"An unexpected error occurred with 'gdalinfo -hist' for {geotiff_path}: {e}")
-            # return False
-
-    # 3. Get stats including STATISTICS_VALID_PERCENT using gdalinfo -json -stats
-    cmd_json_stats = [gdalinfo_path, '-json', '-stats', geotiff_path]
-    if verbose:
-        hb.log(f"Fetching JSON stats for {geotiff_path} with: {' '.join(cmd_json_stats)}")
-    gdalinfo_data = None # Initialize
-    try:
-        process_json = subprocess.run(cmd_json_stats, capture_output=True, text=True, check=True, env=os.environ.copy())
-        gdalinfo_data = json.loads(process_json.stdout)
-    except FileNotFoundError:
-        hb.log(f"ERROR: gdalinfo command not found. Cannot run '{' '.join(cmd_json_stats)}'.")
-        # return False
-    except subprocess.CalledProcessError as e:
-        hb.log(f"ERROR: 'gdalinfo -json -stats' failed for {geotiff_path} with exit code {e.returncode}.")
-        hb.log(f"  Stdout: {e.stdout.strip() if e.stdout else 'N/A'}")
-        hb.log(f"  Stderr: {e.stderr.strip() if e.stderr else 'N/A'}")
-        # return False
-    except json.JSONDecodeError as e:
-        hb.log(f"ERROR: Failed to parse JSON output from 'gdalinfo -json -stats' for {geotiff_path}: {e}")
-        hb.log(f"  gdalinfo stdout that caused error: {process_json.stdout[:500] if process_json and process_json.stdout else 'N/A'}...")
-        # return False
-    except Exception as e:
-        hb.log(f"An unexpected error occurred with 'gdalinfo -json -stats' for {geotiff_path}: {e}")
-        # return False
-
-    if not gdalinfo_data: # Should not happen if try block succeeded, but as a safeguard
-        hb.log(f"ERROR: No data parsed from 'gdalinfo -json -stats' for {geotiff_path}.")
-        # return False
-
-    # 4. Open the GeoTIFF with GDAL Python API to write STATISTICS_VALID_COUNT
-    ds = None # Initialize ds to ensure it's defined for finally block if open fails
-    try:
-        # Ensure GDAL Python bindings are using exceptions
-        gdal.UseExceptions()
-        ds = gdal.OpenEx(geotiff_path, gdal.GA_Update, open_options=["IGNORE_COG_LAYOUT_BREAK=YES"])
-        if not ds:
-            hb.log(f"ERROR: GDAL Python could not open {geotiff_path} in update mode.")
-            return False
-
-        if 'bands' in gdalinfo_data:
-            for i, band_info_from_json in enumerate(gdalinfo_data['bands']):
-                band_index_gdal = i + 1 # GDAL bands are 1-indexed
-                
-                band = ds.GetRasterBand(band_index_gdal)
-                if not band:
-                    hb.log(f"  Band {band_index_gdal}: Could not retrieve band object from dataset using GDAL Python. Skipping.")
-                    continue
-
-                if force_recompute:
-                    # Clear any pre-existing STATISTICS_VALID_COUNT from previous runs
-                    # band.SetMetadataItem("STATISTICS_VALID_COUNT", None)
-                    pass # Why did I do this? then it just fails the next check.
-
-                band_metadata_json = band_info_from_json.get('metadata', {}).get('', {})
-
-                if 'STATISTICS_VALID_PERCENT' not in band_metadata_json:
-                    # set to 100 percent
-                    band_metadata_json['STATISTICS_VALID_PERCENT'] = '100'  # Default to 100% if not present
-                    
-                    
-                if band_metadata_json and 'STATISTICS_VALID_PERCENT' in band_metadata_json:
-                    try:
-                        valid_percent_str = band_metadata_json['STATISTICS_VALID_PERCENT']
-                        valid_percent = float(valid_percent_str)
-                        
-                        current_band_x_size = band.XSize
-                        current_band_y_size = band.YSize
-
-                        if current_band_x_size > 0 and current_band_y_size > 0:
-                            valid_count = round((valid_percent / 100.0) * current_band_x_size * current_band_y_size)
-                            band.SetMetadataItem("STATISTICS_VALID_COUNT", str(int(valid_count)))
-                            mean = band.GetMetadataItem("STATISTICS_MEAN")
-                            band.SetMetadataItem("STATISTICS_SUM", str(float(valid_count)*float(mean)))
-                            band.SetMetadataItem("STATISTICS_APPROXIMATE", "NO")
-                            if verbose:
-                                hb.log(f"  Band {band_index_gdal}: Set STATISTICS_VALID_COUNT = {valid_count} (from {valid_percent:.2f}%)")
-                        else:
-                            if verbose:
-                                hb.log(f"  Band {band_index_gdal}: Skipping valid count, band dimensions ({current_band_x_size}x{current_band_y_size}) are zero or invalid.")
-                    except ValueError:
-                        if verbose:
-                            hb.log(f"  Band {band_index_gdal}: Could not parse STATISTICS_VALID_PERCENT ('{valid_percent_str}') to float.")
-                    except Exception as e_calc:
-                        if verbose:
-                            hb.log(f"  Band {band_index_gdal}: Error during valid count calculation or setting metadata: {e_calc}")
-                elif verbose:
-                    # More detailed logging for why STATISTICS_VALID_PERCENT might be missing
-                    if not band_info_from_json.get('metadata'):
-                        hb.log(f"  Band {band_index_gdal}: 'metadata' key not found in gdalinfo JSON output for this band.")
-                    elif not band_info_from_json.get('metadata', {}).get(''):
-                        hb.log(f"  Band {band_index_gdal}: Default metadata domain ('') not found in gdalinfo JSON output for this band.")
-                    elif 'STATISTICS_VALID_PERCENT' not in band_metadata_json : # Explicitly check this condition
-                        hb.log(f"  Band {band_index_gdal}: STATISTICS_VALID_PERCENT not found in parsed JSON metadata for this band.")
-                    else: # Should not be reached if the above are exhaustive
-                        hb.log(f"  Band {band_index_gdal}: STATISTICS_VALID_PERCENT not available for an unknown reason in parsed JSON.")
-
-                band.FlushCache()
-        
-        ds.FlushCache() # Final flush for the dataset
-        if verbose:
-            hb.log(f"Successfully processed and updated stats for {geotiff_path}")
+    if not force_recompute and raster_path_has_stats(geotiff_path, approx_ok=approx_ok):
         return True
-
+    try:
+        add_stats_to_geotiff_with_block_scan(geotiff_path, write_to_aux_xml=False, verbose=verbose)
     except Exception as e:
-        hb.log(f"ERROR during GDAL Python update phase for {geotiff_path}: {e}")
+        hb.log(f"ERROR computing stats for {geotiff_path}: {e}")
         return False
-    finally:
-        # Ensure dataset is closed
-        if ds is not None:
-            ds = None
+    if verbose:
+        hb.log(f"Successfully processed and updated stats for {geotiff_path}")
+    return True
+
 
-    
 def add_stats_to_geotiff_with_gdal_full(geotiff_path,
                                    approx_ok=False,
                                    force=True,
@@ -6674,154 +7009,28 @@ def add_stats_to_geotiff_with_gdal_full(geotiff_path,
                                    histogram_buckets=256,
                                    compute_valid_pixels_info=True): # Renamed for clarity
     """
-    
-    STATUS:::: NEVER FINISHED BEACUSE FAILS ON NO OPTIONS
-    
-    
     Computes raster statistics (min, max, mean, stddev, histogram, valid pixels info)
-    and embeds them into GeoTIFF internal metadata. Aims to do this in a single
-    data pass by ComputeStatistics where possible.
+    and embeds them into GeoTIFF internal metadata in a single data pass.
+
+    Now a thin wrapper around add_stats_to_geotiff_with_block_scan.
 
     Parameters:
         geotiff_path (str): Path to GeoTIFF.
-        approx_ok (bool): Allow approximate stats computation. If False, histogram
-                          computation is more likely to be detailed and valid pixel
-                          percentage more accurate.
-        force (bool): Force recomputation of statistics by clearing existing ones.
+        approx_ok (bool): As before, the histogram is only computed if approx_ok is False. When force is False,
+                          existing approximate stats are also accepted. Computed stats are always exact.
+        force (bool): Force recomputation of statistics. If False, existing stats (exact, unless approx_ok) are kept.
         verbose (bool): Print detailed statistics per band.
-        histogram_buckets (int): Number of buckets for the histogram.
-                                 Only effective if approx_ok is False.
-        compute_valid_pixels_info (bool): Whether to compute and store the percentage
-                                          and count of valid pixels.
+        histogram_buckets (int): Number of buckets for the histogram (of float rasters; integer rasters get
+                                 one bucket per value up to this many).
+        compute_valid_pixels_info (bool): Kept for compatibility; STATISTICS_VALID_PERCENT and
+                                          STATISTICS_VALID_COUNT are always written.
     """
-    
-    import os
-    from osgeo import gdal # Re-import to be absolutely sure
-    print(f"WORKER PROCESS {os.getpid()}: GDAL Version: {gdal.VersionInfo()}")
-    print(f"WORKER PROCESS {os.getpid()}: GDAL Version Num: {gdal.VersionInfo('VERSION_NUM')}")
-    print(f"WORKER PROCESS {os.getpid()}: osgeo path: {os.path.dirname(gdal.__file__)}")
-    # ... rest of your function
-    
-    
-    ds = gdal.Open(geotiff_path, gdal.GA_Update)
-
-    if not ds:
-        raise ValueError(f"Could not open {geotiff_path}")
-
-    if verbose:
-        hb.log(f"Processing {geotiff_path}...")
-
-    total_pixels_raster = ds.RasterXSize * ds.RasterYSize
-
-    for band_index in range(1, ds.RasterCount + 1):
-        band = ds.GetRasterBand(band_index)
-        band_total_pixels = band.XSize * band.YSize # In case of overviews or different band sizes
-
-        if force:
-            if verbose:
-                hb.log(f"  Band {band_index}: Clearing existing statistics (force=True)...")
-            metadata = band.GetMetadata()
-            keys_to_delete = [k for k in metadata.keys() if k.startswith("STATISTICS_")]
-            if keys_to_delete:
-                delete_dict = {key: None for key in keys_to_delete}
-                band.SetMetadata(delete_dict)
-            else: # Fallback for safety, though usually not needed
-                common_stat_keys = [
-                    "STATISTICS_MINIMUM", "STATISTICS_MAXIMUM", "STATISTICS_MEAN",
-                    "STATISTICS_STDDEV", "STATISTICS_APPROXIMATE",
-                    "STATISTICS_HISTONUMBINS", "STATISTICS_HISTOMIN",
-                    "STATISTICS_HISTOMAX", "STATISTICS_HISTOBINVALUES",
-                    "STATISTICS_VALID_PERCENT", "STATISTICS_VALID_COUNT"
-                ]
-                for key in common_stat_keys:
-                    band.SetMetadataItem(key, None)
-
-        # Options for ComputeStatistics
-        cs_options = []
-        if not approx_ok:
-            cs_options.append(f"STATISTICS_HISTONUMBINS={histogram_buckets}")
-        if compute_valid_pixels_info:
-            # This option tells ComputeStatistics to calculate and store STATISTICS_VALID_PERCENT
-            cs_options.append("STATISTICS_VALID_PERCENT=YES")
-
-
-        callback_fn = hb.make_gdal_callback(f'  Band {band_index} Calculating stats:') if verbose else None
-        
-        try:
-            if verbose:
-                log_msg_cs = f"  Band {band_index}: Computing statistics..."
-                if cs_options:
-                    log_msg_cs += f" with options: {cs_options}"
-                hb.log(log_msg_cs)
-
-            # ComputeStatistics will calculate min, max, mean, stddev
-            # And if options are set: histogram and valid_percent
-            # All in one pass over the data.
-            stats_list = band.ComputeStatistics(approx_ok, callback=callback_fn, options=cs_options)
-            # stats_list = [min, max, mean, stddev]
-        except RuntimeError as e:
-            hb.log(f"  Band {band_index}: Error computing statistics: {e}. Skipping stats for this band.")
-            band.FlushCache()
-            continue
-
-        # ComputeStatistics should have set the relevant metadata items internally.
-        # We explicitly set STATISTICS_APPROXIMATE as good practice.
-        band.SetMetadataItem("STATISTICS_APPROXIMATE", "YES" if approx_ok else "NO")
-
-        valid_pixel_count_derived = -1
-        if compute_valid_pixels_info:
-            # Retrieve the valid percent that ComputeStatistics should have stored
-            valid_percent_str = band.GetMetadataItem("STATISTICS_VALID_PERCENT", "STATISTICS")
-            if not valid_percent_str: # Fallback to default domain
-                valid_percent_str = band.GetMetadataItem("STATISTICS_VALID_PERCENT")
-
-            if valid_percent_str is not None:
-                try:
-                    valid_percent = float(valid_percent_str)
-                    # Calculate count from percent and total pixels for the band
-                    valid_pixel_count_derived = round(band_total_pixels * (valid_percent / 100.0))
-                    band.SetMetadataItem("STATISTICS_VALID_COUNT", str(int(valid_pixel_count_derived)))
-                except ValueError:
-                    if verbose:
-                        hb.log(f"  Band {band_index}: Could not parse STATISTICS_VALID_PERCENT ('{valid_percent_str}') to float.")
-            elif verbose:
-                hb.log(f"  Band {band_index}: STATISTICS_VALID_PERCENT not found in metadata after ComputeStatistics.")
-        
-        if verbose:
-            log_message = (
-                f"  Band {band_index} stats (from ComputeStatistics):\n"
-                f"    Min: {stats_list[0]:.4f}, Max: {stats_list[1]:.4f}, "
-                f"Mean: {stats_list[2]:.4f}, StdDev: {stats_list[3]:.4f}"
-            )
-            if compute_valid_pixels_info:
-                vp_str = band.GetMetadataItem("STATISTICS_VALID_PERCENT", "STATISTICS") or band.GetMetadataItem("STATISTICS_VALID_PERCENT")
-                vc_str = band.GetMetadataItem("STATISTICS_VALID_COUNT", "STATISTICS") or band.GetMetadataItem("STATISTICS_VALID_COUNT")
-                log_message += f"\n    Valid Percent: {vp_str if vp_str else 'N/A'}"
-                log_message += f"\n    Valid Count (derived): {vc_str if vc_str else 'N/A'}"
-
-
-            hist_num_bins = band.GetMetadataItem("STATISTICS_HISTONUMBINS", "STATISTICS") or band.GetMetadataItem("STATISTICS_HISTONUMBINS")
-            if hist_num_bins:
-                hist_min = band.GetMetadataItem("STATISTICS_HISTOMIN", "STATISTICS") or band.GetMetadataItem("STATISTICS_HISTOMIN")
-                hist_max = band.GetMetadataItem("STATISTICS_HISTOMAX", "STATISTICS") or band.GetMetadataItem("STATISTICS_HISTOMAX")
-                hist_values_str = band.GetMetadataItem("STATISTICS_HISTOBINVALUES", "STATISTICS") or band.GetMetadataItem("STATISTICS_HISTOBINVALUES")
-                log_message += (
-                    f"\n    Histogram (from GDAL ComputeStatistics):\n"
-                    f"      Bins: {hist_num_bins}, Min: {hist_min}, Max: {hist_max}"
-                )
-                if hist_values_str:
-                    hist_values_snippet = hist_values_str[:60] + ('...' if len(hist_values_str) > 60 else '')
-                    log_message += f"\n      Bin Values (snippet): {hist_values_snippet}"
-            elif not approx_ok:
-                 log_message += "\n    Histogram: Not computed or not found in metadata."
-            hb.log(log_message)
+    if not force and raster_path_has_stats(geotiff_path, approx_ok=approx_ok):
+        return
+    add_stats_to_geotiff_with_block_scan(geotiff_path, calculate_histogram=not approx_ok, histogram_buckets=histogram_buckets,
+                                         write_to_aux_xml=False, verbose=verbose)
 
-        band.FlushCache()
 
-    if verbose:
-        hb.log(f"Finished processing {geotiff_path}. All changes should be flushed.")
-    ds = None
-    
 def get_stats_from_geotiff(geotiff_path):
     """
     Returns a dictionary of statistics (min, max, mean, stddev) for each band in the GeoTIFF.
@@ -6885,25 +7094,937 @@ def add_stats_to_geotiff_from_dict(geotiff_path, stats_dict, ignore_cog_warning=
   
 
 
+def _scan_blocks_for_raster_stats(raster_path, band_index, offsets, ndv, track_unique_values, max_unique_values, histogram_edges):
+    """Worker for compute_raster_stats_block_scan. Opens its own handle (GDAL datasets are not thread safe) and
+    reduces the given block offsets to a partial result that _merge_raster_stats_partials can combine."""
+    ds = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = ds.GetRasterBand(band_index)
+
+    partial = {'n': 0, 'mean': 0.0, 'm2': 0.0, 'min': None, 'max': None, 'histogram': None, 'unique_values': None, 'unique_counts': None}
+    if histogram_edges is not None:
+        partial['histogram'] = np.zeros(len(histogram_edges) - 1, dtype=np.int64)
+    if track_unique_values:
+        partial['unique_values'] = np.zeros(0, dtype=np.int64)
+        partial['unique_counts'] = np.zeros(0, dtype=np.int64)
+
+    for offset in offsets:
+        block = band.ReadAsArray(**offset)
+        if ndv is not None:
+            if np.issubdtype(block.dtype, np.floating):
+                valid = block[(block != ndv) & ~np.isnan(block)]
+            else:
+                valid = block[block != ndv]
+        elif np.issubdtype(block.dtype, np.floating):
+            valid = block[~np.isnan(block)]
+        else:
+            valid = block.ravel()
+        if valid.size == 0:
+            continue
+
+        # Chan et al. pairwise update so that the mean and stdev are exact from a single read.
+        block_n = valid.size
+        block_mean = float(valid.mean(dtype=np.float64))
+        block_m2 = float(np.sum((valid.astype(np.float64) - block_mean) ** 2))
+        partial = _merge_raster_stats_moments(partial, block_n, block_mean, block_m2)
+
+        block_min, block_max = valid.min(), valid.max()
+        partial['min'] = block_min if partial['min'] is None else min(partial['min'], block_min)
+        partial['max'] = block_max if partial['max'] is None else max(partial['max'], block_max)
+
+        if partial['unique_values'] is not None:
+            block_values, block_counts = np.unique(valid, return_counts=True)
+            partial['unique_values'], partial['unique_counts'] = _merge_unique_value_counts(
+                partial['unique_values'], partial['unique_counts'], block_values.astype(np.int64), block_counts.astype(np.int64))
+            if max_unique_values is not None and len(partial['unique_values']) > max_unique_values:
+                partial['unique_values'] = None
+                partial['unique_counts'] = None
+
+        if histogram_edges is not None:
+            # Values outside of the histogram range are counted in the edge buckets, as GDAL does with include_out_of_range.
+            clipped = np.clip(valid, histogram_edges[0], histogram_edges[-1])
+            partial['histogram'] += np.histogram(clipped, bins=histogram_edges)[0]
+
+    band = None
+    ds = None
+    return partial
+
+
+def _merge_raster_stats_moments(partial, n, mean, m2):
+    """Combine a running (n, mean, m2) with another set of moments. Modifies and returns partial."""
+    if n == 0:
+        return partial
+    if partial['n'] == 0:
+        partial['n'], partial['mean'], partial['m2'] = n, mean, m2
+        return partial
+    combined_n = partial['n'] + n
+    delta = mean - partial['mean']
+    partial['mean'] += delta * n / combined_n
+    partial['m2'] += m2 + delta ** 2 * partial['n'] * n / combined_n
+    partial['n'] = combined_n
+    return partial
+
+
+def _merge_unique_value_counts(values_a, counts_a, values_b, counts_b):
+    """Merge two sorted (values, counts) pairs into one sorted (values, counts) pair."""
+    values, inverse = np.unique(np.concatenate((values_a, values_b)), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate((counts_a, counts_b)), minlength=len(values)).astype(np.int64)
+    return values, counts
+
+
+def _merge_raster_stats_partials(partials):
+    merged = {'n': 0, 'mean': 0.0, 'm2': 0.0, 'min': None, 'max': None, 'histogram': None, 'unique_values': None, 'unique_counts': None}
+    unique_overflowed = False
+    for partial in partials:
+        merged = _merge_raster_stats_moments(merged, partial['n'], partial['mean'], partial['m2'])
+        if partial['min'] is not None:
+            merged['min'] = partial['min'] if merged['min'] is None else min(merged['min'], partial['min'])
+            merged['max'] = partial['max'] if merged['max'] is None else max(merged['max'], partial['max'])
+        if partial['histogram'] is not None:
+            merged['histogram'] = partial['histogram'].copy() if merged['histogram'] is None else merged['histogram'] + partial['histogram']
+        if partial['unique_values'] is None:
+            unique_overflowed = True
+        elif not unique_overflowed:
+            if merged['unique_values'] is None:
+                merged['unique_values'], merged['unique_counts'] = partial['unique_values'], partial['unique_counts']
+            else:
+                merged['unique_values'], merged['unique_counts'] = _merge_unique_value_counts(
+                    merged['unique_values'], merged['unique_counts'], partial['unique_values'], partial['unique_counts'])
+    if unique_overflowed:
+        merged['unique_values'], merged['unique_counts'] = None, None
+    return merged
+
+
+def compute_raster_stats_block_scan(raster_path,
+                                    band_index=1,
+                                    calculate_histogram=True,
+                                    calculate_unique_values=None,
+                                    histogram_buckets=256,
+                                    histogram_range=None,
+                                    max_unique_values=10000,
+                                    n_workers=None,
+                                    largest_block=hb.globals.LARGEST_ITERBLOCK,
+                                    verbose=False):
+    """Compute exact min, max, mean, stddev, a histogram and (for integer rasters) unique values with counts
+    from a SINGLE multithreaded read of the raster. Nothing is written; see add_stats_to_geotiff_with_block_scan.
+
+    The blocks from hb.iterblocks_hb are dealt out to n_workers threads, each of which reduces its blocks to
+    partial moments, a partial histogram and partial unique counts. These are then merged exactly.
+
+    Histogram: for integer rasters with unique values available, the histogram is derived exactly from the unique
+    counts over [min - 0.5, max + 0.5] ([-0.5, 255.5] for Byte, matching GDAL). For float rasters (or integer rasters
+    with more than max_unique_values unique values) the range is histogram_range if given, otherwise the approximate
+    min/max from GDAL (which is cheap on pyramidal rasters because it reads the overviews). Values outside of that
+    range are counted in the edge buckets.
+
+    Args:
+        raster_path (str): Path to a GDAL-readable raster.
+        band_index (int): 1-based band index.
+        calculate_histogram (bool): Compute a histogram with histogram_buckets buckets.
+        calculate_unique_values (bool): Track unique values and their counts. Defaults to True for integer rasters,
+            and is ignored for float rasters.
+        histogram_buckets (int): Number of histogram buckets.
+        histogram_range (tuple): Optional (min, max) of the histogram for float rasters.
+        max_unique_values (int): Stop tracking unique values once more than this many are found. None for no limit.
+        n_workers (int): Number of reader threads. Defaults to the cpu count.
+        largest_block (int): Passed to hb.iterblocks_hb to decide how many cells are read at once.
+
+    Returns:
+        dict with keys min, max, mean, stddev, sum, valid_count, valid_percent, approximate (always False),
+        histogram (dict with min, max, buckets and counts, or None), unique_values and unique_counts (np.ndarrays or None).
+        If there are no valid pixels, min/max/mean/stddev are None.
+    """
+    ds = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    if ds is None:
+        raise FileNotFoundError('compute_raster_stats_block_scan could not open ' + str(raster_path))
+    band = ds.GetRasterBand(band_index)
+    data_type = band.DataType
+    ndv = band.GetNoDataValue()
+    n_pixels = band.XSize * band.YSize
+    numpy_type = gdal_number_to_numpy_type[data_type]
+    is_integer = np.issubdtype(numpy_type, np.integer)
+
+    if calculate_unique_values is None:
+        calculate_unique_values = is_integer
+    track_unique_values = bool(calculate_unique_values and is_integer)
+
+    # Without unique values, a single-pass histogram needs its range before the scan starts.
+    histogram_edges = None
+    if calculate_histogram and not track_unique_values:
+        if histogram_range is None:
+            try:
+                histogram_range = band.ComputeRasterMinMax(True)
+            except RuntimeError:
+                histogram_range = None # Raised by GDAL when there are no valid pixels, in which case there is no histogram.
+        if histogram_range is not None:
+            histogram_min, histogram_max = float(histogram_range[0]), float(histogram_range[1])
+            if histogram_min == histogram_max:
+                histogram_min, histogram_max = histogram_min - 0.5, histogram_max + 0.5
+            histogram_edges = np.linspace(histogram_min, histogram_max, histogram_buckets + 1)
+    band = None
+    ds = None
+
+    offsets = list(hb.iterblocks_hb((raster_path, band_index), largest_block=largest_block, offset_only=True))
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(1, min(n_workers, len(offsets)))
+
+    if verbose:
+        hb.log('Scanning ' + str(len(offsets)) + ' blocks of ' + str(raster_path) + ' with ' + str(n_workers) + ' threads.')
+
+    # Interleave blocks across workers so that each thread gets a similar mix of ocean and land.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_scan_blocks_for_raster_stats, raster_path, band_index, offsets[i::n_workers], ndv,
+                                   track_unique_values, max_unique_values, histogram_edges) for i in range(n_workers)]
+        partials = [future.result() for future in futures]
+    merged = _merge_raster_stats_partials(partials)
+
+    n = merged['n']
+    stats = {
+        'min': None, 'max': None, 'mean': None, 'stddev': None,
+        'sum': merged['mean'] * n,
+        'valid_count': n,
+        'valid_percent': 100.0 * n / n_pixels if n_pixels else 0.0,
+        'approximate': False,
+        'histogram': None,
+        'unique_values': merged['unique_values'],
+        'unique_counts': merged['unique_counts'],
+    }
+    if n > 0:
+        stats['min'] = float(merged['min'])
+        stats['max'] = float(merged['max'])
+        stats['mean'] = merged['mean']
+        stats['stddev'] = (merged['m2'] / n) ** 0.5
+
+    if calculate_histogram and n > 0:
+        if merged['histogram'] is None and merged['unique_values'] is not None:
+            if data_type == 1:
+                histogram_min, histogram_max, buckets = -0.5, 255.5, 256
+            else:
+                histogram_min, histogram_max = stats['min'] - 0.5, stats['max'] + 0.5
+                buckets = int(min(histogram_buckets, histogram_max - histogram_min))
+            counts = np.histogram(merged['unique_values'], bins=buckets, range=(histogram_min, histogram_max), weights=merged['unique_counts'])[0]
+            stats['histogram'] = {'min': histogram_min, 'max': histogram_max, 'buckets': buckets, 'counts': counts.astype(np.int64)}
+        elif merged['histogram'] is not None:
+            stats['histogram'] = {'min': float(histogram_edges[0]), 'max': float(histogram_edges[-1]), 'buckets': len(histogram_edges) - 1, 'counts': merged['histogram']}
+        else:
+            # Unique values overflowed on an integer raster, so fall back to a second, histogram-only read.
+            hb.log('More than ' + str(max_unique_values) + ' unique values in ' + str(raster_path) + ', computing histogram from a second read.')
+            return_stats = compute_raster_stats_block_scan(raster_path, band_index=band_index, calculate_histogram=True, calculate_unique_values=False,
+                                                           histogram_buckets=histogram_buckets, histogram_range=(stats['min'], stats['max']),
+                                                           n_workers=n_workers, largest_block=largest_block)
+            stats['histogram'] = return_stats['histogram']
+
+    return stats
+
+
+def add_stats_to_geotiff_with_block_scan(geotiff_path,
+                                         band_index=None,
+                                         calculate_histogram=True,
+                                         write_unique_values_list=None,
+                                         histogram_buckets=256,
+                                         histogram_range=None,
+                                         max_unique_values=10000,
+                                         write_to_aux_xml=True,
+                                         n_workers=None,
+                                         verbose=False):
+    """Compute exact stats, histogram and unique values with compute_raster_stats_block_scan (one read of the data)
+    and write them where get_stats_from_geotiff and get_unique_values_from_geotiff will find them.
+
+    add_stats_to_geotiff_with_gdal, add_stats_to_geotiff_with_gdalinfo and add_stats_to_geotiff_with_gdal_full are
+    thin wrappers around this, replacing their separate ComputeStatistics, GetHistogram and gdalinfo passes.
+
+    If write_to_aux_xml is True, the file is opened read-only so that GDAL writes the results to the .aux.xml sidecar,
+    otherwise it is opened in update mode and they are written internally. Unique values are written as comma
+    separated lists to the STATISTICS_UNIQUE_VALUES and STATISTICS_UNIQUE_COUNTS metadata items.
+
+    Returns a dict of stats dicts keyed by band number.
+    """
+    if write_to_aux_xml:
+        ds = gdal.OpenEx(geotiff_path, gdal.OF_RASTER)
+    else:
+        ds = gdal.OpenEx(geotiff_path, gdal.OF_RASTER | gdal.OF_UPDATE, open_options=["IGNORE_COG_LAYOUT_BREAK=YES"])
+    if ds is None:
+        raise FileNotFoundError(f"Could not open {geotiff_path}")
+
+    if band_index is None:
+        band_indices = range(1, ds.RasterCount + 1)
+    else:
+        band_indices = [band_index]
+
+    # Integer rasters still track unique values when they are not written because it gives the exact histogram for free.
+    if write_unique_values_list is False:
+        calculate_unique_values = None if calculate_histogram else False
+    else:
+        calculate_unique_values = write_unique_values_list
+
+    stats_by_band = {}
+    for current_band_index in band_indices:
+        stats = compute_raster_stats_block_scan(geotiff_path, band_index=current_band_index, calculate_histogram=calculate_histogram,
+                                                calculate_unique_values=calculate_unique_values, histogram_buckets=histogram_buckets,
+                                                histogram_range=histogram_range, max_unique_values=max_unique_values, n_workers=n_workers)
+        stats_by_band[current_band_index] = stats
+        band = ds.GetRasterBand(current_band_index)
+
+        if stats['valid_count'] == 0:
+            L.warning('Stats not calculated for ' + str(geotiff_path) + ' band ' + str(current_band_index) + ' since no valid pixels were found.')
+            continue
+
+        band.SetStatistics(stats['min'], stats['max'], stats['mean'], stats['stddev'])
+        band.SetMetadataItem('STATISTICS_APPROXIMATE', 'NO')
+        band.SetMetadataItem('STATISTICS_VALID_PERCENT', str(stats['valid_percent']))
+        band.SetMetadataItem('STATISTICS_VALID_COUNT', str(int(stats['valid_count'])))
+        band.SetMetadataItem('STATISTICS_SUM', str(stats['sum']))
+
+        if stats['histogram'] is not None:
+            histogram = stats['histogram']
+            band.SetDefaultHistogram(histogram['min'], histogram['max'], [int(i) for i in histogram['counts']])
+
+        if write_unique_values_list is not False and stats['unique_values'] is not None:
+            band.SetMetadataItem('STATISTICS_UNIQUE_VALUES', ','.join(str(int(i)) for i in stats['unique_values']))
+            band.SetMetadataItem('STATISTICS_UNIQUE_COUNTS', ','.join(str(int(i)) for i in stats['unique_counts']))
+
+        if verbose:
+            hb.log(f"Band {current_band_index} from path {geotiff_path} has stats: min={stats['min']:.4f}, max={stats['max']:.4f}, mean={stats['mean']:.4f}, stddev={stats['stddev']:.4f}, valid_count={stats['valid_count']}")
+
+        band.FlushCache()
+        band = None
+
+    ds.FlushCache()
+    ds = None
+    return stats_by_band
+
+
+def get_unique_values_from_geotiff(geotiff_path, band_index=1):
+    """Return an OrderedDict of unique value to count as written by add_stats_to_geotiff_with_block_scan, or None
+    if the raster has no unique values list."""
+    ds = gdal.OpenEx(geotiff_path, gdal.OF_RASTER)
+    if ds is None:
+        raise FileNotFoundError(f"Could not open file: {geotiff_path}")
+    band = ds.GetRasterBand(band_index)
+    values_string = band.GetMetadataItem('STATISTICS_UNIQUE_VALUES')
+    counts_string = band.GetMetadataItem('STATISTICS_UNIQUE_COUNTS')
+    band = None
+    ds = None
 
+    if not values_string:
+        return None
+    values = [int(i) for i in values_string.split(',')]
+    counts = [int(i) for i in counts_string.split(',')]
+    return OrderedDict(zip(values, counts))
 
 
+def _get_class_index_array(values, sorted_classes, nodata=None):
+    """Return int32 positions of values in sorted_classes, -1 where the value is nodata or not a class."""
+    if len(sorted_classes) == 0:
+        raise ValueError('No classes given to look values up in.')
+    index = np.searchsorted(sorted_classes, values)
+    np.clip(index, 0, len(sorted_classes) - 1, out=index)
+    matched = sorted_classes[index] == values
+    if nodata is not None:
+        matched &= values != nodata
+    return np.where(matched, index, -1).astype(np.int32)
 
 
+def _get_raster_classes(raster_path, band_index=1):
+    """Unique values of an integer raster, from its unique values metadata if present, otherwise from a block scan."""
+    numpy_type = gdal_number_to_numpy_type[hb.get_raster_info_hb(raster_path)['datatype']]
+    if not np.issubdtype(numpy_type, np.integer):
+        raise ValueError('Classes can only be read from integer rasters, but ' + str(raster_path) + ' is ' + str(np.dtype(numpy_type)) + '. Pass the classes explicitly.')
+    unique_values = get_unique_values_from_geotiff(raster_path, band_index)
+    if unique_values is not None:
+        return list(unique_values.keys())
+    stats = compute_raster_stats_block_scan(raster_path, band_index, calculate_histogram=False, calculate_unique_values=True, max_unique_values=None)
+    return [int(i) for i in stats['unique_values']]
 
 
+def calculate_change_matrix_from_rasters(
+        baseline_path, scenario_path, classes=None, zones_path=None,
+        zone_ids=None, class_labels=None, n_threads=None,
+        largest_block=hb.globals.LARGEST_ITERBLOCK):
+    """Count the cell transitions between two aligned integer rasters (eg baseline and scenario LULC), streaming both
+    through iterblocks_hb so memory does not depend on raster size.
 
+    Blocks are counted on a thread pool by the nogil cython_functions.accumulate_change_matrix, each thread into its
+    own counts array, and the partial counts are summed at the end. Cells that are nodata in either raster (or in
+    zones_path) or that are not in classes (or zone_ids) are not counted.
 
+    Args:
+        baseline_path (str): Raster whose classes become the rows.
+        scenario_path (str): Raster whose classes become the columns.
+        classes (list): Classes to count. Defaults to the union of the unique values of both rasters.
+        zones_path (str): Optional aligned integer raster; if given a matrix is computed for every zone.
+        zone_ids (list): Zones to count. Defaults to the unique values of zones_path.
+        class_labels (dict): Optional class to label mapping used for the row and column labels.
+        n_threads (int): Threads counting blocks. Defaults to the cpu count.
+        largest_block (int): See iterblocks_hb.
 
+    Returns:
+        DataFrame of int64 counts with baseline classes as the index and scenario classes as the columns. With
+        zones_path, the index is a (zone, baseline) MultiIndex.
+    """
+    from hazelbean.calculation_core.cython_functions import accumulate_change_matrix
+
+    input_paths = [baseline_path, scenario_path] + ([zones_path] if zones_path is not None else [])
+    raster_sizes = [hb.get_raster_info_hb(path)['raster_size'] for path in input_paths]
+    if len(set(raster_sizes)) > 1:
+        raise ValueError('Rasters must be aligned, got sizes ' + str(raster_sizes) + ' for ' + str(input_paths))
+    nodata_list = [hb.get_ndv_from_path(path) for path in input_paths]
+
+    if classes is None:
+        classes = sorted(set(_get_raster_classes(baseline_path)) | set(_get_raster_classes(scenario_path)))
+        classes = [i for i in classes if i not in nodata_list[:2]]
+    if len(classes) == 0:
+        raise ValueError('No classes to count in ' + str(baseline_path) + ' and ' + str(scenario_path) + '.')
+    sorted_classes = np.asarray(sorted(classes), dtype=np.int64)
+    n_classes = len(sorted_classes)
+
+    if zones_path is not None:
+        if zone_ids is None:
+            zone_ids = [i for i in _get_raster_classes(zones_path) if i != nodata_list[2]]
+        if len(zone_ids) == 0:
+            raise ValueError('No zones to count in ' + str(zones_path) + '.')
+        sorted_zones = np.asarray(sorted(zone_ids), dtype=np.int64)
+    else:
+        sorted_zones = np.zeros(1, dtype=np.int64)
+    n_zones = len(sorted_zones)
+
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    thread_local = threading.local()
+    partial_counts = []
+    partial_counts_lock = threading.Lock()
+
+    def _count_block(offset):
+        if not hasattr(thread_local, 'bands'):
+            thread_local.rasters = [gdal.OpenEx(path, gdal.OF_RASTER) for path in input_paths]
+            thread_local.bands = [raster.GetRasterBand(1) for raster in thread_local.rasters]
+            thread_local.counts = np.zeros((n_zones, n_classes, n_classes), dtype=np.int64)
+            with partial_counts_lock:
+                partial_counts.append(thread_local.counts)
+        arrays = [band.ReadAsArray(**offset) for band in thread_local.bands]
+        baseline_index = _get_class_index_array(arrays[0], sorted_classes, nodata_list[0])
+        scenario_index = _get_class_index_array(arrays[1], sorted_classes, nodata_list[1])
+        zone_index = _get_class_index_array(arrays[2], sorted_zones, nodata_list[2]) if zones_path is not None else None
+        accumulate_change_matrix(baseline_index, scenario_index, zone_index, thread_local.counts)
+
+    offsets = list(hb.iterblocks_hb((baseline_path, 1), largest_block=largest_block, offset_only=True))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(_count_block, offsets))
+    counts = np.sum(partial_counts, axis=0) if partial_counts else np.zeros((n_zones, n_classes, n_classes), dtype=np.int64)
+
+    if class_labels is not None:
+        labels = [class_labels.get(i, i) for i in sorted_classes.tolist()]
+    else:
+        labels = sorted_classes.tolist()
+    columns = pd.Index(labels, name='scenario')
+    if zones_path is None:
+        return pd.DataFrame(counts[0], index=pd.Index(labels, name='baseline'), columns=columns)
+    index = pd.MultiIndex.from_product([sorted_zones.tolist(), labels], names=['zone', 'baseline'])
+    return pd.DataFrame(counts.reshape(n_zones * n_classes, n_classes), index=index, columns=columns)
+
+
+def _create_raster_like(base_raster_info, target_path, n_cols, n_rows, pixel_scale, datatype, nodata, gtiff_creation_options, n_bands=1):
+    """Create a GeoTIFF covering the same extent as base_raster_info with the pixel size multiplied by pixel_scale.
+    Returns the open dataset."""
+    geotransform = list(base_raster_info['geotransform'])
+    geotransform[1] *= pixel_scale
+    geotransform[2] *= pixel_scale
+    geotransform[4] *= pixel_scale
+    geotransform[5] *= pixel_scale
+    target_raster = gdal.GetDriverByName('GTiff').Create(target_path, n_cols, n_rows, n_bands, datatype, options=gtiff_creation_options)
+    target_raster.SetProjection(base_raster_info['projection'])
+    target_raster.SetGeoTransform(geotransform)
+    if nodata is not None:
+        for band_index in range(1, n_bands + 1):
+            target_raster.GetRasterBand(band_index).SetNoDataValue(nodata)
+    return target_raster
 
 
+def upscale_raster_by_factor(
+        fine_path, coarse_path, upscale_factor, method='sum',
+        output_nodata=None, n_threads=None,
+        largest_block=hb.globals.LARGEST_ITERBLOCK * 4,
+        gtiff_creation_options=hb.globals.DEFAULT_GTIFF_CREATION_OPTIONS):
+    """Aggregate a raster to a coarser grid whose cells are upscale_factor by upscale_factor fine cells, streaming
+    strips of fine rows aligned to the coarse grid so that the fine raster is never fully in memory.
 
+    Each strip is reduced by aspect_ratio_array_functions.upscale_block_by_factor (nogil) on a thread pool and written
+    to the coarse raster as it completes. Nodata (and NaN) fine cells are skipped. The output type follows the
+    kernel: min and max keep the input type, sum is Int64 for integer input (Float64 for float), mean is Float64 and
+    count is Int64 (or 'proportion_valid', the Float64 share of valid fine cells, as
+    cython_calc_proportion_of_coarse_res_with_valid_fine_res computes in memory).
 
+    Args:
+        fine_path (str): Input raster. Its size must be a multiple of upscale_factor.
+        coarse_path (str): Output raster.
+        upscale_factor (int): Fine cells per coarse cell along each axis.
+        method (str): 'sum', 'mean', 'min', 'max', 'count' or 'proportion_valid'.
+        output_nodata: Value for coarse cells with no valid fine cells. Defaults to the input nodata for min and max,
+            and -9999 otherwise. Not used for sum, count and proportion_valid, which are 0 there.
+        n_threads (int): Threads reducing strips. Defaults to the cpu count.
+        largest_block (int): Approximate number of fine cells per strip.
+        gtiff_creation_options (list): Creation options for the output.
+    """
+    from hazelbean.calculation_core.aspect_ratio_array_functions import upscale_block_by_factor
+
+    if method not in ('sum', 'mean', 'min', 'max', 'count', 'proportion_valid'):
+        raise ValueError('method must be one of sum, mean, min, max, count or proportion_valid, got ' + str(method))
+    upscale_factor = int(upscale_factor)
+    raster_info = hb.get_raster_info_hb(fine_path)
+    n_fine_cols, n_fine_rows = raster_info['raster_size']
+    if n_fine_cols % upscale_factor or n_fine_rows % upscale_factor:
+        raise ValueError('Raster size ' + str(raster_info['raster_size']) + ' of ' + str(fine_path) + ' is not a multiple of ' + str(upscale_factor))
+    n_coarse_cols, n_coarse_rows = n_fine_cols // upscale_factor, n_fine_rows // upscale_factor
+    input_nodata = raster_info['nodata'][0]
+    input_numpy_type = np.dtype(gdal_number_to_numpy_type[raster_info['datatype']])
+    kernel_method = 'count' if method == 'proportion_valid' else method
+
+    if method in ('min', 'max'):
+        output_datatype = raster_info['datatype']
+    elif method == 'sum' and not np.issubdtype(input_numpy_type, np.floating):
+        output_datatype = gdal.GDT_Int64
+    elif method == 'count':
+        output_datatype = gdal.GDT_Int64
+    else:
+        output_datatype = gdal.GDT_Float64
+    if method in ('sum', 'count', 'proportion_valid'):
+        output_nodata = None
+    elif output_nodata is None:
+        output_nodata = input_nodata if (method in ('min', 'max') and input_nodata is not None) else -9999
+
+    target_raster = _create_raster_like(
+        raster_info, coarse_path, n_coarse_cols, n_coarse_rows, upscale_factor, output_datatype, output_nodata,
+        gtiff_creation_options)
+    target_band = target_raster.GetRasterBand(1)
+
+    coarse_rows_per_strip = max(1, int(largest_block // (n_fine_cols * upscale_factor)))
+    thread_local = threading.local()
+    write_lock = threading.Lock()
+
+    def _upscale_strip(coarse_row_offset):
+        if not hasattr(thread_local, 'band'):
+            thread_local.raster = gdal.OpenEx(fine_path, gdal.OF_RASTER)
+            thread_local.band = thread_local.raster.GetRasterBand(1)
+        n_strip_rows = min(coarse_rows_per_strip, n_coarse_rows - coarse_row_offset)
+        fine_array = thread_local.band.ReadAsArray(0, coarse_row_offset * upscale_factor, n_fine_cols, n_strip_rows * upscale_factor)
+        coarse_array, valid_count = upscale_block_by_factor(np.ascontiguousarray(fine_array), upscale_factor, kernel_method, input_nodata)
+        if method == 'proportion_valid':
+            coarse_array = coarse_array / float(upscale_factor * upscale_factor)
+        elif output_nodata is not None:
+            coarse_array[valid_count == 0] = output_nodata
+        with write_lock:
+            target_band.WriteArray(coarse_array, 0, coarse_row_offset)
+
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(_upscale_strip, range(0, n_coarse_rows, coarse_rows_per_strip)))
+
+    target_band.FlushCache()
+    target_band = None
+    target_raster = None
 
 
+def downscale_raster_by_factor(
+        coarse_path, fine_path, downscale_factor, n_threads=None,
+        largest_block=hb.globals.LARGEST_ITERBLOCK * 4,
+        gtiff_creation_options=hb.globals.DEFAULT_GTIFF_CREATION_OPTIONS):
+    """Raster-to-raster version of naive_downscale: write each coarse cell into its downscale_factor by
+    downscale_factor fine cells, keeping the input type and nodata. Streams strips of coarse rows through
+    aspect_ratio_array_functions.naive_downscale_block (nogil) on a thread pool.
 
+    Args:
+        coarse_path (str): Input raster.
+        fine_path (str): Output raster, downscale_factor times larger along each axis.
+        downscale_factor (int): Fine cells per coarse cell along each axis.
+        n_threads (int): Threads expanding strips. Defaults to the cpu count.
+        largest_block (int): Approximate number of fine cells written per strip.
+        gtiff_creation_options (list): Creation options for the output.
+    """
+    from hazelbean.calculation_core.aspect_ratio_array_functions import naive_downscale_block
+
+    downscale_factor = int(downscale_factor)
+    raster_info = hb.get_raster_info_hb(coarse_path)
+    n_coarse_cols, n_coarse_rows = raster_info['raster_size']
+    n_fine_cols = n_coarse_cols * downscale_factor
+
+    target_raster = _create_raster_like(
+        raster_info, fine_path, n_fine_cols, n_coarse_rows * downscale_factor, 1.0 / downscale_factor,
+        raster_info['datatype'], raster_info['nodata'][0], gtiff_creation_options)
+    target_band = target_raster.GetRasterBand(1)
+
+    coarse_rows_per_strip = max(1, int(largest_block // (n_fine_cols * downscale_factor)))
+    thread_local = threading.local()
+    write_lock = threading.Lock()
+
+    def _downscale_strip(coarse_row_offset):
+        if not hasattr(thread_local, 'band'):
+            thread_local.raster = gdal.OpenEx(coarse_path, gdal.OF_RASTER)
+            thread_local.band = thread_local.raster.GetRasterBand(1)
+        n_strip_rows = min(coarse_rows_per_strip, n_coarse_rows - coarse_row_offset)
+        coarse_array = thread_local.band.ReadAsArray(0, coarse_row_offset, n_coarse_cols, n_strip_rows)
+        fine_array = naive_downscale_block(np.ascontiguousarray(coarse_array), downscale_factor)
+        with write_lock:
+            target_band.WriteArray(fine_array, 0, coarse_row_offset * downscale_factor)
+
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(_downscale_strip, range(0, n_coarse_rows, coarse_rows_per_strip)))
+
+    target_band.FlushCache()
+    target_band = None
+    target_raster = None
 
 
+def calculate_class_coverage_from_fine_raster(
+        fine_path, coarse_match_path, class_list, output_path=None,
+        class_output_paths=None, units='fraction', mode_path=None,
+        majority_path=None, n_threads=None,
+        largest_block=hb.globals.LARGEST_ITERBLOCK * 4,
+        gtiff_creation_options=hb.globals.DEFAULT_GTIFF_CREATION_OPTIONS):
+    """Aggregate a fine categorical raster (eg LULC) to the coarse grid of coarse_match_path as the fraction (or
+    hectares) of each coarse cell covered by each class, in one streamed read of the fine raster.
 
+    This is the raster-to-raster, parallel version of calculate_coarse_state_stack_from_fine_classified. Strips of fine
+    rows aligned to the coarse grid are read on a thread pool and reduced by the nogil
+    cython_functions.accumulate_class_coverage_by_factor, and the coarse strips are written as they complete. The fine
+    raster must be an integer multiple of the coarse raster in both dimensions, with the same origin and a pixel size
+    that is exactly the coarse pixel size divided by that multiple. A ValueError is raised otherwise.
 
+    Args:
+        fine_path (str): Fine categorical raster.
+        coarse_match_path (str): Raster defining the coarse grid.
+        class_list (list): Classes to summarize, one output band (or raster) per class in this order.
+        output_path (str): Multi-band output, band i for class_list[i].
+        class_output_paths (list): Alternatively (or additionally), one single-band output path per class.
+        units (str): 'fraction' of the coarse cell (nodata fine cells count toward the total), 'hectares', or 'count'.
+            Hectares use the ellipsoidal cell area by latitude for geographic rasters.
+        mode_path (str): Optional output of the most common valid fine value per coarse cell (ties to the first in
+            class_list; values not in class_list are never the mode).
+        majority_path (str): Optional output of the class covering more than half of the valid fine cells, nodata
+            where no class does.
+        n_threads (int): Threads processing strips. Defaults to the cpu count.
+        largest_block (int): Approximate number of fine cells per strip.
+        gtiff_creation_options (list): Creation options for the outputs.
+    """
+    from hazelbean.calculation_core.cython_functions import accumulate_class_coverage_by_factor
+
+    if units not in ('fraction', 'hectares', 'count'):
+        raise ValueError('units must be fraction, hectares or count, got ' + str(units))
+    if output_path is None and class_output_paths is None and mode_path is None and majority_path is None:
+        raise ValueError('No output requested.')
+    if len(class_list) == 0:
+        raise ValueError('class_list must have at least one class.')
+    if class_output_paths is not None and len(class_output_paths) != len(class_list):
+        raise ValueError('class_output_paths must have one path per class.')
+
+    fine_info = hb.get_raster_info_hb(fine_path)
+    coarse_info = hb.get_raster_info_hb(coarse_match_path)
+    n_fine_cols, n_fine_rows = fine_info['raster_size']
+    n_coarse_cols, n_coarse_rows = coarse_info['raster_size']
+    if n_fine_cols % n_coarse_cols or n_fine_rows % n_coarse_rows or n_fine_cols // n_coarse_cols != n_fine_rows // n_coarse_rows:
+        raise ValueError('Fine raster size ' + str(fine_info['raster_size']) + ' is not the same integer multiple of coarse raster size ' + str(coarse_info['raster_size']))
+    upscale_factor = n_fine_cols // n_coarse_cols
+    # The sizes alone do not mean the grids line up, so also check the origins and that the fine pixel size is
+    # exactly 1 / upscale_factor of the coarse one (to a small fraction of a fine pixel).
+    fine_geotransform = fine_info['geotransform']
+    coarse_geotransform = coarse_info['geotransform']
+    tolerance = 1e-6 * min(abs(fine_geotransform[1]), abs(fine_geotransform[5]))
+    if (abs(fine_geotransform[0] - coarse_geotransform[0]) > tolerance or abs(fine_geotransform[3] - coarse_geotransform[3]) > tolerance
+            or abs(fine_geotransform[1] * upscale_factor - coarse_geotransform[1]) > tolerance
+            or abs(fine_geotransform[5] * upscale_factor - coarse_geotransform[5]) > tolerance
+            or fine_geotransform[2] != 0 or fine_geotransform[4] != 0 or coarse_geotransform[2] != 0 or coarse_geotransform[4] != 0):
+        raise ValueError('Fine raster geotransform ' + str(list(fine_geotransform)) + ' is not aligned with coarse raster geotransform ' + str(list(coarse_geotransform))
+                         + ': they must share an origin and the fine pixel size must be the coarse pixel size divided by ' + str(upscale_factor) + '.')
+    fine_nodata = fine_info['nodata'][0]
+    sorted_order = np.argsort(class_list, kind='stable')
+    sorted_classes = np.asarray(class_list, dtype=np.int64)[sorted_order]
+    n_classes = len(class_list)
+
+    # Weight added per fine cell, by fine row.
+    if units == 'hectares':
+        geotransform = fine_info['geotransform']
+        if fine_info['projection'] and osr.SpatialReference(fine_info['projection']).IsGeographic():
+            center_lats = geotransform[3] + geotransform[5] * (np.arange(n_fine_rows) + 0.5)
+            fine_row_weights = np.abs([hb.get_area_of_pixel_from_center_lat(abs(geotransform[5]), lat) for lat in center_lats]) / 10000.0
+        else:
+            fine_row_weights = np.full(n_fine_rows, abs(geotransform[1] * geotransform[5]) / 10000.0)
+    else:
+        fine_row_weights = np.ones(n_fine_rows, dtype=np.float64)
+    fine_row_weights = np.ascontiguousarray(fine_row_weights, dtype=np.float64)
+
+    output_nodata = -9999.0
+    output_datatype = gdal.GDT_Int32 if units == 'count' else gdal.GDT_Float32 if units == 'fraction' else gdal.GDT_Float64
+    class_numpy_type = gdal_number_to_numpy_type[fine_info['datatype']]
+    class_nodata = fine_nodata
+    if class_nodata is None:
+        # Mode and majority use the fine type, where -9999 would wrap (eg to 241 for Byte), so take the largest value
+        # of that type that is not a class.
+        if np.issubdtype(class_numpy_type, np.integer):
+            class_values = set(int(i) for i in class_list)
+            class_nodata = int(np.iinfo(class_numpy_type).max)
+            while class_nodata in class_values:
+                class_nodata -= 1
+        else:
+            class_nodata = -9999
+    targets = []
+    if output_path is not None:
+        targets.append(_create_raster_like(coarse_info, output_path, n_coarse_cols, n_coarse_rows, 1.0, output_datatype, output_nodata, gtiff_creation_options, n_bands=n_classes))
+    if class_output_paths is not None:
+        targets.extend(_create_raster_like(coarse_info, path, n_coarse_cols, n_coarse_rows, 1.0, output_datatype, output_nodata, gtiff_creation_options) for path in class_output_paths)
+    mode_raster = _create_raster_like(coarse_info, mode_path, n_coarse_cols, n_coarse_rows, 1.0, fine_info['datatype'], class_nodata, gtiff_creation_options) if mode_path is not None else None
+    majority_raster = _create_raster_like(coarse_info, majority_path, n_coarse_cols, n_coarse_rows, 1.0, fine_info['datatype'], class_nodata, gtiff_creation_options) if majority_path is not None else None
+
+    coarse_rows_per_strip = max(1, int(largest_block // (n_fine_cols * upscale_factor)))
+    thread_local = threading.local()
+    write_lock = threading.Lock()
+
+    def _coverage_strip(coarse_row_offset):
+        if not hasattr(thread_local, 'band'):
+            thread_local.raster = gdal.OpenEx(fine_path, gdal.OF_RASTER)
+            thread_local.band = thread_local.raster.GetRasterBand(1)
+        n_strip_rows = min(coarse_rows_per_strip, n_coarse_rows - coarse_row_offset)
+        fine_row_offset = coarse_row_offset * upscale_factor
+        fine_array = thread_local.band.ReadAsArray(0, fine_row_offset, n_fine_cols, n_strip_rows * upscale_factor)
+
+        # Position of each cell's class in class_list; valid cells of other classes go in an extra last layer so
+        # that mode and majority know the number of valid fine cells.
+        sorted_position = _get_class_index_array(fine_array, sorted_classes, fine_nodata)
+        class_position = np.where(sorted_position >= 0, sorted_order[np.maximum(sorted_position, 0)], n_classes).astype(np.int32)
+        if fine_nodata is not None:
+            class_position[fine_array == fine_nodata] = -1
+
+        coverage = np.zeros((n_classes + 1, n_strip_rows, n_coarse_cols), dtype=np.float64)
+        accumulate_class_coverage_by_factor(class_position, upscale_factor, fine_row_weights[fine_row_offset:fine_row_offset + n_strip_rows * upscale_factor], coverage)
+
+        class_coverage = coverage[:n_classes]
+        if units == 'fraction':
+            class_coverage = class_coverage / float(upscale_factor * upscale_factor)
+        results = []
+        if mode_raster is not None or majority_raster is not None:
+            valid_total = coverage.sum(axis=0)
+            best = np.argmax(coverage[:n_classes], axis=0)
+            best_coverage = np.take_along_axis(coverage[:n_classes], best[np.newaxis], axis=0)[0]
+            best_class = np.asarray(class_list, dtype=class_numpy_type)[best]
+            if mode_raster is not None:
+                results.append((mode_raster, 1, np.where(best_coverage > 0, best_class, class_nodata).astype(class_numpy_type)))
+            if majority_raster is not None:
+                results.append((majority_raster, 1, np.where(best_coverage > 0.5 * valid_total, best_class, class_nodata).astype(class_numpy_type)))
+
+        with write_lock:
+            target_index = 0
+            if output_path is not None:
+                for class_index in range(n_classes):
+                    targets[0].GetRasterBand(class_index + 1).WriteArray(class_coverage[class_index], 0, coarse_row_offset)
+                target_index = 1
+            if class_output_paths is not None:
+                for class_index in range(n_classes):
+                    targets[target_index + class_index].GetRasterBand(1).WriteArray(class_coverage[class_index], 0, coarse_row_offset)
+            for raster, band_index, array in results:
+                raster.GetRasterBand(band_index).WriteArray(array, 0, coarse_row_offset)
+
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(_coverage_strip, range(0, n_coarse_rows, coarse_rows_per_strip)))
+
+    for raster in targets + [mode_raster, majority_raster]:
+        if raster is not None:
+            raster.FlushCache()
+    targets = None
+    mode_raster = None
+    majority_raster = None
+
+
+def get_zone_block_index_path(zone_ids_raster_path):
+    """Path of the zone-to-block index sidecar stored next to zone_ids_raster_path."""
+    return str(zone_ids_raster_path) + '.zone_block_index.npz'
+
+
+def _get_zone_ids_of_block(zone_ids_raster_path, block_offsets, thread_local):
+    if not hasattr(thread_local, 'band'):
+        thread_local.raster = gdal.OpenEx(zone_ids_raster_path, gdal.OF_RASTER)
+        thread_local.band = thread_local.raster.GetRasterBand(1)
+    xoff, yoff, win_xsize, win_ysize = block_offsets
+    zones_array = thread_local.band.ReadAsArray(int(xoff), int(yoff), int(win_xsize), int(win_ysize))
+    return np.unique(zones_array, return_counts=True)
+
+
+def build_zone_block_index(zone_ids_raster_path, index_path=None, largest_block=hb.globals.LARGEST_ITERBLOCK, n_threads=None):
+    """Scan an integer zone ids raster (eg country ids) once and record which zone ids occur in which blocks, saving the
+    result as an .npz sidecar (see get_zone_block_index_path) so that later calls can read only the blocks that intersect
+    the zones they need.
+
+    The blocks are the windows hb.iterblocks_hb gives for largest_block. The index stores the block offsets, the sorted
+    zone ids present (including the nodata value, if present), and for each zone the indices of its blocks and the
+    number of cells it has in each, in CSR form. The size and mtime of the zone raster are recorded so that a stale
+    index is rebuilt by load_zone_block_index. If the sidecar cannot be written (eg a read-only directory) the index is
+    still returned, just not saved.
+
+    Returns the index dict (as load_zone_block_index).
+    """
+    if index_path is None:
+        index_path = get_zone_block_index_path(zone_ids_raster_path)
+    block_offsets = np.asarray([[i['xoff'], i['yoff'], i['win_xsize'], i['win_ysize']]
+                                for i in hb.iterblocks_hb((zone_ids_raster_path, 1), largest_block=largest_block, offset_only=True)], dtype=np.int64).reshape(-1, 4)
+
+    thread_local = threading.local()
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        block_results = list(executor.map(lambda offsets: _get_zone_ids_of_block(zone_ids_raster_path, offsets, thread_local), block_offsets))
+
+    # Flatten to (zone, block, count) triples and sort by zone then block.
+    block_zone_ids = np.concatenate([ids for ids, counts in block_results] + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    block_cell_counts = np.concatenate([counts for ids, counts in block_results] + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    block_indices = np.repeat(np.arange(len(block_results), dtype=np.int64), [len(ids) for ids, counts in block_results])
+    order = np.lexsort((block_indices, block_zone_ids))
+    block_zone_ids = block_zone_ids[order]
+    zone_ids, zone_starts = np.unique(block_zone_ids, return_index=True)
+    zone_block_indptr = np.append(zone_starts, len(block_zone_ids)).astype(np.int64)
+
+    stat_result = os.stat(zone_ids_raster_path)
+    index = {
+        'zone_ids': zone_ids,
+        'zone_block_indptr': zone_block_indptr,
+        'zone_block_indices': block_indices[order],
+        'zone_block_cell_counts': block_cell_counts[order],
+        'block_offsets': block_offsets,
+        'largest_block': np.int64(largest_block),
+        'source_size': np.int64(stat_result.st_size),
+        'source_mtime_ns': np.int64(stat_result.st_mtime_ns),
+    }
+
+    # Write to a temporary file first so that a concurrent reader never sees a partial index. The sidecar is only a
+    # cache, so if it cannot be written (eg a read-only data directory) the index is just used from memory.
+    temp_path = index_path + '.' + str(os.getpid()) + '.tmp.npz'
+    try:
+        np.savez(temp_path, **index)
+        os.replace(temp_path, index_path)
+    except Exception as e:
+        L.debug('Unable to write zone block index ' + str(index_path) + ', using it from memory: ' + str(e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return index
+
+
+def load_zone_block_index(zone_ids_raster_path, index_path=None, build_if_missing=True, largest_block=hb.globals.LARGEST_ITERBLOCK, n_threads=None):
+    """Load the zone-to-block index sidecar of zone_ids_raster_path, (re)building it if it is missing or the zone
+    raster changed since it was built. Returns None if there is no valid index and build_if_missing is False."""
+    if index_path is None:
+        index_path = get_zone_block_index_path(zone_ids_raster_path)
+    if hb.path_exists(index_path):
+        try:
+            with np.load(index_path) as npz:
+                index = {key: npz[key] for key in npz.files}
+            stat_result = os.stat(zone_ids_raster_path)
+            if index['source_size'] == stat_result.st_size and index['source_mtime_ns'] == stat_result.st_mtime_ns and index['largest_block'] == largest_block:
+                return index
+            L.info('Zone block index ' + str(index_path) + ' is out of date with ' + str(zone_ids_raster_path) + '.')
+        except Exception as e:
+            L.debug('Ignoring unreadable zone block index ' + str(index_path) + ': ' + str(e))
+    if not build_if_missing:
+        return None
+    L.info('Building zone block index for ' + str(zone_ids_raster_path))
+    return build_zone_block_index(zone_ids_raster_path, index_path=index_path, largest_block=largest_block, n_threads=n_threads)
+
+
+def get_block_offsets_for_zone_ids(zone_ids_raster_path, zone_ids, zone_block_index=None):
+    """Return the iterblocks_hb-style offset dicts (xoff, yoff, win_xsize, win_ysize) of only the blocks of
+    zone_ids_raster_path that contain at least one of zone_ids, in raster order. Uses (and builds if needed) the
+    zone block index sidecar."""
+    if zone_block_index is None:
+        zone_block_index = load_zone_block_index(zone_ids_raster_path)
+    block_indices = _get_block_indices_for_zone_ids(zone_block_index, zone_ids)
+    return [{'xoff': int(xoff), 'yoff': int(yoff), 'win_xsize': int(win_xsize), 'win_ysize': int(win_ysize)}
+            for xoff, yoff, win_xsize, win_ysize in zone_block_index['block_offsets'][block_indices]]
+
+
+def _get_block_indices_for_zone_ids(zone_block_index, zone_ids):
+    zone_ids = np.unique(np.asarray(zone_ids, dtype=np.int64).ravel())
+    index_zone_ids = zone_block_index['zone_ids']
+    positions = np.searchsorted(index_zone_ids, zone_ids)
+    in_range = positions < len(index_zone_ids)
+    positions = positions[in_range]
+    positions = positions[index_zone_ids[positions] == zone_ids[in_range]]
+    if len(positions) == 0:
+        return np.zeros(0, dtype=np.int64)
+    indptr = zone_block_index['zone_block_indptr']
+    return np.unique(np.concatenate([zone_block_index['zone_block_indices'][indptr[i]: indptr[i + 1]] for i in positions]))
+
+
+def get_zone_ids_window(zone_ids_raster_path, zone_ids, zone_block_index=None):
+    """Return the smallest window (xoff, yoff, win_xsize, win_ysize dict) containing all cells of zone_ids, or None if
+    none are present. Only the blocks the zone block index lists for zone_ids are read."""
+    block_offsets = get_block_offsets_for_zone_ids(zone_ids_raster_path, zone_ids, zone_block_index=zone_block_index)
+    if len(block_offsets) == 0:
+        return None
+    zone_ids = np.asarray(zone_ids, dtype=np.int64).ravel()
+    zone_raster = gdal.OpenEx(zone_ids_raster_path, gdal.OF_RASTER)
+    zone_band = zone_raster.GetRasterBand(1)
+    min_x, min_y, max_x, max_y = None, None, None, None
+    for offsets in block_offsets:
+        zones_array = zone_band.ReadAsArray(offsets['xoff'], offsets['yoff'], offsets['win_xsize'], offsets['win_ysize'])
+        rows, cols = np.nonzero(np.isin(zones_array, zone_ids))
+        if len(rows) == 0:
+            continue
+        block_min_x, block_max_x = offsets['xoff'] + cols.min(), offsets['xoff'] + cols.max()
+        block_min_y, block_max_y = offsets['yoff'] + rows.min(), offsets['yoff'] + rows.max()
+        min_x = block_min_x if min_x is None else min(min_x, block_min_x)
+        min_y = block_min_y if min_y is None else min(min_y, block_min_y)
+        max_x = block_max_x if max_x is None else max(max_x, block_max_x)
+        max_y = block_max_y if max_y is None else max(max_y, block_max_y)
+    zone_band = None
+    zone_raster = None
+    if min_x is None:
+        return None
+    return {'xoff': int(min_x), 'yoff': int(min_y), 'win_xsize': int(max_x - min_x + 1), 'win_ysize': int(max_y - min_y + 1)}
+
+
+def read_arrays_for_zone_ids(raster_path_list, zone_ids_raster_path, zone_ids, mask_outside_zones=True, zone_block_index=None):
+    """Read the window of each (aligned) raster in raster_path_list that just contains zone_ids, eg to clip global
+    inputs to one country before running the allocators on it. Returns (window, array_list, zone_mask), where window is
+    the offset dict from get_zone_ids_window and zone_mask is True where the zone raster is one of zone_ids. If
+    mask_outside_zones, cells outside the zones are set to each raster's nodata value (or 0 if it has none).
+    Returns (None, None, None) if the zones are not present."""
+    window = get_zone_ids_window(zone_ids_raster_path, zone_ids, zone_block_index=zone_block_index)
+    if window is None:
+        return None, None, None
+    read_args = (window['xoff'], window['yoff'], window['win_xsize'], window['win_ysize'])
+    zone_raster = gdal.OpenEx(zone_ids_raster_path, gdal.OF_RASTER)
+    zone_mask = np.isin(zone_raster.GetRasterBand(1).ReadAsArray(*read_args), np.asarray(zone_ids, dtype=np.int64).ravel())
+    zone_raster = None
+    array_list = []
+    for raster_path in raster_path_list:
+        raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+        band = raster.GetRasterBand(1)
+        array = band.ReadAsArray(*read_args)
+        if mask_outside_zones:
+            nodata = band.GetNoDataValue()
+            array[~zone_mask] = nodata if nodata is not None else 0
+        array_list.append(array)
+        band = None
+        raster = None
+    return window, array_list, zone_mask
+
+
+def clip_raster_to_zone_ids(input_path, zone_ids_raster_path, zone_ids, output_path, mask_outside_zones=True,
+                            gtiff_creation_options=hb.globals.DEFAULT_GTIFF_CREATION_OPTIONS):
+    """Clip input_path (aligned with zone_ids_raster_path) to the extent of zone_ids, eg a single country of a global
+    country ids raster, reading only the blocks of the zone raster that contain those zones rather than rasterizing
+    and scanning a clip vector."""
+    window, array_list, zone_mask = read_arrays_for_zone_ids([input_path], zone_ids_raster_path, zone_ids, mask_outside_zones=mask_outside_zones)
+    if window is None:
+        raise ValueError('None of the zone ids ' + str(zone_ids) + ' are present in ' + str(zone_ids_raster_path))
+    input_info = hb.get_raster_info_hb(input_path)
+    geotransform = list(input_info['geotransform'])
+    geotransform[0] += window['xoff'] * geotransform[1] + window['yoff'] * geotransform[2]
+    geotransform[3] += window['xoff'] * geotransform[4] + window['yoff'] * geotransform[5]
+    clipped_info = dict(input_info)
+    clipped_info['geotransform'] = geotransform
+    target_raster = _create_raster_like(clipped_info, output_path, window['win_xsize'], window['win_ysize'], 1.0, input_info['datatype'], input_info['nodata'][0], gtiff_creation_options)
+    target_raster.GetRasterBand(1).WriteArray(array_list[0])
+    target_raster.FlushCache()
+    target_raster = None
 
@@ -1,4 +1,7 @@
 import os, sys, shutil, subprocess
+import multiprocessing
+import threading
+import concurrent.futures
 
 import pprint
 from collections import OrderedDict
@@ -141,310 +144,193 @@ class RegressionFrame(object):
 
         self.variable_sets[variable_set_label] = [depvar_label] + indvars
 
-    def initialize_df_from_equation(self, equation, current_bounding_box, existing_df=None,):
-        if existing_df is None:
-            df = pd.DataFrame()
+    def get_stride_rate_for_input(self, input_label):
+        # Stride rate varies with resolution so that pyramidal inputs of different resolutions load to the same shape.
+        if input_label.endswith('10sec'):
+            return self.stride_rate
+        elif input_label.endswith('30sec'):
+            return int(math.floor(float(self.stride_rate) / 3.0))
+        elif input_label.endswith('5min'):
+            return int(math.floor(float(self.stride_rate) / 30.0))
         else:
-            df = existing_df
-
+            return self.stride_rate
+
+    def load_equation_data(self, equation, current_bounding_box, n_threads=None, dtype=None, row_order='quad_tile', sampling=None,
+                           sample_block_size=64, strata_label=None, seed=None):
+        """Load everything equation needs within current_bounding_box as a contiguous (n_obs, n_columns) design matrix.
+
+        All the necessary rasters (the dependent variable, regression inputs and mask inputs) are read concurrently by
+        n_threads with load_geotiff_chunk_by_bb. The validity mask (the dependent variable's and every input's NDV, zero
+        depvar values if self.drop_zero_from_dependent_variable, and valuemask / conditionalmask terms) is then built in
+        one vectorized pass, and only the valid cells of each input are copied into the matrix, so no full-size float64
+        copies or growing DataFrames are made. Transforms (intercept, dummy, log, algebra of two inputs and integer
+        powers) are computed on those rows, and any other transform (eg a*2 or a:b) raises a NameError.
+
+        dtype defaults to float32 if every input's data type is exactly representable in it (eg byte, int16, float32
+        rasters) and float64 otherwise. With row_order 'quad_tile' the rows are ordered by the quadrants of
+        array_columnize (so the last 25% are the lower right tile), otherwise in row-major order. The flat index of
+        each row's cell is kept in self.valid_row_indices.
+
+        With sampling 'stratified_blocks', instead of striding, only a reproducible (given seed) random sample of
+        sample_block_size square blocks holding about self.max_cells_to_load_to_df cells is read (see
+        get_stratified_block_sample), stratified by the values of the input strata_label if given. The sampled blocks
+        are concatenated as a (1, n_cells) window, rows are in that order, and the windows are kept in
+        self.sample_windows.
+
+        Returns data, columns (the labels of data's columns) and all_valid_array (int8, the window's shape).
+        """
         self.equation_dict = parse_equation_to_dict(equation)
+        equation_dict = self.equation_dict
 
-        if self.stride_rate is None:
-            if self.max_cells_to_load_to_df is not None:
+        if sampling is not None or (self.stride_rate is None and self.max_cells_to_load_to_df is not None):
+            if isinstance(self.dependent_variable_input_path, hb.netcdf.NetcdfRasterSource):
+                c, r, c_size, r_size = self.dependent_variable_input_path.bb_to_cr_size(current_bounding_box)
+            else:
                 c, r, c_size, r_size = hb.bb_path_to_cr_size(self.dependent_variable_input_path, current_bounding_box)
+
+        if sampling is not None:
+            if sampling != 'stratified_blocks':
+                raise NameError('Unknown sampling ' + str(sampling) + ' given to load_equation_data. Use None or stratified_blocks.')
+            if self.max_cells_to_load_to_df is None:
+                raise NameError('load_equation_data needs self.max_cells_to_load_to_df to know how many cells to sample.')
+            block_strata = None
+            if strata_label is not None:
+                # One value per block is enough to stratify, so the strata are read with a stride of the block size.
+                block_strata = hb.load_geotiff_chunk_by_bb(self.aligned_inputs[strata_label].path, current_bounding_box, stride_rate=sample_block_size)
+            self.sample_windows = get_stratified_block_sample(r_size, c_size, self.max_cells_to_load_to_df, block_size=sample_block_size, block_strata=block_strata, seed=seed)
+            row_order = None
+        elif self.stride_rate is None:
+            if self.max_cells_to_load_to_df is not None:
                 self.stride_rate = self.get_stride_rate_from_desired_sample_size(self.max_cells_to_load_to_df, n_rows=r_size, n_cols=c_size)
             else:
                 self.stride_rate = 1
 
-        # NOTE: DIsabled global inputs for now, but eventually I would love to have the feature where you could mix and match global with local regression sources and have it clip conditionally.
-        is_global = False
-        if is_global:
-            correct_aligned_inputs = self.global_aligned_inputs
-            strided_dependent_variable_array = hb.load_geotiff_chunk_by_bb(correct_aligned_inputs[
-                self.dependent_variable_label].path, current_bounding_box, stride_rate=self.stride_rate)
-            depvar_ndv = correct_aligned_inputs[self.dependent_variable_label].ndv
-        else:
-            correct_aligned_inputs = self.aligned_inputs
-            implied_path = self.aligned_inputs[self.dependent_variable_label].path
-            strided_dependent_variable_array = hb.load_geotiff_chunk_by_bb(implied_path, current_bounding_box, stride_rate=self.stride_rate)
-            implied_ndv = correct_aligned_inputs[self.dependent_variable_label]
-            
-            self.depvar_shape = strided_dependent_variable_array.shape
+        aligned_inputs = self.aligned_inputs
+        depvar_label = equation_dict['dependent_variable']
+        labels_to_load = list(equation_dict['necessary_variables'])
+        if depvar_label not in labels_to_load:
+            labels_to_load.insert(0, depvar_label)
 
-            depvar_ndv = implied_ndv
+        def load_input(label):
+            if sampling is None:
+                return hb.load_geotiff_chunk_by_bb(aligned_inputs[label].path, current_bounding_box, stride_rate=self.get_stride_rate_for_input(label))
 
-        strided_array_shape = strided_dependent_variable_array.shape
-
-        # Create an array that calculates efficiently if ALL values are valid in each pixel-stack.
-        self.all_valid_array = np.full(strided_array_shape, 1, np.int8)
-
-        # For the depvar write as zero where its not valid based on its NDV value.
-         # TODOO incorporate into call
+            # Read only the sampled blocks, through one open band per input.
+            path = aligned_inputs[label].path
+            if isinstance(path, hb.netcdf.NetcdfRasterSource):
+                band = path
+            else:
+                ds = gdal.OpenEx(path, gdal.OF_RASTER)
+                band = ds.GetRasterBand(1)
+            blocks = [band.ReadAsArray(c + col, r + row, n_cols, n_rows).ravel() for row, col, n_rows, n_cols in self.sample_windows]
+            band = ds = None
+            return np.concatenate(blocks)[np.newaxis, :]
+
+        if n_threads is None:
+            n_threads = min(len(labels_to_load), multiprocessing.cpu_count())
+        # GDAL releases the GIL while reading, so threads overlap the reads of the different rasters.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(n_threads, 1)) as executor:
+            arrays = OrderedDict(zip(labels_to_load, executor.map(load_input, labels_to_load)))
+
+        shape = arrays[depvar_label].shape
+        for label, array in arrays.items():
+            if array.shape != shape:
+                raise NameError('Input ' + str(label) + ' loaded with shape ' + str(array.shape) + ' but the dependent variable has shape ' + str(shape))
+        self.depvar_shape = shape
+
+        # Validity of every pixel-stack in one pass.
+        valid = np.ones(shape, dtype=bool)
+        for label, array in arrays.items():
+            ndv = aligned_inputs[label].ndv
+            if ndv is not None:
+                valid &= array != ndv
         if self.drop_zero_from_dependent_variable:
-            current_invalid_mask = (strided_dependent_variable_array != depvar_ndv) & (strided_dependent_variable_array != 0)
-        else:
-            # pass # HACK so that get full array doing dropping later.
-            current_invalid_mask = strided_dependent_variable_array != depvar_ndv
-
-        self.all_valid_array[~current_invalid_mask] = 0
-
-        # Create a list of masks read at this step for later incorporation into data matrix
-        loaded_masks = {}
-        # Update self.all_valid_array based on mask inputs.
-        for c, variable_transform in enumerate(self.equation_dict['variable_transforms']):
+            valid &= arrays[depvar_label] != 0
+        conditional_operators = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal, '!=': np.not_equal, '==': np.equal}
+        for variable_transform in equation_dict['variable_transforms']:
             if variable_transform[0] == 'valuemask':
                 parsed_input_name = variable_transform[2].split(',')[0]
-                parsed_variable_name = variable_transform[2].split(',')[1]
                 values_for_valid_mask = [int(i) for i in variable_transform[4].split(',')]
-
-                current_valid_array = hb.load_geotiff_chunk_by_bb(correct_aligned_inputs[parsed_input_name].path,
-                                                            current_bounding_box,
-                                                                  stride_rate=self.stride_rate)
-
-                current_valid_array = np.where(np.isin(current_valid_array, values_for_valid_mask), 1, 0)
-
-                # Keep track of where all are valid or not
-                self.all_valid_array *= current_valid_array
-
-                # To be used later with data array
-                loaded_masks[parsed_variable_name] = current_valid_array
-
-        for c, variable_transform in enumerate(self.equation_dict['variable_transforms']):
-            if variable_transform[0] == 'conditionalmask':
+                valid &= np.isin(arrays[parsed_input_name], values_for_valid_mask)
+            elif variable_transform[0] == 'conditionalmask':
                 parsed_input_name = variable_transform[2].split(',')[0]
-                parsed_variable_name = variable_transform[2].split(',')[1]
                 value_for_conditional = hb.convert_string_to_implied_type(variable_transform[2].split(',')[2])
                 conditional_operator = variable_transform[2].split(',')[3]
+                valid &= conditional_operators[conditional_operator](arrays[parsed_input_name], value_for_conditional)
+        self.all_valid_array = valid.astype(np.int8)
 
-                current_valid_array = hb.load_geotiff_chunk_by_bb(correct_aligned_inputs[parsed_input_name].path,
-                                                                  current_bounding_box,
-                                                                  stride_rate=self.stride_rate)
-
-                if conditional_operator == '>':
-                    L.info('Making mask from conditional operator ' + conditional_operator + ' with value ' + str(value_for_conditional))
-                    current_valid_array = np.where(conditional_operator > value_for_conditional, 1, 0)
-                elif conditional_operator == '>=':
-                    L.info('Making mask from conditional operator ' + conditional_operator + ' with value ' + str(value_for_conditional))
-                    current_valid_array = np.where(conditional_operator >= value_for_conditional, 1, 0)
-                elif conditional_operator == '<':
-                    L.info('Making mask from conditional operator ' + conditional_operator + ' with value ' + str(value_for_conditional))
-                    current_valid_array = np.where(conditional_operator < value_for_conditional, 1, 0)
-                elif conditional_operator == '>=':
-                    L.info('Making mask from conditional operator ' + conditional_operator + ' with value ' + str(value_for_conditional))
-                    current_valid_array = np.where(conditional_operator <= value_for_conditional, 1, 0)
-                elif conditional_operator == '!=':
-                    L.info('Making mask from conditional operator ' + conditional_operator + ' with value ' + str(value_for_conditional))
-                    current_valid_array = np.where(conditional_operator != value_for_conditional, 1, 0)
-                elif conditional_operator == '==':
-                    L.info('Making mask from conditional operator ' + conditional_operator + ' with value ' + str(value_for_conditional))
-                    current_valid_array = np.where(conditional_operator == value_for_conditional, 1, 0)
-
-                # Keep track of where all are valid or not
-                self.all_valid_array *= current_valid_array
-
-                # To be used later with data array
-                loaded_masks[parsed_variable_name] = current_valid_array
-                
-                
-        # if self.currently_loaded_masks is not None:
-        #     if loaded_masks.keys() != self.currently_loaded_masks.keys():
-        #     # NOTE, you will get the wrong size arrays if masks are added OR removed. Thus always trigger a full reload. And thus also, it's best to have only a single, all inclusive load at the beginning.
-        #     # Maybe add a secondary filter step at the df phase.
-        #     # if any([True for i in loaded_masks.keys() if i not in self.currently_loaded_masks.keys()]):
-        #         L.info('Reloading DF because new masks were added.')
-        #         df = pd.DataFrame()
-        
-        all_valid_mask = np.where(self.all_valid_array.astype(bool))
-        
-        n_obs = len(all_valid_mask[0])
-        
-        test_train_split = 0.75 # Hardcoded for now because pyramidal structure of data makes quarters nice.
-        
-        n_train_obs = n_obs * test_train_split
-        n_test_obs = n_obs * (1 - test_train_split)
-        
-        # if self.train_test_split_strategy == 'spatial_tile':
-        #     current_ul
-        
-        if len(df) == 0:
-            df_loaded_data = None
+        if row_order == 'quad_tile':
+            order = get_quad_tile_order(shape)
+            self.valid_row_indices = order[valid.ravel()[order]]
         else:
-            df_loaded_data = df.values    
-        
-        # Calculate size of data (new or to be added)
-        n_new_necessary_cols = 0
-        for c, necessary_variable in enumerate(self.equation_dict['necessary_variables']):
-            if necessary_variable not in df.columns:
-                n_new_necessary_cols += 1
-
-        # Initialize the data array with a NDV.
-        necessary_data = np.full((n_obs, n_new_necessary_cols), -9999., dtype=np.float64)
-
-        # columns_to_add = list(df.columns)  # Copy list because want to add new ones to end of list.
-
-        # FEATURE! RFs can still regress over data with different resoutions so long as they are pyramidal.
-        columns_to_add = []
-        added_column_index = 0
-        for c, necessary_variable in enumerate(self.equation_dict['necessary_variables']):
-            # Stride rate varies with resolution
-            if necessary_variable.endswith('10sec'):
-                actual_stride_rate = self.stride_rate
-            elif necessary_variable.endswith('30sec'):
-                actual_stride_rate = int(math.floor(float(self.stride_rate) / 3.0))
-            elif necessary_variable.endswith('5min'):
-                actual_stride_rate = int(math.floor(float(self.stride_rate) / 30.0))
+            self.valid_row_indices = np.flatnonzero(valid)
+        valid = None
+        n_obs = len(self.valid_row_indices)
+
+        # Columns: the loaded inputs, then the transforms.
+        columns = list(labels_to_load)
+        # Only transforms that are computed below get a column, so no column is left uninitialized.
+        algebra_operators = {'*': np.multiply, '/': np.divide, '+': np.add, '-': np.subtract}
+        transform_columns = []
+        for variable_transform in equation_dict['variable_transforms']:
+            if variable_transform == 'intercept':
+                transform_columns.append(('intercept', variable_transform))
+            elif variable_transform[0] in ['mask', 'valuemask', 'conditionalmask']:
+                continue
+            elif variable_transform[0] == 'dummy':
+                transform_columns.append((variable_transform[2].split(',')[1], variable_transform))
+            elif variable_transform[0] == 'log' and variable_transform[2] in labels_to_load:
+                transform_columns.append((''.join(variable_transform), variable_transform))
+            elif len(variable_transform) == 3 and variable_transform[0] in labels_to_load and variable_transform[1] == '^' and variable_transform[2].isdigit():
+                transform_columns.append((''.join(variable_transform), variable_transform))
+            elif len(variable_transform) == 3 and variable_transform[0] in labels_to_load and variable_transform[1] in algebra_operators and variable_transform[2] in labels_to_load:
+                transform_columns.append((''.join(variable_transform), variable_transform))
             else:
-                actual_stride_rate = self.stride_rate
-
-            if necessary_variable not in list(df.columns):
-                L.info('Loading necessary_variable', necessary_variable)
-                columns_to_add.append(necessary_variable)
-                
-                L.debug('Loading ' + str(necessary_variable) + ' to df from ' + str(correct_aligned_inputs[necessary_variable].path)
-                        + ' with shape ' + str(hb.get_shape_from_dataset_path(correct_aligned_inputs[necessary_variable].path))
-                        + ' and ndv: ' + str(hb.get_ndv_from_path(correct_aligned_inputs[necessary_variable].path)))
-                current_array = hb.load_geotiff_chunk_by_bb(correct_aligned_inputs[necessary_variable].path,
-                                                              current_bounding_box,
-                                                            stride_rate=actual_stride_rate)
-                
-                # Split array into quadrants # TODOO Make it order these four randomly
-                
-                necessary_data = self.array_columnize(current_array, necessary_data, added_column_index, method='quad_tile')
-                
-                added_column_index += 1
-                
-        necessary_df = pd.DataFrame(data=necessary_data, columns=columns_to_add, copy=False)
-        
-        df = pd.concat([df, necessary_df], axis=1)
-                
-        # Awful hack here, using data_cur so it only loads once and doesn't just restart each time, but i think this makes it so that it doesn't work with OTHER types of transforms.
-        # Confused additionally by the fact that when you load it from csv to save time, the data is bigger than the df because it hasn't had the ADDITIONAL drop logic implemented
-        # Note that the next time you try to rebuild the original, pre transform DF to CSV, it will faile here.
-        
-        n_transform_cols = len(self.equation_dict['variable_transforms'])
+                raise NameError('Unsupported transform ' + str(''.join(variable_transform)) + ' in equation. Supported transforms are intercept, dummy(), log() of an input, an input ^ an integer and *, /, + or - of two inputs.')
+        columns += [i[0] for i in transform_columns if i[0] not in columns]
 
-        # Calculate size of data (new or to be added)
-        n_new_transform_cols = 0
-        for c, transform_variable in enumerate(self.equation_dict['variable_transforms']):
-            if transform_variable not in df.columns:
-                n_new_transform_cols += 1
+        if dtype is None:
+            float32_safe = [np.dtype(i) for i in [np.bool_, np.int8, np.uint8, np.int16, np.uint16, np.float16, np.float32]]
+            dtype = np.float32 if all(array.dtype in float32_safe for array in arrays.values()) else np.float64
 
-        transforms_data = np.full((n_obs, n_new_transform_cols), -9999., dtype=np.float64)
-        
-        added_column_index = 0
-        columns_to_add = []
-        for c, variable_transform in enumerate(self.equation_dict['variable_transforms']):
-            
-            # Add intercept transforms
+        data = np.empty((n_obs, len(columns)), dtype=dtype)
+        for column_index, label in enumerate(labels_to_load):
+            data[:, column_index] = arrays[label].ravel()[self.valid_row_indices]
+            arrays[label] = None
+
+        for column_label, variable_transform in transform_columns:
+            column_index = columns.index(column_label)
             if variable_transform == 'intercept':
-                if 'intercept' not in df.columns:
-                    columns_to_add.append('intercept')
-                    L.debug('Loading INTERCEPT transform to df.')
-                    current_array = np.ones(strided_array_shape)
-                    transforms_data[:, added_column_index] = current_array.flatten()
-                    added_column_index += 1
-                    
-            # Add dummy transforms
-            elif variable_transform[0] == 'dummy':   
-                
-                # Parse from transform name necessary information             
-                parsed_input_name = variable_transform[2].split(',')[0]
-                parsed_variable_name = variable_transform[2].split(',')[1]
-                values_to_make_dummy = variable_transform[4].split(',')
-                
-                # Determine stride-rate from the source of the transform
-                if parsed_input_name.endswith('10sec'):
-                    actual_stride_rate = self.stride_rate
-                elif parsed_input_name.endswith('30sec'):
-                    actual_stride_rate = int(math.floor(float(self.stride_rate) / 3.0))
-                elif parsed_input_name.endswith('5min'):
-                    actual_stride_rate = int(math.floor(float(self.stride_rate) / 30.0))
-                else:
-                    actual_stride_rate = self.stride_rate
-
-                # If it's not in the current df, add it to transform DFs for later merging.
-                if parsed_variable_name not in df.columns:
-                    columns_to_add.append(parsed_variable_name)
-                    L.debug('Loading DUMMY transform' + str(parsed_variable_name) + ' to df.')                    
-                    current_array = np.where(np.isin(df[parsed_input_name].values, values_to_make_dummy), 1, 0)
-                    transforms_data[added_column_index] = current_array
-                    added_column_index += 1
-
-            # Add log transforms # TODOO This could be easily shrunken with helper functions
+                data[:, column_index] = 1
+            elif variable_transform[0] == 'dummy':
+                values_to_make_dummy = [float(i) for i in variable_transform[4].split(',')]
+                input_column = data[:, columns.index(variable_transform[2].split(',')[0])]
+                data[:, column_index] = np.isin(input_column, values_to_make_dummy)
             elif variable_transform[0] == 'log':
-                
-                # Parse from transform name necessary information             
-                parsed_input_name = variable_transform[2].split(',')[0]
-                parsed_variable_name = variable_transform[2].split(',')[1]
-                values_to_make_dummy = variable_transform[4].split(',')
-                
-                # Determine stride-rate from the source of the transform
-                if parsed_input_name.endswith('10sec'):
-                    actual_stride_rate = self.stride_rate
-                elif parsed_input_name.endswith('30sec'):
-                    actual_stride_rate = int(math.floor(float(self.stride_rate) / 3.0))
-                elif parsed_input_name.endswith('5min'):
-                    actual_stride_rate = int(math.floor(float(self.stride_rate) / 30.0))
-                else:
-                    actual_stride_rate = self.stride_rate
-
-                # If it's not in the current df, add it to transform DFs for later merging.
-                if parsed_variable_name not in df.columns:
-                    columns_to_add.append(parsed_variable_name)
-                    L.debug('Loading LOG transform' + str(parsed_variable_name) + ' to df.')                    
-                    current_array = np.log(df[parsed_input_name].values)
-                    transforms_data[added_column_index] = current_array
-                    added_column_index += 1
-                    
-            # Add raster-math transforms
-            elif variable_transform[0] in self.equation_dict['necessary_variables']:
-                if variable_transform[2] in self.equation_dict['necessary_variables']: # Then it is some algebra on two rasters.
-                    if variable_transform[1] == '*':
-                        current_array = df[variable_transform[0]] * df[variable_transform[2]]
-                        parsed_variable_name = variable_transform[0]+'*'+ variable_transform[2]
-                        columns_to_add.append(parsed_variable_name)
-                        transforms_data[added_column_index] = current_array
-                        added_column_index += 1
-                    elif variable_transform[1] == '/':
-                        current_array = df[variable_transform[0]] / df[variable_transform[2]]
-                        parsed_variable_name = variable_transform[0]+'/'+ variable_transform[2]
-                        columns_to_add.append(parsed_variable_name)
-                        transforms_data[added_column_index] = current_array
-                        added_column_index += 1
-                    elif variable_transform[1] == '+':
-                        current_array = df[variable_transform[0]] + df[variable_transform[2]]
-                        parsed_variable_name = variable_transform[0]+'+'+ variable_transform[2]
-                        columns_to_add.append(parsed_variable_name)
-                        transforms_data[added_column_index] = current_array
-                        added_column_index += 1
-                    elif variable_transform[1] == '-':
-                        current_array = df[variable_transform[0]] - df[variable_transform[2]]
-                        parsed_variable_name = variable_transform[0]+'-'+ variable_transform[2]
-                        columns_to_add.append(parsed_variable_name)
-                        transforms_data[added_column_index] = current_array
-                        added_column_index += 1
-                elif variable_transform[1] == '^':
-                    print( 'variable_transform', variable_transform)
-                    current_array = df[variable_transform[0]].to_numpy(dtype=None, copy=False) ** int(variable_transform[2])
-                    parsed_variable_name = variable_transform[0] + '^' + variable_transform[2]
-                    columns_to_add.append(parsed_variable_name)
-                    transforms_data[added_column_index] = current_array
-                    added_column_index += 1
-
-        transforms_df = pd.DataFrame(data=transforms_data, columns=columns_to_add, copy=False)
-        df = pd.concat([df, transforms_df], axis=1)
-
-
-        self.currently_loaded_masks = loaded_masks
-
-        # # Drop based on masks
-        # masks_list = [i[2].split(',')[1] for i in self.equation_dict['mask_variables']]
-        # for i in masks_list:
-        #     self.all_valid_array
-        #     # df = df[df[i] == 1]
-
-        return df, self.all_valid_array
-    
+                np.log(data[:, columns.index(variable_transform[2])], out=data[:, column_index])
+            elif variable_transform[1] == '^':
+                np.power(data[:, columns.index(variable_transform[0])], int(variable_transform[2]), out=data[:, column_index])
+            else:
+                algebra_operators[variable_transform[1]](data[:, columns.index(variable_transform[0])], data[:, columns.index(variable_transform[2])], out=data[:, column_index])
+
+        L.info('Loaded ' + str(n_obs) + ' valid observations of ' + str(len(columns)) + ' columns as ' + str(np.dtype(dtype)) + ' from window of shape ' + str(shape))
+        return data, columns, self.all_valid_array
+
+    def initialize_df_from_equation(self, equation, current_bounding_box, existing_df=None, n_threads=None, dtype=None, sampling=None, strata_label=None, seed=None):
+        # Load the data for equation with load_equation_data and wrap the design matrix in a DataFrame (without copying it).
+        # If existing_df is given (with the same rows), only the columns it does not already have are added to it.
+        data, columns, all_valid_array = self.load_equation_data(equation, current_bounding_box, n_threads=n_threads, dtype=dtype, sampling=sampling, strata_label=strata_label, seed=seed)
+        df = pd.DataFrame(data=data, columns=columns, copy=False)
+
+        if existing_df is not None and len(existing_df) > 0:
+            if len(existing_df) != len(df):
+                L.info('Reloading DF because the number of valid observations changed from ' + str(len(existing_df)) + ' to ' + str(len(df)))
+            else:
+                columns_to_add = [i for i in columns if i not in existing_df.columns]
+                df = pd.concat([existing_df, df[columns_to_add]], axis=1)
+
+        return df, all_valid_array
+
     def array_columnize(self, input_array, target_array, column_index, method=None):
         # Put a 2d array into a 1d column of a bigger array, flattened according to different logic. This enables,
         # e.g., the ability to withhold a TILE of data instead.
@@ -769,9 +655,32 @@ class RegressionFrame(object):
                 v = self.add_variable(label, source.label, 'log10')
 
 
-    def run_sm_lm(self, regression_label, df, equation_dict,  output_dir=None, has_constant=True):
+    def run_sm_lm(self, regression_label, df, equation_dict,  output_dir=None, has_constant=True, fit_mode='in_memory', chunk_rows=2 ** 20):
         # self.coeff_labels = self.variable_sets[variable_set_label][1:] # NOTE dropping depvar
 
+        # With fit_mode 'out_of_core', df can also be the path of a design matrix saved with save_design_matrix. X'X and
+        # X'y are accumulated over chunk_rows rows at a time and the same results are computed from them.
+        if fit_mode == 'out_of_core':
+            L.info('Starting out-of-core OLS with equation_dict: ' + str(equation_dict))
+            gram = accumulate_design_matrix_gram(df, equation_dict['regression_terms'], equation_dict['dependent_variable'], chunk_rows=chunk_rows)
+            ols = fit_ols_from_gram(gram, has_constant=has_constant)
+            self.coeff_values = ols['params']
+
+            result = OrderedDict()
+            result['depvar_label'] = self.dependent_variable_label
+            result['coefficients'] = OrderedDict(zip(list(ols['params'].index), list(ols['params'].values)))
+            result['pvalues'] = OrderedDict(zip(list(ols['params'].index), list(ols['pvalues'])))
+            for key in ['aic', 'bic', 'bse', 'rsquared', 'rsquared_adj', 'nobs']:
+                result[key] = ols[key]
+            result['coefficient_means'] = OrderedDict(zip(gram['labels'], list(gram['x_sum'] / gram['n'])))
+            result['equation_dict'] = equation_dict
+            result['regression_label'] = regression_label
+            result['all_valid_path'] = self.all_valid_path
+            self.results[regression_label] = result
+            return ols['summary'], result
+        elif fit_mode != 'in_memory':
+            raise NameError('Unknown fit_mode ' + str(fit_mode) + '. Use in_memory or out_of_core.')
+
         try:
             L.info('Starting OLS with equation_dict: ' + str(equation_dict))
 
@@ -822,9 +731,32 @@ class RegressionFrame(object):
         else:
             return None, None
 
-    def run_logit(self, regression_label, df, equation_dict,  output_dir=None, has_constant=True):
+    def run_logit(self, regression_label, df, equation_dict,  output_dir=None, has_constant=True, fit_mode='in_memory', chunk_rows=2 ** 20, initial_params=None):
         # self.coeff_labels = self.variable_sets[variable_set_label][1:] # NOTE dropping depvar
 
+        # With fit_mode 'out_of_core', df can also be the path of a saved design matrix. The logit is fit on all rows by
+        # fit_logit_out_of_core, streaming chunk_rows rows at a time and warm started from initial_params if given (eg
+        # the params of a fit on a stratified block sample).
+        if fit_mode == 'out_of_core':
+            L.info('Starting out-of-core LOGIT with equation_dict: ' + str(equation_dict))
+            logit = fit_logit_out_of_core(df, equation_dict['regression_terms'], equation_dict['dependent_variable'], chunk_rows=chunk_rows, initial_params=initial_params)
+            self.coeff_values = logit['params']
+
+            result = OrderedDict()
+            result['depvar_label'] = equation_dict['dependent_variable']
+            result['coefficients'] = OrderedDict(zip(list(logit['params'].index), list(logit['params'].values)))
+            result['pvalues'] = OrderedDict(zip(list(logit['params'].index), list(logit['pvalues'])))
+            for key in ['aic', 'bic', 'bse', 'llf', 'nobs']:
+                result[key] = logit[key]
+            result['equation_dict'] = equation_dict
+            result['regression_label'] = regression_label
+            self.results[regression_label] = result
+
+            summary = pd.DataFrame({'coef': logit['params'], 'std err': logit['bse'], 'P>|z|': logit['pvalues']})
+            if output_dir is not None:
+                summary.to_csv(os.path.join(output_dir, regression_label + '_params.csv'))
+            return summary, result
+
 
         L.info('Starting LOGIT with equation_dict: ' + str(equation_dict))
 
@@ -998,11 +930,16 @@ class RegressionFrame(object):
         #     return None, None
 
 
-    def run_lasso(self, regression_label, df, equation_dict, output_dir=None, has_constant=True):
+    def run_lasso(self, regression_label, df, equation_dict, output_dir=None, has_constant=True, fit_mode='in_memory', chunk_rows=2 ** 20):
         # lm_sm = sm.OLS(df[equation_dict['dependent_variable']], df[equation_dict['regression_terms']], hasconst=has_constant).fit()
         # self.coeff_labels = self.variable_sets[variable_set_label][1:] # NOTE dropping depvar
         # depvar_label = self.variable_sets[variable_set_label][0]
 
+        if fit_mode == 'out_of_core':
+            return self.run_lasso_out_of_core(regression_label, df, equation_dict, output_dir=output_dir, chunk_rows=chunk_rows)
+        elif fit_mode != 'in_memory':
+            raise NameError('Unknown fit_mode ' + str(fit_mode) + '. Use in_memory or out_of_core.')
+
         # Load X and y. For posterity
         df_copy = df.copy()
 
@@ -1234,13 +1171,67 @@ class RegressionFrame(object):
 
         return lm_sm.summary(), self.results[result['name']], raw_models
 
+    def run_lasso_out_of_core(self, regression_label, df, equation_dict, output_dir=None, chunk_rows=2 ** 20):
+        # Same path of alphas, selection and OLS refits as run_lasso, but df (a DataFrame or saved design matrix path) is
+        # streamed once to accumulate X'X and X'y. Each alpha's lasso is then solved by coordinate descent on those,
+        # warm started from the previous alpha's coefficients, and the OLS refit uses the selected rows and columns of them.
+        gram = accumulate_design_matrix_gram(df, equation_dict['regression_terms'], equation_dict['dependent_variable'], chunk_rows=chunk_rows)
+        raw_models = []
+        coef = None
+        alphas_to_test = [0.0000000001, 0.000000001, 0.00000001, 0.0000001, 0.000001, 0.00001, 0.0001, 0.00025, 0.0005, 0.00075, 0.001, .0025, .005, .0075, 0.01, .025, .05, .075, 0.1, .125, .15, .175, .2, .3, .5, .9, .99, 1.0, 2.0, 4.0, 8.0, 16.0]
+        for alpha in alphas_to_test:
+            alpha_regression_label = regression_label + '_alpha' + str(alpha).replace('.', '-')
+            coef, intercept = fit_lasso_from_gram(gram, alpha, initial_coef=coef)
+            self.coeff_values = coef
+
+            result = OrderedDict()
+            result['coefficients_intermediate'] = OrderedDict(zip(['intercept'] + gram['labels'], [intercept] + list(coef)))
+            result['name'] = alpha_regression_label
+            result['depvar_label'] = equation_dict['dependent_variable']
+            self.results[result['name']] = result
+
+            self.selected_variable_labels = [str(k) for k, v in result['coefficients_intermediate'].items() if v != 0.0 and k != 'intercept']
+            self.selected_variable_labels.insert(0, 'intercept')
+            L.info('Alpha ' + str(alpha) + ' for alpha_regression_label ' + str(alpha_regression_label) + ' selected variables: ' + str(self.selected_variable_labels))
+            if len(self.selected_variable_labels) < 3:
+                break
+
+            ols = fit_ols_from_gram(subset_design_matrix_gram(gram, self.selected_variable_labels), has_constant=True)
+            raw_models.append(ols)
+            self.coeff_values = ols['params']
+            if output_dir is not None:
+                hb.write_to_file(ols['summary'].to_string(), os.path.join(output_dir, alpha_regression_label + '_summary.txt'))
+                ols['params'].to_csv(os.path.join(output_dir, alpha_regression_label + '_params.csv'))
 
-    def run_skl_lm(self, variable_set_label, regression_label, df, output_dir=None):
+        return ols['summary'], self.results[result['name']], raw_models
+
+    def run_skl_lm(self, variable_set_label, regression_label, df, output_dir=None, fit_mode='in_memory', chunk_rows=2 ** 20):
         L.info('Starting to fit regression.')
 
         self.coeff_labels = self.variable_sets[variable_set_label][1:]  # NOTE dropping depvar
         depvar_label = self.variable_sets[variable_set_label][0]
 
+        if fit_mode == 'out_of_core':
+            # Least squares with an intercept from the centered X'X and X'y, accumulated over chunks of df (a DataFrame or
+            # saved design matrix path), and predictions computed a chunk at a time.
+            gram = accumulate_design_matrix_gram(df, self.coeff_labels, depvar_label, chunk_rows=chunk_rows)
+            x_mean = gram['x_sum'] / gram['n']
+            centered_xtx = gram['XtX'] - gram['n'] * np.outer(x_mean, x_mean)
+            centered_xty = gram['Xty'] - x_mean * gram['y_sum']
+            self.coeff_values = np.linalg.lstsq(centered_xtx, centered_xty, rcond=None)[0]
+            intercept = gram['y_sum'] / gram['n'] - x_mean @ self.coeff_values
+
+            output_df = pd.DataFrame({'linear_regression': self.coeff_values}, index=self.coeff_labels)
+            output_df.to_csv(os.path.join(output_dir, variable_set_label + '_skl_params.csv'))
+            self.predictions = np.concatenate([chunk @ self.coeff_values + intercept for chunk in iter_design_matrix_chunks(df, self.coeff_labels, chunk_rows=chunk_rows)])
+
+            result = OrderedDict()
+            result['coefficients'] = OrderedDict(zip(list(self.coeff_labels), list(self.coeff_values)))
+            result['variable_set_label'] = variable_set_label
+            result['regression_label'] = regression_label
+            self.results[regression_label] = result
+            return
+
         lm_skl = sklearn.linear_model.LinearRegression(normalize=True, fit_intercept=True)
         lm_skl.fit(df[self.coeff_labels], df.iloc[:, 0])
 
@@ -1259,7 +1250,51 @@ class RegressionFrame(object):
         result['regression_label'] = regression_label
         self.results[regression_label] = result
 
-    def predict_output(self, regression_label, output_dir, current_bounding_box, replacement_dict=None):
+    def get_regression_term_inputs(self, label, equation_dict=None, replacement_dict=None):
+        # Return the input labels needed to compute the regression term label (after replacement_dict substitution of
+        # both the term and its inputs), and a function computing the term from a dict of those inputs' blocks.
+        if replacement_dict is None:
+            replacement_dict = OrderedDict()
+        label = replacement_dict.get(label, label)
+        transforms = {}
+        if equation_dict is not None:
+            for variable_transform in equation_dict['variable_transforms']:
+                if variable_transform == 'intercept' or variable_transform[0] in ['mask', 'valuemask', 'conditionalmask']:
+                    continue
+                elif variable_transform[0] == 'dummy':
+                    transforms[variable_transform[2].split(',')[1]] = variable_transform
+                elif variable_transform[0] == 'log' or len(variable_transform) == 3:
+                    transforms[''.join(variable_transform)] = variable_transform
+
+        algebra_operators = {'*': np.multiply, '/': np.divide, '+': np.add, '-': np.subtract}
+        if label == 'intercept':
+            return [], lambda blocks: 1.0
+        elif label in transforms and transforms[label][0] == 'dummy':
+            input_label = replacement_dict.get(transforms[label][2].split(',')[0], transforms[label][2].split(',')[0])
+            values_to_make_dummy = [float(i) for i in transforms[label][4].split(',')]
+            return [input_label], lambda blocks: np.isin(blocks[input_label], values_to_make_dummy)
+        elif label in transforms and transforms[label][0] == 'log':
+            input_label = replacement_dict.get(transforms[label][2], transforms[label][2])
+            return [input_label], lambda blocks: np.log(blocks[input_label].astype(np.float64))
+        elif label in transforms and transforms[label][1] == '^':
+            input_label = replacement_dict.get(transforms[label][0], transforms[label][0])
+            exponent = int(transforms[label][2])
+            return [input_label], lambda blocks: blocks[input_label].astype(np.float64) ** exponent
+        elif label in transforms and transforms[label][1] in algebra_operators:
+            input_labels = [replacement_dict.get(i, i) for i in (transforms[label][0], transforms[label][2])]
+            operator = algebra_operators[transforms[label][1]]
+            return input_labels, lambda blocks: operator(blocks[input_labels[0]].astype(np.float64), blocks[input_labels[1]])
+        else:
+            return [label], lambda blocks: blocks[label]
+
+    def predict_output(self, regression_label, output_dir, current_bounding_box, replacement_dict=None, n_threads=None,
+                       largest_block=hb.globals.LARGEST_ITERBLOCK):
+        # Project the fitted coefficients of regression_label over current_bounding_box of the global aligned inputs,
+        # writing the projection, residuals and all-valid rasters (and the depvar clip to
+        # self.zone_dependent_variable_path). This is a blockwise pass: each window of rows reads only the inputs the
+        # terms need (after replacement_dict substitution), applies transforms (dummies, logs, powers, algebra of inputs)
+        # and coefficients, and is written straight to the outputs, so memory is a few blocks rather than
+        # n_coefficients + 2 full arrays. Windows are processed by n_threads threads, each with its own GDAL handles.
 
         # Get dependent variable for this regression
         result = self.results[regression_label]
@@ -1270,155 +1305,94 @@ class RegressionFrame(object):
 
         # variable_set_label = result['variable_set_label']
         regression_label = result['regression_label']
+        equation_dict = result.get('equation_dict')
 
-
-        depvar_source = self.global_aligned_inputs[self.dependent_variable_label]
-        depvar_array = hb.load_geotiff_chunk_by_bb(self.global_aligned_inputs[self.dependent_variable_label].path,
-                                                  current_bounding_box,
-                                                  1,
-                                                   output_path=self.zone_dependent_variable_path) # Notice stride rate of 1 now that we are doing projecting.
-
-        projected_array = np.full(depvar_array.shape, 0., dtype=np.float64)
-        # self.all_valid_array = np.where(depvar_array != -9999., 1, 0).astype(np.int8)
-        self.all_valid_array = hb.as_array(self.all_valid_path)
+        terms = []
+        input_labels = [self.dependent_variable_label]
         for label, output_value in result['coefficients'].items():
-            if label in replacement_dict:
-                label = replacement_dict[label]
+            term_input_labels, term_function = self.get_regression_term_inputs(label, equation_dict, replacement_dict)
+            terms.append((np.float64(output_value), term_function))
+            input_labels += [i for i in term_input_labels if i not in input_labels]
+
+        # All global aligned inputs share a grid, so the window is the same in each.
+        depvar_path = self.global_aligned_inputs[self.dependent_variable_label].path
+        if isinstance(depvar_path, hb.netcdf.NetcdfRasterSource):
+            c, r, n_cols, n_rows = depvar_path.bb_to_cr_size(current_bounding_box)
+            depvar_info = depvar_path.get_raster_info()
+        else:
+            c, r, n_cols, n_rows = hb.bb_path_to_cr_size(depvar_path, current_bounding_box)
+            depvar_info = hb.get_raster_info_hb(depvar_path)
+        geotransform = list(depvar_info['geotransform'])
+        geotransform[0] += c * geotransform[1]
+        geotransform[3] += r * geotransform[5]
+        depvar_ndv = depvar_info['nodata'][0]
 
-            if label == 'intercept':
-                # array = np.zeros(depvar_array.shape, dtype=np.float64)
-                array = np.ones(depvar_array.shape, dtype=np.float64)
-                coeff = np.float64(output_value)
+        projected_path = os.path.join(output_dir, regression_label, 'agb_' + regression_label + '.tif')
+        residuals_path = os.path.join(output_dir, regression_label, 'residuals_' + regression_label + '.tif')
+        all_valid_prediction_path = os.path.join(output_dir, regression_label, 'all_valid_' + regression_label + '.tif')
+        output_specs = [('projected', projected_path, gdal.GDT_Float32, -9999.), ('residuals', residuals_path, gdal.GDT_Float32, -9999.),
+                        ('valid', all_valid_prediction_path, gdal.GDT_Float32, -9999.)]
+        if getattr(self, 'zone_dependent_variable_path', None) is not None:
+            output_specs.append(('depvar', self.zone_dependent_variable_path, depvar_info['datatype'], depvar_ndv))
+        output_datasets = OrderedDict()
+        for key, output_path, data_type, ndv in output_specs:
+            hb.create_directories(output_path)
+            output_ds = gdal.GetDriverByName('GTiff').Create(output_path, n_cols, n_rows, 1, data_type, hb.DEFAULT_GTIFF_CREATION_OPTIONS)
+            output_ds.SetGeoTransform(geotransform)
+            output_ds.SetProjection(depvar_info['projection'])
+            if ndv is not None:
+                output_ds.GetRasterBand(1).SetNoDataValue(ndv)
+            output_datasets[key] = output_ds
+
+        rows_per_block = max(1, int(largest_block // max(n_cols, 1)))
+        block_row_starts = list(range(0, n_rows, rows_per_block))
+        write_lock = threading.Lock()
+        thread_local = threading.local()
+
+        def read_window(path, xoff, yoff, win_ysize):
+            if isinstance(path, hb.netcdf.NetcdfRasterSource):
+                return path.ReadAsArray(xoff, yoff, n_cols, win_ysize)
+            if not hasattr(thread_local, 'bands'):
+                thread_local.datasets = {}
+                thread_local.bands = {}
+            if path not in thread_local.bands:
+                thread_local.datasets[path] = gdal.OpenEx(path, gdal.OF_RASTER)
+                thread_local.bands[path] = thread_local.datasets[path].GetRasterBand(1)
+            return thread_local.bands[path].ReadAsArray(xoff, yoff, n_cols, win_ysize)
+
+        def predict_block(row_start):
+            win_ysize = min(rows_per_block, n_rows - row_start)
+            blocks = {}
+            for label in input_labels:
+                blocks[label] = read_window(self.global_aligned_inputs[label].path, c, r + row_start, win_ysize)
+            depvar_block = blocks[self.dependent_variable_label]
+            if self.all_valid_path is not None:
+                valid_block = read_window(self.all_valid_path, 0, row_start, win_ysize).astype(np.float64)
             else:
-                coeff = np.float64(output_value)
-                globally_aligned_input = self.global_aligned_inputs[label]
-                array = hb.load_geotiff_chunk_by_bb(globally_aligned_input.path,
-                                                                  current_bounding_box,
-                                                                  1)
-
-                # TODOO Need to reimplement transform modeling for predict
-                # if label != 'intercept':
-                #     globally_aligned_input = self.global_aligned_inputs[label]
-
-                # if globally_aligned_input.data is None:
-                #         source.data = hb.as_array(source.path).astype(np.float64)
-                #         self.all_valid_array[source.data == -9999.] = 0
-                #     array = source.data ** 2
-            projected_array += array * coeff
-
-            array = None
-
-
-
-
-
+                valid_block = (depvar_block != depvar_ndv).astype(np.float64)
 
-        # # TODOO Add transforms here.
-        # for label, output_value in result['coefficients'].items():
-        #     if label in replacement_dict:
-        #         label = replacement_dict[label]
-        #
-        #     coeff = np.float64(output_value)
-        #
-        #     L.info('Creating projected map from ' + str(label) + ' with coefficient ' + str(coeff))
-        #     if label != 'intercept':
-        #         source = self.variables[label].source
-        #     else:
-        #         L.info('intercept', output_value)
-        #     # TODOO Potential memory optimization here: iterate throug sources first, THEN variables, unloading as needed.
-        #     if label == 'intercept':
-        #         # TODOO why zero not one?
-        #         array = np.zeros_like(projected_array, dtype=np.float64)
-        #     # elif '_square' in label:
-        #     #     if source.data is None:
-        #     #         source.data = hb.as_array(source.path).astype(np.float64)
-        #     #         self.all_valid_array[source.data == -9999.] = 0
-        #     #     array = source.data ** 2
-        #     # elif '_cube' in label:
-        #     #     if source.data is None:
-        #     #         source.data = hb.as_array(source.path).astype(np.float64)
-        #     #         self.all_valid_array[source.data == -9999.] = 0
-        #     #     array = source.data ** 3
-        #     # elif '_quad' in label:
-        #     #     if source.data is None:
-        #     #         source.data = hb.as_array(source.path).astype(np.float64)
-        #     #         self.all_valid_array[source.data == -9999.] = 0
-        #     #     array = source.data ** 4
-        #     # elif '_quint' in label:
-        #     #     if source.data is None:
-        #     #         source.data = hb.as_array(source.path).astype(np.float64)
-        #     #         self.all_valid_array[source.data == -9999.] = 0
-        #     #     array = source.data ** 5
-        #     # elif '_ln' in label:
-        #     #     if source.data is None:
-        #     #         source.data = hb.as_array(source.path).astype(np.float64)
-        #     #         self.all_valid_array[source.data == -9999.] = 0
-        #     #     array = np.log(source.data)
-        #     # elif '_log10' in label:
-        #     #     if source.data is None:
-        #     #         source.data = hb.as_array(source.path).astype(np.float64)
-        #     #         self.all_valid_array[source.data == -9999.] = 0
-        #     #     array = np.log10(source.data)
-        #
-        #     # NOTE WEIRDNESS, interact has to be before dummy otherwise interactions on dummies wont be picked up as it grabs the first one.
-        #     elif 'interact' in label:
-        #         var1_label, var2_label = label.split('_interact_')
-        #         source1 = self.variables[var1_label].source
-        #         source2 = self.variables[var2_label].source
-        #         dummy_value = float(var2_label.split('dummy')[1])
-        #         if source1.data is None:
-        #             source1.data = hb.as_array(source1.path).astype(np.float64)
-        #             self.all_valid_array[source1.data == -9999.] = 0
-        #         if source2.data is None:
-        #             source2.data = hb.as_array(source2.path).astype(np.float64)
-        #             self.all_valid_array[source2.data == -9999.] = 0
-        #         array = source1.data * np.where(source2.data == dummy_value, 1., 0.)
-        #     elif '_convolve' in label:
-        #         class_id_from_label = int(label.split('_dummy')[1].split('_')[0])
-        #         esa_class_id = [k for k, v in hb.esacci_extended_short_class_descriptions.items() if k == class_id_from_label][0]
-        #
-        #         if source.data is None:
-        #             source.data = hb.as_array(source.path).astype(np.float64)
-        #             self.all_valid_array[source.data == -9999.] = 0
-        #
-        #         array = source.data
-        #
-        #     elif '_dummy' in label:
-        #         class_id_from_label = int(label.split('_dummy')[-1].split('_')[0])
-        #         esa_class_id = [k for k, v in hb.esacci_extended_short_class_descriptions.items() if k == class_id_from_label][0]
-        #
-        #         if source.data is None:
-        #             source.data = hb.as_array(source.path).astype(np.float64)
-        #             self.all_valid_array[source.data == -9999.] = 0
-        #         array = np.where(source.data == esa_class_id, 1, 0)
-        #
-        #     else:  # Then its a standard, untransformed variable
-        #
-        #         if source.data is None:
-        #             source.data = hb.as_array(source.path).astype(np.float64)
-        #
-        #             self.all_valid_array[source.data == -9999.] = 0
-        #         array = source.data
-        #     # Only calculate projection for where there is a full pixelstack of observation data
-        #     # array = np.where(self.all_valid_array == 1, array, 0)
-        #
-        #     projected_array += array * coeff
-        #     array = None
-        #     source.data = None
-        #     L.info('sum added: ' + str(np.sum(array)) + ', projected mean: ' + str(np.mean(projected_array)))
+            projected_block = np.zeros(depvar_block.shape, dtype=np.float64)
+            for coeff, term_function in terms:
+                projected_block += term_function(blocks) * coeff
+            projected_block *= valid_block
+            residuals_block = (projected_block - depvar_block) * valid_block
 
+            output_blocks = {'projected': projected_block, 'residuals': residuals_block, 'valid': valid_block, 'depvar': depvar_block}
+            with write_lock:
+                for key, output_ds in output_datasets.items():
+                    output_ds.GetRasterBand(1).WriteArray(output_blocks[key], 0, row_start)
 
-        hb.save_array_as_geotiff(self.all_valid_array, hb.temp(), self.zone_dependent_variable_path)
-        projected_array *= self.all_valid_array
-        projected_path = os.path.join(output_dir, regression_label, 'agb_' + regression_label + '.tif')
-        hb.save_array_as_geotiff(projected_array, projected_path, self.zone_dependent_variable_path, data_type=6, ndv=-9999.)
-
-        residuals_array = (projected_array - depvar_array) * self.all_valid_array
-        residuals_path = os.path.join(output_dir, regression_label, 'residuals_' + regression_label + '.tif')
-        hb.save_array_as_geotiff(residuals_array, residuals_path, self.zone_dependent_variable_path, data_type=6, ndv=-9999.)
+        if n_threads is None:
+            n_threads = multiprocessing.cpu_count()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(n_threads, 1)) as executor:
+            for _ in executor.map(predict_block, block_row_starts):
+                pass
 
-        all_valid_prediction_path = os.path.join(output_dir, regression_label, 'all_valid_' + regression_label + '.tif')
-        hb.save_array_as_geotiff(self.all_valid_array, all_valid_prediction_path, self.zone_dependent_variable_path, data_type=6, ndv=-9999.)
+        for output_ds in output_datasets.values():
+            output_ds.FlushCache()
+        output_datasets = None
+        L.info('Wrote prediction of ' + str(regression_label) + ' to ' + str(projected_path))
+        return projected_path, residuals_path, all_valid_prediction_path
 
 
 
@@ -1470,11 +1444,15 @@ class RegressionAlignedInput(object):
         self.rf = rf
         self.tags = tags
 
-        # Check that the path exists
-        if not os.path.exists(self.path):
-            L.critical('RegressionSource', self.path, 'does not exist')
+        # Aligned inputs may also be netcdf raster sources, which are read by window without extracting them.
+        if isinstance(path, hb.netcdf.NetcdfRasterSource):
+            self.ndv = path.GetNoDataValue()
+        else:
+            # Check that the path exists
+            if not os.path.exists(self.path):
+                L.critical('RegressionSource', self.path, 'does not exist')
 
-        self.ndv = hb.get_raster_info_hb(path)['ndv']
+            self.ndv = hb.get_raster_info_hb(path)['ndv']
 
         if self.ndv == None:
             L.debug('No NDV set in ' + str(path))
@@ -1496,11 +1474,15 @@ class RegressionGlobalAlignedInput(object):
         self.rf = rf
         self.tags = tags
 
-        # Check that the path exists
-        if not os.path.exists(self.path):
-            L.critical('RegressionSource', self.path, 'does not exist')
+        # Aligned inputs may also be netcdf raster sources, which are read by window without extracting them.
+        if isinstance(path, hb.netcdf.NetcdfRasterSource):
+            self.ndv = path.GetNoDataValue()
+        else:
+            # Check that the path exists
+            if not os.path.exists(self.path):
+                L.critical('RegressionSource', self.path, 'does not exist')
 
-        self.ndv = hb.get_raster_info_hb(path)['ndv']
+            self.ndv = hb.get_raster_info_hb(path)['ndv']
 
         if self.ndv == None:
             L.debug('No NDV set in ' + str(path))
@@ -1647,6 +1629,212 @@ def parse_equation_to_dict(equation):
     # equation_dict['necessary_variables'] = list(set(equation_dict['necessary_variables']))
 
     return equation_dict
+def get_quad_tile_order(shape):
+    """Flat indices of an array of shape in the order RegressionFrame.array_columnize lays out its 'quad_tile' method
+    (upper left, lower left, upper right then lower right quadrant, each row-major)."""
+    flat_indices = np.arange(shape[0] * shape[1]).reshape(shape)
+    split_row = int(shape[0] / 2)
+    split_col = int(shape[1] / 2) + 1
+    return np.concatenate([flat_indices[0: split_row, 0: split_col].ravel(), flat_indices[split_row:, 0: split_col].ravel(),
+                           flat_indices[0: split_row, split_col:].ravel(), flat_indices[split_row:, split_col:].ravel()])
+
+
+def save_design_matrix(data, columns, output_path):
+    """Save a design matrix (eg from RegressionFrame.load_equation_data) as a .npy file, with its column labels in a
+    .columns.json sidecar, so it can be memory mapped and streamed by the out-of-core fitting modes."""
+    hb.create_directories(output_path)
+    np.save(output_path, np.ascontiguousarray(data))
+    with open(output_path + '.columns.json', 'w') as f:
+        json.dump(list(columns), f)
+    return output_path
+
+
+def load_design_matrix(input_path, mmap_mode='r'):
+    """Return the (memory mapped) data and column labels of a design matrix written by save_design_matrix."""
+    with open(input_path + '.columns.json') as f:
+        columns = json.load(f)
+    return np.load(input_path, mmap_mode=mmap_mode), columns
+
+
+def iter_design_matrix_chunks(df_or_path, labels, chunk_rows=2 ** 20):
+    """Yield float64 arrays of the labels columns of a DataFrame or a saved design matrix path, chunk_rows rows at a
+    time, so only one chunk is ever converted or read from disk."""
+    if isinstance(df_or_path, str):
+        data, columns = load_design_matrix(df_or_path)
+        column_indices = [columns.index(i) for i in labels]
+        for start in range(0, data.shape[0], chunk_rows):
+            yield np.asarray(data[start: start + chunk_rows][:, column_indices], dtype=np.float64)
+    else:
+        for start in range(0, len(df_or_path), chunk_rows):
+            yield df_or_path[labels].iloc[start: start + chunk_rows].to_numpy(dtype=np.float64)
+
+
+def accumulate_design_matrix_gram(df_or_path, regressor_labels, depvar_label, chunk_rows=2 ** 20):
+    """Accumulate X'X, X'y, y'y and the column sums of the regressors and depvar over row chunks of a DataFrame or saved
+    design matrix (see iter_design_matrix_chunks). These are sufficient statistics for OLS and lasso, so fitting on
+    them needs memory independent of the number of observations."""
+    n_regressors = len(regressor_labels)
+    gram = {'labels': list(regressor_labels), 'depvar_label': depvar_label, 'n': 0,
+            'XtX': np.zeros((n_regressors, n_regressors)), 'Xty': np.zeros(n_regressors), 'yty': 0.0,
+            'x_sum': np.zeros(n_regressors), 'y_sum': 0.0}
+    for chunk in iter_design_matrix_chunks(df_or_path, list(regressor_labels) + [depvar_label], chunk_rows=chunk_rows):
+        x = chunk[:, :n_regressors]
+        y = chunk[:, n_regressors]
+        gram['n'] += len(chunk)
+        gram['XtX'] += x.T @ x
+        gram['Xty'] += x.T @ y
+        gram['yty'] += float(y @ y)
+        gram['x_sum'] += x.sum(axis=0)
+        gram['y_sum'] += float(y.sum())
+    return gram
+
+
+def subset_design_matrix_gram(gram, labels):
+    """Return gram restricted to the regressors in labels."""
+    indices = [gram['labels'].index(i) for i in labels]
+    subset = dict(gram)
+    subset['labels'] = list(labels)
+    subset['XtX'] = gram['XtX'][np.ix_(indices, indices)]
+    subset['Xty'] = gram['Xty'][indices]
+    subset['x_sum'] = gram['x_sum'][indices]
+    return subset
+
+
+def fit_ols_from_gram(gram, has_constant=True):
+    """OLS estimates and the statistics run_sm_lm reports (matching statsmodels OLS) from the sufficient statistics of
+    accumulate_design_matrix_gram. has_constant means one regressor is a constant, so rsquared is centered."""
+    n = gram['n']
+    k = len(gram['labels'])
+    params = np.linalg.lstsq(gram['XtX'], gram['Xty'], rcond=None)[0]
+    rss = gram['yty'] - 2.0 * params @ gram['Xty'] + params @ gram['XtX'] @ params
+    df_resid = n - k
+    scale = rss / df_resid
+    bse = np.sqrt(np.diag(np.linalg.pinv(gram['XtX'])) * scale)
+    tvalues = params / bse
+    pvalues = 2.0 * st.t.sf(np.abs(tvalues), df_resid)
+    tss = gram['yty'] - gram['y_sum'] ** 2 / n if has_constant else gram['yty']
+    rsquared = 1.0 - rss / tss
+    llf = -n / 2.0 * (np.log(2.0 * np.pi) + np.log(rss / n) + 1.0)
+
+    result = OrderedDict()
+    result['params'] = pd.Series(params, index=gram['labels'])
+    result['bse'] = pd.Series(bse, index=gram['labels'])
+    result['tvalues'] = pd.Series(tvalues, index=gram['labels'])
+    result['pvalues'] = pd.Series(pvalues, index=gram['labels'])
+    result['rsquared'] = rsquared
+    result['rsquared_adj'] = 1.0 - (n - int(has_constant)) / df_resid * (1.0 - rsquared)
+    result['llf'] = llf
+    result['aic'] = 2.0 * k - 2.0 * llf
+    result['bic'] = k * np.log(n) - 2.0 * llf
+    result['nobs'] = n
+    result['summary'] = pd.DataFrame({'coef': params, 'std err': bse, 't': tvalues, 'P>|t|': pvalues}, index=gram['labels'])
+    return result
+
+
+def fit_lasso_from_gram(gram, alpha, initial_coef=None, max_iter=1000, tol=1e-6):
+    """Lasso with an intercept (the objective of sklearn Lasso and LassoLars, 1 / (2n) * ||y - Xb - b0||^2 + alpha *
+    ||b||_1) by coordinate descent on the centered sufficient statistics of accumulate_design_matrix_gram. Constant
+    regressors get a zero coefficient, as they do when sklearn centers them. Pass the previous coef as initial_coef to
+    warm start along a path of alphas. Returns (coef, intercept)."""
+    n = gram['n']
+    x_mean = gram['x_sum'] / n
+    y_mean = gram['y_sum'] / n
+    covariance = gram['XtX'] / n - np.outer(x_mean, x_mean)
+    cross = gram['Xty'] / n - x_mean * y_mean
+    coef = np.zeros(len(x_mean)) if initial_coef is None else np.array(initial_coef, dtype=np.float64)
+    variances = np.diag(covariance)
+    active = variances > 1e-12 * max(variances.max(), 1e-300)
+    coef[~active] = 0.0
+    for iteration in range(max_iter):
+        max_change = 0.0
+        for j in np.flatnonzero(active):
+            residual_cross = cross[j] - covariance[j] @ coef + variances[j] * coef[j]
+            new_coef = np.sign(residual_cross) * max(abs(residual_cross) - alpha, 0.0) / variances[j]
+            max_change = max(max_change, abs(new_coef - coef[j]))
+            coef[j] = new_coef
+        if max_change < tol * max(np.abs(coef).max(), 1e-12):
+            break
+    intercept = y_mean - x_mean @ coef
+    return coef, intercept
+
+
+def fit_logit_out_of_core(df_or_path, regressor_labels, depvar_label, chunk_rows=2 ** 20, initial_params=None, max_iter=35, tol=1e-8):
+    """Logit maximum likelihood (matching statsmodels Logit) by Newton iterations that each stream the row chunks of a
+    DataFrame or saved design matrix once, accumulating the gradient and X'WX. Pass the params of a previous fit (eg on
+    a sample) as initial_params to warm start, which usually converges in a few passes."""
+    labels = list(regressor_labels)
+    params = np.zeros(len(labels)) if initial_params is None else np.array(initial_params, dtype=np.float64)
+    for iteration in range(max_iter):
+        gradient = np.zeros(len(labels))
+        hessian = np.zeros((len(labels), len(labels)))
+        llf = 0.0
+        nobs = 0
+        for chunk in iter_design_matrix_chunks(df_or_path, labels + [depvar_label], chunk_rows=chunk_rows):
+            x = chunk[:, :-1]
+            y = chunk[:, -1]
+            linear = x @ params
+            p = st.logistic.cdf(linear)
+            gradient += x.T @ (y - p)
+            hessian += (x * (p * (1.0 - p))[:, np.newaxis]).T @ x
+            llf += float(np.sum(y * linear - np.logaddexp(0.0, linear)))
+            nobs += len(chunk)
+        step = np.linalg.lstsq(hessian, gradient, rcond=None)[0]
+        params = params + step
+        if np.max(np.abs(step)) < tol * max(1.0, np.max(np.abs(params))):
+            break
+    else:
+        L.warning('fit_logit_out_of_core did not converge in ' + str(max_iter) + ' iterations.')
+
+    bse = np.sqrt(np.diag(np.linalg.pinv(hessian)))
+    result = OrderedDict()
+    result['params'] = pd.Series(params, index=labels)
+    result['bse'] = pd.Series(bse, index=labels)
+    result['pvalues'] = pd.Series(2.0 * st.norm.sf(np.abs(params / bse)), index=labels)
+    result['llf'] = llf
+    result['aic'] = 2.0 * len(labels) - 2.0 * llf
+    result['bic'] = len(labels) * np.log(nobs) - 2.0 * llf
+    result['nobs'] = nobs
+    result['n_iterations'] = iteration + 1
+    return result
+
+
+def get_stratified_block_sample(n_rows, n_cols, sample_size, block_size=64, block_strata=None, seed=None):
+    """Choose square blocks of block_size cells of an n_rows by n_cols window holding about sample_size cells in total,
+    as (row, col, n_block_rows, n_block_cols) windows sorted in read order.
+
+    Blocks rather than strided cells keep reads contiguous and preserve local spatial structure. If block_strata (an
+    array with one stratum per block, eg the strata raster read with a stride of block_size) is given, each stratum
+    gets blocks in proportion to its number of blocks, and at least one. The same seed gives the same sample.
+    """
+    block_row_starts = np.arange(0, n_rows, block_size)
+    block_col_starts = np.arange(0, n_cols, block_size)
+    n_blocks = len(block_row_starts) * len(block_col_starts)
+    n_to_sample = min(n_blocks, int(math.ceil(float(sample_size) / (block_size * block_size))))
+
+    if block_strata is None:
+        block_strata = np.zeros(n_blocks, dtype=np.int64)
+    else:
+        # Pad (or trim) a strided read of the strata to the block grid.
+        block_strata = np.asarray(block_strata)[:len(block_row_starts), :len(block_col_starts)]
+        block_strata = np.pad(block_strata, ((0, len(block_row_starts) - block_strata.shape[0]), (0, len(block_col_starts) - block_strata.shape[1])), mode='edge').ravel()
+
+    rng = np.random.default_rng(seed)
+    strata, block_stratum_indices = np.unique(block_strata, return_inverse=True)
+    chosen = []
+    for stratum_index in range(len(strata)):
+        stratum_blocks = np.flatnonzero(block_stratum_indices == stratum_index)
+        n_stratum_sample = min(len(stratum_blocks), max(1, int(round(n_to_sample * len(stratum_blocks) / float(n_blocks)))))
+        chosen.append(rng.choice(stratum_blocks, n_stratum_sample, replace=False))
+    chosen = np.sort(np.concatenate(chosen))
+
+    windows = []
+    for block_index in chosen:
+        row = int(block_row_starts[block_index // len(block_col_starts)])
+        col = int(block_col_starts[block_index % len(block_col_starts)])
+        windows.append((row, col, min(block_size, n_rows - row), min(block_size, n_cols - col)))
+    return windows
+
+
 def generate_gaussian_kernel(kernlen=21, nsig=3):
     """Returns a 2D Gaussian kernel array. kernlen determines the size (always choose ODD numbers unless you're baller cause of asymmetric results.
     nsig is the signma blur. HAving it too small makes the blur not hit zero before the edge."""
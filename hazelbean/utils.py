@@ -15,6 +15,8 @@ import contextlib
 import logging
 from google.cloud import storage
 import hashlib
+import uuid
+import copy
 import inspect
 import subprocess
 from tqdm import tqdm
@@ -590,7 +592,7 @@ def df_plot(input_df, output_png_path, type='bar', legend_labels=None):
     # Save the png to output_png_path
     plt.savefig(output_png_path, dpi=300, bbox_inches='tight')
 
-def df_merge_list_of_csv_paths(csv_path_list, output_csv_path=None, on='index', left_on=None, right_on=None, column_suffix='fileroot',verbose=False):
+def df_merge_list_of_csv_paths(csv_path_list, output_csv_path=None, on='index', left_on=None, right_on=None, column_suffix='fileroot',verbose=False, use_cache=True):
     print('CAVEAT NYI, only use on otherwise left and right_on get overwrit')
     merged_df = None
 
@@ -608,7 +610,7 @@ def df_merge_list_of_csv_paths(csv_path_list, output_csv_path=None, on='index',
         right_on = on
 
     for c, csv_path in enumerate(csv_path_list):
-        current_df = pd.read_csv(csv_path)  
+        current_df = df_read(csv_path, use_cache=use_cache)
 
         if column_suffix == 'fileroot':
             columns = {k: v for k, v in zip(current_df.columns, [str(i) + '_' + hb.file_root(csv_path) for i in current_df.columns])}
@@ -814,6 +816,96 @@ def df_pivot_vertical_up(df, row_indices, column_indices, values, aggregation_di
         
     return df_p
                 
+def df_build_merge_index(right_df, right_on):
+    """Index right_df by its unique right_on key column(s) (a label or list of labels, kept as columns too) for
+    many-to-one merges with df_merge_indexed. Keep the result to merge the same right table repeatedly: the hash table
+    of its keys is built on the first merge and reused by the later ones."""
+    right_indexed = right_df.set_index(right_on, drop=False)
+    if not right_indexed.index.is_unique:
+        raise NameError('Keys ' + str(right_on) + ' of the right df are not unique, so it cannot be used as a merge index.')
+    return right_indexed
+
+
+def df_merge_indexed(left_df, right_index, left_on, how='left'):
+    """Merge left_df with right_index (from df_build_merge_index) the way pd.merge(left_df, right_df, how=how,
+    left_on=left_on, right_on=right_on) does for a how of 'left' or 'inner' and unique right keys: the rows and
+    order of left_df, with the right key columns dropped where they have the same name as the left keys. Instead of a
+    join, the left keys are looked up in the right keys' hash table and the right columns gathered, so left_df is copied
+    once and the right index is reused across calls."""
+    if how not in ['left', 'inner']:
+        raise NameError('df_merge_indexed only supports how of left or inner, not ' + str(how))
+    left_keys = [left_on] if not isinstance(left_on, list) else left_on
+    right_keys = list(right_index.index.names)
+    if len(left_keys) != len(right_keys):
+        raise NameError('df_merge_indexed given ' + str(len(left_keys)) + ' left keys but the right index has ' + str(len(right_keys)))
+
+    if len(left_keys) == 1:
+        keys = pd.Index(left_df[left_keys[0]])
+    else:
+        keys = pd.MultiIndex.from_frame(left_df[left_keys])
+
+    if how == 'inner':
+        # Drop the unmatched left rows before gathering so the right columns keep their dtypes, as in pd.merge.
+        matched = np.flatnonzero(right_index.index.get_indexer(keys) >= 0)
+        if len(matched) < len(left_df):
+            left_df = left_df.take(matched)
+            keys = keys.take(matched)
+
+    right_columns = [i for i in right_index.columns if not (i in right_keys and i == left_keys[right_keys.index(i)])]
+    right_part = right_index[right_columns].reindex(keys)
+    return pd.concat([left_df.reset_index(drop=True), right_part.reset_index(drop=True)], axis=1)
+
+
+def df_merge_key_dtypes_compatible(left_dtype, right_dtype):
+    """True if merge keys of these dtypes can be matched by df_merge_indexed with the same result as pd.merge."""
+    if isinstance(left_dtype, pd.CategoricalDtype) or isinstance(right_dtype, pd.CategoricalDtype):
+        return False
+    if left_dtype == right_dtype:
+        return True
+    if not isinstance(left_dtype, np.dtype) or not isinstance(right_dtype, np.dtype):
+        return False
+    return {left_dtype.kind, right_dtype.kind} <= {'i', 'u'} or left_dtype.kind == right_dtype.kind == 'f'
+
+
+def df_merge_frames(left_df, right_df, how, left_on, right_on):
+    # pd.merge, with 'index' as left_on or right_on meaning the index, that uses df_merge_indexed when it gives the same
+    # result more cheaply: left or inner merges of plain DataFrames on columns with unique right keys, no other shared
+    # column names, and key dtypes that are identical (but not categorical) or both integer or both float. Other key
+    # pairs, eg bool against int, match differently in pd.merge than in the hash lookup.
+    if left_on == 'index' and right_on == 'index':
+        return pd.merge(left_df, right_df, how=how, left_index=True, right_index=True)
+    elif left_on == 'index':
+        return pd.merge(left_df, right_df, how=how, left_index=True, right_on=right_on)
+    elif right_on == 'index':
+        return pd.merge(left_df, right_df, how=how, left_on=left_on, right_index=True)
+
+    left_keys = left_on if isinstance(left_on, list) else [left_on]
+    right_keys = right_on if isinstance(right_on, list) else [right_on]
+    use_index = how in ['left', 'inner'] and type(left_df) is pd.DataFrame and type(right_df) is pd.DataFrame and len(left_keys) == len(right_keys)
+    if use_index:
+        use_index = all(i in left_df.columns for i in left_keys) and all(i in right_df.columns for i in right_keys)
+    if use_index:
+        shared = set(left_df.columns) & set(right_df.columns)
+        use_index = all(i in left_keys and i in right_keys and left_keys.index(i) == right_keys.index(i) for i in shared)
+    if use_index:
+        use_index = all(df_merge_key_dtypes_compatible(left_df[i].dtype, right_df[j].dtype) for i, j in zip(left_keys, right_keys))
+    if use_index:
+        use_index = not right_df.duplicated(right_keys).any()
+    if use_index:
+        return df_merge_indexed(left_df, df_build_merge_index(right_df, right_on), left_on, how=how)
+    return pd.merge(left_df, right_df, how=how, left_on=left_on, right_on=right_on)
+
+
+def df_columns_equal_ignoring_order(left_values, right_values):
+    """True if the two columns hold the same values (including NaN) with the same counts, in any order. Both are coded
+    against one shared factorization and their counts compared, rather than converted to strings and sorted."""
+    left_values = np.asarray(left_values)
+    right_values = np.asarray(right_values)
+    if len(left_values) != len(right_values):
+        return False
+    codes, uniques = pd.factorize(np.concatenate([left_values, right_values]), use_na_sentinel=False)
+    return np.array_equal(np.bincount(codes[:len(left_values)], minlength=len(uniques)), np.bincount(codes[len(left_values):], minlength=len(uniques)))
+
 def df_merge_quick(
     left_df, 
     right_df, 
@@ -823,23 +915,31 @@ def df_merge_quick(
     check_identicality=True,
     raise_error_if_not_identical=False, 
     verbose=False,
+    right_index=None,
     ):
     
     """ Quick merge of two dataframe where it will drop the right columns that are identical to the left columns. This
-    Prevents the annoying proliferation of _x and _y columns when they're the same."""
+    Prevents the annoying proliferation of _x and _y columns when they're the same.
+
+    If right_index (from df_build_merge_index(right_df, right_on)) is given, a left or inner merge looks the left keys
+    up in it instead of joining, which is faster when the same right_df is merged onto many left dfs."""
     
     comparison = hb.df_compare_column_labels_as_dict(left_df, right_df)
-    right_df = right_df.rename(columns={i: i + '_right' for i in comparison['intersection'] if i != left_on and i != right_on})
+    right_renames = {i: i + '_right' for i in comparison['intersection'] if i != left_on and i != right_on}
+    right_df = right_df.rename(columns=right_renames)
 
     # Merge
-    merged_df = pd.merge(left_df, right_df, how=how, left_on=left_on, right_on=right_on)
+    if right_index is not None and how in ['left', 'inner']:
+        merged_df = df_merge_indexed(left_df, right_index.rename(columns=right_renames), left_on, how=how)
+    else:
+        merged_df = df_merge_frames(left_df, right_df, how, left_on, right_on)
     
     if check_identicality:
         keep_right = []
         for col in comparison['intersection']:
             right_col = col + '_right'
             if col in merged_df.columns and right_col in merged_df.columns:
-                if not hb.arrays_equal_ignoring_order(merged_df[col].values, merged_df[right_col].values): # , ignore_values=[-9999]        
+                if not df_columns_equal_ignoring_order(merged_df[col].values, merged_df[right_col].values):
                     if raise_error_if_not_identical:
                         raise NameError('Column ' + col + ' is not identical between left and right dataframes. Contents: ' + str(left_df[col].values) + ' ' + str(right_df[col].values))
                     else:
@@ -850,11 +950,271 @@ def df_merge_quick(
         
     return merged_df
 
-def df_read(input_path, delimiter=','):
+_file_cache = {}
+_csv_encoding_cache = {}
+csv_encodings_to_try = [None, 'utf-8', 'ISO-8859-1', 'latin1']
+
+
+def encode_cache_object(input_object, array_writer=None):
+    """Convert input_object to something json.dump can write, so cache sidecars never need pickle (which would run
+    code from whoever wrote the sidecar when it is loaded). Handles None, bools, numbers, strings, bytes, lists,
+    tuples, dicts (OrderedDicts and non-string keys included), builtin types such as int, numpy arrays (masked too),
+    scalars and dtypes, and DataFrames and Series whose values are any of those. Types that are not json-like are tagged with '__hb_type__' so
+    decode_cache_object can restore them. Raises TypeError for anything else.
+
+    If array_writer is given, numeric arrays and numeric or string DataFrame columns are passed to it instead of being
+    written as json lists, and the name it returns (eg of an .npy file) is stored in their place."""
+    if input_object is None or isinstance(input_object, (bool, int, float, str)) and not isinstance(input_object, np.generic):
+        return input_object
+    if isinstance(input_object, bytes):
+        return {'__hb_type__': 'bytes', 'value': input_object.hex()}
+    if isinstance(input_object, list):
+        return [encode_cache_object(i, array_writer) for i in input_object]
+    if isinstance(input_object, tuple):
+        return {'__hb_type__': 'tuple', 'items': [encode_cache_object(i, array_writer) for i in input_object]}
+    if isinstance(input_object, dict):
+        if type(input_object) is dict and all(isinstance(k, str) for k in input_object) and '__hb_type__' not in input_object:
+            return {k: encode_cache_object(v, array_writer) for k, v in input_object.items()}
+        return {'__hb_type__': 'OrderedDict' if isinstance(input_object, OrderedDict) else 'dict',
+                'items': [[encode_cache_object(k, array_writer), encode_cache_object(v, array_writer)] for k, v in input_object.items()]}
+    if isinstance(input_object, type) and input_object in [bool, int, float, str, bytes, list, tuple, dict]:
+        return {'__hb_type__': 'type', 'value': input_object.__name__}
+    if isinstance(input_object, np.dtype):
+        if input_object.fields is not None:
+            raise TypeError('Structured dtypes are not supported by encode_cache_object: ' + str(input_object))
+        return {'__hb_type__': 'dtype', 'value': input_object.str}
+    if isinstance(input_object, np.generic):
+        return {'__hb_type__': 'scalar', 'dtype': encode_cache_object(input_object.dtype), 'value': encode_cache_object(input_object.item())}
+    if isinstance(input_object, np.ndarray):
+        if array_writer is not None and input_object.dtype.kind in 'biufcmM':
+            encoded = {'__hb_type__': 'ndarray_file', 'file': array_writer(np.ma.getdata(input_object))}
+            if isinstance(input_object, np.ma.MaskedArray):
+                encoded['mask_file'] = array_writer(np.ma.getmaskarray(input_object))
+            return encoded
+        encoded = {'__hb_type__': 'ndarray', 'dtype': encode_cache_object(input_object.dtype), 'shape': list(input_object.shape),
+                   'data': encode_cache_object(np.ma.getdata(input_object).tolist())}
+        if isinstance(input_object, np.ma.MaskedArray):
+            encoded['mask'] = np.ma.getmaskarray(input_object).tolist()
+        return encoded
+    if isinstance(input_object, pd.DataFrame):
+        return {'__hb_type__': 'DataFrame', 'index': encode_cache_object(input_object.index),
+                'columns': encode_cache_object(input_object.columns),
+                'dtypes': [str(i) for i in input_object.dtypes],
+                'data': [encode_cache_column(input_object.iloc[:, i], array_writer) for i in range(input_object.shape[1])]}
+    if isinstance(input_object, pd.Series):
+        return {'__hb_type__': 'Series', 'index': encode_cache_object(input_object.index), 'name': encode_cache_object(input_object.name),
+                'dtype': str(input_object.dtype), 'data': encode_cache_column(input_object, array_writer)}
+    if isinstance(input_object, pd.Index) and not isinstance(input_object, pd.MultiIndex):
+        if isinstance(input_object, pd.RangeIndex):
+            return {'__hb_type__': 'RangeIndex', 'start': int(input_object.start), 'stop': int(input_object.stop), 'step': int(input_object.step),
+                    'name': encode_cache_object(input_object.name)}
+        return {'__hb_type__': 'Index', 'dtype': str(input_object.dtype), 'name': encode_cache_object(input_object.name),
+                'data': encode_cache_object(input_object.tolist())}
+    raise TypeError('Unable to encode ' + str(type(input_object)) + ' for a cache sidecar.')
+
+
+def encode_cache_column(input_series, array_writer=None):
+    """Encode the values of a Series for encode_cache_object. With an array_writer, numeric, bool and datetime values
+    are written as they are and all-string values (missing ones allowed) as a fixed width unicode array plus a
+    missing mask, so neither needs pickle. Anything else is a json list."""
+    if array_writer is not None:
+        values = input_series.to_numpy()
+        if values.dtype.kind in 'biufcmM':
+            return {'__hb_type__': 'ndarray_file', 'file': array_writer(values)}
+        missing = np.asarray(pd.isna(values), dtype=bool)
+        if all(isinstance(i, str) for i in values[~missing]):
+            strings = np.where(missing, '', values).astype(str)
+            return {'__hb_type__': 'strings_file', 'file': array_writer(strings), 'missing_file': array_writer(missing)}
+    return encode_cache_object(input_series.tolist())
+
+
+def decode_cache_object(input_object, array_reader=None):
+    """Inverse of encode_cache_object on the result of json.load. array_reader loads what the array_writer given to
+    encode_cache_object wrote, from the name it returned."""
+    if isinstance(input_object, list):
+        return [decode_cache_object(i, array_reader) for i in input_object]
+    if not isinstance(input_object, dict):
+        return input_object
+    hb_type = input_object.get('__hb_type__')
+    if hb_type is None:
+        return {k: decode_cache_object(v, array_reader) for k, v in input_object.items()}
+    if hb_type == 'bytes':
+        return bytes.fromhex(input_object['value'])
+    if hb_type == 'tuple':
+        return tuple(decode_cache_object(i, array_reader) for i in input_object['items'])
+    if hb_type in ['dict', 'OrderedDict']:
+        items = [(decode_cache_object(k, array_reader), decode_cache_object(v, array_reader)) for k, v in input_object['items']]
+        return OrderedDict(items) if hb_type == 'OrderedDict' else dict(items)
+    if hb_type == 'type':
+        return {'bool': bool, 'int': int, 'float': float, 'str': str, 'bytes': bytes, 'list': list, 'tuple': tuple, 'dict': dict}[input_object['value']]
+    if hb_type == 'dtype':
+        return np.dtype(input_object['value'])
+    if hb_type == 'scalar':
+        return decode_cache_object(input_object['dtype']).type(decode_cache_object(input_object['value']))
+    if hb_type in ['ndarray_file', 'strings_file']:
+        if array_reader is None:
+            raise TypeError('Cache sidecar refers to array files but no array_reader was given.')
+        array = array_reader(input_object['file'])
+        if 'mask_file' in input_object:
+            array = np.ma.masked_array(array, mask=array_reader(input_object['mask_file']))
+        if hb_type == 'strings_file':
+            array = array.astype(object)
+            array[array_reader(input_object['missing_file'])] = np.nan
+        return array
+    if hb_type == 'ndarray':
+        dtype = decode_cache_object(input_object['dtype'])
+        array = np.asarray(decode_cache_object(input_object['data']), dtype=dtype).reshape(input_object['shape'])
+        if 'mask' in input_object:
+            array = np.ma.masked_array(array, mask=np.asarray(input_object['mask'], dtype=bool).reshape(input_object['shape']))
+        return array
+    if hb_type == 'DataFrame':
+        columns = decode_cache_object(input_object['columns'])
+        index = decode_cache_object(input_object['index'])
+        df = pd.DataFrame({position: pd.Series(decode_cache_object(data, array_reader), index=index, dtype=dtype)
+                           for position, (data, dtype) in enumerate(zip(input_object['data'], input_object['dtypes']))}, index=index)
+        df.columns = columns
+        return df
+    if hb_type == 'Series':
+        return pd.Series(decode_cache_object(input_object['data'], array_reader), index=decode_cache_object(input_object['index']),
+                         dtype=input_object['dtype'], name=decode_cache_object(input_object['name']))
+    if hb_type == 'RangeIndex':
+        return pd.RangeIndex(input_object['start'], input_object['stop'], input_object['step'], name=decode_cache_object(input_object['name']))
+    if hb_type == 'Index':
+        return pd.Index(decode_cache_object(input_object['data']), dtype=input_object['dtype'], name=decode_cache_object(input_object['name']))
+    raise TypeError('Unknown cache sidecar type ' + str(hb_type))
+
+
+def get_cache_object_files(input_object):
+    """Names of the array files referred to by the output of encode_cache_object."""
+    files = []
+    if isinstance(input_object, list):
+        for i in input_object:
+            files.extend(get_cache_object_files(i))
+    elif isinstance(input_object, dict):
+        for k, v in input_object.items():
+            if k in ['file', 'mask_file', 'missing_file'] and input_object.get('__hb_type__') in ['ndarray_file', 'strings_file']:
+                files.append(v)
+            else:
+                files.extend(get_cache_object_files(v))
+    return files
+
+
+def get_file_cache_path(input_path, cache_dir):
+    """Path of the directory in cache_dir holding the parsed contents of the file at input_path, named by the file
+    root and a hash of its absolute path. It holds a small metadata.json and one .npy file per array or column."""
+    return os.path.join(cache_dir, hb.file_root(input_path) + '_' + hashlib.md5(os.path.abspath(input_path).encode('utf-8')).hexdigest() + '.hbcache')
+
+
+def read_with_file_cache(input_path, variant_key, read_function, use_cache=True, cache_dir=None):
+    """Return read_function(input_path), cached in memory keyed by the file's path, size and mtime, so the same table
+    read by many tasks or iterator workers is parsed once. variant_key distinguishes reads of the same file with
+    different options (eg the delimiter). A copy is returned so callers can modify it without changing the cache.
+
+    If cache_dir is given, the contents are also written there (see get_file_cache_path) so other processes reuse
+    them: arrays and DataFrame columns as .npy files saved and loaded with allow_pickle=False, the rest encoded by
+    encode_cache_object into metadata.json. Nothing is written next to input_path unless cache_dir is its directory.
+    Contents that cannot be encoded, or a cache_dir that cannot be written, are only cached in memory."""
+    if not use_cache:
+        return read_function(input_path)
+
+    stat = os.stat(input_path)
+    memory_key = (os.path.abspath(input_path), stat.st_size, stat.st_mtime_ns, variant_key)
+    if memory_key in _file_cache:
+        return copy.deepcopy(_file_cache[memory_key])
+
+    if cache_dir is None:
+        contents = read_function(input_path)
+        _file_cache[memory_key] = contents
+        return copy.deepcopy(contents)
+
+    cache_path = get_file_cache_path(input_path, cache_dir)
+    metadata_path = os.path.join(cache_path, 'metadata.json')
+    array_reader = lambda name: np.load(os.path.join(cache_path, name), allow_pickle=False)
+
+    # Entries are kept encoded and only the requested variant is decoded, so adding a variant does not rewrite the others.
+    entries = []
+    stale_entries = []
+    found = False
+    if os.path.exists(metadata_path):
+        try:
+            with open(metadata_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached['source_size'] == stat.st_size and cached['source_mtime_ns'] == stat.st_mtime_ns:
+                entries = cached['variants']
+            else:
+                stale_entries = cached['variants']
+            for encoded_key, encoded_contents in entries:
+                if decode_cache_object(encoded_key) == variant_key:
+                    contents = decode_cache_object(encoded_contents, array_reader)
+                    found = True
+                    break
+        except Exception as e:
+            L.debug('Ignoring unreadable file cache ' + cache_path + ': ' + str(e))
+            entries = []
+
+    if not found:
+        contents = read_function(input_path)
+        written_files = []
+
+        def array_writer(array):
+            name = uuid.uuid4().hex + '.npy'
+            written_files.append(name)
+            np.save(os.path.join(cache_path, name), array, allow_pickle=False)
+            return name
+
+        # Arrays get fresh names and metadata.json is written to a temporary file then renamed, so concurrent readers
+        # never see a partial cache.
+        temp_path = metadata_path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            hb.create_directories(cache_path)
+            entries = entries + [[encode_cache_object(variant_key), encode_cache_object(contents, array_writer)]]
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns, 'variants': entries}, f)
+            os.replace(temp_path, metadata_path)
+            for name in get_cache_object_files(stale_entries):
+                if os.path.exists(os.path.join(cache_path, name)):
+                    os.remove(os.path.join(cache_path, name))
+        except Exception as e:
+            L.debug('Unable to write file cache ' + cache_path + ': ' + str(e))
+            for path in [temp_path] + [os.path.join(cache_path, name) for name in written_files]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    _file_cache[memory_key] = contents
+    return copy.deepcopy(contents)
+
+
+def read_csv_detecting_encoding(input_path, delimiter=','):
+    """Read a CSV with pd.read_csv, trying the encodings in csv_encodings_to_try (None is pandas' default) in order.
+    The encoding that worked is remembered for the file's path, size and mtime, so later reads try it first.
+
+    Returns the DataFrame and the encoding used."""
+    stat = os.stat(input_path)
+    encoding_key = (os.path.abspath(input_path), stat.st_size, stat.st_mtime_ns)
+    encodings = list(csv_encodings_to_try)
+    if encoding_key in _csv_encoding_cache:
+        encodings.insert(0, _csv_encoding_cache[encoding_key])
+
+    for encoding in encodings:
+        try:
+            df = pd.read_csv(input_path, delimiter=delimiter, encoding=encoding)
+        except Exception:
+            continue
+        _csv_encoding_cache[encoding_key] = encoding
+        return df, encoding
+    raise NameError(f'Unable to read {input_path} as a csv. It may not be a csv or it may be malformed.\n    Abspath: {os.path.abspath(input_path)}. \n    Normpath: {os.path.normpath(input_path)}')
+
+
+def df_read(input_path, delimiter=',', use_cache=True, cache_dir=None):
     """Read an input path to a Pandas DataFram
     
     Args:
         input_path (str): Path string to the file. Currently only implements CSV.
+        delimiter (str): Delimiter passed to pd.read_csv.
+        use_cache (bool): Keep the parsed DataFrame and the encoding that read it in memory keyed by the file's
+            path, size and mtime (see read_with_file_cache), so rereading an unchanged CSV does not reparse it.
+        cache_dir (str): Also keep them here as .npy columns, so other processes reuse them. Nothing is written
+            to disk if None.
     
     Returns:
         The Pandas DataFrame read from the CSV file.
@@ -878,26 +1238,8 @@ def df_read(input_path, delimiter=','):
         raise NameError(f'df_read only accepts a string path. You passed in {str(input_path)} of type {str(type(input_path))} which is not a string.')
     if not os.path.exists(input_path):
         raise NameError(f'Path does not exist, so df_read cannot read it\n    Inputted: {input_path}\n    Abspath:  {os.path.abspath(input_path)} \n    Normpath: {os.path.normpath(input_path)}')
-    
-    try:
-        df = pd.read_csv(input_path, delimiter=delimiter)
-    except:
-        encoding = 'utf-8'
-        try:
-            df = pd.read_csv(input_path, delimiter=delimiter, encoding=encoding)
-        except:
-            encoding = 'ISO-8859-1'
-            try:
-                df = pd.read_csv(input_path, delimiter=delimiter, encoding=encoding)
-            except:
-                encoding = 'latin1'
-                try:
-                    df = pd.read_csv(input_path, delimiter=delimiter, encoding=encoding)
-                except:
-                    raise NameError(f'Unable to read {input_path} as a csv. It may not be a csv or it may be malformed.\n    Abspath: {os.path.abspath(input_path)}. \n    Normpath: {os.path.normpath(input_path)}')
-                raise NameError(f'Unable to read {input_path} as a csv. It may not be a csv or it may be malformed. \n     Abspath: {os.path.abspath(input_path)}. \n     Normpath: {os.path.normpath(input_path)}')
-            raise NameError(f'Unable to read {input_path} as a csv. It may not be a csv or it may be malformed.  \n    Abspath: {os.path.abspath(input_path)}. \n     Normpath: {os.path.normpath(input_path)}')
-        raise NameError(f'Unable to read {input_path} as a csv. It may not be a csv or it may be malformed.  \n    Abspath: {os.path.abspath(input_path)}.  \n    Normpath: {os.path.normpath(input_path)}')
+
+    df, encoding = read_with_file_cache(input_path, ('df_read', delimiter), lambda path: read_csv_detecting_encoding(path, delimiter=delimiter), use_cache=use_cache, cache_dir=cache_dir)
     return df
 
 def df_write(df, output_path, index=False, handle_quotes='auto'):
@@ -954,17 +1296,24 @@ def df_write(df, output_path, index=False, handle_quotes='auto'):
         raise NameError(f"Unsupported file extension: '{file_ext}'. Please use '.csv' or '.xlsx'.")
 
 # TODOOO Reorg hazelbean dfs to be in df.py so you would call hb.df.smartcast(df) instead of hb.df_smartcast(df)
-def df_smartcast(df):
+def df_smartcast(df, copy=True):
     """
     Automatically infer and convert DataFrame columns to appropriate types.
     
     Args:
         df: pandas DataFrame
+        copy: If False, df itself is returned when no column needs converting (eg all numeric), and otherwise only
+            the converted columns are new.
         
     Returns:
         pandas DataFrame with optimized column types
     """
-    df_copy = df.copy()
+    if not copy:
+        if all(pd.api.types.is_numeric_dtype(df[col]) for col in df.columns):
+            return df
+        df_copy = df.copy(deep=False)
+    else:
+        df_copy = df.copy()
     
     for col in df_copy.columns:
         # Skip if already numeric
@@ -1113,17 +1462,10 @@ def df_merge(left_input,
         # I chose to have this be considered non-identical and let the user deal with it pre function.
         if full_check_for_identicallity:
             if 'int' in str(left_df[col].dtype) or 'float' in str(left_df[col].dtype):
-                # temporarily replace np.nan with -9999 so that it can test equality between nans
-                left_df[col + '_temp'] = left_df[col].fillna(-9999)
-                right_df[col + '_temp'] = right_df[col].fillna(-9999)
-
-                if hb.arrays_equal_ignoring_order(left_df[col + '_temp'].values, right_df[col + '_temp'].values, ignore_values=[-9999]):
+                # Replace np.nan with -9999 so that it can test equality between nans (without adding temp columns to the inputs)
+                if hb.arrays_equal_ignoring_order(left_df[col].fillna(-9999).values, right_df[col].fillna(-9999).values, ignore_values=[-9999]):
                     identical_columns.append(left_df[col])
                     identical_column_labels.append(col)
-                    
-                # Now drop the temp columns
-                left_df = left_df.drop(col + '_temp', axis=1)
-                right_df = right_df.drop(col + '_temp', axis=1)
                 
             else:
                 if left_df[col].sort_values().reset_index(drop=True).equals(right_df[col].sort_values().reset_index(drop=True)):
@@ -1179,17 +1521,19 @@ def df_merge(left_input,
     right_df = right_df.rename(columns={i: i + '_right' for i in comparison['intersection'] if i != left_on and i != right_on and i not in left_on and i not in right_on})
     
     # Make all DF objects have the right types, as implied by analysis of their content.
-    right_df = df_smartcast(right_df)
-    left_df = df_smartcast(left_df)
+    right_df = df_smartcast(right_df, copy=False)
+    left_df = df_smartcast(left_df, copy=False)
     
-    merged_df = pd.merge(left_df, right_df, how=how, left_on=left_on, right_on=right_on)
+    # Merge once. The identicality checks only decide which columns are kept, and that is applied by selecting columns.
+    merged_df = df_merge_frames(left_df, right_df, how, left_on, right_on)
 
+    keep_right = []
+    dropped_columns = []
     if check_identicality:
-        keep_right = []
         for col in comparison['intersection']:
             right_col = col + '_right'
             if col in merged_df.columns and right_col in merged_df.columns:
-                if not hb.arrays_equal_ignoring_order(merged_df[col].values, merged_df[right_col].values): # , ignore_values=[-9999]        
+                if not df_columns_equal_ignoring_order(merged_df[col].values, merged_df[right_col].values):
                     if raise_error_if_not_identical:
                         raise NameError('Column ' + col + ' is not identical between left and right dataframes. Contents: ' + str(left_df[col].values) + ' ' + str(right_df[col].values))
                     else:
@@ -1205,31 +1549,22 @@ def df_merge(left_input,
                         keep_right.append(right_col)
                     elif same_name_nonidentical_column_behavior == 'keep_left':
                         hb.log('Keeping left column ' + col + ' and dropping right column ' + right_col)
-                        if right_col in merged_df.columns:
-                            merged_df = merged_df.drop(right_col, axis=1)
+                        dropped_columns.append(right_col)
                     elif same_name_nonidentical_column_behavior == 'keep_right':
                         hb.log('Keeping right column ' + right_col + ' and dropping left column ' + col)
-                        merged_df = merged_df.drop(col, axis=1)
+                        dropped_columns.append(col)
                         keep_right.append(right_col)
                     elif same_name_nonidentical_column_behavior == 'raise_error':
                         raise NameError('Column ' + col + ' is not identical between left and right dataframes. Contents: ' + str(left_df[col].values) + ' ' + str(right_df[right_col].values))
-                        
-                        
-        # for col in merged_df.columns:
-        merged_df = merged_df[[i for i in merged_df.columns if not str(i).endswith('_right') or i in keep_right]]
-        
+
+
+        kept_columns = [i for i in merged_df.columns if i not in dropped_columns and (not str(i).endswith('_right') or i in keep_right)]
+    else:
+        kept_columns = list(merged_df.columns)
+
 
     if compare_inner_outer:
-        if left_on == 'index' and right_on == 'index':
-            df_inner = pd.merge(left_df, right_df, how='inner', left_index=True, right_index=True)
-            df_outer = pd.merge(left_df, right_df, how='outer', left_index=True, right_index=True)
-        elif left_on == 'index':
-            df_inner = pd.merge(left_df, right_df, how='inner', left_index=True, right_on=right_on)
-            df_outer = pd.merge(left_df, right_df, how='outer', left_index=True, right_on=right_on)      
-        elif right_on == 'index':
-            df_inner = pd.merge(left_df, right_df, how='inner', left_on=left_on, right_index=True)
-            df_outer = pd.merge(left_df, right_df, how='outer', left_on=left_on, right_index=True)
-        else:
+        if left_on != 'index' and right_on != 'index':
             if type(left_on) is list:
                 # check if list contents are same
                 if set(left_on) & set(left_df.columns) != set(left_on):
@@ -1241,25 +1576,13 @@ def df_merge(left_input,
                     raise NameError('Left merge column not in left df columns: ' + left_on + ' not in ' + str(left_df.columns))
                 if not left_on in left_df.columns:
                     raise NameError('Right merge column not in right df columns: ' + right_on + ' not in ' + str(right_df.columns))            
-            df_inner = pd.merge(left_df, right_df, how='inner', left_on=left_on, right_on=right_on)    
-            df_outer = pd.merge(left_df, right_df, how='outer', left_on=left_on, right_on=right_on)    
-         
-        if how == 'inner':
-            df = df_inner
-        elif how == 'outer':
-            df = df_outer
+
+        # The merge with how is already done, so only the outer merge (for comparing the merge columns) may be needed.
+        if how == 'outer':
+            df_outer = merged_df
         else:
-            if left_on == 'index' and right_on == 'index':
-                df = pd.merge(left_df, right_df, how=how, left_index=True, right_index=True)
-            elif left_on == 'index':
-                df = pd.merge(left_df, right_df, how=how, left_index=True, right_on=right_on)     
-            elif right_on == 'index':
-                df = pd.merge(left_df, right_df, how=how, left_on=left_on, right_index=True)          
-            else:
-                df = pd.merge(left_df, right_df, how=how, left_on=left_on, right_on=right_on)     
-        
-        # TODOO AWKWARD but i messed up the logic here and have to do this again here. simplify.
-        df = df[[i for i in merged_df.columns if not str(i).endswith('_right') or i in keep_right]]         
+            df_outer = df_merge_frames(left_df, right_df, 'outer', left_on, right_on)
+        df = merged_df[kept_columns]
         comparison_dict = hb.df_compare_column_contents_as_dict(df_outer[left_on], df_outer[right_on])
         
         if verbose:
@@ -1281,14 +1604,10 @@ def df_merge(left_input,
                 )
             
     else:
-        if left_on == 'index' and right_on == 'index':
-            df = pd.merge(left_df, right_df, how=how, left_index=True, right_index=True)
-        elif left_on == 'index':
-            df = pd.merge(left_df, right_df, how=how, left_index=True, right_on=right_on)     
-        elif right_on == 'index':
-            df = pd.merge(left_df, right_df, how=how, left_on=left_on, right_index=True)          
-        else:
-            df = pd.merge(left_df, right_df, how=how, left_on=left_on, right_on=right_on)    
+        df = merged_df
+
+    if fill_left_col_nan_with_right_value:
+        df = df_fill_left_cols_nan_with_right_values(df, [i for i in comparison['intersection'] if i in df.columns and i + '_right' in df.columns])
 
     if verbose:
         hb.log('Finished merge. Found the following DF:\n' + str(df) +'\n which has columns ' + str(list(df.columns.values)))
@@ -1301,42 +1620,29 @@ def df_merge(left_input,
         # Convert the df to a geodataframe
         df = gpd.GeoDataFrame(df, geometry='geometry')
         
-    # NYI fill_left_col_nan_with_right_value
-    ## Have to think this through. Would those inherit the geometry of right then?]
     return df
 
 def df_fill_left_col_nan_with_right_value(df, left_col, right_col, output_col_name=None):
     
-    # Combines two columns, filling missing values of left with the value of right
-    # while also checking that no value in left does not equal the value in right
-    # good for validating merge.
+    # Combines two columns, filling missing values of left with the value of right, and puts the result in
+    # output_col_name (at the end) in place of both. df itself is not modified.
     
     if output_col_name is None:
         output_col_name = left_col
-    
-    left_series = df[left_col]
-    right_series = df[right_col]
-    
-    mismatch = df[left_col] != df[right_col]
-    mismatch_df = df[df[left_col] != df[right_col]][[left_col, right_col]]
-    
-    # Drop where at least one column has a nan
-    mismatch_df = mismatch_df.dropna()
-    
-    # if len(mismatch_df) > 0:
-    #     raise NameError('Mismatched values in columns ' + left_col + ' and ' + right_col + ' in dataframe ' + str(df) + ' at indices ' + str(mismatch_df.index.values))
-    
-    output_col_name_temp = output_col_name + '_' + hb.random_alphanumeric_string()
-    df[output_col_name_temp] = np.where(left_series.isnull(), right_series, left_series)
 
-    # Drop the two columns that were merged
+    filled = df[left_col].where(df[left_col].notnull(), df[right_col])
     df = df.drop([left_col, right_col], axis=1)
-    
-    columns = {output_col_name_temp: output_col_name}
-    df.rename(columns=columns, inplace=True)
+    df[output_col_name] = filled
 
     return df
 
+def df_fill_left_cols_nan_with_right_values(df, left_cols, right_suffix='_right'):
+    """Fill the missing values of each of left_cols with its col + right_suffix column (eg as left by df_merge) and
+    drop the right columns, in one pass over the frame rather than one copy per column."""
+    filled = {col: df[col].where(df[col].notnull(), df[col + right_suffix]) for col in left_cols}
+    df = df.drop([col + right_suffix for col in left_cols], axis=1)
+    return df.assign(**filled)
+
 # TODOO Move this to a new dataframe_utils file.
 def df_reorder_columns(input_df, initial_columns=None, prespecified_order=None, remove_columns=None, sort_method=None):
     """If both initial_columns and prespecified_order are given, initial columns will override. Initial columns will also
@@ -1365,556 +1671,43 @@ def df_reorder_columns(input_df, initial_columns=None, prespecified_order=None,
 
     return input_df[final_columns]
 
-def df_groupby_old(df, groupby_cols, agg_dict=None, preserve='keep_all', preserve_cols=None, on_conflict='concat_unique', conflict_reporting='warn', concat_separator='^'):
-    """
-    Constrains a pandas groupby operation to check for several key pitfalls and enable within-cell concatentation of values.
-    Processes valid non-grouped, non-aggregated columns based. A valid such group is one with all unique values. This
-    means we are just preserving the column for later use and is not affected by the grouping in any way. If a perserved
-    col does have more than 1 unique value, it will be kept based on the `on_conflict` parameter, which makes
-    a default ^ delimited list stored as a string in the target cell. Thie effectively is an alternate, space efficient and 
-    flexible way to raise the dimensionality of the data without adding tons of indices.
-        
-    Parameters:
-    -----------
-    df : pandas.DataFrame
-        The DataFrame to group
-    groupby_cols : str or list
-        Column(s) to group by. Can be one or many columns, but the more you have, the less aggregation happens.
-    agg_dict : dict, optional
-        Dictionary mapping column names to aggregation functions.
-        If None and preserve='keep_all_valid', will only preserve valid (nunique=1) columns without aggregating.
-        Special aggregation functions:
-        - 'concat': Concatenate all values as strings delimited with default '^'
-        - 'concat_unique': Concatenate unique values as strings delimited with default'^'
-    preserve : {'keep_all', 'keep_all_valid'}
-        Strategy for preserving columns:
-        - 'keep_all': Keep all non-grouped, non-aggregated columns using on_conflict grouping for non-unique cols.
-        - 'keep_all_valid': Keep only columns that have unique values within groups
-    preserve_cols : list, optional
-        If preserve is 'keep_all' it will lose any non unique cols. Use preserve cols to still add them back in, using the on_conflict strategy.
-        If preserve is 'keep_all_valid', this parameter is ignored.
-    on_conflict : {'concat', 'concat_unique'}
-        What to do when preserved columns have multiple values within a group:
-        - 'concat': Concatenate all values as strings
-        - 'concat_unique': Concatenate unique values as strings
-        - 'raise': Raise an exception
-    concat_separator : str, default ', '
-        Separator to use when concatenating strings
-    
-    Returns:
-    --------
-    pandas.DataFrame
-        Grouped DataFrame with preserved columns
-    """
-    
-    # Ensure 'groupby_cols' is a list
-    groupby_cols = [groupby_cols] if isinstance(groupby_cols, str) else list(groupby_cols)
-    
-    # Handle case where agg_dict is None
-    if agg_dict is None:
-        agg_dict = {}
-    
-    # Process agg_dict to handle special string aggregations
-    processed_agg_dict = {}
-    for col, func in agg_dict.items():
-        if func == 'concat':
-            processed_agg_dict[col] = lambda x, sep=concat_separator: sep.join(x.astype(str))
-        elif func == 'concat_unique':
-            processed_agg_dict[col] = lambda x, sep=concat_separator: sep.join(x.astype(str).unique())
-        else:
-            processed_agg_dict[col] = func
-    
-    # Determine columns to preserve based on preserve strategy
-    if preserve == 'keep_all':
-        # Keep all columns except groupby and aggregation columns
-        preserve_cols = [col for col in df.columns 
-                        if col not in groupby_cols and col not in processed_agg_dict]
-    
-    elif preserve == 'keep_all_valid':
-        # Find columns that have unique values within each group
-        grouped = df.groupby(groupby_cols)
-        valid_cols = []
-        
-        # First, let's examine the problematic groups more thoroughly
-        print(f"Total groups: {grouped.ngroups}")
-        print(f"Group sizes: {grouped.size().describe()}")
-        
-        for col in df.columns:
-            if col not in groupby_cols and col not in processed_agg_dict:
-                unique_counts = grouped[col].nunique()
-                
-                # print(f"\nColumn '{col}' unique counts per group: {unique_counts.to_dict()}")
-                
-                # For area_code specifically, let's dig deeper
-                if col == 'area_code':
-                    problematic_groups = unique_counts[unique_counts > 1]
-                    print(f"Found {len(problematic_groups)} groups with multiple area_codes, specifically: " )
-                    # print('problematic_groups:', problematic_groups )
-                    # print the first row of this
-                    # print(grouped[grouped[col].nunique() > 1])
-                    
-                    # for group_key, unique_count in problematic_groups.items():
-                    #     group_data = grouped.get_group(group_key)
-                    #     # print(f"\nGroup {group_key}:")
-                    #     print(f"  - {unique_count} unique area_codes: {group_data[col].unique()}")
-                    #     # print(f"  - Group size: {len(group_data)}")
-                    #     # print(f"  - Sample rows:")
-                    #     print(group_data[[*groupby_cols, col]].head().to_string())
-                        
-                        # # Check for data quality issues
-                        # print(f"  - Any NaN values: {group_data[col].isna().any()}")
-                        # print(f"  - Data types: {group_data[col].apply(type).unique()}")
-            
-                if (unique_counts == 1).all():
-                    valid_cols.append(col)
-        
-        preserve_cols = valid_cols
-        
-        # Report which columns were excluded
-        excluded_cols = [col for col in df.columns 
-                        if col not in groupby_cols and col not in processed_agg_dict and col not in valid_cols]
-        
-        if excluded_cols and len(processed_agg_dict) == 0:
-            print(f"Excluded columns with multiple values per group: {excluded_cols}")
-    
-    elif preserve == 'specified':
-        if preserve_cols is None:
-            raise ValueError("preserve_cols must be specified when preserve='specified'")
-        # Filter out groupby and aggregation columns
-        preserve_cols = [col for col in preserve_cols 
-                        if col not in groupby_cols and col not in processed_agg_dict]
-    
-    else:
-        raise ValueError(f"Invalid preserve value: {preserve}")
-    
-    # If no aggregation and no columns to preserve, just return groupby columns
-    if len(processed_agg_dict) == 0 and len(preserve_cols) == 0:
-        return df[groupby_cols].drop_duplicates().reset_index(drop=True)
-    
-    # Check for conflicts in preserved columns
-    conflicts = {}
-    grouped = df.groupby(groupby_cols)
-    
-    for col in preserve_cols:
-        # Check if each group has unique values
-        unique_counts = grouped[col].nunique()
-        conflict_groups = unique_counts[unique_counts > 1]
-        
-        if len(conflict_groups) > 0:
-            conflicts[col] = conflict_groups
-    
-    # Handle conflicts based on on_conflict parameter
-    preserve_agg = {}
-    
-    for col in preserve_cols:
-        if col in conflicts:
-            if on_conflict == 'raise':
-                conflict_info = []
-                for group_key, count in conflicts[col].items():
-                    group_data = grouped.get_group(group_key)[col].unique()
-                    conflict_info.append(f"  Group {group_key}: {count} unique values: {group_data}")
-                
-                raise ValueError(
-                    f"Column '{col}' has multiple values within groups:\n" + 
-                    "\n".join(conflict_info[:5]) +  # Show first 5 conflicts
-                    ("\n  ..." if len(conflict_info) > 5 else "")
-                )
-            
-            elif on_conflict == 'warn':
-                warnings.warn(
-                    f"Column '{col}' has multiple values in {len(conflicts[col])} groups. "
-                    f"Using first value."
-                )
-                preserve_agg[col] = 'first'
-            
-            elif on_conflict == 'first':
-                preserve_agg[col] = 'first'
-            
-            elif on_conflict == 'last':
-                preserve_agg[col] = 'last'
-            
-            elif on_conflict == 'concat':
-                preserve_agg[col] = lambda x, sep=concat_separator: sep.join(x.astype(str))
-            
-            elif on_conflict == 'concat_unique':
-                preserve_agg[col] = lambda x, sep=concat_separator: sep.join(x.astype(str).unique())
-            
-            else:
-                raise ValueError(f"Invalid on_conflict value: {on_conflict}")
-        else:
-            # No conflict, just take the first (only) value
-            preserve_agg[col] = 'first'
-    
-    # Combine aggregation dictionaries
-    full_agg_dict = {**processed_agg_dict, **preserve_agg}
-    
-    # Perform aggregation
-    if full_agg_dict:
-        result = df.groupby(groupby_cols).agg(full_agg_dict).reset_index()
-    else:
-        # No aggregation needed, just get unique group keys
-        result = df[groupby_cols].drop_duplicates().reset_index(drop=True)
-    
-    # Reorder columns to match original order where possible
-    original_order = list(df.columns)
-    new_order = []
-    
-    for col in original_order:
-        if col in result.columns:
-            new_order.append(col)
-    
-    # Add any new columns created by aggregation
-    for col in result.columns:
-        if col not in new_order:
-            new_order.append(col)
-    
-    return result[new_order]
-
-def df_groupby_opus(df, groupby_cols, agg_dict=None, preserve='keep_all', preserve_cols=None, on_conflict='concat_unique', conflict_reporting='warn', concat_separator='^'):
-    """
-    Constrains a pandas groupby operation to check for several key pitfalls and enable within-cell concatenation of values.
-    Processes valid non-grouped, non-aggregated columns based. A valid such group is one with all unique values. This
-    means we are just preserving the column for later use and is not affected by the grouping in any way. If a preserved
-    col does have more than 1 unique value, it will be kept based on the `on_conflict` parameter, which makes
-    a default ^ delimited list stored as a string in the target cell. This effectively is an alternate, space efficient and 
-    flexible way to raise the dimensionality of the data without adding tons of indices.
-        
-    Parameters:
-    -----------
-    df : pandas.DataFrame
-        The DataFrame to group
-    groupby_cols : str or list
-        Column(s) to group by. Can be one or many columns, but the more you have, the less aggregation happens.
-    agg_dict : dict, optional
-        Dictionary mapping column names to aggregation functions.
-        If None and preserve='keep_all_valid', will only preserve valid (nunique=1) columns without aggregating.
-        Special aggregation functions:
-        - 'concat': Concatenate all values as strings delimited with default '^'
-        - 'concat_unique': Concatenate unique values as strings delimited with default'^'
-    preserve : {'keep_all', 'keep_all_valid'}
-        Strategy for preserving columns:
-        - 'keep_all': Keep all non-grouped, non-aggregated columns using on_conflict grouping for non-unique cols.
-        - 'keep_all_valid': Keep only columns that have unique values within groups
-    preserve_cols : list, optional
-        If preserve is 'keep_all' it will lose any non unique cols. Use preserve cols to still add them back in, using the on_conflict strategy.
-        If preserve is 'keep_all_valid', this parameter is ignored.
-    on_conflict : {'concat', 'concat_unique'}
-        What to do when preserved columns have multiple values within a group:
-        - 'concat': Concatenate all values as strings
-        - 'concat_unique': Concatenate unique values as strings
-        - 'raise': Raise an exception
-    conflict_reporting : {'warn', 'silent', 'raise'}
-        How to report conflicts when they occur:
-        - 'warn': Issue a warning for conflicts
-        - 'silent': Don't report conflicts
-        - 'raise': Raise an exception on any conflict
-    concat_separator : str, default '^'
-        Separator to use when concatenating strings
-    
-    Returns:
-    --------
-    pandas.DataFrame
-        Grouped DataFrame with preserved columns
-    """
-    
-    # Ensure 'groupby_cols' is a list
-    groupby_cols = [groupby_cols] if isinstance(groupby_cols, str) else list(groupby_cols)
-    
-    # Validate parameters
-    if preserve not in ['keep_all', 'keep_all_valid']:
-        raise ValueError(f"Invalid preserve value: {preserve}. Must be 'keep_all' or 'keep_all_valid'")
-    
-    if on_conflict not in ['concat', 'concat_unique', 'raise']:
-        raise ValueError(f"Invalid on_conflict value: {on_conflict}. Must be 'concat', 'concat_unique', or 'raise'")
-    
-    if conflict_reporting not in ['warn', 'silent', 'raise']:
-        raise ValueError(f"Invalid conflict_reporting value: {conflict_reporting}. Must be 'warn', 'silent', or 'raise'")
-    
-    # Handle case where agg_dict is None
-    if agg_dict is None:
-        agg_dict = {}
-    
-    # Process agg_dict to handle special string aggregations
-    processed_agg_dict = {}
-    for col, func in agg_dict.items():
-        if func == 'concat':
-            processed_agg_dict[col] = lambda x, sep=concat_separator: sep.join(x.astype(str))
-        elif func == 'concat_unique':
-            processed_agg_dict[col] = lambda x, sep=concat_separator: sep.join(x.astype(str).unique())
-        else:
-            processed_agg_dict[col] = func
-    
-    # Determine columns to preserve based on preserve strategy
-    if preserve == 'keep_all':
-        # Keep all columns except groupby and aggregation columns
-        cols_to_preserve = [col for col in df.columns 
-                           if col not in groupby_cols and col not in processed_agg_dict]
-        
-        # If preserve_cols is specified, ensure these are included
-        if preserve_cols is not None:
-            # Add any preserve_cols that aren't already in the list
-            for col in preserve_cols:
-                if col in df.columns and col not in groupby_cols and col not in processed_agg_dict:
-                    if col not in cols_to_preserve:
-                        cols_to_preserve.append(col)
-    
-    elif preserve == 'keep_all_valid':
-        # Find columns that have unique values within each group
-        grouped = df.groupby(groupby_cols)
-        valid_cols = []
-        
-        # Debug information (can be commented out in production)
-        if conflict_reporting == 'warn':
-            print(f"Total groups: {grouped.ngroups}")
-            print(f"Group sizes: {grouped.size().describe()}")
-        
-        for col in df.columns:
-            if col not in groupby_cols and col not in processed_agg_dict:
-                unique_counts = grouped[col].nunique()
-                
-                if (unique_counts == 1).all():
-                    valid_cols.append(col)
-                elif conflict_reporting == 'warn' and col == 'area_code':
-                    # Special debugging for area_code column (can be removed or generalized)
-                    problematic_groups = unique_counts[unique_counts > 1]
-                    print(f"Found {len(problematic_groups)} groups with multiple area_codes")
-        
-        cols_to_preserve = valid_cols
-        
-        # Report which columns were excluded
-        excluded_cols = [col for col in df.columns 
-                        if col not in groupby_cols and col not in processed_agg_dict and col not in valid_cols]
-        
-        if excluded_cols and len(processed_agg_dict) == 0 and conflict_reporting == 'warn':
-            print(f"Excluded columns with multiple values per group: {excluded_cols}")
-        
-        # Note: preserve_cols is ignored when preserve='keep_all_valid' as documented
-    
-    # If no aggregation and no columns to preserve, just return groupby columns
-    if len(processed_agg_dict) == 0 and len(cols_to_preserve) == 0:
-        return df[groupby_cols].drop_duplicates().reset_index(drop=True)
-    
-    # Check for conflicts in preserved columns
-    conflicts = {}
-    grouped = df.groupby(groupby_cols)
-    
-    for col in cols_to_preserve:
-        # Check if each group has unique values
-        unique_counts = grouped[col].nunique()
-        conflict_groups = unique_counts[unique_counts > 1]
-        
-        if len(conflict_groups) > 0:
-            conflicts[col] = conflict_groups
-    
-    # Handle conflict reporting
-    if conflicts and conflict_reporting == 'raise':
-        conflict_info = []
-        for col, conflict_groups in conflicts.items():
-            for group_key, count in list(conflict_groups.items())[:5]:  # Show first 5 conflicts
-                group_data = grouped.get_group(group_key)[col].unique()
-                conflict_info.append(f"  Column '{col}', Group {group_key}: {count} unique values: {group_data}")
-        
-        raise ValueError(
-            f"Found conflicts in preserved columns:\n" + 
-            "\n".join(conflict_info) +
-            ("\n  ..." if sum(len(cg) for cg in conflicts.values()) > 5 else "")
-        )
-    
-    # Handle conflicts based on on_conflict parameter
-    preserve_agg = {}
-    
-    for col in cols_to_preserve:
-        if col in conflicts:
-            if on_conflict == 'raise':
-                conflict_info = []
-                for group_key, count in conflicts[col].items():
-                    group_data = grouped.get_group(group_key)[col].unique()
-                    conflict_info.append(f"  Group {group_key}: {count} unique values: {group_data}")
-                
-                raise ValueError(
-                    f"Column '{col}' has multiple values within groups:\n" + 
-                    "\n".join(conflict_info[:5]) +  # Show first 5 conflicts
-                    ("\n  ..." if len(conflict_info) > 5 else "")
-                )
-            
-            elif conflict_reporting == 'warn':
-                warnings.warn(
-                    f"Column '{col}' has multiple values in {len(conflicts[col])} groups. "
-                    f"Using {on_conflict} strategy."
-                )
-            
-            if on_conflict == 'concat':
-                preserve_agg[col] = lambda x, sep=concat_separator: sep.join(x.astype(str))
-            elif on_conflict == 'concat_unique':
-                preserve_agg[col] = lambda x, sep=concat_separator: sep.join(x.astype(str).unique())
-        else:
-            # No conflict, just take the first (only) value
-            preserve_agg[col] = 'first'
-    
-    # Combine aggregation dictionaries
-    full_agg_dict = {**processed_agg_dict, **preserve_agg}
-    
-    # Perform aggregation
-    if full_agg_dict:
-        result = df.groupby(groupby_cols).agg(full_agg_dict).reset_index()
-    else:
-        # No aggregation needed, just get unique group keys
-        result = df[groupby_cols].drop_duplicates().reset_index(drop=True)
-    
-    # Reorder columns to match original order where possible
-    original_order = list(df.columns)
-    new_order = []
-    
-    for col in original_order:
-        if col in result.columns:
-            new_order.append(col)
-    
-    # Add any new columns created by aggregation
-    for col in result.columns:
-        if col not in new_order:
-            new_order.append(col)
-    
-    return result[new_order]
-
-def df_groupby_gemini(df, groupby_cols, agg_dict=None, preserve='keep_all', preserve_cols=None, on_conflict='concat_unique', conflict_reporting='warn', concat_separator='^'):
-    """
-    Constrains a pandas groupby operation to check for several key pitfalls and enable within-cell concatentation of values.
-    Processes valid non-grouped, non-aggregated columns based. A valid such group is one with all unique values. This
-    means we are just preserving the column for later use and is not affected by the grouping in any way. If a perserved
-    col does have more than 1 unique value, it will be kept based on the `on_conflict` parameter, which makes
-    a default ^ delimited list stored as a string in the target cell. Thie effectively is an alternate, space efficient and
-    flexible way to raise the dimensionality of the data without adding tons of indices.
-
-    Parameters:
-    -----------
-    df : pandas.DataFrame
-        The DataFrame to group
-    groupby_cols : str or list
-        Column(s) to group by. Can be one or many columns, but the more you have, the less aggregation happens.
-    agg_dict : dict, optional
-        Dictionary mapping column names to aggregation functions.
-        If None and preserve='keep_all_valid', will only preserve valid (nunique=1) columns without aggregating.
-        Special aggregation functions:
-        - 'concat': Concatenate all values as strings delimited with default '^'
-        - 'concat_unique': Concatenate unique values as strings delimited with default'^'
-    preserve : {'keep_all', 'keep_all_valid'}
-        Strategy for preserving columns:
-        - 'keep_all': Keep all non-grouped, non-aggregated columns using on_conflict grouping for non-unique cols.
-        - 'keep_all_valid': Keep only columns that have unique values within groups
-    preserve_cols : list, optional
-        If provided, this list explicitly defines which columns to preserve, overriding the automatic selection
-        in 'keep_all'. The `on_conflict` strategy will be applied to these columns if they are not unique within groups.
-        This parameter is ignored if preserve is 'keep_all_valid'.
-    on_conflict : {'concat', 'concat_unique', 'raise'}
-        What to do when preserved columns have multiple values within a group:
-        - 'concat': Concatenate all values as strings
-        - 'concat_unique': Concatenate unique values as strings
-        - 'raise': Raise an exception
-    conflict_reporting : {'warn', 'ignore'}
-        How to report conflicts found in preserved columns:
-        - 'warn': Issue a warning detailing which columns have conflicts.
-        - 'ignore': Do not report conflicts.
-    concat_separator : str, default '^'
-        Separator to use when concatenating strings
-
-    Returns:
-    --------
-    pandas.DataFrame
-        Grouped DataFrame with preserved columns
-    """
-    # Ensure 'groupby_cols' is a list
-    groupby_cols = [groupby_cols] if isinstance(groupby_cols, str) else list(groupby_cols)
-
-    # Handle case where agg_dict is None
-    if agg_dict is None:
-        agg_dict = {}
-
-    # Process agg_dict to handle special string aggregations
-    processed_agg_dict = {}
-    for col, func in agg_dict.items():
-        if func == 'concat':
-            processed_agg_dict[col] = lambda x, sep=concat_separator: sep.join(x.astype(str).dropna())
-        elif func == 'concat_unique':
-            processed_agg_dict[col] = lambda x, sep=concat_separator: sep.join(x.astype(str).dropna().unique())
-        else:
-            processed_agg_dict[col] = func
-
-    # Identify potential columns to preserve
-    all_potential_preserve_cols = [col for col in df.columns if col not in groupby_cols and col not in processed_agg_dict]
-    
-    final_preserve_cols = []
-    
-    # Determine columns to preserve based on preserve strategy
-    if preserve == 'keep_all':
-        if preserve_cols:
-            # User has provided an explicit list of columns to preserve
-            final_preserve_cols = [col for col in preserve_cols if col in all_potential_preserve_cols]
-        else:
-            # Default to keeping all non-grouped, non-aggregated columns
-            final_preserve_cols = all_potential_preserve_cols
-
-    elif preserve == 'keep_all_valid':
-        grouped = df.groupby(groupby_cols)
-        for col in all_potential_preserve_cols:
-            if grouped[col].nunique().max() <= 1:
-                final_preserve_cols.append(col)
+def df_groupby_nunique(group_codes, n_groups, values):
+    """Number of unique non-NaN values in each group, like groupby(...)[col].nunique(), from the group codes of each row
+    (eg groupby(...).ngroup(), with -1 for rows in no group). Unique (group, value) pairs are found with one np.unique
+    rather than per group."""
+    value_codes = pd.factorize(values)[0]
+    n_values = max(int(value_codes.max(initial=-1)) + 1, 1)
+    valid = (group_codes >= 0) & (value_codes >= 0)
+    pairs = np.unique(group_codes[valid].astype(np.int64) * n_values + value_codes[valid])
+    return np.bincount(pairs // n_values, minlength=n_groups)
+
+
+def df_groupby_concat(group_codes, n_groups, values, separator='^', unique=False):
+    """Concatenate the string form of values (as Series.astype(str), dropping NaN) within each group, in row order, and
+    if unique only the first occurrence of each value. Returns an object array with one string per group code.
+
+    The rows of each group are ordered with one stable sort (and, if unique, one np.unique of the (group, value)
+    pairs), so only the final join is done per group."""
+    strings = pd.Series(values).astype(str)
+    valid = (group_codes >= 0) & strings.notna().to_numpy()
+    strings = strings.to_numpy(dtype=object)[valid]
+    codes = group_codes[valid].astype(np.int64)
+    if unique:
+        value_codes = pd.factorize(strings)[0]
+        pairs, first_rows = np.unique(codes * max(int(value_codes.max(initial=-1)) + 1, 1) + value_codes, return_index=True)
+        rows = first_rows[np.lexsort((first_rows, codes[first_rows]))]
     else:
-        raise ValueError(f"Invalid preserve value: '{preserve}'. Must be 'keep_all' or 'keep_all_valid'.")
-
-    # If nothing to do, return unique group keys
-    if not processed_agg_dict and not final_preserve_cols:
-        return df[groupby_cols].drop_duplicates().reset_index(drop=True)
-
-    # Check for conflicts in the final list of preserved columns
-    conflicts = {}
-    grouped = df.groupby(groupby_cols)
-    for col in final_preserve_cols:
-        if grouped[col].nunique().max() > 1:
-            conflicts[col] = grouped[col].nunique()[grouped[col].nunique() > 1]
-
-    # Report and handle conflicts
-    preserve_agg = {}
-    if conflicts:
-        if conflict_reporting == 'warn':
-            warnings.warn(f"Columns {list(conflicts.keys())} have multiple values in some groups. Applying '{on_conflict}' strategy.")
-
-        if on_conflict == 'raise':
-            conflict_info = []
-            for col, series in conflicts.items():
-                group_examples = series.head(3).index.tolist()
-                conflict_info.append(f"  - Column '{col}' in groups like {group_examples}")
-            raise ValueError("Conflicts found in preserved columns:\n" + "\n".join(conflict_info))
-
-    # Define aggregation logic for preserved columns
-    for col in final_preserve_cols:
-        if col in conflicts:
-            # Apply conflict resolution strategy
-            if on_conflict == 'concat':
-                preserve_agg[col] = lambda x, sep=concat_separator: sep.join(x.astype(str).dropna())
-            elif on_conflict == 'concat_unique':
-                preserve_agg[col] = lambda x, sep=concat_separator: sep.join(x.astype(str).dropna().unique())
-            else: # This case should ideally not be hit if 'raise' is handled above, but as a fallback.
-                 raise ValueError(f"Invalid on_conflict value: {on_conflict}")
-        else:
-            # No conflict, just take the first value
-            preserve_agg[col] = 'first'
-            
-    # Combine aggregation dictionaries
-    full_agg_dict = {**processed_agg_dict, **preserve_agg}
-
-    # Perform aggregation
-    if full_agg_dict:
-        result = df.groupby(groupby_cols).agg(full_agg_dict)
-    else:
-        result = df[groupby_cols].drop_duplicates()
-
-    result = result.reset_index()
+        rows = np.argsort(codes, kind='stable')
+    sorted_codes = codes[rows]
+    sorted_strings = strings[rows]
+    boundaries = np.flatnonzero(np.diff(sorted_codes)) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(rows)]])
+
+    output = np.full(n_groups, '', dtype=object)
+    output[sorted_codes[starts]] = [separator.join(sorted_strings[start: end]) for start, end in zip(starts, ends)]
+    return output
 
-    # Reorder columns to match original order as much as possible
-    original_order = [col for col in df.columns if col in result.columns]
-    new_cols = [col for col in result.columns if col not in original_order]
-    
-    return result[original_order + new_cols]
 
 def df_groupby(df, groupby_cols, agg_cols=None, agg_dict=None, preserve='keep_all', preserve_cols=None, 
                on_conflict='concat_unique', conflict_reporting='warn', concat_separator='^',
@@ -1926,6 +1719,10 @@ def df_groupby(df, groupby_cols, agg_cols=None, agg_dict=None, preserve='keep_al
     col does have more than 1 unique value, it will be kept based on the `on_conflict` parameter, which makes
     a default ^ delimited list stored as a string in the target cell. This effectively is an alternate, space efficient and 
     flexible way to raise the dimensionality of the data without adding tons of indices.
+
+    The group keys are factorized once (groupby(...).ngroup()). Conflicts are counted and the concat aggregations built
+    from those codes with vectorized sorts and np.unique on (group, value) pairs (see df_groupby_nunique and
+    df_groupby_concat), and the other aggregations are done by one pandas agg, so there are no per-group Python calls.
         
     Parameters:
     -----------
@@ -1940,8 +1737,8 @@ def df_groupby(df, groupby_cols, agg_cols=None, agg_dict=None, preserve='keep_al
         Dictionary mapping column names to aggregation functions.
         If None and preserve='keep_all_valid', will only preserve valid (nunique=1) columns without aggregating.
         Special aggregation functions:
-        - 'concat': Concatenate all values as strings delimited with separator (excludes NaN)
-        - 'concat_unique': Concatenate unique values as strings delimited with separator (excludes NaN)
+        - 'concat': Concatenate all values as strings delimited with separator
+        - 'concat_unique': Concatenate unique values as strings delimited with separator
     preserve : {'keep_all', 'keep_all_valid'}
         Strategy for preserving columns:
         - 'keep_all': Keep non-grouped, non-aggregated columns. If preserve_cols is provided, only those columns
@@ -1952,9 +1749,9 @@ def df_groupby(df, groupby_cols, agg_cols=None, agg_dict=None, preserve='keep_al
         The on_conflict strategy will be applied to these columns if they are not unique within groups.
         This parameter is ignored if preserve='keep_all_valid'.
     on_conflict : {'concat', 'concat_unique', 'raise'}
-        What to do when preserved columns have multiple values within a group:
-        - 'concat': Concatenate all values as strings (excluding NaN)
-        - 'concat_unique': Concatenate unique values as strings (excluding NaN)
+        What to do when preserved columns have multiple (non-NaN) values within a group:
+        - 'concat': Concatenate all values as strings
+        - 'concat_unique': Concatenate unique values as strings
         - 'raise': Raise an exception
     conflict_reporting : {'warn', 'ignore', 'raise'}
         How to report conflicts found in preserved columns:
@@ -1996,29 +1793,23 @@ def df_groupby(df, groupby_cols, agg_cols=None, agg_dict=None, preserve='keep_al
         for col in agg_cols:
             if col not in agg_dict:
                 agg_dict[col] = 'sum'
-    
-    # Create proper lambda functions that capture the separator
-    def make_concat_func(separator):
-        return lambda x: separator.join(x.astype(str).dropna())
-    
-    def make_concat_unique_func(separator):
-        return lambda x: separator.join(x.astype(str).dropna().unique())
-    
-    # Process agg_dict to handle special string aggregations
-    processed_agg_dict = {}
-    for col, func in agg_dict.items():
-        if func == 'concat':
-            processed_agg_dict[col] = make_concat_func(concat_separator)
-        elif func == 'concat_unique':
-            processed_agg_dict[col] = make_concat_unique_func(concat_separator)
-        else:
-            processed_agg_dict[col] = func
-    
+
+    # Factorize the group keys once. Rows with a NaN key are in no group (code -1), as in df.groupby.
+    grouped = df.groupby(groupby_cols)
+    group_codes = grouped.ngroup().to_numpy()
+    group_index = grouped.size().index
+    n_groups = len(group_index)
+
+    if debug:
+        print(f"Total groups: {n_groups}")
+        print(f"Group sizes: {grouped.size().describe()}")
+
     # Identify potential columns to preserve
     all_potential_preserve_cols = [col for col in df.columns 
-                                  if col not in groupby_cols and col not in processed_agg_dict]
+                                  if col not in groupby_cols and col not in agg_dict]
     
     final_preserve_cols = []
+    nunique_dict = {}
     
     # Determine columns to preserve based on preserve strategy
     if preserve == 'keep_all':
@@ -2037,48 +1828,34 @@ def df_groupby(df, groupby_cols, agg_cols=None, agg_dict=None, preserve='keep_al
     
     elif preserve == 'keep_all_valid':
         # Find columns that have unique values within each group
-        grouped = df.groupby(groupby_cols)
-        
-        # Debug information
-        if debug:
-            print(f"Total groups: {grouped.ngroups}")
-            print(f"Group sizes: {grouped.size().describe()}")
-        
         for col in all_potential_preserve_cols:
-            if grouped[col].nunique().max() <= 1:
+            nunique_dict[col] = df_groupby_nunique(group_codes, n_groups, df[col].to_numpy())
+            if nunique_dict[col].max(initial=0) <= 1:
                 final_preserve_cols.append(col)
         
         # Report which columns were excluded
         excluded_cols = [col for col in all_potential_preserve_cols if col not in final_preserve_cols]
         
-        if excluded_cols and len(processed_agg_dict) == 0 and (conflict_reporting == 'warn' or debug):
+        if excluded_cols and len(agg_dict) == 0 and (conflict_reporting == 'warn' or debug):
             print(f"Excluded columns with multiple values per group: {excluded_cols}")
     
     # If nothing to do, return unique group keys
-    if not processed_agg_dict and not final_preserve_cols:
+    if not agg_dict and not final_preserve_cols:
         return df[groupby_cols].drop_duplicates().reset_index(drop=True)
     
     # Check for conflicts in the final list of preserved columns
     conflicts = {}
-    grouped = df.groupby(groupby_cols)
-    
     for col in final_preserve_cols:
-        unique_counts = grouped[col].nunique()
-        if unique_counts.max() > 1:
-            conflict_groups = unique_counts[unique_counts > 1]
-            conflicts[col] = conflict_groups
-            
-            # Debug information for specific columns
-            if debug and col == 'area_code':
-                print(f"\nColumn 'area_code' has {len(conflict_groups)} groups with multiple values")
-                for group_key, unique_count in list(conflict_groups.items())[:5]:
-                    group_data = grouped.get_group(group_key)
-                    print(f"  Group {group_key}: {unique_count} unique values: {group_data[col].unique()}")
+        if col not in nunique_dict:
+            nunique_dict[col] = df_groupby_nunique(group_codes, n_groups, df[col].to_numpy())
+        conflict_mask = nunique_dict[col] > 1
+        if conflict_mask.any():
+            conflicts[col] = pd.Series(nunique_dict[col][conflict_mask], index=group_index[conflict_mask])
+            if debug:
+                print(f"\nColumn '{col}' has {conflict_mask.sum()} groups with multiple values")
     
     # Handle conflict reporting
     if conflicts:
-        conflict_summary = {col: len(groups) for col, groups in conflicts.items()}
-        
         if conflict_reporting == 'raise':
             conflict_info = []
             for col, groups in conflicts.items():
@@ -2090,69 +1867,52 @@ def df_groupby(df, groupby_cols, agg_cols=None, agg_dict=None, preserve='keep_al
         elif conflict_reporting == 'warn':
             warnings.warn(f"Columns {list(conflicts.keys())} have multiple values in some groups. "
                          f"Applying '{on_conflict}' strategy.")
-    
-    # Define aggregation logic for preserved columns
-    preserve_agg = {}
-    
+
+    if on_conflict == 'raise' and conflicts:
+        col = list(conflicts.keys())[0]
+        conflict_info = []
+        for group_code in np.flatnonzero(nunique_dict[col] > 1)[:5]:
+            group_data = pd.unique(df[col].to_numpy()[group_codes == group_code])
+            conflict_info.append(f"  Group {group_index[group_code]}: {nunique_dict[col][group_code]} unique values: {group_data}")
+        raise ValueError(
+            f"Column '{col}' has multiple values within groups:\n" + 
+            "\n".join(conflict_info) +
+            ("\n  ..." if len(conflicts[col]) > 5 else "")
+        )
+
+    # Split the aggregations into the concats, which are built from the group codes, and the rest, which pandas does
+    # in one vectorized agg. Preserved columns without conflicts just take the first value.
+    concat_dict = {}
+    pandas_agg_dict = {}
+    for col, func in agg_dict.items():
+        if isinstance(func, str) and func in ['concat', 'concat_unique']:
+            concat_dict[col] = func
+        else:
+            pandas_agg_dict[col] = func
     for col in final_preserve_cols:
         if col in conflicts:
-            if on_conflict == 'raise':
-                conflict_info = []
-                for group_key, count in list(conflicts[col].items())[:5]:
-                    group_data = grouped.get_group(group_key)[col].unique()
-                    conflict_info.append(f"  Group {group_key}: {count} unique values: {group_data}")
-                
-                raise ValueError(
-                    f"Column '{col}' has multiple values within groups:\n" + 
-                    "\n".join(conflict_info) +
-                    ("\n  ..." if len(conflicts[col]) > 5 else "")
-                )
-            
-            elif on_conflict == 'concat':
-                preserve_agg[col] = make_concat_func(concat_separator)
-            
-            elif on_conflict == 'concat_unique':
-                preserve_agg[col] = make_concat_unique_func(concat_separator)
+            concat_dict[col] = on_conflict
         else:
-            # No conflict, just take the first value
-            preserve_agg[col] = 'first'
-    
-    # Combine aggregation dictionaries
-    full_agg_dict = {**processed_agg_dict, **preserve_agg}
-    
-    # Perform aggregation
-    if full_agg_dict:
-        result = df.groupby(groupby_cols).agg(full_agg_dict).reset_index()
-        # Warn and show sample output if using concat or concat_unique
-        if on_conflict in ['concat', 'concat_unique'] and conflicts:
-            sample_outputs = []
-            for col in conflicts:
-            # Try to find a group where the concatenation separator will actually appear (i.e., more than one unique value)
-                found = False
-                for group_key in conflicts[col].index:
-                    group_data = grouped.get_group(group_key)[col]
-                    if on_conflict == 'concat':
-                        sample = concat_separator.join(group_data.astype(str).dropna())
-                    else:
-                        sample = concat_separator.join(group_data.astype(str).dropna().unique())
-                    if concat_separator in sample:
-                        sample_outputs.append(f"Column '{col}', group {group_key}: {sample[:200]}")
-                        found = True
-                        break
-                if not found:
-                    # Fallback: just show the first group
-                    group_key = conflicts[col].index[0]
-                    group_data = grouped.get_group(group_key)[col]
-                    if on_conflict == 'concat':
-                        sample = concat_separator.join(group_data.astype(str).dropna())
-                    else:
-                        sample = concat_separator.join(group_data.astype(str).dropna().unique())
-                        sample_outputs.append(f"Column '{col}', group {group_key}: {sample[:200]}")
-            if sample_outputs:
-                warnings.warn("Sample output of concatenated cells (first 200 chars):\n" + "\n".join(sample_outputs))
+            pandas_agg_dict[col] = 'first'
+
+    if pandas_agg_dict:
+        result = grouped.agg(pandas_agg_dict)
     else:
-        # No aggregation needed, just get unique group keys
-        result = df[groupby_cols].drop_duplicates().reset_index(drop=True)
+        result = pd.DataFrame(index=group_index)
+    for col, func in concat_dict.items():
+        result[col] = df_groupby_concat(group_codes, n_groups, df[col].to_numpy(), separator=concat_separator, unique=func == 'concat_unique')
+    result = result.reset_index()
+
+    # Warn and show sample output if using concat or concat_unique
+    if on_conflict in ['concat', 'concat_unique'] and conflicts:
+        sample_outputs = []
+        for col in conflicts:
+            # Show the first conflicting group whose cell actually has the separator in it.
+            conflict_strings = result[col].to_numpy()[nunique_dict[col] > 1]
+            has_separator = [concat_separator in i for i in conflict_strings[:100]]
+            sample_index = has_separator.index(True) if True in has_separator else 0
+            sample_outputs.append(f"Column '{col}', group {conflicts[col].index[sample_index]}: {conflict_strings[sample_index][:200]}")
+        warnings.warn("Sample output of concatenated cells (first 200 chars):\n" + "\n".join(sample_outputs))
     
     # Reorder columns to match original order where possible
     original_order = [col for col in df.columns if col in result.columns]
@@ -399,6 +399,107 @@ class TestIntegrationScenarioBenchmarks(BasePerformanceTest):
             assert os.path.exists(resolved)
 
 
+class TestRasterExpressionBenchmarks(BasePerformanceTest):
+    """Expression raster calculator (in-place ufunc chains) against the equivalent numpy lambda"""
+
+    @pytest.mark.benchmark
+    def test_expression_vs_lambda_block_benchmark(self):
+        """Evaluate one large block both ways and compare time and peak memory"""
+        import tracemalloc
+
+        rng = np.random.RandomState(0)
+        a = rng.rand(2000, 2000) * 2 - 1
+        b = rng.randint(0, 3, size=(2000, 2000)).astype(np.float64)
+        c = rng.rand(2000, 2000)
+        a[0:10] = -9999.
+
+        def op(a, b, c):
+            return np.where(a == -9999., -9999., np.where((a > 0) & (b == 0), a * c, -1.))
+
+        compiled = hb.compile_raster_expression('where((a > 0) & (b == 0), a * c, -1)', ['a', 'b', 'c'])
+        buffer_dict = {}
+        arrays = {'a': a, 'b': b, 'c': c}
+        hb.evaluate_raster_expression(compiled, arrays, nodata_dict={'a': -9999.}, target_nodata=-9999., buffer_dict=buffer_dict)
+
+        tracemalloc.start()
+        start_time = time.time()
+        expression_result = hb.evaluate_raster_expression(compiled, arrays, nodata_dict={'a': -9999.}, target_nodata=-9999., buffer_dict=buffer_dict)
+        expression_duration = time.time() - start_time
+        expression_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        start_time = time.time()
+        lambda_result = op(a, b, c)
+        lambda_duration = time.time() - start_time
+        lambda_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f"expression: {expression_duration:.4f}s, {expression_peak} bytes peak; lambda: {lambda_duration:.4f}s, {lambda_peak} bytes peak")
+        np.testing.assert_array_equal(expression_result, lambda_result)
+
+        # With warm buffers the expression allocates nothing block-sized, whereas the lambda makes several temporaries.
+        assert expression_peak < a.nbytes / 10, f"Expression evaluation allocated {expression_peak} bytes"
+        assert lambda_peak > a.nbytes
+        assert expression_duration < 10.0
+
+    @pytest.mark.benchmark
+    @pytest.mark.slow
+    def test_raster_calculator_expression_benchmark(self):
+        """Full raster calculator run with an expression and with a lambda"""
+        rng = np.random.RandomState(1)
+        paths = {}
+        for name in ['a', 'b', 'c']:
+            paths[name] = os.path.join(self.test_dir, name + '.tif')
+            hb.save_array_as_geotiff(rng.rand(1800, 3600), paths[name], geotransform_override=(-180.0, 0.1, 0.0, 90.0, 0.0, -0.1), projection_override=4326, n_cols=3600, n_rows=1800, data_type=7, ndv=-9999.)
+
+        expression_path = os.path.join(self.test_dir, 'expression.tif')
+        start_time = time.time()
+        hb.raster_calculator_expression('where((a > 0.5) & (b < 0.5), a * c, 0)', paths, expression_path, datatype_target=7)
+        expression_duration = time.time() - start_time
+
+        lambda_path = os.path.join(self.test_dir, 'lambda.tif')
+        start_time = time.time()
+        hb.raster_calculator_hb([(paths[name], 1) for name in ['a', 'b', 'c']], lambda a, b, c: np.where((a > 0.5) & (b < 0.5), a * c, 0), lambda_path, 7, -9999., reuse_buffers=False)
+        lambda_duration = time.time() - start_time
+
+        print(f"raster_calculator_expression: {expression_duration:.4f}s, lambda raster_calculator_hb: {lambda_duration:.4f}s")
+        np.testing.assert_array_equal(hb.as_array(expression_path), hb.as_array(lambda_path))
+        assert expression_duration < 60.0
+
+class TestDataframeBenchmarks(BasePerformanceTest):
+    """Vectorized df_groupby conflict resolution on a large table"""
+
+    @pytest.mark.benchmark
+    def test_df_groupby_concat_unique_benchmark(self):
+        """Group 1M rows into 100k groups with summed, preserved and conflicting (concat_unique) columns"""
+        import warnings
+
+        rng = np.random.RandomState(0)
+        n_rows = 1000000
+        df = pd.DataFrame({
+            'region_id': rng.randint(0, 100000, n_rows),
+            'value': rng.rand(n_rows),
+            'iso3': 'USA',
+            'crop': rng.choice(['maize', 'rice', 'wheat', 'soy', 'barley'], n_rows),
+        })
+
+        start_time = time.time()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            result = hb.df_groupby(df, 'region_id', agg_cols=['value'], on_conflict='concat_unique')
+        duration = time.time() - start_time
+        print(f"df_groupby of {n_rows} rows into {len(result)} groups: {duration:.4f}s")
+
+        # Check against the per-group lambdas it replaces on a few groups.
+        expected_groups = df[df['region_id'] < 50].groupby('region_id')
+        expected_crop = expected_groups['crop'].agg(lambda x: '^'.join(x.astype(str).dropna().unique()))
+        np.testing.assert_array_equal(result['crop'].values[:50], expected_crop.values)
+        np.testing.assert_allclose(result['value'].values[:50], expected_groups['value'].sum().values)
+        self.assertTrue((result['iso3'] == 'USA').all())
+        assert duration < 30.0, f"df_groupby took {duration:.4f}s, should be <30s"
+
+
 if __name__ == "__main__":
     unittest.main()
 
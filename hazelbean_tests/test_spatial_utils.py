@@ -1,6 +1,6 @@
 from unittest import TestCase
 import unittest
-import os, sys, time
+import os, sys, time, tempfile, shutil
 import pytest
 
 # NOTE Awkward inclusion heere so that I don't have to run the test via a setup config each  time
@@ -49,6 +49,418 @@ class DataStructuresTester(TestCase):
         assert (ranked_array[1, 2] == -9999)
         assert (len(ranked_pared_keys[0] == 30))
 
+    def test_get_ranked_flat_keys(self):
+        array = np.random.RandomState(3).randint(0, 20, size=(50, 40)).astype(np.float64)
+        array[5, 5:15] = np.nan
+        nan_mask = np.zeros(array.shape)
+        nan_mask[20:30, :] = 1
+
+        keys = hb.get_ranked_flat_keys(array, nan_mask=nan_mask, highest_first=True)
+        self.assertEqual(keys.dtype, np.int32)
+
+        flat = array.ravel()
+        valid_keys = np.flatnonzero((nan_mask.ravel() != 1) & ~np.isnan(flat))
+        expected = valid_keys[np.lexsort((valid_keys, -flat[valid_keys]))]
+        np.testing.assert_array_equal(keys, expected)
+
+        top_keys = hb.get_ranked_flat_keys(array, nan_mask=nan_mask, highest_first=True, top_k=25)
+        np.testing.assert_array_equal(top_keys, expected[:25])
+
+        values = np.random.RandomState(4).randint(0, 100, 100000)
+        np.testing.assert_array_equal(hb.parallel_stable_argsort(values, n_threads=4, min_chunk_size=1000), np.argsort(values, kind='stable'))
+
+    def test_rank_raster_out_of_core(self):
+        array = np.random.RandomState(6).randint(0, 50, size=(180, 360)).astype(np.float32)
+        array[100:120, 10:200] = -9999.0
+        raster_path = hb.temp('.tif', 'rank_out_of_core', True)
+        hb.save_array_as_geotiff(array, raster_path, self.global_1deg_raster_path, data_type=6, ndv=-9999.0)
+
+        keys_path = hb.temp('.npy', 'rank_out_of_core_keys', True)
+        keys = hb.rank_raster_out_of_core(raster_path, keys_path, max_run_size=5000, merge_buffer_size=1000, largest_block=4000)
+
+        _, expected_keys = hb.get_rank_array_and_keys(array, ndv=-9999.0)
+        np.testing.assert_array_equal(keys, expected_keys)
+
+        order_array = hb.create_order_array_from_ranked_keys(keys, array.shape[0], array.shape[1])
+        self.assertEqual(order_array[keys[0, 10], keys[1, 10]], 10)
+
+    def test_allocate_all_sectors_partitioned(self):
+        n_rows, n_cols, n_sectors = 40, 50, 2
+        country_ids = np.ones((n_rows, n_cols), dtype=np.int32)
+        country_ids[:, 25:] = 2
+        random_state = np.random.RandomState(7)
+        ranked_keys = np.zeros((n_sectors, 2, n_rows * n_cols), dtype=np.int64)
+        sector_yields = np.zeros((n_sectors, n_rows * n_cols))
+        for sector in range(n_sectors):
+            yields = random_state.rand(n_rows, n_cols)
+            flat_keys = np.argsort(-yields, axis=None)
+            ranked_keys[sector, 0], ranked_keys[sector, 1] = np.divmod(flat_keys, n_cols)
+            sector_yields[sector] = yields.ravel()[flat_keys]
+        available_land = random_state.rand(n_rows, n_cols)
+
+        results = []
+        for n_threads in [1, 2]:
+            projections = np.array([[20.0, 10.0], [15.0, 5.0]])
+            land = available_land.copy()
+            output = hb.allocate_all_sectors_partitioned(
+                projections, ['AAA', 'BBB'], ['s1', 's2'], np.full(n_sectors, 0.1), np.full(n_sectors, 0.6),
+                np.zeros(n_sectors), np.zeros(n_sectors), ranked_keys, sector_yields,
+                np.full(n_sectors, n_rows * n_cols, dtype=np.int64), land, country_ids, n_threads=n_threads)
+            np.testing.assert_allclose(projections, 0.0, atol=1e-9)
+            np.testing.assert_allclose(output[3], [[20.0, 10.0], [15.0, 5.0]])
+            results.append((output, land))
+
+        # Same result regardless of how countries were scheduled.
+        for a, b in zip(results[0][0][:4], results[1][0][:4]):
+            np.testing.assert_array_equal(a, b)
+        np.testing.assert_array_equal(results[0][1], results[1][1])
+
+    def test_calculate_change_matrix_from_rasters(self):
+        import pandas as pd
+        random_state = np.random.RandomState(8)
+        baseline = random_state.randint(1, 6, size=(180, 360)).astype(np.uint8)
+        scenario = np.where(random_state.rand(180, 360) < 0.2, 3, baseline).astype(np.uint8)
+        scenario[0:10, :] = 255
+        baseline_path = hb.temp('.tif', 'change_baseline', True)
+        scenario_path = hb.temp('.tif', 'change_scenario', True)
+        hb.save_array_as_geotiff(baseline, baseline_path, self.global_1deg_raster_path, data_type=1, ndv=255)
+        hb.save_array_as_geotiff(scenario, scenario_path, self.global_1deg_raster_path, data_type=1, ndv=255)
+
+        df = hb.calculate_change_matrix_from_rasters(baseline_path, scenario_path, largest_block=5000, n_threads=3)
+
+        valid = scenario != 255
+        expected = pd.crosstab(baseline[valid], scenario[valid])
+        np.testing.assert_array_equal(df.values, expected.values)
+        self.assertEqual(list(df.index), [1, 2, 3, 4, 5])
+
+        # Classes cannot be read from float rasters, and there must be some to count.
+        float_path = hb.temp('.tif', 'change_float', True)
+        hb.save_array_as_geotiff(baseline.astype(np.float32), float_path, self.global_1deg_raster_path, data_type=6, ndv=255)
+        with self.assertRaises(ValueError):
+            hb.calculate_change_matrix_from_rasters(float_path, scenario_path)
+        with self.assertRaises(ValueError):
+            hb.calculate_change_matrix_from_rasters(baseline_path, scenario_path, classes=[])
+
+    def test_upscale_and_downscale_raster_by_factor(self):
+        array = np.random.RandomState(9).randint(0, 100, size=(180, 360)).astype(np.int32)
+        array[0:3, 0:3] = -9999
+        fine_path = hb.temp('.tif', 'upscale_fine', True)
+        hb.save_array_as_geotiff(array, fine_path, self.global_1deg_raster_path, data_type=5, ndv=-9999)
+
+        coarse_path = hb.temp('.tif', 'upscale_coarse_sum', True)
+        hb.upscale_raster_by_factor(fine_path, coarse_path, 3, method='sum', largest_block=3000, n_threads=3)
+        windows = np.where(array == -9999, 0, array).reshape(60, 3, 120, 3).astype(np.int64)
+        np.testing.assert_array_equal(hb.as_array(coarse_path), windows.sum(axis=(1, 3)))
+        self.assertEqual(hb.get_raster_info_hb(coarse_path)['geotransform'][1], 3 * hb.get_raster_info_hb(fine_path)['geotransform'][1])
+
+        max_path = hb.temp('.tif', 'upscale_coarse_max', True)
+        hb.upscale_raster_by_factor(fine_path, max_path, 3, method='max')
+        coarse_max = hb.as_array(max_path)
+        self.assertEqual(coarse_max[0, 0], -9999)
+        np.testing.assert_array_equal(coarse_max[1:], array.reshape(60, 3, 120, 3).max(axis=(1, 3))[1:])
+
+        downscaled_path = hb.temp('.tif', 'downscaled', True)
+        hb.downscale_raster_by_factor(max_path, downscaled_path, 3, largest_block=5000)
+        np.testing.assert_array_equal(hb.as_array(downscaled_path), np.repeat(np.repeat(coarse_max, 3, axis=0), 3, axis=1))
+
+        # A nodata the block type cannot hold is ignored rather than overflowing or truncating onto a valid value.
+        from hazelbean.calculation_core.aspect_ratio_array_functions import upscale_block_by_factor
+        block = np.arange(16, dtype=np.uint8).reshape(4, 4)
+        for nodata, block_dtype in [(-9999, np.uint8), (-3.4e38, np.int32), (2.5, np.int32)]:
+            coarse_array, valid_count = upscale_block_by_factor(block.astype(block_dtype), 2, 'sum', nodata)
+            np.testing.assert_array_equal(coarse_array, [[10, 18], [42, 50]])
+            self.assertTrue((valid_count == 4).all())
+        self.assertEqual(upscale_block_by_factor(block, 2, 'count', 5.0)[0][0, 0], 3)
+
+    def test_calculate_class_coverage_from_fine_raster(self):
+        array = np.random.RandomState(4).randint(1, 6, size=(180, 360)).astype(np.uint8)
+        array[0:3, 0:3] = 255
+        fine_path = hb.temp('.tif', 'coverage_fine', True)
+        hb.save_array_as_geotiff(array, fine_path, self.global_1deg_raster_path, data_type=1, ndv=255)
+        coarse_match_path = hb.temp('.tif', 'coverage_match', True)
+        hb.upscale_raster_by_factor(fine_path, coarse_match_path, 3, method='max')
+
+        class_list = [3, 1, 2]
+        output_path = hb.temp('.tif', 'coverage', True)
+        majority_path = hb.temp('.tif', 'coverage_majority', True)
+        hb.calculate_class_coverage_from_fine_raster(fine_path, coarse_match_path, class_list, output_path=output_path, majority_path=majority_path, largest_block=5000, n_threads=3)
+
+        windows = array.reshape(60, 3, 120, 3)
+        for band_index, class_id in enumerate(class_list):
+            expected = (windows == class_id).sum(axis=(1, 3)) / 9.0
+            np.testing.assert_allclose(hb.as_array(output_path, band_number=band_index + 1), expected, rtol=1e-6)
+        self.assertEqual(hb.as_array(majority_path)[0, 0], 255)
+
+        # Without a fine nodata, mode and majority use a nodata that fits Byte and is not a class, not a wrapped -9999.
+        from osgeo import gdal
+        no_nodata_path = hb.temp('.tif', 'coverage_fine_no_nodata', True)
+        hb.save_array_as_geotiff(np.where(array == 255, 2, array).astype(np.uint8), no_nodata_path, self.global_1deg_raster_path, data_type=1, ndv=255)
+        dataset = gdal.OpenEx(no_nodata_path, gdal.OF_RASTER | gdal.OF_UPDATE)
+        dataset.GetRasterBand(1).DeleteNoDataValue()
+        dataset = None
+        self.assertIsNone(hb.get_raster_info_hb(no_nodata_path)['nodata'][0])
+        class_list_with_max = [3, 1, 2, 255]
+        majority_no_nodata_path = hb.temp('.tif', 'coverage_majority_no_nodata', True)
+        hb.calculate_class_coverage_from_fine_raster(no_nodata_path, coarse_match_path, class_list_with_max, majority_path=majority_no_nodata_path)
+        self.assertEqual(hb.get_raster_info_hb(majority_no_nodata_path)['nodata'][0], 254)
+        majority = hb.as_array(majority_no_nodata_path)
+        self.assertTrue(np.isin(majority, [3, 1, 2, 254]).all())
+        self.assertTrue((majority == 254).any())
+
+        # A coarse grid of the right size but shifted by one fine cell is not aligned.
+        shifted_match_path = hb.temp('.tif', 'coverage_match_shifted', True)
+        coarse_geotransform = list(hb.get_raster_info_hb(coarse_match_path)['geotransform'])
+        coarse_geotransform[0] += 1.0
+        hb.save_array_as_geotiff(hb.as_array(coarse_match_path), shifted_match_path, coarse_match_path, data_type=1, ndv=255, geotransform_override=coarse_geotransform)
+        with self.assertRaises(ValueError):
+            hb.calculate_class_coverage_from_fine_raster(fine_path, shifted_match_path, class_list, output_path=hb.temp('.tif', 'coverage_shifted', True))
+
+    def test_zone_block_index(self):
+        zones = np.zeros((180, 360), dtype=np.int32)
+        zones[100:120, 200:230] = 7
+        zones[0:10] = 255
+        zones_path = hb.temp('.tif', 'zone_block_index_zones', True)
+        hb.save_array_as_geotiff(zones, zones_path, self.global_1deg_raster_path, data_type=5, ndv=255)
+        values = np.random.RandomState(3).rand(180, 360)
+        values_path = hb.temp('.tif', 'zone_block_index_values', True)
+        hb.save_array_as_geotiff(values, values_path, self.global_1deg_raster_path, data_type=7, ndv=-9999.)
+
+        index = hb.load_zone_block_index(zones_path)
+        self.assertTrue(hb.path_exists(hb.get_zone_block_index_path(zones_path)))
+        np.testing.assert_array_equal(index['zone_ids'], [0, 7, 255])
+        self.assertEqual(sum(index['zone_block_cell_counts'][index['zone_block_indptr'][1]:index['zone_block_indptr'][2]]), 600)
+
+        unique_zone_ids, sums = hb.zonal_statistics_rasterized(zones_path, values_path, unique_zone_ids=np.asarray([7]), verbose=False, use_zone_block_index=True)
+        self.assertAlmostEqual(sums[7], values[zones == 7].sum(), places=6)
+
+        # Without opting in, zonal stats do not write an index next to the zone raster.
+        unindexed_zones_path = hb.temp('.tif', 'zone_block_index_unindexed_zones', True)
+        hb.save_array_as_geotiff(zones, unindexed_zones_path, self.global_1deg_raster_path, data_type=5, ndv=255)
+        unique_zone_ids, sums = hb.zonal_statistics_rasterized(unindexed_zones_path, values_path, unique_zone_ids=np.asarray([7]), verbose=False)
+        self.assertAlmostEqual(sums[7], values[zones == 7].sum(), places=6)
+        self.assertFalse(os.path.exists(hb.get_zone_block_index_path(unindexed_zones_path)))
+
+        self.assertEqual(hb.get_zone_ids_window(zones_path, [7]), {'xoff': 200, 'yoff': 100, 'win_xsize': 30, 'win_ysize': 20})
+        clipped_path = hb.temp('.tif', 'zone_block_index_clipped', True)
+        hb.clip_raster_to_zone_ids(values_path, zones_path, [7], clipped_path)
+        np.testing.assert_allclose(hb.as_array(clipped_path), values[100:120, 200:230])
+
+        # An index that cannot be saved (eg a read-only directory) is still returned from memory.
+        unsaved_index_path = os.path.join(os.path.dirname(zones_path), 'missing_dir', 'zones.zone_block_index.npz')
+        index = hb.build_zone_block_index(zones_path, index_path=unsaved_index_path)
+        np.testing.assert_array_equal(index['zone_ids'], [0, 7, 255])
+        self.assertFalse(os.path.exists(unsaved_index_path))
+
+    def test_sparse_nodata_block_skipping(self):
+        array = np.full((180, 360), -9999., dtype=np.float64)
+        array[100:120, 200:230] = np.random.RandomState(5).rand(20, 30)
+        sparse_path = hb.temp('.tif', 'sparse_input', True)
+        hb.save_array_as_geotiff(array, sparse_path, self.global_1deg_raster_path, data_type=7, ndv=-9999., sparse=True)
+        np.testing.assert_array_equal(hb.as_array(sparse_path), array)
+
+        hb.build_block_valid_count_index((sparse_path, 1))
+        self.assertIsNotNone(hb.load_block_valid_count_index((sparse_path, 1)))
+
+        # An index that cannot be saved (eg a read-only directory) is still returned from memory.
+        unsaved_index_path = os.path.join(os.path.dirname(sparse_path), 'missing_dir', 'sparse.block_valid_counts.npz')
+        unsaved_index = hb.load_block_valid_count_index((sparse_path, 1), build_if_missing=True, index_path=unsaved_index_path)
+        self.assertEqual(sum(unsaved_index.values()), 600)
+        self.assertFalse(os.path.exists(unsaved_index_path))
+
+        calls = []
+        def op(a):
+            calls.append(a.shape)
+            return np.where(a == -9999., -9999., a * 2)
+        output_path = hb.temp('.tif', 'sparse_output', True)
+        hb.raster_calculator_hb([(sparse_path, 1)], op, output_path, 7, -9999., largest_block=360 * 8, skip_nodata_blocks=True)
+        np.testing.assert_array_equal(hb.as_array(output_path), np.where(array == -9999., -9999., array * 2))
+        self.assertLess(len(calls), len(list(hb.iterblocks_hb((output_path, 1), largest_block=360 * 8, offset_only=True))))
+
+    def test_block_buffer_reuse(self):
+        array = np.random.RandomState(6).rand(180, 360).astype(np.float32)
+        input_path = hb.temp('.tif', 'buffer_reuse_input', True)
+        hb.save_array_as_geotiff(array, input_path, self.global_1deg_raster_path, data_type=6, ndv=-9999.)
+
+        buffers = set()
+        for offsets, block in hb.iterblocks_hb((input_path, 1), largest_block=360 * 7, dtype=np.float64, reuse_buffer=True):
+            self.assertEqual(block.dtype, np.float64)
+            np.testing.assert_array_equal(block, array[offsets['yoff']: offsets['yoff'] + offsets['win_ysize'], offsets['xoff']: offsets['xoff'] + offsets['win_xsize']])
+            buffers.add(block.__array_interface__['data'][0])
+        self.assertEqual(len(buffers), 1)
+        self.assertAlmostEqual(hb.tiled_sum(input_path), float(np.sum(array, dtype=np.float64)), places=1)
+
+        output_path = hb.temp('.tif', 'buffer_reuse_output', True)
+        hb.raster_calculator_hb([(input_path, 1), (input_path, 1)], lambda a, b: a + b, output_path, 7, -9999., largest_block=360 * 7)
+        np.testing.assert_array_equal(hb.as_array(output_path), array.astype(np.float64) * 2)
+
+        # A local_op that modifies its inputs in place does not change a full size array passed in.
+        def double_in_place(a, b):
+            b *= 2
+            return a + b
+        array_input = array.astype(np.float64)
+        array_output_path = hb.temp('.tif', 'buffer_reuse_array_output', True)
+        hb.raster_calculator_hb([(input_path, 1), array_input], double_in_place, array_output_path, 7, -9999., largest_block=360 * 7)
+        np.testing.assert_array_equal(array_input, array.astype(np.float64))
+        np.testing.assert_array_equal(hb.as_array(array_output_path), array.astype(np.float64) * 3)
+
+    def test_raster_calculator_expression(self):
+        rng = np.random.RandomState(7)
+        a = rng.rand(180, 360) * 2 - 1
+        a[0:5] = -9999.
+        b = rng.randint(0, 3, size=(180, 360)).astype(np.float64)
+        a_path = hb.temp('.tif', 'expression_a', True)
+        b_path = hb.temp('.tif', 'expression_b', True)
+        hb.save_array_as_geotiff(a, a_path, self.global_1deg_raster_path, data_type=7, ndv=-9999.)
+        hb.save_array_as_geotiff(b, b_path, self.global_1deg_raster_path, data_type=7, ndv=-9999.)
+
+        output_path = hb.temp('.tif', 'expression_output', True)
+        hb.raster_calculator_expression('where((a > 0) & (b == 0), a * k, -1)', {'a': a_path, 'b': b_path}, output_path, datatype_target=7, constants={'k': 3}, largest_block=360 * 7)
+        expected = np.where((a > 0) & (b == 0), a * 3, -1.)
+        expected[a == -9999.] = -9999.
+        np.testing.assert_array_equal(hb.as_array(output_path), expected)
+
+        compiled = hb.compile_raster_expression('a * 2 + b * 3 - (a - b) * (b + 1)', ['a', 'b'])
+        self.assertLessEqual(compiled['n_registers']['num'], 3)
+
+        # & | ^ ~ are bitwise on numbers, so bits of a bitmask raster can be tested.
+        bitmask = rng.randint(0, 16, size=(180, 360)).astype(np.int32)
+        bitmask_path = hb.temp('.tif', 'expression_bitmask', True)
+        hb.save_array_as_geotiff(bitmask, bitmask_path, self.global_1deg_raster_path, data_type=5, ndv=-9999)
+        bitmask_output_path = hb.temp('.tif', 'expression_bitmask_output', True)
+        hb.raster_calculator_expression('where((m & 4) > 0, m ^ 1, ~m)', {'m': bitmask_path}, bitmask_output_path, datatype_target=5, largest_block=360 * 7)
+        np.testing.assert_array_equal(hb.as_array(bitmask_output_path), np.where((bitmask & 4) > 0, bitmask ^ 1, ~bitmask))
+        with self.assertRaises(ValueError):
+            hb.compile_raster_expression('a & 0.5', ['a'])
+
+    def test_add_stats_to_geotiff_with_block_scan(self):
+        temp_path = hb.temp('.tif', 'block_scan_stats', True)
+        hb.path_copy(self.ee_r264_ids_900sec_path, temp_path)
+
+        stats_by_band = hb.add_stats_to_geotiff_with_block_scan(temp_path, write_unique_values_list=True, n_workers=4)
+
+        array = hb.as_array(temp_path)
+        ndv = hb.get_ndv_from_path(temp_path)
+        valid = array[array != ndv]
+        self.assertEqual(stats_by_band[1]['valid_count'], valid.size)
+        self.assertAlmostEqual(stats_by_band[1]['mean'], float(np.mean(valid)), places=6)
+        self.assertAlmostEqual(stats_by_band[1]['stddev'], float(np.std(valid)), places=6)
+
+        # Written to the aux.xml in the form get_stats_from_geotiff reads.
+        read_stats = hb.get_stats_from_geotiff(temp_path)
+        self.assertEqual(read_stats[1]['min'], float(np.min(valid)))
+        self.assertEqual(read_stats[1]['max'], float(np.max(valid)))
+
+        values, counts = np.unique(valid, return_counts=True)
+        unique_values = hb.get_unique_values_from_geotiff(temp_path)
+        self.assertEqual(list(unique_values.keys()), [int(i) for i in values])
+        self.assertEqual(list(unique_values.values()), [int(i) for i in counts])
+        self.assertEqual(sum(stats_by_band[1]['histogram']['counts']), valid.size)
+
+        # The older entry points are wrappers around the same block scan.
+        wrapper_path = hb.temp('.tif', 'block_scan_stats_wrapper', True)
+        hb.path_copy(self.ee_r264_ids_900sec_path, wrapper_path)
+        self.assertTrue(hb.add_stats_to_geotiff_with_gdalinfo(wrapper_path, verbose=False))
+        self.assertEqual(hb.get_stats_from_geotiff(wrapper_path)[1]['max'], float(np.max(valid)))
+        self.assertEqual(hb.get_unique_values_from_geotiff(wrapper_path), unique_values)
+
+        # Float rasters, whose unique values the block scan does not track, are still counted.
+        float_path = hb.temp('.tif', 'unique_values_float', True)
+        float_array = np.full((180, 360), 0.5)
+        float_array[0:10] = 1.5
+        float_array[10:12] = -9999.
+        hb.save_array_as_geotiff(float_array, float_path, self.global_1deg_raster_path, data_type=7, ndv=-9999.)
+        self.assertEqual(dict(hb.unique_raster_values_count(float_path)), {0.5: 168 * 360, 1.5: 10 * 360})
+
+    def test_compress_and_add_overviews_for_geotiffs_in_dir_parallel(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        for name in ['a.tif', 'b.tif']:
+            hb.path_copy(self.global_1deg_raster_path, os.path.join(temp_dir, name))
+
+        results = hb.compress_and_add_overviews_for_geotiffs_in_dir_parallel(temp_dir, min_size_to_compress=0, max_workers=2, verbose=False)
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(success for _, success, _ in results))
+        self.assertTrue(os.path.exists(os.path.join(temp_dir, 'a.tif.ovr')))
+
+        manifest = hb.read_batch_manifest(os.path.join(temp_dir, 'hb_batch_manifest.json'))
+        self.assertEqual(manifest[os.path.join(temp_dir, 'a.tif')]['settings']['compression'], 'DEFLATE')
+
+        # A second call resumes from the manifest and has nothing left to do.
+        results = hb.compress_and_add_overviews_for_geotiffs_in_dir_parallel(temp_dir, min_size_to_compress=0, max_workers=2, verbose=False)
+        self.assertEqual(results, [])
+
+        # Overviews keep DEFLATE when the geotiffs use another compression, and no temporary outputs are left.
+        from osgeo import gdal
+        results = hb.compress_and_add_overviews_for_geotiffs_in_dir_parallel(temp_dir, min_size_to_compress=0, compression='LZW', max_workers=2, verbose=False)
+        self.assertTrue(all(success for _, success, _ in results))
+        self.assertEqual(gdal.Open(os.path.join(temp_dir, 'a.tif')).GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION'), 'LZW')
+        self.assertEqual(gdal.Open(os.path.join(temp_dir, 'a.tif.ovr')).GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION'), 'DEFLATE')
+        self.assertEqual([i for i in os.listdir(temp_dir) if '_compressing_' in i], [])
+
+    def test_distance_transform_edt_tiled(self):
+        import scipy.ndimage
+        mask = np.zeros((180, 360), dtype=np.uint8)
+        mask[90, 2] = 1
+        mask[20:25, 200:210] = 1
+        mask_path = hb.temp('.tif', 'edt_mask', True)
+        hb.save_array_as_geotiff(mask, mask_path, self.global_1deg_raster_path, data_type=1, ndv=255)
+
+        # Without wrap_x the east and west edges are not neighbors, even for a global raster. The small largest_block
+        # makes the column pass read each strip in several row chunks.
+        distance_path = hb.temp('.tif', 'edt_distance', True)
+        hb.distance_transform_edt_tiled((mask_path, 1), distance_path, strip_size=50, n_workers=3, largest_block=50 * 40)
+        np.testing.assert_allclose(hb.as_array(distance_path), scipy.ndimage.distance_transform_edt(mask == 0), atol=1e-4)
+
+        # With wrap_x distances wrap around the antimeridian.
+        wrapped_distance_path = hb.temp('.tif', 'edt_distance_wrapped', True)
+        hb.distance_transform_edt_tiled((mask_path, 1), wrapped_distance_path, wrap_x=True, strip_size=50, n_workers=3, largest_block=50 * 40)
+        distance = hb.as_array(wrapped_distance_path)
+        expected = scipy.ndimage.distance_transform_edt(np.tile(mask, (1, 3)) == 0)[:, 360:720]
+        np.testing.assert_allclose(distance, expected, atol=1e-4)
+        self.assertAlmostEqual(float(distance[90, 358]), 4.0, places=4)
+
+    def test_convolve_2d_multi(self):
+        import scipy.signal
+        lulc = np.random.RandomState(4).randint(1, 4, size=(180, 360)).astype(np.uint8)
+        lulc[10:20, 30:40] = 255
+        lulc_path = hb.temp('.tif', 'convolve_multi_lulc', True)
+        hb.save_array_as_geotiff(lulc, lulc_path, self.global_1deg_raster_path, data_type=1, ndv=255)
+
+        kernel = hb.generate_gaussian_kernel(9, 2)
+        class_list = [1, 3]
+        target_path_list = [hb.temp('.tif', 'convolve_multi_' + str(i), True) for i in class_list]
+        hb.convolve_2d_multi((lulc_path, 1), kernel, target_path_list, class_list=class_list, largest_block=4000, n_threads=3)
+
+        valid = lulc != 255
+        for class_id, target_path in zip(class_list, target_path_list):
+            expected = scipy.signal.fftconvolve(((lulc == class_id) & valid).astype(np.float64), kernel, mode='same')
+            result = hb.as_array(target_path)
+            np.testing.assert_allclose(result[valid], expected[valid], atol=1e-4)
+            self.assertTrue(np.all(result[~valid] == np.finfo(np.float32).min))
+
+    def test_focal_statistics(self):
+        import scipy.ndimage
+        data = np.random.RandomState(5).rand(180, 360).astype(np.float32)
+        data[40:43, 100:110] = -9999.0
+        data_path = hb.temp('.tif', 'focal_data', True)
+        hb.save_array_as_geotiff(data, data_path, self.global_1deg_raster_path, data_type=6, ndv=-9999.0)
+
+        max_path = hb.temp('.tif', 'focal_max', True)
+        hb.focal_max(data_path, max_path, radius=1, largest_block=5000, n_threads=3)
+        result = hb.as_array(max_path)
+
+        # The raster is global, so windows wrap east-west but not north-south.
+        padded = np.pad(np.where(data == -9999.0, -np.inf, data), ((1, 1), (0, 0)), constant_values=-np.inf)
+        expected = scipy.ndimage.maximum_filter(padded, size=3, mode='wrap')[1:-1]
+        valid = data != -9999.0
+        np.testing.assert_allclose(result[valid], expected[valid])
+        self.assertTrue(np.all(result[~valid] == -9999.0))
+
+        sum_path = hb.temp('.tif', 'focal_sum', True)
+        hb.focal_sum((data_path, 1), sum_path, radius=2, wrap_x=False, mask_nodata=False)
+        expected_sum = scipy.ndimage.uniform_filter(np.where(valid, data, 0).astype(np.float64), size=5, mode='constant') * 25
+        np.testing.assert_allclose(hb.as_array(sum_path), expected_sum, rtol=1e-5, atol=1e-4)
+
     def test_create_vector_from_raster_extents(self):
         extent_path = hb.temp('.shp', remove_at_exit=True)
         hb.create_vector_from_raster_extents(self.pyramid_match_900sec_path, extent_path)
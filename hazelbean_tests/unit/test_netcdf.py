@@ -0,0 +1,127 @@
+import unittest, os, sys, json
+import numpy as np
+import netCDF4
+import hazelbean as hb
+import hazelbean.netcdf
+
+
+class TestNetcdf(unittest.TestCase):
+    def setUp(self):
+        """Write a small global (time, lat, lon) netcdf with chunked, compressed data."""
+        self.nc_path = hb.temp('.nc', 'test_netcdf', True)
+        self.data = np.random.RandomState(0).rand(7, 90, 180).astype(np.float32)
+        self.data[:, 0, 0] = -1.
+        with netCDF4.Dataset(self.nc_path, 'w') as ds:
+            ds.createDimension('time', 7)
+            ds.createDimension('lat', 90)
+            ds.createDimension('lon', 180)
+            ds.createVariable('time', 'i4', ('time',))[:] = np.arange(2015, 2022)
+            ds.createVariable('lat', 'f4', ('lat',))[:] = np.arange(89., -91., -2.)
+            ds.createVariable('lon', 'f4', ('lon',))[:] = np.arange(-179., 181., 2.)
+            var = ds.createVariable('primf', 'f4', ('time', 'lat', 'lon'), zlib=True, chunksizes=(3, 30, 60), fill_value=-1.)
+            var[:] = self.data
+
+    def test_netcdf_description_cache(self):
+        description = hb.netcdf.get_netcdf_description_dict(self.nc_path)
+        cache_path = hb.netcdf.get_netcdf_description_cache_path(self.nc_path)
+        self.assertTrue(os.path.exists(cache_path))
+        self.assertEqual(list(description['dims']['time']['values']), list(range(2015, 2022)))
+
+        # Another process only has the sidecar, which is used as long as the file is unchanged.
+        hb.netcdf._netcdf_description_cache.clear()
+        self.assertEqual(list(hb.netcdf.get_netcdf_description_dict(self.nc_path)['vars']['primf']['dimensions']), ['time', 'lat', 'lon'])
+        self.assertEqual(hb.netcdf.get_cell_size_from_nc_path(self.nc_path), 2.0)
+
+        # The sidecar is plain json, and max_dimension_load_size None loads every dimension value.
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            self.assertIn('descriptions', json.load(f))
+        self.assertEqual(len(hb.netcdf.get_netcdf_description_dict(self.nc_path, 5)['dims']['time']['values']), 5)
+        self.assertEqual(len(hb.netcdf.get_netcdf_description_dict(self.nc_path, None)['dims']['time']['values']), 7)
+
+        with netCDF4.Dataset(self.nc_path, 'a') as ds:
+            ds.variables['time'][:] = np.arange(2020, 2027)
+        os.utime(self.nc_path, ns=(os.stat(self.nc_path).st_atime_ns, os.stat(self.nc_path).st_mtime_ns + 10 ** 9))
+        self.assertEqual(list(hb.netcdf.get_netcdf_description_dict(self.nc_path)['dims']['time']['values']), list(range(2020, 2027)))
+
+    def test_extract_netcdf_slices_to_geotiffs(self):
+        plan = hb.netcdf.plan_netcdf_slice_reads((7, 90, 180), [3, 30, 60], [(0,), (2,), (3,), (6,)], 4, max_read_bytes=3 * 30 * 180 * 4)
+        self.assertEqual([group['members'] for group in plan], [[0, 1], [2], [3]])
+        self.assertEqual(plan[0]['row_strips'], [(0, 30), (30, 60), (60, 90)])
+
+        output_paths = [hb.temp('.tif', 'netcdf_slice_' + str(i), True) for i in [0, 2, 3, 6]]
+        slice_job_list = [('primf', (i,), path) for i, path in zip([0, 2, 3, 6], output_paths)]
+        written = hb.netcdf.extract_netcdf_slices_to_geotiffs(self.nc_path, slice_job_list, ndv=-9999., max_read_bytes=3 * 30 * 180 * 4, n_writer_threads=2)
+        self.assertEqual(sorted(written), sorted(output_paths))
+        for i, path in zip([0, 2, 3, 6], output_paths):
+            expected = np.where(self.data[i] == -1., -9999., self.data[i])
+            np.testing.assert_allclose(hb.as_array(path), expected)
+        self.assertEqual(hb.get_raster_info_hb(output_paths[0])['geotransform'][1], 2.0)
+
+        # Existing outputs are skipped without reading.
+        self.assertEqual(hb.netcdf.extract_netcdf_slices_to_geotiffs(self.nc_path, slice_job_list, skip_if_exists=True), [])
+
+        # Without a data_type the variable's type is kept, widened only as far as the ndv needs.
+        native_type_path = hb.temp('.tif', 'netcdf_slice_native_type', True)
+        hb.netcdf.extract_netcdf_slices_to_geotiffs(self.nc_path, [('primf', (0,), native_type_path)], ndv=-9999., data_type=None)
+        self.assertEqual(hb.get_raster_info_hb(native_type_path)['datatype'], 6)
+        self.assertEqual(hb.netcdf.get_gdal_data_type_for_netcdf_var(np.uint8, -9999), 3)
+        self.assertEqual(hb.netcdf.get_gdal_data_type_for_netcdf_var(np.uint8, 255), 1)
+        self.assertEqual(hb.netcdf.get_gdal_data_type_for_netcdf_var(np.float32, 0.1), 7)
+
+    def test_netcdf_raster_source(self):
+        source = hb.netcdf.NetcdfRasterSource(self.nc_path, 'primf', (4,))
+        expected = np.where(self.data[4] == -1., -9999., self.data[4])
+        self.assertEqual((source.XSize, source.YSize), (180, 90))
+        self.assertEqual(source.GetBlockSize(), [60, 30])
+        np.testing.assert_allclose(source.ReadAsArray(10, 5, 20, 7), expected[5:12, 10:30])
+
+        # Windows of a bounding box, with stride, are read without extracting the slice.
+        np.testing.assert_allclose(hb.load_geotiff_chunk_by_bb(source, [-170, 60, -150, 80], stride_rate=2), expected[5:15:2, 5:15:2])
+
+        # The block engine reads it like a band and takes the geotransform from it.
+        output_path = hb.temp('.tif', 'netcdf_raster_source', True)
+        hb.raster_calculator_hb([source], lambda a: np.where(a == -9999., -9999., a * 2.), output_path, 7, -9999.)
+        np.testing.assert_allclose(hb.as_array(output_path), np.where(expected == -9999., -9999., expected * 2.))
+        self.assertEqual(hb.get_raster_info_hb(output_path)['geotransform'][1], 2.0)
+        source.close()
+
+    def test_stack_geotiffs_to_netcdf(self):
+        self.assertEqual(hb.netcdf.get_netcdf_stack_chunk_shape(30, 90, 180, 4, target_chunk_bytes=4 * 3000), [2, 27, 55])
+
+        tif_paths = [hb.temp('.tif', 'stack_layer_' + str(i), True) for i in range(7)]
+        hb.netcdf.extract_netcdf_slices_to_geotiffs(self.nc_path, [('primf', (i,), path) for i, path in enumerate(tif_paths)], ndv=-9999., data_type=6)
+        output_path = hb.temp('.nc', 'stacked', True)
+        hb.netcdf.stack_geotiffs_to_netcdf(tif_paths, output_path, var_name='primf', stack_dim_name='time', stack_dim_values=list(range(2015, 2022)),
+                                           chunk_shape=[2, 30, 60], max_block_bytes=2 * 30 * 180 * 4, n_reader_threads=2)
+        with netCDF4.Dataset(output_path) as ds:
+            var = ds.variables['primf']
+            self.assertEqual(var.dimensions, ('time', 'lat', 'lon'))
+            self.assertEqual(var.chunking(), [2, 30, 60])
+            self.assertEqual(list(ds.variables['time'][:]), list(range(2015, 2022)))
+            var.set_auto_maskandscale(False)
+            np.testing.assert_allclose(var[:], np.where(self.data == -1., -9999., self.data))
+
+        # It reads back through the lazy source with the same geotransform.
+        source = hb.netcdf.NetcdfRasterSource(output_path, 'primf', (3,))
+        np.testing.assert_allclose(source.ReadAsArray(), hb.as_array(tif_paths[3]))
+        source.close()
+
+        # A non-global extent keeps its geotransform through the crs grid mapping.
+        clipped_path = hb.temp('.tif', 'stack_clipped', True)
+        clipped_geotransform = [10.0, 0.5, 0.0, 50.0, 0.0, -0.5]
+        hb.save_array_as_geotiff(self.data[0, :20, :30], clipped_path, tif_paths[0], data_type=6, ndv=-9999., geotransform_override=clipped_geotransform,
+                                 n_rows_override=20, n_cols_override=30)
+        clipped_nc_path = hb.temp('.nc', 'stacked_clipped', True)
+        hb.netcdf.stack_geotiffs_to_netcdf([clipped_path], clipped_nc_path, var_name='primf', stack_dim_name=None)
+        source = hb.netcdf.NetcdfRasterSource(clipped_nc_path, 'primf')
+        self.assertEqual(source.geotransform, clipped_geotransform)
+        self.assertEqual(source.get_raster_info()['bounding_box'], [10.0, 40.0, 25.0, 50.0])
+        np.testing.assert_allclose(source.ReadAsArray(), hb.as_array(clipped_path))
+        output_path = hb.temp('.tif', 'stacked_clipped_output', True)
+        hb.raster_calculator_hb([source], lambda a: a, output_path, 6, -9999.)
+        self.assertEqual(list(hb.get_raster_info_hb(output_path)['geotransform']), clipped_geotransform)
+        source.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
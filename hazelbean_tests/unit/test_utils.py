@@ -1,4 +1,4 @@
-import unittest, os, sys
+import unittest, os, sys, json, shutil, tempfile
 import hazelbean as hb        
 import pandas as pd
 import numpy as np # Optional, as None can be used directly
@@ -28,6 +28,166 @@ class TestUtils(unittest.TestCase):
         r = parse_equation_to_dict(equation)
         print(r)            
         
+    def test_regression_frame_load_equation_data(self):
+        """Test loading an equation's inputs concurrently into a design matrix of only the valid rows."""
+        match_path = os.path.join(self.data_dir, "pyramids", "ha_per_cell_3600sec.tif")
+        rs = np.random.RandomState(0)
+        arrays = {
+            'depvar': rs.rand(180, 360).astype(np.float32),
+            'indvar_1': rs.randint(0, 5, (180, 360)).astype(np.int16),
+            'indvar_2': rs.rand(180, 360).astype(np.float32),
+        }
+        arrays['depvar'][0:10, :] = -9999.
+        arrays['indvar_2'][:, 0:20] = -9999.
+
+        rf = RegressionFrame()
+        for label, array in arrays.items():
+            path = hb.temp('.tif', label, True)
+            hb.save_array_as_geotiff(array, path, match_path, ndv=-9999.)
+            rf.add_aligned_input(label, path)
+
+        data, columns, all_valid_array = rf.load_equation_data('depvar ~ indvar_1 + indvar_2 + indvar_1 * indvar_2 + intercept', [-180., -90., 180., 90.], n_threads=3)
+        self.assertEqual(columns, ['depvar', 'indvar_1', 'indvar_2', 'indvar_1*indvar_2', 'intercept'])
+        self.assertEqual(data.dtype, np.float32)
+        self.assertTrue(data.flags['C_CONTIGUOUS'])
+        self.assertEqual(len(data), 170 * 340)
+        self.assertEqual(int(all_valid_array.sum()), 170 * 340)
+
+        rows = rf.valid_row_indices
+        np.testing.assert_allclose(data[:, 3], arrays['indvar_1'].ravel()[rows] * arrays['indvar_2'].ravel()[rows])
+        self.assertTrue(np.all(data[:, 4] == 1))
+
+        # Transforms that are not computed raise instead of leaving an uninitialized column.
+        with self.assertRaises(NameError):
+            rf.load_equation_data('depvar ~ indvar_1 + indvar_1 * 2', [-180., -90., 180., 90.])
+
+    def test_regression_frame_predict_output(self):
+        """Test blockwise prediction with transforms (including log) and a replacement input."""
+        match_path = os.path.join(self.data_dir, "pyramids", "ha_per_cell_3600sec.tif")
+        rs = np.random.RandomState(0)
+        arrays = {
+            'depvar': rs.rand(180, 360).astype(np.float32),
+            'indvar_1': rs.rand(180, 360).astype(np.float32),
+            'indvar_1_future': rs.rand(180, 360).astype(np.float32),
+            'indvar_2': rs.rand(180, 360).astype(np.float32) + 0.5,
+        }
+        arrays['depvar'][0:10, :] = -9999.
+
+        rf = RegressionFrame()
+        for label, array in arrays.items():
+            path = hb.temp('.tif', label, True)
+            hb.save_array_as_geotiff(array, path, match_path, ndv=-9999.)
+            rf.add_global_aligned_input(label, path)
+        rf.dependent_variable_label = 'depvar'
+        rf.zone_dependent_variable_path = hb.temp('.tif', 'zone_depvar', True)
+        rf.results['ols'] = {
+            'depvar_label': 'depvar',
+            'regression_label': 'ols',
+            'equation_dict': parse_equation_to_dict('depvar ~ indvar_1 + indvar_1 * indvar_2 + log(indvar_2) + intercept'),
+            'coefficients': {'indvar_1': 2., 'indvar_1*indvar_2': 0.5, 'log(indvar_2)': 3., 'intercept': 10.},
+        }
+
+        output_dir = os.path.dirname(hb.temp('.tif', 'predict', True))
+        projected_path, residuals_path, all_valid_path = rf.predict_output('ols', output_dir, [-180., -90., 180., 90.], replacement_dict={'indvar_1': 'indvar_1_future'},
+                                                                           n_threads=2, largest_block=360 * 16)
+        valid = arrays['depvar'] != -9999.
+        expected = (2. * arrays['indvar_1_future'] + 0.5 * arrays['indvar_1_future'] * arrays['indvar_2'] + 3. * np.log(arrays['indvar_2']) + 10.) * valid
+        np.testing.assert_allclose(hb.as_array(projected_path), expected, rtol=1e-5)
+        np.testing.assert_allclose(hb.as_array(all_valid_path), valid)
+        np.testing.assert_allclose(hb.as_array(rf.zone_dependent_variable_path), arrays['depvar'])
+
+    def test_regression_frame_out_of_core_fit(self):
+        """Test that OLS and logit streamed from a saved design matrix match the in-memory fits, and reproducible block sampling."""
+        rs = np.random.RandomState(0)
+        x = rs.rand(20000, 2)
+        y = x @ [1., -2.] + 3. + rs.randn(20000) * 0.3
+        y_binary = (rs.rand(20000) < 1. / (1. + np.exp(-(x @ [2., -3.] - 0.5)))).astype(np.float64)
+        df = pd.DataFrame({'y': y, 'y_binary': y_binary, 'a': x[:, 0], 'b': x[:, 1], 'intercept': 1.})
+        design_matrix_path = save_design_matrix(df.values, list(df.columns), hb.temp('.npy', 'design_matrix', True))
+
+        rf = RegressionFrame()
+        equation_dict = parse_equation_to_dict('y ~ a + b + intercept')
+        summary, result = rf.run_sm_lm('ols', design_matrix_path, equation_dict, fit_mode='out_of_core', chunk_rows=3000)
+        expected = sm.OLS(df['y'], df[['a', 'b', 'intercept']]).fit()
+        np.testing.assert_allclose(list(result['coefficients'].values()), expected.params.values)
+        np.testing.assert_allclose(result['bse'].values, expected.bse.values)
+        self.assertAlmostEqual(result['rsquared_adj'], expected.rsquared_adj)
+
+        summary, result = rf.run_logit('logit', df, parse_equation_to_dict('y_binary ~ a + b + intercept'), fit_mode='out_of_core', chunk_rows=3000)
+        expected = sm.Logit(df['y_binary'], df[['a', 'b', 'intercept']]).fit(disp=0)
+        np.testing.assert_allclose(list(result['coefficients'].values()), expected.params.values, atol=1e-6)
+
+        block_strata = np.zeros((10, 16), dtype=np.int16)
+        block_strata[:, 12:] = 1
+        windows = get_stratified_block_sample(300, 500, 20000, block_size=32, block_strata=block_strata, seed=4)
+        self.assertEqual(windows, get_stratified_block_sample(300, 500, 20000, block_size=32, block_strata=block_strata, seed=4))
+        self.assertEqual(len(windows), 20)
+        self.assertEqual(len([i for i in windows if i[1] >= 12 * 32]), 5)
+
+    def test_df_read_cache(self):
+        """Test that df_read caches the parsed CSV and its encoding until the file changes, only on disk in cache_dir."""
+        csv_dir, cache_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, csv_dir)
+        self.addCleanup(shutil.rmtree, cache_dir)
+        csv_path = os.path.join(csv_dir, 'df_read_cache.csv')
+        with open(csv_path, 'wb') as f:
+            f.write('id,name,value\n1,Côte,0.5\n2,,1.5\n'.encode('latin1'))
+
+        # Without a cache_dir nothing is written next to the CSV.
+        df = hb.df_read(csv_path)
+        self.assertEqual(df['name'].tolist()[0], 'Côte')
+        self.assertEqual(os.listdir(csv_dir), ['df_read_cache.csv'])
+
+        hb.utils._file_cache.clear()
+        df = hb.df_read(csv_path, cache_dir=cache_dir)
+        cache_path = hb.get_file_cache_path(csv_path, cache_dir)
+        with open(os.path.join(cache_path, 'metadata.json'), 'r', encoding='utf-8') as f:
+            self.assertIn('variants', json.load(f))
+        self.assertEqual(len([i for i in os.listdir(cache_path) if i.endswith('.npy')]), 4)
+
+        # Modifying the returned df does not change the cache, and another process reuses the .npy columns.
+        df['name'] = 'changed'
+        hb.utils._file_cache.clear()
+        pd.testing.assert_frame_equal(hb.df_read(csv_path, cache_dir=cache_dir), hb.df_read(csv_path, use_cache=False))
+
+        with open(csv_path, 'ab') as f:
+            f.write(b'3,c,2.5\n')
+        os.utime(csv_path, ns=(os.stat(csv_path).st_atime_ns, os.stat(csv_path).st_mtime_ns + 10 ** 9))
+        self.assertEqual(len(hb.df_read(csv_path, cache_dir=cache_dir)), 3)
+
+    def test_df_merge_indexed(self):
+        """Test that merges through a reusable right index match pd.merge, and that df_merge does not modify its inputs."""
+        rs = np.random.RandomState(0)
+        left_df = pd.DataFrame({'id': rs.randint(0, 60, 200), 'value': rs.rand(200), 'shared': rs.rand(200)}, index=np.arange(200)[::-1])
+        right_df = pd.DataFrame({'id': np.arange(50), 'region_value': np.arange(50), 'name': ['r' + str(i) for i in range(50)]})
+
+        right_index = hb.df_build_merge_index(right_df, 'id')
+        for how in ['left', 'inner']:
+            pd.testing.assert_frame_equal(hb.df_merge_indexed(left_df, right_index, 'id', how=how), pd.merge(left_df, right_df, how=how, on='id'))
+        pd.testing.assert_frame_equal(hb.df_merge_quick(left_df, right_df, left_on='id', right_on='id', how='left', right_index=right_index),
+                                      pd.merge(left_df, right_df, how='left', on='id'))
+
+        with self.assertRaises(NameError):
+            hb.df_build_merge_index(left_df, 'id')
+
+        # Keys that the hash lookup would match differently from pd.merge (bool against int, categoricals) use pd.merge.
+        key_cases = [(pd.Series([True, False, True]), pd.Series([1, 2])),
+                     (pd.Categorical(['a', 'b', 'c']), pd.Categorical(['b', 'a'])),
+                     (np.array([3, 1, 2], dtype=np.int32), np.array([1, 2], dtype=np.int64))]
+        for left_keys, right_keys in key_cases:
+            key_left_df = pd.DataFrame({'id': left_keys, 'value': [1, 2, 3]})
+            key_right_df = pd.DataFrame({'id': right_keys, 'region_value': [10, 20]})
+            for how in ['left', 'inner']:
+                pd.testing.assert_frame_equal(hb.df_merge_frames(key_left_df, key_right_df, how, 'id', 'id'), pd.merge(key_left_df, key_right_df, how=how, on='id'))
+        self.assertFalse(hb.df_merge_key_dtypes_compatible(np.dtype(bool), np.dtype(np.int64)))
+        self.assertTrue(hb.df_merge_key_dtypes_compatible(np.dtype(np.int32), np.dtype(np.int64)))
+
+        right_df['shared'] = rs.rand(50)
+        left_copy = left_df.copy()
+        merged_df = hb.df_merge(left_df, right_df, how='left', on='id', full_check_for_identicallity=True)
+        self.assertEqual(list(merged_df.columns), ['id', 'value', 'shared', 'region_value', 'name', 'shared_right'])
+        pd.testing.assert_frame_equal(left_df, left_copy)
+
     def test_parse_flex_to_python_object(self):
         """Test parsing a flex item (int, float, string, None, string that represents a python object) element to a Python object."""
 